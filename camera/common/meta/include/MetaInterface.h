@@ -29,6 +29,8 @@
 
 namespace lima
 {
+  class CtThreadPools;
+
   namespace Meta
   {
     class DetInfoCtrlObj;
@@ -44,6 +46,10 @@ namespace lima
       virtual ~Interface();
 
       void addInterface(int row,int column,HwInterface*);
+      /** pools of the CtControl, the reconstruction of the tiles is
+       * posted to its Processing role. NULL == processlib global pool
+       */
+      void setThreadPools(CtThreadPools*);
       
       //- From HwInterface
       virtual void	getCapList(CapList&) const;
@@ -88,6 +94,7 @@ namespace lima
       Mutex		m_lock;
       PendingFrames	m_pending_frames;
       BufferFrameCBKs   m_buffer_cbks;
+      CtThreadPools*	m_thread_pools;
     };
   }
 }
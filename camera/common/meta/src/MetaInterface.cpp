@@ -29,6 +29,7 @@
 #include "processlib/LinkTask.h"
 
 #include "lima/CtBuffer.h"
+#include "lima/CtThreadPools.h"
 
 using namespace lima;
 using namespace lima::Meta;
@@ -83,7 +84,13 @@ protected:
 	    mgr->setInputData(aFrameData);
 	    rTaskPt->setEventCallback(m_reconstruction_cbk);
 	    mgr->setLinkTask(0,rTaskPt);
-	    PoolThreadMgr::get().addProcess(mgr);
+	    AutoMutex aLock(m_interface.m_lock);
+	    CtThreadPools *aPoolsPt = m_interface.m_thread_pools;
+	    aLock.unlock();
+	    if(aPoolsPt)
+	      aPoolsPt->addProcess(CtThreadPools::Processing,mgr);
+	    else
+	      PoolThreadMgr::get().addProcess(mgr);
 	    return true;
 	  }
       }
@@ -109,7 +116,8 @@ void Interface::_BufferFrameCBK::cbk::finished(Data& data)
 
 Interface::Interface(Interface::Geometry geom) :
   m_geometry(geom),
-  m_dirty_geom_flag(true)
+  m_dirty_geom_flag(true),
+  m_thread_pools(NULL)
 {
   DEB_CONSTRUCTOR();
 
@@ -147,6 +155,15 @@ void Interface::addInterface(int row,int column,HwInterface* i)
 
 }
 
+void Interface::setThreadPools(CtThreadPools* thread_pools)
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR1(thread_pools);
+
+  AutoMutex aLock(m_lock);
+  m_thread_pools = thread_pools;
+}
+
 void Interface::getCapList(CapList& cap_list) const
 {
   cap_list.push_back(HwCap(m_det_info));
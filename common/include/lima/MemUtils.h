@@ -50,7 +50,7 @@ class LIMACORE_API MemBuffer
 	MemBuffer(const MemBuffer& buffer);
 	~MemBuffer();
 
-	void alloc(int size);
+	void alloc(int size, int alignment = Alignment);
 	void copy(const MemBuffer& buffer);
 	void release();
 
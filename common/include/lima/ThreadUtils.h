@@ -25,12 +25,15 @@
 #include "lima/LimaCompatibility.h"
 #include "lima/AutoObj.h"
 #include <pthread.h>
+#include <list>
+#include <vector>
 
 namespace lima
 {
 
 class Mutex;
 class Cond;
+class Exception;
 
 class LIMACORE_API MutexAttr
 {
@@ -176,6 +179,72 @@ class LIMACORE_API CmdThread
 	volatile int m_cmd;
 };
 
+/** @brief persistent threads sharing the tiles of one job.
+ *
+ *  run() gives the tiles of a job to the threads, processes tiles
+ *  itself and returns when all are done. A job run while an other one
+ *  is in progress is processed by its caller alone.
+ *  If a tile throws, the tiles not started are skipped and run()
+ *  throws the first error once the other tiles are finished.
+ */
+class LIMACORE_API TileWorkers
+{
+ public:
+	class Job
+	{
+	public:
+		virtual ~Job() {}
+		virtual void process(int tile) = 0;
+	};
+
+	TileWorkers(int nb_threads);
+	~TileWorkers();
+
+	void run(Job& job,int nb_tiles);
+	// the threads above nb_threads are stopped, the new ones
+	// are started by the next run
+	void setNbThreads(int nb_threads);
+	int getNbThreads() const;
+	// cpus the threads run on (Linux only), empty == all
+	void setCpuAffinity(const std::list<int>& cpus);
+	std::list<int> getCpuAffinity() const;
+
+ private:
+	class WorkerThread : public Thread
+	{
+	public:
+		WorkerThread(TileWorkers& workers)
+			: m_workers(workers), m_stop(false),
+			  m_affinity_gen(0) {}
+		virtual ~WorkerThread();
+	protected:
+		void threadFunction();
+		TileWorkers& m_workers;
+	public:
+		bool m_stop;
+		int m_affinity_gen;
+	};
+	friend class WorkerThread;
+
+	void startThreads();
+	void threadLoop(WorkerThread& thread);
+	void processTiles(AutoMutex& l);
+	void jobFailed();
+
+	int				m_nb_threads;
+	std::vector<WorkerThread*>	m_threads;
+	mutable Cond			m_cond;
+	Job*				m_job;
+	int				m_nb_tiles;
+	int				m_next_tile;
+	int				m_nb_done;
+	bool				m_failed;
+	Exception*			m_error;	// NULL on bad_alloc
+	bool				m_quit;
+	std::list<int>			m_cpus;
+	int				m_affinity_gen;
+};
+
 #define EXEC_ONCE(statement)						\
 	do {								\
 		class RunOnce						\
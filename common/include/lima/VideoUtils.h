@@ -10,6 +10,8 @@
 
 namespace lima
 {
+  class TileWorkers;
+
   struct VideoImage
   {
     VideoImage() :
@@ -92,8 +94,27 @@ namespace lima
   };
 
   void data2Image(Data &aData,VideoImage &anImage);
+  /** @brief color conversions are split in stripes run by workers,
+   *  one stripe per thread (calling thread included); if NULL, by the
+   *  threads shared by all the conversions (see
+   *  setVideoConversionNbThreads)
+   */
   void image2YUV(const unsigned char *srcPt,int width,int height,VideoMode mode,
-		 unsigned char *dst);
+		 unsigned char *dst,TileWorkers *workers = NULL);
+
+  /** @brief number of threads used by image2YUV for color conversions,
+   *  when no workers are given.
+   *  The image is split in horizontal stripes, one per thread; the
+   *  threads are started once and shared by all the conversions.
+   *  0 (default) chooses from the number of cpus and the image size
+   */
+  void setVideoConversionNbThreads(int nb_threads);
+  int getVideoConversionNbThreads();
+  /** @brief use the SSE4.1/AVX2 kernels when the cpu has them (default),
+   *  false forces the scalar code
+   */
+  void setVideoConversionSimd(bool enable);
+  bool getVideoConversionSimd();
 
   inline std::ostream& operator<<(std::ostream &os,
 				  const VideoImage &anImage)
@@ -124,20 +124,20 @@ MemBuffer::~MemBuffer()
 }
 
 
-void MemBuffer::alloc(int size)
+void MemBuffer::alloc(int size, int alignment)
 {
-	if (m_size == size)
+	if ((m_size == size) && !((unsigned long) m_ptr % alignment))
 		return;
 
 	release();
 
 #ifdef __unix
-	int ret = posix_memalign(&m_ptr, Alignment, size);
+	int ret = posix_memalign(&m_ptr, alignment, size);
 	if (ret != 0)
 		throw LIMA_COM_EXC(Error, "Error in posix_memalign: ")
 			<< strerror(ret);
 #else
-	m_ptr = _aligned_malloc(size,Alignment);
+	m_ptr = _aligned_malloc(size,alignment);
 	if(!m_ptr)
 	  throw LIMA_COM_EXC(Error, "Error in _aligned_malloc: NULL pointer return");
 #endif
@@ -22,11 +22,16 @@
 #include "lima/ThreadUtils.h"
 #include "lima/Exceptions.h"
 #include <errno.h>
+#include <exception>
+#include <new>
 #ifdef __unix
 #include <sys/time.h>
 #else
 #include <time_compat.h>
 #endif
+#ifdef __linux__
+#include <sched.h>
+#endif
 
 using namespace lima;
 
@@ -418,3 +423,208 @@ void CmdThread::cmdLoop()
 		}
 	}
 }
+
+
+TileWorkers::TileWorkers(int nb_threads)
+	: m_nb_threads(nb_threads), m_job(NULL), m_nb_tiles(0),
+	  m_next_tile(0), m_nb_done(0), m_failed(false), m_error(NULL),
+	  m_quit(false), m_affinity_gen(0)
+{
+}
+
+TileWorkers::~TileWorkers()
+{
+	AutoMutex l(m_cond.mutex());
+	m_quit = true;
+	m_cond.broadcast();
+	l.unlock();
+
+	std::vector<WorkerThread*>::iterator i, end = m_threads.end();
+	for (i = m_threads.begin(); i != end; ++i)
+		delete *i;
+}
+
+void TileWorkers::run(Job& job, int nb_tiles)
+{
+	AutoMutex l(m_cond.mutex());
+	if (m_job) {	// busy with an other job, do it here
+		l.unlock();
+		for (int i = 0; i < nb_tiles; ++i)
+			job.process(i);
+		return;
+	}
+	if ((nb_tiles > 1) && (int(m_threads.size()) < m_nb_threads))
+		startThreads();
+
+	m_job = &job;
+	m_nb_tiles = nb_tiles;
+	m_next_tile = m_nb_done = 0;
+	m_cond.broadcast();
+
+	processTiles(l);
+	while (m_nb_done < m_nb_tiles)
+		m_cond.wait();
+	m_job = NULL;
+	if (!m_failed)
+		return;
+
+	Exception *error = m_error;
+	m_failed = false;
+	m_error = NULL;
+	l.unlock();
+	if (!error)
+		throw std::bad_alloc();
+	try {
+		throw *error;
+	} catch (...) {
+		delete error;
+		throw;
+	}
+}
+
+void TileWorkers::setNbThreads(int nb_threads)
+{
+	if (nb_threads < 0)
+		nb_threads = 0;
+
+	std::vector<WorkerThread*> stopped;
+	AutoMutex l(m_cond.mutex());
+	m_nb_threads = nb_threads;
+	while (int(m_threads.size()) > m_nb_threads) {
+		WorkerThread *t = m_threads.back();
+		m_threads.pop_back();
+		t->m_stop = true;
+		stopped.push_back(t);
+	}
+	m_cond.broadcast();
+	l.unlock();
+
+	std::vector<WorkerThread*>::iterator i, end = stopped.end();
+	for (i = stopped.begin(); i != end; ++i)
+		delete *i;
+}
+
+int TileWorkers::getNbThreads() const
+{
+	AutoMutex l(m_cond.mutex());
+	return m_nb_threads;
+}
+
+// each thread applies it, the busy ones at the end of their job
+void TileWorkers::setCpuAffinity(const std::list<int>& cpus)
+{
+	AutoMutex l(m_cond.mutex());
+	m_cpus = cpus;
+	++m_affinity_gen;
+	m_cond.broadcast();
+}
+
+std::list<int> TileWorkers::getCpuAffinity() const
+{
+	AutoMutex l(m_cond.mutex());
+	return m_cpus;
+}
+
+static void _set_thread_cpu_affinity(const std::list<int>& cpus)
+{
+#ifdef __linux__
+	cpu_set_t cpu_set;
+	CPU_ZERO(&cpu_set);
+	std::list<int>::const_iterator i, end = cpus.end();
+	for (i = cpus.begin(); i != end; ++i)
+		if ((*i >= 0) && (*i < CPU_SETSIZE))
+			CPU_SET(*i, &cpu_set);
+	if (cpus.empty())
+		for (int cpu = 0; cpu < CPU_SETSIZE; ++cpu)
+			CPU_SET(cpu, &cpu_set);
+	// on error the thread keeps running where it was
+	pthread_setaffinity_np(pthread_self(), sizeof(cpu_set), &cpu_set);
+#endif
+}
+
+void TileWorkers::startThreads()
+{
+	try {
+		while (int(m_threads.size()) < m_nb_threads) {
+			WorkerThread *t = new WorkerThread(*this);
+			m_threads.push_back(t);
+			t->start();
+		}
+	} catch (...) {
+		// run with the threads already started
+	}
+}
+
+void TileWorkers::threadLoop(WorkerThread& thread)
+{
+	AutoMutex l(m_cond.mutex());
+	while (!m_quit && !thread.m_stop) {
+		if (thread.m_affinity_gen != m_affinity_gen) {
+			thread.m_affinity_gen = m_affinity_gen;
+			std::list<int> cpus = m_cpus;
+			l.unlock();
+			_set_thread_cpu_affinity(cpus);
+			l.lock();
+		} else if (m_job && (m_next_tile < m_nb_tiles))
+			processTiles(l);
+		else
+			m_cond.wait();
+	}
+}
+
+// should be called with the lock
+void TileWorkers::processTiles(AutoMutex& l)
+{
+	while (m_next_tile < m_nb_tiles) {
+		int tile = m_next_tile++;
+		if (!m_failed) {
+			Job *job = m_job;
+			l.unlock();
+			try {
+				job->process(tile);
+			} catch (...) {
+				l.lock();
+				jobFailed();
+				l.unlock();
+			}
+			l.lock();
+		}
+		if (++m_nb_done == m_nb_tiles)
+			m_cond.broadcast();
+	}
+}
+
+// should be called with the lock from a catch block,
+// keeps the first error of the job for run
+void TileWorkers::jobFailed()
+{
+	if (m_failed)
+		return;
+	m_failed = true;
+	try {
+		try {
+			throw;
+		} catch (std::bad_alloc&) {
+		} catch (Exception& e) {
+			m_error = new Exception(e);
+		} catch (std::exception& e) {
+			m_error = new LIMA_COM_EXC(Error, e.what());
+		} catch (...) {
+			m_error = new LIMA_COM_EXC(Error, "Unknown tile job error");
+		}
+	} catch (...) {
+		// no memory to keep it, reported as bad_alloc
+		m_error = NULL;
+	}
+}
+
+TileWorkers::WorkerThread::~WorkerThread()
+{
+	if (hasStarted())
+		join();
+}
+
+void TileWorkers::WorkerThread::threadFunction()
+{
+	m_workers.threadLoop(*this);
+}
@@ -1,8 +1,298 @@
 #include "lima/Exceptions.h"
 
+#include "lima/ThreadUtils.h"
 #include "lima/VideoUtils.h"
+
+#include <algorithm>
+#include <cstring>
+#include <vector>
+#ifdef __unix
+#include <unistd.h>
+#endif
+
+#if defined(__GNUC__) && (defined(__x86_64__) || defined(__i386__)) && \
+    (__GNUC__ > 4 || (__GNUC__ == 4 && __GNUC_MINOR__ >= 9))
+#define VIDEO_X86_SIMD
+#include <immintrin.h>
+#endif
+
 using namespace lima;
 
+/** conversion settings, see setVideoConversionNbThreads and
+ *  setVideoConversionSimd
+ */
+static Mutex _video_lock;
+static int _video_nb_threads = 0;
+static bool _video_simd = true;
+
+/** below this number of pixels the conversion is not split
+ *  into stripes, waking up the threads would cost more than it saves
+ */
+static const int STRIPE_MIN_PIXELS = 256 * 1024;
+static const int STRIPE_MAX_AUTO_THREADS = 4;
+
+#ifdef VIDEO_X86_SIMD
+
+enum _SimdLevel {SIMD_SCALAR, SIMD_SSE41, SIMD_AVX2};
+
+static _SimdLevel _cpu_level = SIMD_SCALAR;
+
+static void _init_cpu_simd_level()
+{
+  __builtin_cpu_init();
+  if(__builtin_cpu_supports("avx2"))
+    _cpu_level = SIMD_AVX2;
+  else if(__builtin_cpu_supports("sse4.1"))
+    _cpu_level = SIMD_SSE41;
+  else
+    _cpu_level = SIMD_SCALAR;
+}
+
+static _SimdLevel _cpu_simd_level()
+{
+  EXEC_ONCE(_init_cpu_simd_level());
+  return _cpu_level;
+}
+
+static inline _SimdLevel _simd_level()
+{
+  AutoMutex aLock(_video_lock);
+  bool simd = _video_simd;
+  aLock.unlock();
+  return simd ? _cpu_simd_level() : SIMD_SCALAR;
+}
+
+/** @brief vectorized luma of 8 bit rgb pixels (4 pixels per 128 bits)
+ *
+ *  each pixel is widened to 16 bits and multiplied/added by pairs
+ *  (pmaddwd) with the (c0,c1,c2,0) coefficients.
+ *  24 bit pixels are first expanded to 32 bits with a byte shuffle.
+ *  Return the number of pixels converted, the caller finishes the tail.
+ */
+__attribute__((target("sse4.1")))
+static int _rgb_2_yuv_sse41(const unsigned char *data,unsigned char *luma,
+			    int nb_pixels,int bandes,int c0,int c1,int c2)
+{
+  const __m128i coeffs = _mm_setr_epi16(c0,c1,c2,0,c0,c1,c2,0);
+  const __m128i round = _mm_set1_epi32(128);
+  const __m128i expand = _mm_setr_epi8(0,1,2,-1,3,4,5,-1,
+				       6,7,8,-1,9,10,11,-1);
+  const int step = 4 * bandes;
+  // a 16 bytes load is done for each 4 pixels, keep it inside the source
+  int nb_blocks = (nb_pixels - (bandes == 3 ? 2 : 0)) / 16;
+  for(int i = 0;i < nb_blocks;++i,data += 4 * step,luma += 16)
+    {
+      __m128i sum[4];
+      for(int j = 0;j < 4;++j)
+	{
+	  __m128i pix = _mm_loadu_si128((const __m128i*)(data + j * step));
+	  if(bandes == 3)
+	    pix = _mm_shuffle_epi8(pix,expand);
+	  __m128i lo = _mm_madd_epi16(_mm_cvtepu8_epi16(pix),coeffs);
+	  __m128i hi = _mm_madd_epi16(_mm_unpackhi_epi8(pix,_mm_setzero_si128()),
+				      coeffs);
+	  sum[j] = _mm_srli_epi32(_mm_add_epi32(_mm_hadd_epi32(lo,hi),round),8);
+	}
+      __m128i w0 = _mm_packus_epi32(sum[0],sum[1]);
+      __m128i w1 = _mm_packus_epi32(sum[2],sum[3]);
+      _mm_storeu_si128((__m128i*)luma,_mm_packus_epi16(w0,w1));
+    }
+  return nb_blocks * 16;
+}
+
+/** @brief vectorized bayer interpolation of 8 bit data
+ *
+ *  Each lane computes both the "red/blue" pixel and the "green" pixel
+ *  formula of the scalar loop and lanes are blended depending
+ *  on their parity. The 3x3 neighbourhood sums fit in 16 bits.
+ *  Return the number of pixels converted (always even).
+ */
+__attribute__((target("sse4.1")))
+static int _bayer_2_yuv_sse41(const unsigned char *p,unsigned char *dst,
+			      int nb_pixels,int step,int wr,int wb)
+{
+  const __m128i r_w = _mm_set1_epi16(wr);
+  const __m128i b_w = _mm_set1_epi16(wb);
+  const __m128i g_w = _mm_set1_epi16(150);
+  const __m128i one = _mm_set1_epi16(1);
+  const __m128i two = _mm_set1_epi16(2);
+  int done = 0;
+#define LOAD8(off) _mm_cvtepu8_epi16(_mm_loadl_epi64((const __m128i*)(p + (off))))
+  for(;done + 8 <= nb_pixels;done += 8,p += 8,dst += 8)
+    {
+      __m128i a = LOAD8(0),b = LOAD8(1),c = LOAD8(2);
+      __m128i d = LOAD8(step),e = LOAD8(step + 1),f = LOAD8(step + 2);
+      __m128i g = LOAD8(2 * step),h = LOAD8(2 * step + 1),i = LOAD8(2 * step + 2);
+
+      __m128i t0 = _mm_add_epi16(_mm_add_epi16(a,c),_mm_add_epi16(g,i));
+      t0 = _mm_srli_epi16(_mm_add_epi16(t0,two),2);
+      __m128i t1 = _mm_add_epi16(_mm_add_epi16(b,d),_mm_add_epi16(f,h));
+      t1 = _mm_srli_epi16(_mm_add_epi16(t1,two),2);
+      __m128i even = _mm_add_epi16(_mm_add_epi16(_mm_mullo_epi16(t0,r_w),
+						 _mm_mullo_epi16(t1,g_w)),
+				   _mm_mullo_epi16(e,b_w));
+
+      t0 = _mm_srli_epi16(_mm_add_epi16(_mm_add_epi16(b,h),one),1);
+      t1 = _mm_srli_epi16(_mm_add_epi16(_mm_add_epi16(d,f),one),1);
+      __m128i odd = _mm_add_epi16(_mm_add_epi16(_mm_mullo_epi16(t0,r_w),
+						_mm_mullo_epi16(e,g_w)),
+				  _mm_mullo_epi16(t1,b_w));
+
+      __m128i res = _mm_srli_epi16(_mm_blend_epi16(even,odd,0xaa),8);
+      _mm_storel_epi64((__m128i*)dst,_mm_packus_epi16(res,res));
+    }
+#undef LOAD8
+  return done;
+}
+
+/** @brief same as above for 16 bit data, computed on 32 bit lanes
+ */
+__attribute__((target("sse4.1")))
+static int _bayer_2_yuv_sse41(const unsigned short *p,unsigned short *dst,
+			      int nb_pixels,int step,int wr,int wb)
+{
+  const __m128i r_w = _mm_set1_epi32(wr);
+  const __m128i b_w = _mm_set1_epi32(wb);
+  const __m128i g_w = _mm_set1_epi32(150);
+  const __m128i one = _mm_set1_epi32(1);
+  const __m128i two = _mm_set1_epi32(2);
+  int done = 0;
+#define LOAD4(off) _mm_cvtepu16_epi32(_mm_loadl_epi64((const __m128i*)(p + (off))))
+  for(;done + 4 <= nb_pixels;done += 4,p += 4,dst += 4)
+    {
+      __m128i a = LOAD4(0),b = LOAD4(1),c = LOAD4(2);
+      __m128i d = LOAD4(step),e = LOAD4(step + 1),f = LOAD4(step + 2);
+      __m128i g = LOAD4(2 * step),h = LOAD4(2 * step + 1),i = LOAD4(2 * step + 2);
+
+      __m128i t0 = _mm_add_epi32(_mm_add_epi32(a,c),_mm_add_epi32(g,i));
+      t0 = _mm_srli_epi32(_mm_add_epi32(t0,two),2);
+      __m128i t1 = _mm_add_epi32(_mm_add_epi32(b,d),_mm_add_epi32(f,h));
+      t1 = _mm_srli_epi32(_mm_add_epi32(t1,two),2);
+      __m128i even = _mm_add_epi32(_mm_add_epi32(_mm_mullo_epi32(t0,r_w),
+						 _mm_mullo_epi32(t1,g_w)),
+				   _mm_mullo_epi32(e,b_w));
+
+      t0 = _mm_srli_epi32(_mm_add_epi32(_mm_add_epi32(b,h),one),1);
+      t1 = _mm_srli_epi32(_mm_add_epi32(_mm_add_epi32(d,f),one),1);
+      __m128i odd = _mm_add_epi32(_mm_add_epi32(_mm_mullo_epi32(t0,r_w),
+						_mm_mullo_epi32(e,g_w)),
+				  _mm_mullo_epi32(t1,b_w));
+
+      __m128i res = _mm_srli_epi32(_mm_blend_epi16(even,odd,0xcc),8);
+      _mm_storel_epi64((__m128i*)dst,_mm_packus_epi32(res,res));
+    }
+#undef LOAD4
+  return done;
+}
+
+__attribute__((target("avx2")))
+static int _bayer_2_yuv_avx2(const unsigned char *p,unsigned char *dst,
+			     int nb_pixels,int step,int wr,int wb)
+{
+  const __m256i r_w = _mm256_set1_epi16(wr);
+  const __m256i b_w = _mm256_set1_epi16(wb);
+  const __m256i g_w = _mm256_set1_epi16(150);
+  const __m256i one = _mm256_set1_epi16(1);
+  const __m256i two = _mm256_set1_epi16(2);
+  int done = 0;
+#define LOAD16(off) _mm256_cvtepu8_epi16(_mm_loadu_si128((const __m128i*)(p + (off))))
+  for(;done + 16 <= nb_pixels;done += 16,p += 16,dst += 16)
+    {
+      __m256i a = LOAD16(0),b = LOAD16(1),c = LOAD16(2);
+      __m256i d = LOAD16(step),e = LOAD16(step + 1),f = LOAD16(step + 2);
+      __m256i g = LOAD16(2 * step),h = LOAD16(2 * step + 1),i = LOAD16(2 * step + 2);
+
+      __m256i t0 = _mm256_add_epi16(_mm256_add_epi16(a,c),_mm256_add_epi16(g,i));
+      t0 = _mm256_srli_epi16(_mm256_add_epi16(t0,two),2);
+      __m256i t1 = _mm256_add_epi16(_mm256_add_epi16(b,d),_mm256_add_epi16(f,h));
+      t1 = _mm256_srli_epi16(_mm256_add_epi16(t1,two),2);
+      __m256i even = _mm256_add_epi16(_mm256_add_epi16(_mm256_mullo_epi16(t0,r_w),
+						       _mm256_mullo_epi16(t1,g_w)),
+				      _mm256_mullo_epi16(e,b_w));
+
+      t0 = _mm256_srli_epi16(_mm256_add_epi16(_mm256_add_epi16(b,h),one),1);
+      t1 = _mm256_srli_epi16(_mm256_add_epi16(_mm256_add_epi16(d,f),one),1);
+      __m256i odd = _mm256_add_epi16(_mm256_add_epi16(_mm256_mullo_epi16(t0,r_w),
+						      _mm256_mullo_epi16(e,g_w)),
+				     _mm256_mullo_epi16(t1,b_w));
+
+      __m256i res = _mm256_srli_epi16(_mm256_blend_epi16(even,odd,0xaa),8);
+      __m128i packed = _mm_packus_epi16(_mm256_castsi256_si128(res),
+					_mm256_extracti128_si256(res,1));
+      _mm_storeu_si128((__m128i*)dst,packed);
+    }
+#undef LOAD16
+  return done;
+}
+
+__attribute__((target("avx2")))
+static int _bayer_2_yuv_avx2(const unsigned short *p,unsigned short *dst,
+			     int nb_pixels,int step,int wr,int wb)
+{
+  const __m256i r_w = _mm256_set1_epi32(wr);
+  const __m256i b_w = _mm256_set1_epi32(wb);
+  const __m256i g_w = _mm256_set1_epi32(150);
+  const __m256i one = _mm256_set1_epi32(1);
+  const __m256i two = _mm256_set1_epi32(2);
+  int done = 0;
+#define LOAD8(off) _mm256_cvtepu16_epi32(_mm_loadu_si128((const __m128i*)(p + (off))))
+  for(;done + 8 <= nb_pixels;done += 8,p += 8,dst += 8)
+    {
+      __m256i a = LOAD8(0),b = LOAD8(1),c = LOAD8(2);
+      __m256i d = LOAD8(step),e = LOAD8(step + 1),f = LOAD8(step + 2);
+      __m256i g = LOAD8(2 * step),h = LOAD8(2 * step + 1),i = LOAD8(2 * step + 2);
+
+      __m256i t0 = _mm256_add_epi32(_mm256_add_epi32(a,c),_mm256_add_epi32(g,i));
+      t0 = _mm256_srli_epi32(_mm256_add_epi32(t0,two),2);
+      __m256i t1 = _mm256_add_epi32(_mm256_add_epi32(b,d),_mm256_add_epi32(f,h));
+      t1 = _mm256_srli_epi32(_mm256_add_epi32(t1,two),2);
+      __m256i even = _mm256_add_epi32(_mm256_add_epi32(_mm256_mullo_epi32(t0,r_w),
+						       _mm256_mullo_epi32(t1,g_w)),
+				      _mm256_mullo_epi32(e,b_w));
+
+      t0 = _mm256_srli_epi32(_mm256_add_epi32(_mm256_add_epi32(b,h),one),1);
+      t1 = _mm256_srli_epi32(_mm256_add_epi32(_mm256_add_epi32(d,f),one),1);
+      __m256i odd = _mm256_add_epi32(_mm256_add_epi32(_mm256_mullo_epi32(t0,r_w),
+						      _mm256_mullo_epi32(e,g_w)),
+				     _mm256_mullo_epi32(t1,b_w));
+
+      __m256i res = _mm256_srli_epi32(_mm256_blend_epi32(even,odd,0xaa),8);
+      __m128i packed = _mm_packus_epi32(_mm256_castsi256_si128(res),
+					_mm256_extracti128_si256(res,1));
+      _mm_storeu_si128((__m128i*)dst,packed);
+    }
+#undef LOAD8
+  return done;
+}
+
+#endif // VIDEO_X86_SIMD
+
+/** @brief vectorized part of a bayer row.
+ *
+ *  p points to the top-left corner of the first (red/blue, green) pair,
+ *  nb_pixels is the number of pixels the scalar pair loop would produce.
+ *  Return the number of pixels done, always a multiple of 2.
+ */
+template<class xClass>
+inline int _bayer_2_yuv_simd(const xClass *p,xClass *dst,int nb_pixels,
+			     int step,int blue)
+{
+#ifdef VIDEO_X86_SIMD
+  int wr = blue > 0 ? 76 : 29;
+  int wb = blue > 0 ? 29 : 76;
+  switch(_simd_level())
+    {
+    case SIMD_AVX2:
+      return _bayer_2_yuv_avx2(p,dst,nb_pixels,step,wr,wb);
+    case SIMD_SSE41:
+      return _bayer_2_yuv_sse41(p,dst,nb_pixels,step,wr,wb);
+    default:
+      break;
+    }
+#endif
+  return 0;
+}
+
 /** func tool to convert from color 2 yuv
  */
 inline void _rgb555_2_yuv(const unsigned char *data,unsigned char *luma,
@@ -32,31 +322,59 @@ inline void _rgb565_2_yuv(const unsigned char *data,unsigned char *luma,
 inline void _rgb_2_yuv(const unsigned char *data,unsigned char *luma,
 			int column,int row,int bandes)
 {
-  for(int aSize = column * row;aSize;--aSize,data += bandes,++luma)
+  int aSize = column * row;
+#ifdef VIDEO_X86_SIMD
+  if(_simd_level() >= SIMD_SSE41)
+    {
+      int done = _rgb_2_yuv_sse41(data,luma,aSize,bandes,66,129,25);
+      data += done * bandes;
+      luma += done;
+      aSize -= done;
+    }
+#endif
+  for(;aSize;--aSize,data += bandes,++luma)
     *luma = ((66 * data[0] + 129 * data[1] + 25 * data[2]) + 128) >> 8;
 }
 
 inline void _bgr_2_yuv(const unsigned char *data,unsigned char *luma,
 			int column,int row,int bandes)
 {
-  for(int aSize = column * row;aSize;--aSize,data += bandes,++luma)
+  int aSize = column * row;
+#ifdef VIDEO_X86_SIMD
+  if(_simd_level() >= SIMD_SSE41)
+    {
+      int done = _rgb_2_yuv_sse41(data,luma,aSize,bandes,25,129,66);
+      data += done * bandes;
+      luma += done;
+      aSize -= done;
+    }
+#endif
+  for(;aSize;--aSize,data += bandes,++luma)
     *luma = ((25 * data[0] + 129 * data[1] + 66 * data[2]) + 128) >> 8;
 }
 
+/** @brief bayer interpolation of luma rows [first_row,last_row[
+ *
+ *  column x row is the full image size, the interpolated rows
+ *  must be inside [1,row - 1[. blue and start_with_green are
+ *  the values of the first image row, they alternate on each row.
+ */
 template<class xClass>
-inline void _bayer_2_yuv(const xClass* bayer0,xClass* luma,
-			 int column,int row,int blue,int start_with_green)
+inline void _bayer_2_yuv_rows(const xClass* bayer0,xClass* luma,
+			      int column,int row,int blue,int start_with_green,
+			      int first_row,int last_row)
 {
-  int luma_step = column * sizeof(xClass);
   int bayer_step = column;
-  xClass *luma0 = (xClass*)luma;
-  memset( luma0, 0, luma_step);
-  memset( luma0 + (row - 1)*bayer_step, 0, luma_step);
-  luma0 += column + 1;
-  row -= 2;
+  if((first_row - 1) & 1)
+    {
+      blue = -blue;
+      start_with_green = !start_with_green;
+    }
+  bayer0 += (first_row - 1) * bayer_step;
+  xClass *luma0 = luma + first_row * bayer_step + 1;
   column -= 2;
 
-  for( ; row > 0;--row,bayer0 += bayer_step, luma0 += bayer_step )
+  for(row = last_row - first_row; row > 0;--row,bayer0 += bayer_step, luma0 += bayer_step )
     {
       int t0, t1;
       const xClass* bayer = bayer0;
@@ -80,6 +398,11 @@ inline void _bayer_2_yuv(const xClass* bayer0,xClass* luma,
 	  ++dst;
         }
 
+      int done = _bayer_2_yuv_simd(bayer,dst,int(bayer_end - bayer) & ~1,
+				   bayer_step,blue);
+      bayer += done;
+      dst += done;
+
       if( blue > 0 )
         {
 	  for( ; bayer <= bayer_end - 2; bayer += 2)
@@ -134,20 +457,206 @@ inline void _bayer_2_yuv(const xClass* bayer0,xClass* luma,
     }
 }
 
-template<class xClass>
-inline void _bayer_rg_2_yuv(const xClass* bayer0,xClass* luma,
-			    int column,int row)
+/** @brief parameters of one image2YUV call, shared by all stripes
+ */
+struct _ConvertPars
 {
-  _bayer_2_yuv<xClass>(bayer0,luma,column,row,1,0);
+  const unsigned char *src;
+  unsigned char *dst;
+  int width;
+  int height;
+  VideoMode mode;
+};
+
+/** @brief convert the luma rows [first_row,last_row[
+ *
+ *  For bayer modes, the first and last image rows have no
+ *  neighbourhood and are cleared by image2YUV.
+ */
+static void _convert_rows(const _ConvertPars &pars,int first_row,int last_row)
+{
+  int w = pars.width,h = pars.height;
+  int nb_rows = last_row - first_row;
+  const unsigned char *src = pars.src;
+  unsigned char *dst = pars.dst;
+  switch(pars.mode)
+    {
+    case RGB555:
+      _rgb555_2_yuv(src + first_row * w * 2,dst + first_row * w,w,nb_rows);
+      break;
+    case RGB565:
+      _rgb565_2_yuv(src + first_row * w * 2,dst + first_row * w,w,nb_rows);
+      break;
+    case RGB32:
+      _rgb_2_yuv(src + first_row * w * 4,dst + first_row * w,w,nb_rows,4);
+      break;
+    case BGR32:
+      _bgr_2_yuv(src + first_row * w * 4,dst + first_row * w,w,nb_rows,4);
+      break;
+    case RGB24:
+      _rgb_2_yuv(src + first_row * w * 3,dst + first_row * w,w,nb_rows,3);
+      break;
+    case BGR24:
+      _bgr_2_yuv(src + first_row * w * 3,dst + first_row * w,w,nb_rows,3);
+      break;
+    case BAYER_RG8:
+      _bayer_2_yuv_rows(src,dst,w,h,1,0,first_row,last_row);
+      break;
+    case BAYER_BG8:
+      _bayer_2_yuv_rows(src,dst,w,h,-1,0,first_row,last_row);
+      break;
+    case BAYER_RG16:
+      _bayer_2_yuv_rows((const unsigned short*)src,(unsigned short*)dst,
+			w,h,1,0,first_row,last_row);
+      break;
+    case BAYER_BG16:
+      _bayer_2_yuv_rows((const unsigned short*)src,(unsigned short*)dst,
+			w,h,-1,0,first_row,last_row);
+      break;
+    default:
+      break;
+    }
 }
 
-template<class xClass>
-inline void _bayer_bg_2_yuv(const xClass* bayer0,xClass* luma,
-			    int column,int row)
+namespace
+{
+class _StripeJob : public TileWorkers::Job
+{
+public:
+  _StripeJob(const _ConvertPars &pars,int first_row,int last_row,
+	     int stripe_rows) :
+    m_pars(pars),m_first_row(first_row),m_last_row(last_row),
+    m_stripe_rows(stripe_rows)
+  {}
+
+  virtual void process(int stripe)
+  {
+    int first_row = m_first_row + stripe * m_stripe_rows;
+    int last_row = std::min(first_row + m_stripe_rows,m_last_row);
+    _convert_rows(m_pars,first_row,last_row);
+  }
+
+private:
+  const _ConvertPars &m_pars;
+  int m_first_row;
+  int m_last_row;
+  int m_stripe_rows;
+};
+}
+
+/** persistent threads of the stripes, shared by all the conversions.
+ *  Sized on the largest number of stripes asked so far.
+ */
+static TileWorkers *_stripe_workers = NULL;
+
+static void _init_stripe_workers()
+{
+  _stripe_workers = new TileWorkers(0);
+}
+
+static TileWorkers& _get_stripe_workers()
 {
-  _bayer_2_yuv<xClass>(bayer0,luma,column,row,-1,0);
+  EXEC_ONCE(_init_stripe_workers());
+  return *_stripe_workers;
 }
 
+static int _nb_stripes(int width,int nb_rows,TileWorkers *workers)
+{
+  int nb_threads;
+  if(workers)
+    nb_threads = workers->getNbThreads() + 1;
+  else
+    {
+      AutoMutex aLock(_video_lock);
+      nb_threads = _video_nb_threads;
+    }
+  // only a fixed number of threads splits small images
+  bool automatic = workers || nb_threads <= 0;
+  if(nb_threads <= 0)
+    {
+#ifdef __unix
+      nb_threads = int(sysconf(_SC_NPROCESSORS_ONLN));
+#else
+      nb_threads = 1;
+#endif
+      if(nb_threads > STRIPE_MAX_AUTO_THREADS)
+	nb_threads = STRIPE_MAX_AUTO_THREADS;
+    }
+  if(automatic)
+    {
+      int max_stripes = int((long long)width * nb_rows / STRIPE_MIN_PIXELS);
+      if(nb_threads > max_stripes)
+	nb_threads = max_stripes;
+    }
+  if(nb_threads > nb_rows)
+    nb_threads = nb_rows;
+  return nb_threads < 1 ? 1 : nb_threads;
+}
+
+/** @brief split rows [first_row,last_row[ in horizontal stripes,
+ *  shared by the stripe threads and the calling thread.
+ *  If the threads are busy with an other conversion, the calling
+ *  thread converts all the stripes.
+ *  Given workers are used as they are, the shared ones are grown
+ *  to the number of stripes.
+ */
+static void _convert_stripes(const _ConvertPars &pars,
+			     int first_row,int last_row,
+			     TileWorkers *given_workers)
+{
+  int nb_rows = last_row - first_row;
+  int nb_stripes = _nb_stripes(pars.width,nb_rows,given_workers);
+  int stripe_rows = ((nb_rows + nb_stripes - 1) / nb_stripes + 1) & ~1;
+  nb_stripes = (nb_rows + stripe_rows - 1) / stripe_rows;
+  if(nb_stripes <= 1)
+    {
+      _convert_rows(pars,first_row,last_row);
+      return;
+    }
+
+  if(given_workers)
+    {
+      _StripeJob job(pars,first_row,last_row,stripe_rows);
+      given_workers->run(job,nb_stripes);
+      return;
+    }
+  TileWorkers& workers = _get_stripe_workers();
+  if(workers.getNbThreads() < nb_stripes - 1)
+    workers.setNbThreads(nb_stripes - 1);
+  _StripeJob job(pars,first_row,last_row,stripe_rows);
+  workers.run(job,nb_stripes);
+}
+
+void lima::setVideoConversionNbThreads(int nb_threads)
+{
+  AutoMutex aLock(_video_lock);
+  _video_nb_threads = nb_threads < 0 ? 0 : nb_threads;
+  // stop the stripe threads which are no more needed
+  int max_nb_threads = _video_nb_threads ? _video_nb_threads : 
+					   STRIPE_MAX_AUTO_THREADS;
+  aLock.unlock();
+  TileWorkers& workers = _get_stripe_workers();
+  if(workers.getNbThreads() > max_nb_threads - 1)
+    workers.setNbThreads(max_nb_threads - 1);
+}
+
+int lima::getVideoConversionNbThreads()
+{
+  AutoMutex aLock(_video_lock);
+  return _video_nb_threads;
+}
+
+void lima::setVideoConversionSimd(bool enable)
+{
+  AutoMutex aLock(_video_lock);
+  _video_simd = enable;
+}
+
+bool lima::getVideoConversionSimd()
+{
+  AutoMutex aLock(_video_lock);
+  return _video_simd;
+}
 
 void lima::data2Image(Data &aData,VideoImage &anImage)
 {
@@ -181,7 +690,7 @@ void lima::data2Image(Data &aData,VideoImage &anImage)
 }
 
 void lima::image2YUV(const unsigned char *srcPt,int width,int height,VideoMode mode,
-		     unsigned char *dst)
+		     unsigned char *dst,TileWorkers *workers)
 {
 
   switch(mode)
@@ -202,35 +711,29 @@ void lima::image2YUV(const unsigned char *srcPt,int width,int height,VideoMode m
       memcpy(dst,srcPt,width * height);
       break;
     case RGB555:
-      _rgb555_2_yuv(srcPt,dst,width,height);
-      break;
     case RGB565:
-      _rgb565_2_yuv(srcPt,dst,width,height);
-      break;
-    case BAYER_RG8:
-      _bayer_rg_2_yuv(srcPt,dst,width,height);
-      break;
-    case BAYER_RG16:
-      _bayer_rg_2_yuv((unsigned short*)srcPt,(unsigned short*)dst,width,height);
-      break;
-    case BAYER_BG8:
-      _bayer_bg_2_yuv(srcPt,dst,width,height);
-      break;
-    case BAYER_BG16:
-      _bayer_bg_2_yuv((unsigned short*)srcPt,(unsigned short*)dst,width,height);
-      break;
     case RGB32:
-      _rgb_2_yuv(srcPt,dst,width,height,4);
-      break;
     case BGR32:
-      _bgr_2_yuv(srcPt,dst,width,height,4);
-      break;
     case RGB24:
-      _rgb_2_yuv(srcPt,dst,width,height,3);
-      break;
     case BGR24:
-      _bgr_2_yuv(srcPt,dst,width,height,3);
-      break;
+      {
+	_ConvertPars pars = {srcPt,dst,width,height,mode};
+	_convert_stripes(pars,0,height,workers);
+	break;
+      }
+    case BAYER_RG8:
+    case BAYER_BG8:
+    case BAYER_RG16:
+    case BAYER_BG16:
+      {
+	int luma_step = width * int(VideoImage::mode_depth(mode));
+	memset(dst,0,luma_step);
+	memset(dst + (height - 1) * luma_step,0,luma_step);
+	_ConvertPars pars = {srcPt,dst,width,height,mode};
+	if(height > 2)
+	  _convert_stripes(pars,1,height - 1,workers);
+	break;
+      }
     default:
       throw LIMA_COM_EXC(Error,"Video mode not yet managed!");
     }
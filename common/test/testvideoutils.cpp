@@ -0,0 +1,108 @@
+//###########################################################################
+// This file is part of LImA, a Library for Image Acquisition
+//
+// Copyright (C) : 2009-2011
+// European Synchrotron Radiation Facility
+// BP 220, Grenoble 38043
+// FRANCE
+//
+// This is free software; you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation; either version 3 of the License, or
+// (at your option) any later version.
+//
+// This software is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program; if not, see <http://www.gnu.org/licenses/>.
+//###########################################################################
+#include "lima/VideoUtils.h"
+#include "lima/Timestamp.h"
+
+#include <iostream>
+#include <iomanip>
+#include <vector>
+#include <cstring>
+#include <cstdlib>
+#include <sstream>
+
+using namespace lima;
+using namespace std;
+
+// micro-benchmark of image2YUV: for each video mode, compare the
+// scalar single thread conversion with the vectorized/striped one
+// usage: testvideoutils [width height [nb_iter]]
+
+static double bench(const vector<unsigned char>& src, int width, int height,
+		    VideoMode mode, vector<unsigned char>& dst, int nb_iter)
+{
+	Timestamp t0 = Timestamp::now();
+	for (int i = 0; i < nb_iter; ++i)
+		image2YUV(&src[0], width, height, mode, &dst[0]);
+	double elapsed = Timestamp::now() - t0;
+	return elapsed / nb_iter;
+}
+
+int main(int argc, char *argv[])
+{
+	int width = 2048, height = 2048, nb_iter = 20;
+	if (argc >= 3) {
+		width = atoi(argv[1]);
+		height = atoi(argv[2]);
+	}
+	if (argc >= 4)
+		nb_iter = atoi(argv[3]);
+
+	static const VideoMode modes[] = {
+		Y8, Y16, RGB555, RGB565, RGB24, RGB32, BGR24, BGR32,
+		BAYER_RG8, BAYER_BG8, BAYER_RG16, BAYER_BG16, YUV422,
+	};
+	int nb_modes = sizeof(modes) / sizeof(modes[0]);
+
+	cout << "image " << width << "x" << height << ", "
+	     << nb_iter << " iterations" << endl;
+	cout << setw(12) << "mode" << setw(14) << "scalar (ms)"
+	     << setw(14) << "fast (ms)" << setw(10) << "speedup"
+	     << setw(8) << "check" << endl;
+
+	bool ok = true;
+	for (int m = 0; m < nb_modes; ++m) {
+		VideoMode mode = modes[m];
+		int src_size = int(width * height * 
+				   VideoImage::mode_depth(mode) + 0.5);
+		int dst_size = width * height * 2;
+		vector<unsigned char> src(src_size);
+		unsigned int seed = 12345;
+		for (int i = 0; i < src_size; ++i) {
+			seed = seed * 1103515245 + 12345;
+			src[i] = seed >> 16;
+		}
+		vector<unsigned char> ref(dst_size), fast(dst_size);
+
+		setVideoConversionSimd(false);
+		setVideoConversionNbThreads(1);
+		double scalar = bench(src, width, height, mode, ref, nb_iter);
+
+		setVideoConversionSimd(true);
+		setVideoConversionNbThreads(0);
+		double best = bench(src, width, height, mode, fast, nb_iter);
+
+		bool same = (ref == fast);
+		ok &= same;
+		VideoImage aImage;
+		aImage.mode = mode;
+		ostringstream name;
+		name << aImage;
+		string s = name.str();
+		string::size_type p = s.find("mode=") + 5;
+		cout << setw(12) << s.substr(p, s.find(',', p) - p)
+		     << setw(14) << fixed << setprecision(3) << scalar * 1e3
+		     << setw(14) << best * 1e3
+		     << setw(10) << setprecision(2) << scalar / best
+		     << setw(8) << (same ? "ok" : "DIFF") << endl;
+	}
+	return ok ? 0 : 1;
+}
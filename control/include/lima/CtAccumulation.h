@@ -23,11 +23,14 @@
 #define CTACCUMULATION_H
 
 #include "lima/LimaCompatibility.h"
+#include <algorithm>
 #include <list>
 #include <deque>
+#include <map>
 
 #include "lima/CtControl.h"
 #include "lima/CtConfig.h"
+#include "lima/ThreadUtils.h"
 #include "processlib/SinkTaskMgr.h"
 
 namespace lima
@@ -40,10 +43,24 @@ namespace lima
     friend class CtControl;
     friend class CtBuffer;
     friend class CtBufferFrameCB;
+    friend class CtImage;
     friend class _ImageReady4AccCallback;
 
     typedef std::list<std::list<long long> > saturatedCounterResult;
 
+    /** @brief per pixel reduction of the sub frames, all computed
+     *  in a single pass without keeping the sub frames
+     */
+    enum Mode {
+      SUM,		///< sum in 32 bit integers (Bpp32S)
+      SUM_FLOAT,	///< sum in 64 bit floats, given as Bpp32F
+      MEAN,		///< running mean (Bpp32F)
+      VARIANCE,		///< Welford unbiased variance (Bpp32F)
+      STD,		///< standard deviation, sqrt(VARIANCE) (Bpp32F)
+      MIN,		///< minimum, same type as the sub frames
+      MAX,		///< maximum, same type as the sub frames
+    };
+
     struct LIMACORE_API Parameters
     {
       DEB_CLASS_NAMESPC(DebModControl,"Accumulation::Parameters","Control");
@@ -53,6 +70,7 @@ namespace lima
       
       bool		active;	///< if true do the calculation
       long long		pixelThresholdValue; ///< value which determine the threshold of the calculation
+      Mode		mode;	///< reduction of the sub frames (default SUM)
 
       bool	  	savingFlag; ///< saving flag if true save saturatedImageCounter
       std::string 	savePrefix; ///< prefix filename of saturatedImageCounter (default is saturated_image_counter)
@@ -86,6 +104,9 @@ namespace lima
     void setPixelThresholdValue(long long pixelThresholdValue);
     void getPixelThresholdValue(long long &pixelThresholdValue) const;
 
+    void setMode(Mode mode);
+    void getMode(Mode &mode) const;
+
     void getBufferSize(int &aBufferSize) const;
 
     void setSavingFlag(bool savingFlag);
@@ -123,10 +144,7 @@ namespace lima
       _CalcSaturatedTaskMgr::ErrorCode 	errorCode;
     };
 
-    class _CalcSaturatedTask;
-    friend class _CalcSaturatedTask;
-    class _CalcEndCBK;
-    friend class _CalcEndCBK;
+    class _BufferPool;
     class _ImageReady4AccCallback : public TaskEventCallback
     {
     public:
@@ -141,16 +159,44 @@ namespace lima
     std::deque<Data> 			m_datas;
     std::deque<Data> 			m_saturated_images;
     CtControl& 				m_ct;
-    bool				m_calc_ready;
-    std::deque<std::pair<Data,Data> >	m_calc_pending_data;
-    TaskEventCallback* 			m_calc_end;
+    int					m_calc_running;
     _CalcSaturatedTaskMgr*		m_calc_mgr;
+    _BufferPool*			m_buffer_pool;
     Data				m_calc_mask;
     mutable Cond 			m_cond;
     ThresholdCallback*			m_threshold_cb;
-    int 				m_last_acc_frame_nb;
     bool 				m_last_continue_flag;
 
+    /** sub frames are accumulated in any order into partial sums,
+     *  reduced when all of them arrived
+     */
+    struct _AccPartial
+    {
+      _AccPartial() : busy(false),nb_frames(0) {}
+
+      Data		acc;	///< sum, mean, min or max
+      Data		aux;	///< sum of squared differences (variance)
+      Data		saturated;
+      bool		busy;	///< a thread is adding into it
+      int		nb_frames; ///< sub frames it holds
+    };
+    typedef std::list<_AccPartial> _AccPartialList;
+    struct _AccSlot
+    {
+      _AccSlot() : nb_received(0),completed(false) {}
+
+      Data		result;	///< the accumulated frame
+      _AccPartialList	partials; ///< reduced into front()
+      int		nb_received;
+      bool		completed;
+    };
+    typedef std::map<int,_AccSlot> _AccSlotMap;
+    _AccSlotMap				m_acc_slots;
+    int					m_last_acc_slot;
+    int					m_next_acc_frame_nb; ///< next to deliver
+    bool				m_delivering;
+    Mode				m_mode;	///< of the running acquisition
+
     // --- Methodes for acquisition
     void prepare();
     bool _newFrameReady(Data&);
@@ -158,8 +204,15 @@ namespace lima
 
     void getFrame(Data &,int frameNumber);
 
-    void _accFrame(Data &src,Data &dst);
-    void _calcSaturatedImageNCounters(Data &src,Data &dst);
+    long long _accFrame(Data &src,Data &dst,Data &aux,Data &saturatedImg,
+			const Data &mask,long long pixelThresholdValue,
+			int nbFrames);
+    Data _newAccData(Data::TYPE,const Data &aData,int frameNumber);
+    _AccPartial _newAccPartial(const Data &aData,int frameNumber,bool active);
+    ImageType _getImageType(ImageType srcType) const;
+    _AccSlot& _getAccSlot(int accFrameNumber,const Data &aData,bool active);
+    void _reduceAccSlot(_AccSlot&);
+    void _deliverAccFrames(AutoMutex&);
 
     inline void _callIfNeedThresholdCallback(Data &aData,long long value);
     
@@ -170,12 +223,57 @@ namespace lima
 
   };
 
+  inline const char* convert_2_string(CtAccumulation::Mode mode)
+  {
+    const char *name;
+    switch(mode)
+      {
+      case CtAccumulation::SUM: name = "SUM";break;
+      case CtAccumulation::SUM_FLOAT: name = "SUM FLOAT";break;
+      case CtAccumulation::MEAN: name = "MEAN";break;
+      case CtAccumulation::VARIANCE: name = "VARIANCE";break;
+      case CtAccumulation::STD: name = "STD";break;
+      case CtAccumulation::MIN: name = "MIN";break;
+      case CtAccumulation::MAX: name = "MAX";break;
+      default:
+	name = "UNKNOWN";
+	break;
+      }
+    return name;
+  }
+  inline void convert_from_string(const std::string& val,
+				  CtAccumulation::Mode& mode)
+  {
+    std::string buffer = val;
+    std::transform(buffer.begin(),buffer.end(),
+		   buffer.begin(),::tolower);
+
+    if(buffer == "sum") mode = CtAccumulation::SUM;
+    else if(buffer == "sum float") mode = CtAccumulation::SUM_FLOAT;
+    else if(buffer == "mean") mode = CtAccumulation::MEAN;
+    else if(buffer == "variance") mode = CtAccumulation::VARIANCE;
+    else if(buffer == "std") mode = CtAccumulation::STD;
+    else if(buffer == "min") mode = CtAccumulation::MIN;
+    else if(buffer == "max") mode = CtAccumulation::MAX;
+    else
+      {
+	std::ostringstream msg;
+	msg << "Accumulation mode can't be:" << DEB_VAR1(val);
+	throw LIMA_EXC(Common,InvalidValue,msg.str());
+      }
+  }
+  inline std::ostream& operator<<(std::ostream &os,
+				  CtAccumulation::Mode mode)
+  {
+    return os << convert_2_string(mode);
+  }
   inline std::ostream& operator<<(std::ostream &os,
 				  const CtAccumulation::Parameters& params)
     {
       os << "<"
 	 << "active=" << (params.active ? "Yes" : "No") << ", "
 	 << "pixelThresholdValue=" << params.pixelThresholdValue << ", "
+	 << "mode=" << convert_2_string(params.mode) << ", "
 	 << "savingFlag=" << (params.savingFlag ? "Yes" : "No") << ", "
 	 << "savingPrefix=" << params.savePrefix
 	 << ">";
@@ -43,11 +43,15 @@ namespace lima
   class CtSaving;
 #ifdef WITH_SPS_IMAGE
   class CtSpsImage;
+#endif
+#ifdef WITH_SHM_RING
+  class CtShmRing;
 #endif
   class CtShutter;
   class CtAccumulation;
   class CtVideo;
   class CtEvent;
+  class CtThreadPools;
 #ifdef WITH_CONFIG
   class CtConfig;
 #endif
@@ -143,6 +147,37 @@ namespace lima
       ImageStatus	ImageCounters;
     };
 
+    /** @brief block of frames referencing the frame buffers
+     *
+     * Each segment shares the buffer of one or more contiguous frames,
+     * which stay pinned while the block holds it. A block wrapping
+     * around the frame buffers has several segments: materialize()
+     * copies the frames into a single contiguous Data on request.
+     */
+    class LIMACORE_API DataBlock
+    {
+      DEB_CLASS_NAMESPC(DebModControl,"Control::DataBlock","Control");
+    public:
+      DataBlock();
+
+      void clear();
+      void addSegment(const Data& data, int nb_frames);
+
+      int getNbFrames() const;
+      int getFrameSize() const;
+      int getNbSegments() const;
+      const Data& getSegment(int segment) const;
+      int getSegmentNbFrames(int segment) const;
+      void *getFramePtr(int frame) const;
+
+      void materialize(Data& data) const;
+    private:
+      std::vector<Data>	m_segments;
+      std::vector<int>	m_first_frames;
+      int		m_nb_frames;
+      int		m_frame_size;
+    };
+
     CtControl(HwInterface *hw);
     ~CtControl();
 
@@ -158,6 +193,9 @@ namespace lima
     CtSaving* 		saving();
 #ifdef WITH_SPS_IMAGE
     CtSpsImage* 	display();
+#endif
+#ifdef WITH_SHM_RING
+    CtShmRing* 		shmRing();
 #endif
     CtImage* 		image();
     CtBuffer* 		buffer();
@@ -165,6 +203,7 @@ namespace lima
     CtVideo*		video();
     CtShutter* 		shutter();
     CtEvent*		event();
+    CtThreadPools*	threadPools();
 #ifdef WITH_CONFIG
     CtConfig*		config();
 #endif
@@ -176,6 +215,9 @@ namespace lima
     CtSaving* 		saving() 		{ return m_ct_saving; }
 #ifdef WITH_SPS_IMAGE
     CtSpsImage* 	display() 		{ return m_ct_sps_image; }
+#endif
+#ifdef WITH_SHM_RING
+    CtShmRing* 		shmRing() 		{ return m_ct_shm_ring; }
 #endif
     CtImage* 		image() 		{ return m_ct_image; }
     CtBuffer* 		buffer() 		{ return m_ct_buffer; }
@@ -183,6 +225,7 @@ namespace lima
     CtVideo*		video()			{ return m_ct_video;}
     CtShutter* 		shutter() 		{ return m_ct_shutter; }
     CtEvent* 		event() 		{ return m_ct_event; }
+    CtThreadPools*	threadPools()		{ return m_ct_thread_pools; }
 #ifdef WITH_CONFIG
     CtConfig*		config()		{ return m_ct_config; }
 #endif
@@ -196,11 +239,17 @@ namespace lima
     void setApplyPolicy(ApplyPolicy policy);
     void getApplyPolicy(ApplyPolicy &policy) const;
 
+    void setOverrunShedding(bool active);
+    void getOverrunShedding(bool& active) const;
+
     void getStatus(Status& status) const; // from HW
     void getImageStatus(ImageStatus& status) const;
 
     void ReadImage(Data&,long frameNumber = -1, long readBlockLen = 1);
     void ReadBaseImage(Data&,long frameNumber = -1, long readBlockLen = 1);
+    void ReadBlock(DataBlock&,long frameNumber = -1, long readBlockLen = 1);
+    void ReadBaseBlock(DataBlock&,long frameNumber = -1,
+		       long readBlockLen = 1);
 
     void reset();
     void resetStatus(bool only_acq_status);
@@ -250,6 +299,9 @@ namespace lima
     CtSaving		*m_ct_saving;
 #ifdef WITH_SPS_IMAGE
     CtSpsImage		*m_ct_sps_image;
+#endif
+#ifdef WITH_SHM_RING
+    CtShmRing		*m_ct_shm_ring;
 #endif
     CtAcquisition	*m_ct_acq;
     CtImage		*m_ct_image;
@@ -258,6 +310,7 @@ namespace lima
     CtAccumulation	*m_ct_accumulation;
     CtVideo		*m_ct_video;
     CtEvent		*m_ct_event;
+    CtThreadPools	*m_ct_thread_pools;
 #ifdef WITH_CONFIG
     CtConfig		*m_ct_config;
 #endif
@@ -279,8 +332,13 @@ namespace lima
     bool		m_ready;
     bool		m_autosave;
     bool		m_running;
+    bool		m_overrun_shedding;
+    bool		m_consumers_shed;
 #ifdef WITH_SPS_IMAGE
     bool		m_display_active_flag;
+#endif
+#ifdef WITH_SHM_RING
+    bool		m_shm_ring_active_flag;
 #endif
     ImageStatusThreadList m_img_status_thread_list;
     SoftOpErrorHandler* m_soft_op_error_handler;
@@ -291,6 +349,8 @@ namespace lima
 
     void readBlock(Data&, long frameNumber, long readBlockLen,
 		   bool baseImage);
+    void readBlock(DataBlock&, long frameNumber, long readBlockLen,
+		   bool baseImage);
     void readOneImageBuffer(Data&, long frameNumber, long readBlockLen,
 			    bool baseImage);
   };
@@ -24,6 +24,8 @@
 
 #include <map>
 #include <list>
+#include <set>
+#include <vector>
 #include <string>
 #include <fstream>
 #include <ios>
@@ -31,6 +33,7 @@
 
 #include "lima/LimaCompatibility.h"
 #include "lima/ThreadUtils.h"
+#include "lima/Timestamp.h"
 #include "lima/CtControl.h"
 #include "lima/CtConfig.h"
 #include "lima/HwSavingCtrlObj.h"
@@ -72,6 +75,12 @@ namespace lima {
 	TIFFFormat,		///< TIFF format
 	HDF5,			///< HDF5 format
 	EDFConcat,		// < EDF format with frame concatenation mode
+	HDF5GZ,			///< HDF5 format with parallel gzip compression (direct chunk write)
+	EDFLZ4,			///< EDF format with lz4 frame compression
+	EDFZSTD,		///< EDF format with zstd compression
+	HDF5LZ4,		///< HDF5 format with lz4 filter (direct chunk write)
+	HDF5BS,			///< HDF5 format with bitshuffle/lz4 filter (direct chunk write)
+	HDF5ZSTD,		///< HDF5 format with zstd filter (direct chunk write)
       };
 
     enum SavingMode 
@@ -89,6 +98,13 @@ namespace lima {
 	MultiSet,		///< Like append but doesn't use file counter
       };	
 
+    enum IOMode
+      {
+	Buffered,		///< Standard buffered write through the page cache
+	DropBehind,		///< Buffered write, written pages are flushed and dropped from the page cache
+	Direct,			///< O_DIRECT aligned write, bypass the page cache (RAW and EDF only)
+      };
+
     struct LIMACORE_API Parameters 
     {
       DEB_CLASS_NAMESPC(DebModControl,"Saving::Parameters","Control");
@@ -105,10 +121,38 @@ namespace lima {
       std::string indexFormat;	///< ie: %.4d if you want 4 digits
       long framesPerFile;	///< the number of images save in one files
       long nbframes;
+      int compressionLevel;	///< compressor level, -1 == compressor default
+      IOMode ioMode;		///< how the files are written (RAW and EDF only)
+      int maxConcurrentWritingTask; ///< number of files written in parallel
       
       Parameters();
       void checkValid() const;
     };
+
+    struct LIMACORE_API TimeStatistic
+    {
+      TimeStatistic();
+      long nb;			///< number of measures
+      double mean;		///< all times are in second
+      double max;
+      double p50;		///< median
+      double p90;
+      double p99;
+    };
+
+    struct LIMACORE_API SavingStatistic
+    {
+      SavingStatistic();
+      long nbFrames;		///< number of frames written
+      long long nbBytes;	///< image bytes written
+      double elapsedTime;	///< from first frame ready to last frame written
+      double bytesPerSecond;	///< nbBytes / elapsedTime
+      TimeStatistic writeTime;	///< open + write + close of one frame
+      TimeStatistic compressionTime;
+      TimeStatistic queueTime;	///< from frame ready to save start (compression included)
+      long outstandingFrames;	///< frames ready but not yet written
+      long maxOutstandingFrames;
+    };
     
     typedef std::pair<std::string, std::string> HeaderValue;
     typedef std::map<std::string,std::string> HeaderMap;
@@ -137,6 +181,15 @@ namespace lima {
     void setFormat(FileFormat format, int stream_idx=0);
     void getFormat(FileFormat& format, int stream_idx=0) const;
 
+    void setCompressionLevel(int level, int stream_idx=0);
+    void getCompressionLevel(int& level, int stream_idx=0) const;
+
+    void setIOMode(IOMode mode, int stream_idx=0);
+    void getIOMode(IOMode& mode, int stream_idx=0) const;
+
+    void setMaxConcurrentWritingTask(int nb, int stream_idx=0);
+    void getMaxConcurrentWritingTask(int& nb, int stream_idx=0) const;
+
     void getHardwareFormatList(std::list<std::string> &format_list) const;
     void setHardwareFormat(const std::string &format);
     void getHardwareFormat(std::string &format) const;
@@ -192,6 +245,16 @@ namespace lima {
     void getWriteTimeStatistic(std::list<double>&, int stream_idx=0) const;
     void setStatisticHistorySize(int aSize, int stream_idx=0);
 
+    void getSavingStatistic(SavingStatistic&, int stream_idx=0) const;
+    void resetSavingStatistic(int stream_idx=0);
+
+    // --- overflow tier
+
+    void setSpillDirectory(const std::string& directory);
+    void getSpillDirectory(std::string& directory) const;
+    void setSpillMaxSize(long long max_size);
+    void getSpillMaxSize(long long& max_size) const;
+
     // --- misc
 
     void clear();
@@ -203,6 +266,9 @@ namespace lima {
     void setStreamActive(int stream_idx, bool  active);
     void getStreamActive(int stream_idx, bool& active) const;
 
+  private:
+    class	_FrameHeader;
+  public:
     class Stream;
 
     class LIMACORE_API SaveContainer
@@ -212,7 +278,7 @@ namespace lima {
       SaveContainer(Stream& stream);
       virtual ~SaveContainer();
       
-      void open(const CtSaving::Parameters&);
+      void open(const CtSaving::Parameters&,long file_nb);
       void close();
       void writeFile(Data&,CtSaving::HeaderMap &);
       void setStatisticSize(int aSize);
@@ -231,6 +297,11 @@ namespace lima {
        *  @see needParallelCompression
        */
       virtual SinkTaskBase* getCompressionTask(const CtSaving::HeaderMap&) {return NULL;}
+      /** @brief should return false if several containers of this
+       *  format can't write their files at the same time
+       *  (i.e: the underlying library is not thread-safe)
+       */
+      virtual bool canWriteConcurrently() const {return true;}
 
     protected:
       virtual bool _open(const std::string &filename,
@@ -249,6 +320,7 @@ namespace lima {
       int			m_statistic_size;
       mutable Cond		m_cond;
       bool			m_file_opened;
+      long			m_file_nb;
       long			m_nb_frames_to_write;
     };
     friend class SaveContainer;
@@ -284,12 +356,14 @@ namespace lima {
       void checkDirectoryAccess(const std::string&);
 
       bool needCompression()
-      { return m_save_cnt->needParallelCompression(); }
+      { return m_save_cnts[0]->needParallelCompression(); }
 
       void setSavingError(CtControl::ErrorCode error)
       { m_saving._setSavingError(error); }
 
-      SinkTaskBase *getTask(TaskType type, const HeaderMap& header);
+      SinkTaskBase *getTask(TaskType type, _FrameHeader* header,
+			    long frame_nr,
+			    const Timestamp& ready_time = Timestamp());
 
       void compressionFinished(Data& data);
       void saveFinished(Data& data);
@@ -301,28 +375,45 @@ namespace lima {
 
       void writeFile(Data& data, HeaderMap& header);
 
+      int getWriterIndex(long frame_nr) const;
+      long getFileNumber(long frame_nr) const;
+      void fileClosed(long file_nb);
+
       bool hasAutoSaveMode()
       { const Parameters& pars = getParameters(Cache);
 	return pars.savingMode != Manual; 
       }
 
-      void getStatistic(std::list<double>& stat_list) const
-      { m_save_cnt->getStatistic(stat_list); }
-      void setStatisticSize(int size) 
-      { m_save_cnt->setStatisticSize(size); }
+      void getStatistic(std::list<double>& stat_list) const;
+      void setStatisticSize(int size);
 
-      void clear()
-      { m_save_cnt->clear(); }
+      void getSavingStatistic(SavingStatistic&) const;
+      void resetSavingStatistic();
+      void addFrameReady(const Timestamp& ready_time);
+      void addWriteTime(double write_time, long long nb_bytes);
+      void addCompressionTime(double compression_time);
+      void addQueueTime(double queue_time);
+
+      void clear();
 
     private:
       class _SaveCBK;
       class _SaveTask;
       class _CompressionCBK;
+      class _CompressionTask;
+      class _Statistic;
+      typedef std::vector<SaveContainer*> SaveContainerList;
+
+      SaveContainer* _newSaveContainer();
+      void _deleteSaveContainers();
 
       CtSaving&			m_saving;
       int			m_idx;
 
-      SaveContainer 	       *m_save_cnt;
+      SaveContainerList		m_save_cnts;
+      bool			m_concurrent_writing;
+      long			m_first_file_nb;
+      mutable Mutex		m_lock;
       _SaveCBK	 	       *m_saving_cbk;
       Parameters		m_pars;
       Parameters		m_reference_pars;
@@ -330,6 +421,7 @@ namespace lima {
       bool			m_pars_dirty_flag;
       bool			m_active;
       _CompressionCBK 	       *m_compression_cbk;
+      _Statistic	       *m_statistic;
     };
     friend class Stream;
 
@@ -338,12 +430,18 @@ namespace lima {
     friend class _ManualBackgroundSaveTask;
     class	_NewFrameSaveCBK;
     friend class _NewFrameSaveCBK;
+    class	_FrameHeaderStore;
+    class	_SpillStore;
+    class	_SpillThread;
+    friend class _SpillThread;
     typedef std::vector<SinkTaskBase *> TaskList;
     typedef std::map<long, long>	FrameCbkCountMap;
-    typedef std::map<long, HeaderMap>	FrameHeaderMap;
+    typedef std::set<long>		FrameSet;
+    typedef std::map<long, Timestamp>	FrameTimestampMap;
 
     void _validateFrameHeader(long frame_nr,
 			      AutoMutex&);
+    bool _canSave(long frame_nr) const;
 
     CtControl& 			m_ctrl;
 
@@ -352,15 +450,20 @@ namespace lima {
 
     HeaderMap			m_common_header;
     HeaderMap			m_internal_common_header;
-    FrameHeaderMap		m_frame_headers;
+    bool			m_common_header_dirty;
+    _FrameHeaderStore	       *m_frame_headers;
     FrameMap			m_frame_datas;
+    _SpillStore		       *m_spill;
+    _SpillThread	       *m_spill_thread;
 
     mutable Cond		m_cond;
     bool			m_ready_flag;
     long			m_last_frameid_saved;
     bool			m_need_compression;
     FrameCbkCountMap		m_nb_compression_cbk;
-    int				m_nb_save_cbk;
+    FrameCbkCountMap		m_nb_save_cbk;
+    FrameSet			m_frames_to_notify;
+    FrameTimestampMap		m_frame_ready_times;
     TaskEventCallback	       *m_end_cbk;
     bool			m_has_hwsaving;
     HwSavingCtrlObj*		m_hwsaving;
@@ -397,22 +500,24 @@ namespace lima {
 	    first_to_save = it->first;
 	}
       }
+      bool _isSpillActive() const;
+      int _markSpill(long nb_to_save, long last_frame_saved,
+		     long high_water);
 
       // --- internal call
       void _prepare(CtControl&);
       void _stop(CtControl&);
       void _close();
-      void _getCommonHeader(HeaderMap&);
-      void _takeHeader(FrameHeaderMap::iterator&, HeaderMap& header,
-		       bool keep_in_map);
-      void _getTaskList(TaskType type, long frame_nr, const HeaderMap& header, 
+      void _spillFrames(int nb_frames);
+      _FrameHeader* _takeHeader(long frame_nr, bool keep_in_map);
+      void _getTaskList(TaskType type, long frame_nr, _FrameHeader* header, 
 			TaskList& task_list);
-      void _postTaskList(Data&, const TaskList&);
+      void _postTaskList(Data&, TaskType, const TaskList&);
       void _compressionFinished(Data&, Stream&);
       void _saveFinished(Data&, Stream&);
       void _setSavingError(CtControl::ErrorCode);
       void _updateParameters();
-      void _synchronousSaving(Data&,HeaderMap&);
+      void _synchronousSaving(Data&,_FrameHeader*);
       bool _controlIsFault();
       bool _newFrameWrite(int);
       bool _checkHwFileFormat(const std::string&) const;
@@ -445,6 +550,18 @@ namespace lima {
 	  aFileFormatHumanPt = "HDF5";break;
 	case CtSaving::EDFConcat:
 	  aFileFormatHumanPt = "EDF Concat";break;
+	case CtSaving::HDF5GZ:
+	  aFileFormatHumanPt = "HDF5 gzip";break;
+	case CtSaving::EDFLZ4:
+	  aFileFormatHumanPt = "EDF lz4";break;
+	case CtSaving::EDFZSTD:
+	  aFileFormatHumanPt = "EDF zstd";break;
+	case CtSaving::HDF5LZ4:
+	  aFileFormatHumanPt = "HDF5 lz4";break;
+	case CtSaving::HDF5BS:
+	  aFileFormatHumanPt = "HDF5 bitshuffle lz4";break;
+	case CtSaving::HDF5ZSTD:
+	  aFileFormatHumanPt = "HDF5 zstd";break;
 	default:
 	  aFileFormatHumanPt = "RAW";break;
 	}
@@ -466,6 +583,12 @@ namespace lima {
       else if(buffer == "tiff")		fileFormat = CtSaving::TIFFFormat;
       else if(buffer == "hdf5")		fileFormat = CtSaving::HDF5;
       else if(buffer == "edf concat")	fileFormat = CtSaving::EDFConcat;
+      else if(buffer == "hdf5 gzip")	fileFormat = CtSaving::HDF5GZ;
+      else if(buffer == "edf lz4")	fileFormat = CtSaving::EDFLZ4;
+      else if(buffer == "edf zstd")	fileFormat = CtSaving::EDFZSTD;
+      else if(buffer == "hdf5 lz4")	fileFormat = CtSaving::HDF5LZ4;
+      else if(buffer == "hdf5 bitshuffle lz4") fileFormat = CtSaving::HDF5BS;
+      else if(buffer == "hdf5 zstd")	fileFormat = CtSaving::HDF5ZSTD;
       else
 	{
 	  std::ostringstream msg;
@@ -569,7 +692,69 @@ namespace lima {
 	}
 
     }
-   inline std::ostream& operator<<(std::ostream &os,const CtSaving::Parameters &params)
+   inline const char* convert_2_string(CtSaving::IOMode ioMode)
+    {
+      const char *anIOModeHumanPt;
+      switch(ioMode)
+	{
+	case CtSaving::DropBehind:
+	  anIOModeHumanPt = "Drop Behind";break;
+	case CtSaving::Direct:
+	  anIOModeHumanPt = "Direct";break;
+	default:
+	  anIOModeHumanPt = "Buffered";break;
+	}
+      return anIOModeHumanPt;
+    }
+  inline void convert_from_string(const std::string& val,
+				  CtSaving::IOMode& ioMode)
+    {
+      std::string buffer = val;
+      std::transform(buffer.begin(),buffer.end(),
+		     buffer.begin(),::tolower);
+
+      if(buffer == "buffered")		ioMode = CtSaving::Buffered;
+      else if(buffer == "drop behind")	ioMode = CtSaving::DropBehind;
+      else if(buffer == "direct")	ioMode = CtSaving::Direct;
+      else
+	{
+	  std::ostringstream msg;
+	  msg << "IOMode can't be:" << DEB_VAR1(val);
+	  throw LIMA_EXC(Control,InvalidValue,msg.str());
+	}
+    }
+  inline std::ostream& operator<<(std::ostream &os,
+				  const CtSaving::TimeStatistic &stat)
+  {
+    os << "<"
+       << "nb=" << stat.nb << ", "
+       << "mean=" << stat.mean << ", "
+       << "max=" << stat.max << ", "
+       << "p50=" << stat.p50 << ", "
+       << "p90=" << stat.p90 << ", "
+       << "p99=" << stat.p99
+       << ">";
+    return os;
+  }
+
+  inline std::ostream& operator<<(std::ostream &os,
+				  const CtSaving::SavingStatistic &stat)
+  {
+    os << "<"
+       << "nbFrames=" << stat.nbFrames << ", "
+       << "nbBytes=" << stat.nbBytes << ", "
+       << "elapsedTime=" << stat.elapsedTime << ", "
+       << "bytesPerSecond=" << stat.bytesPerSecond << ", "
+       << "writeTime=" << stat.writeTime << ", "
+       << "compressionTime=" << stat.compressionTime << ", "
+       << "queueTime=" << stat.queueTime << ", "
+       << "outstandingFrames=" << stat.outstandingFrames << ", "
+       << "maxOutstandingFrames=" << stat.maxOutstandingFrames
+       << ">";
+    return os;
+  }
+
+  inline std::ostream& operator<<(std::ostream &os,const CtSaving::Parameters &params)
     {
       const char *aFileFormatHumanPt = convert_2_string(params.fileFormat);
       const char *aSavingModeHumanPt = convert_2_string(params.savingMode);
@@ -584,7 +769,10 @@ namespace lima {
 	 << "savingMode=" << params.savingMode << "," << aSavingModeHumanPt << ", "
 	 << "overwritePolicy=" << params.overwritePolicy << "," << anOverwritePolicyHumanPt << ", "
 	 << "framesPerFile=" << params.framesPerFile << ", "
-	 << "nbframes=" << params.nbframes
+	 << "nbframes=" << params.nbframes << ", "
+	 << "compressionLevel=" << params.compressionLevel << ", "
+	 << "ioMode=" << convert_2_string(params.ioMode) << ", "
+	 << "maxConcurrentWritingTask=" << params.maxConcurrentWritingTask
 	 << ">";
       return os;
     }
@@ -602,7 +790,10 @@ namespace lima {
 	      (a.overwritePolicy == b.overwritePolicy) &&
 	      (a.indexFormat     == b.indexFormat)     &&
 	      (a.framesPerFile   == b.framesPerFile)   &&
-	      (a.nbframes        == b.nbframes));
+	      (a.nbframes        == b.nbframes)        &&
+	      (a.compressionLevel == b.compressionLevel) &&
+	      (a.ioMode          == b.ioMode) &&
+	      (a.maxConcurrentWritingTask == b.maxConcurrentWritingTask));
     }
 
   inline std::ostream& operator<<(std::ostream &os,const CtSaving::HeaderMap &header)
@@ -630,6 +821,7 @@ namespace lima {
       const std::string& value = str.str();
       HeaderValue anEntry(key,value);
       m_internal_common_header.insert(anEntry);
+      m_common_header_dirty = true;
     }
 
 } // namespace lima
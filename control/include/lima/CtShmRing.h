@@ -0,0 +1,160 @@
+//###########################################################################
+// This file is part of LImA, a Library for Image Acquisition
+//
+// Copyright (C) : 2009-2011
+// European Synchrotron Radiation Facility
+// BP 220, Grenoble 38043
+// FRANCE
+//
+// This is free software; you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation; either version 3 of the License, or
+// (at your option) any later version.
+//
+// This software is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program; if not, see <http://www.gnu.org/licenses/>.
+//###########################################################################
+#ifndef CTSHMRING_H
+#define CTSHMRING_H
+
+#include <string>
+
+#include "lima/LimaCompatibility.h"
+#include "lima/ThreadUtils.h"
+#include "lima/Debug.h"
+#include "lima/SizeUtils.h"
+
+#include "processlib/Data.h"
+
+namespace lima
+{
+
+/** @brief publish every frame in a /dev/shm ring
+ *
+ * Single producer, multiple consumers: each consumer keeps its own read
+ * position and reads all the frames without taking any lock, or is told
+ * how many frames it missed when the producer laps it.
+ *
+ * Layout: Header, then nb_slots slots of slot_size bytes starting at
+ * data_offset; each slot is a SlotHeader followed (at SlotDataOffset)
+ * by the frame data.
+ * Frame #s (publication order) goes to slot s % nb_slots, whose seq is
+ * 2 * s + 1 while it is written and 2 * s + 2 once it is complete;
+ * write_seq is then set to s + 1. A reader checks that seq is the same
+ * before and after copying the slot.
+ */
+class LIMACORE_API CtShmRing
+{
+	DEB_CLASS_NAMESPC(DebModControl,"CtShmRing","Control");
+
+ public:
+	enum {
+		Version = 1,
+		SlotDataOffset = 64,
+		DefNbSlots = 16,
+	};
+
+	enum State {
+		Active, Stale,
+	};
+
+	struct Header {
+		char			magic[8];	// "LIMARING"
+		int			version;
+		int			nb_slots;
+		long long		slot_size;
+		long long		data_offset;
+		int			width;
+		int			height;
+		int			depth;
+		int			data_type;	// Data::TYPE
+		long long		generation;
+		volatile int		state;
+		volatile long long	write_seq;
+	};
+
+	struct SlotHeader {
+		volatile long long	seq;
+		long long		frame_nb;
+		double			timestamp;
+		long long		size;
+	};
+
+	class LIMACORE_API Reader
+	{
+		DEB_CLASS_NAMESPC(DebModControl,"CtShmRing::Reader","Control");
+	public:
+		enum Status {
+			NoFrame, FrameRead, Restarted,
+		};
+
+		Reader(const std::string& name);
+		~Reader();
+
+		Status read(Data& data);
+		long long getNbDropped() const;
+		void getFrameDim(FrameDim& frame_dim) const;
+
+	private:
+		Reader(const Reader&);
+		Reader& operator =(const Reader&);
+
+		void _attach();
+		void _detach();
+
+		std::string	m_name;
+		Header		*m_header;
+		long long	m_map_size;
+		long long	m_generation;
+		long long	m_next_seq;
+		long long	m_nb_dropped;
+	};
+
+	CtShmRing();
+	~CtShmRing();
+
+	void setName(const std::string& name);
+	void getName(std::string& name) const;
+	void setNbSlots(int nb_slots);
+	void getNbSlots(int& nb_slots) const;
+
+	void prepare(const FrameDim& frame_dim);
+	void frameReady(Data&);
+	void reset();
+	void setActive(bool aFlag);
+	bool isActive() const;
+
+	void getNbPublished(long long& nb_frames) const;
+
+ private:
+	void _create(long long map_size);
+	void _release();
+
+	mutable Mutex	m_lock;
+	bool		m_active_flag;
+	std::string	m_name;
+	int		m_nb_slots;
+	int		m_fd;
+	Header		*m_header;
+	long long	m_map_size;
+	long long	m_generation;
+};
+
+inline void CtShmRing::setActive(bool aFlag) 
+{
+	m_active_flag = aFlag;
+}
+
+inline bool CtShmRing::isActive() const 
+{
+	return m_active_flag;
+}
+
+} // namespace lima
+
+#endif // CTSHMRING_H
@@ -0,0 +1,128 @@
+//###########################################################################
+// This file is part of LImA, a Library for Image Acquisition
+//
+// Copyright (C) : 2009-2011
+// European Synchrotron Radiation Facility
+// BP 220, Grenoble 38043
+// FRANCE
+//
+// This is free software; you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation; either version 3 of the License, or
+// (at your option) any later version.
+//
+// This software is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program; if not, see <http://www.gnu.org/licenses/>.
+//###########################################################################
+#ifndef CTTHREADPOOLS_H
+#define CTTHREADPOOLS_H
+
+#include <list>
+
+#include "lima/LimaCompatibility.h"
+#include "lima/Debug.h"
+#include "lima/ThreadUtils.h"
+
+class PoolThreadMgr;
+class TaskMgr;
+
+namespace lima
+{
+  /** @brief processing thread pools of a CtControl, one per role.
+   *
+   *  By default every role posts its tasks to the processlib global
+   *  pool (PoolThreadMgr::get()), shared by all the CtControl of the
+   *  process. Giving a number of threads to a role starts a pool
+   *  dedicated to it, so saving I/O, compression, image processing and
+   *  video can't starve each other.
+   *  Each role also has tile workers, which split the work on a frame
+   *  between its threads.
+   *  abort() throws the tasks of the global pool, those of the other
+   *  CtControl included, unless the global pool is declared shared.
+   */
+  class LIMACORE_API CtThreadPools
+  {
+    DEB_CLASS_NAMESPC(DebModControl,"Thread Pools","Control");
+
+  public:
+    enum Role {Processing,Compression,Saving,Video};
+    enum {MAX_AUTO_TILE_THREADS = 8};
+
+    struct LIMACORE_API Stats
+    {
+      Stats();
+
+      int	nbThreads;	///< 0 == shared global pool
+      long long	nbSubmitted;	///< task managers posted
+      long long	nbFinished;	///< task managers which reached their end
+      int	nbPending;	///< queued or running
+      int	maxPending;	///< high-water mark of nbPending
+      double	meanLatency;	///< from post to end, in seconds
+    };
+
+    CtThreadPools();
+    ~CtThreadPools();
+
+    void setNbThreads(Role role,int nb_threads);
+    void getNbThreads(Role role,int& nb_threads) const;
+
+    void setCpuAffinity(Role role,const std::list<int>& cpus);
+    void getCpuAffinity(Role role,std::list<int>& cpus) const;
+
+    void setGlobalPoolShared(bool shared);
+    void getGlobalPoolShared(bool& shared) const;
+
+    void getStats(Role role,Stats& stats) const;
+    void resetStats();
+
+    void addProcess(Role role,TaskMgr* mgr);
+    TileWorkers& getTileWorkers(Role role);
+    void wait();
+    void abort();
+
+  private:
+    enum {NB_ROLES = Video + 1};
+    class _Pool;
+    class _EndTask;
+
+    _Pool& _getPool(Role role) const;
+
+    _Pool*		m_pools[NB_ROLES];
+    mutable Mutex	m_lock;
+    bool		m_global_pool_shared;
+  };
+
+  inline std::ostream& operator<<(std::ostream &os,
+				  CtThreadPools::Role role)
+  {
+    const char *name = "Unknown";
+    switch(role)
+      {
+      case CtThreadPools::Processing:	name = "Processing"; break;
+      case CtThreadPools::Compression:	name = "Compression"; break;
+      case CtThreadPools::Saving:	name = "Saving"; break;
+      case CtThreadPools::Video:	name = "Video"; break;
+      }
+    return os << name;
+  }
+
+  inline std::ostream& operator<<(std::ostream &os,
+				  const CtThreadPools::Stats& stats)
+  {
+    os << "<"
+       << "nbThreads=" << stats.nbThreads << ", "
+       << "nbSubmitted=" << stats.nbSubmitted << ", "
+       << "nbFinished=" << stats.nbFinished << ", "
+       << "nbPending=" << stats.nbPending << ", "
+       << "maxPending=" << stats.maxPending << ", "
+       << "meanLatency=" << stats.meanLatency
+       << ">";
+    return os;
+  }
+}
+#endif
@@ -27,6 +27,12 @@ namespace lima
     };
     typedef std::vector<AutoGainMode> AutoGainModeList;
 
+    enum StreamEncoding {
+      NO_ENCODING,  ///< no encoded stream
+      JPEG,	    ///< 8 bit (scaled) gray or RGB jpeg
+      LZ4	    ///< lz4 block of the raw video image
+    };
+
     CtVideo(CtControl&);
     ~CtVideo();
     
@@ -44,6 +50,10 @@ namespace lima
       VideoMode		mode;
       Roi		roi;
       Bin		bin;
+      StreamEncoding	stream_encoding;
+      int		stream_jpeg_quality;	///< 1 - 100
+      double		stream_max_rate;	///< images/s, 0. == no limit
+      double		stream_max_bandwidth;	///< bytes/s, 0. == no limit
     };
     class _InternalImageCBK;
     class LIMACORE_API Image
@@ -74,6 +84,31 @@ namespace lima
 
     friend class Image;
 
+    struct LIMACORE_API EncodedImage
+    {
+      EncodedImage();
+
+      StreamEncoding	encoding;
+      int		width;
+      int		height;
+      VideoMode		mode;
+      int		rawSize;	///< size of the decoded lz4 image
+      long long		frameNumber;
+      std::string	payload;
+    };
+
+    class LIMACORE_API EncodedImageCallback
+    {
+      DEB_CLASS_NAMESPC(DebModControl,"Video::EncodedImageCallback", 
+			"Control");
+
+    public:
+      EncodedImageCallback() {}
+      virtual ~EncodedImageCallback() {}
+
+      virtual void newEncodedImage(const EncodedImage&) = 0;
+    };
+
     class LIMACORE_API ImageCallback
     {
       DEB_CLASS_NAMESPC(DebModControl,"Video::ImageCallback", 
@@ -115,12 +150,27 @@ namespace lima
     void setBin(const Bin &aBin);
     void getBin(Bin &aBin) const;
 
+    // --- encoded stream
+    bool checkStreamEncoding(StreamEncoding encoding) const;
+    void setStreamEncoding(StreamEncoding encoding);
+    void getStreamEncoding(StreamEncoding& encoding) const;
+    void setStreamJpegQuality(int quality);
+    void getStreamJpegQuality(int& quality) const;
+    void setStreamMaxRate(double rate);
+    void getStreamMaxRate(double& rate) const;
+    void setStreamMaxBandwidth(double bandwidth);
+    void getStreamMaxBandwidth(double& bandwidth) const;
+
     // --- images
     void getLastImage(Image &anImage) const;
+    void getLastImage(Image &anImage,int max_width,int max_height) const;
     void getLastImageCounter(long long &anImageCounter) const;
+    void getLastEncodedImage(EncodedImage &anImage) const;
 
     void registerImageCallback(ImageCallback &cb);
     void unregisterImageCallback(ImageCallback &cb);
+    void registerEncodedImageCallback(EncodedImageCallback &cb);
+    void unregisterEncodedImageCallback(EncodedImageCallback &cb);
 
     // --- video mode
     void getSupportedVideoMode(std::list<VideoMode> &modeList);
@@ -129,6 +179,7 @@ namespace lima
     friend class _Data2ImageCBK;
     friend class _InternalImageCBK;
     class _videoBackgroundCallback;
+    class _EncodeTask;
 
     void frameReady(Data&);	// callback from CtControl
 
@@ -138,8 +189,15 @@ namespace lima
     void _apply_params(AutoMutex &,bool = false);
     void _read_hw_params();
     void _check_video_mode(VideoMode);
+    void _check_stream_mode(StreamEncoding,VideoMode);
     void _prepareAcq();
     void _startAcqTime();
+    bool _check_stream_rate();
+    void _encode_image(const VideoImage&);
+    void _post_encode_image(const Image&);
+    void _update_read_image() const;
+    VideoImage* _get_thumbnail(VideoImage*,int level,AutoMutex&) const;
+    void _invalidate_thumbnails(const VideoImage*);
 #ifdef WITH_CONFIG
     class _ConfigHandler;
     CtConfig::ModuleTypeCallback* _getConfigHandler();
@@ -165,6 +223,18 @@ namespace lima
     Bin			m_hw_bin;
     bool		m_stopping_live; ///< variable to avoid deadlock when stopping live
     bool		m_active_flag; ///< flag if video is active
+    double		m_next_stream_time;
+    int			m_last_stream_size;
+    EncodedImage	m_last_encoded_image;
+    EncodedImageCallback* m_encoded_image_callback;
+
+    enum {NB_THUMBNAIL_LEVELS = 3};		///< 1/2, 1/4 and 1/8
+    typedef std::list<VideoImage*> VideoImageList;
+    mutable VideoImageList m_thumbnail_pool[NB_THUMBNAIL_LEVELS];
+    mutable VideoImage*	m_thumbnails[NB_THUMBNAIL_LEVELS]; ///< latest built
+    /// full resolution image each thumbnail was reduced from
+    mutable const VideoImage* m_thumbnail_sources[NB_THUMBNAIL_LEVELS];
+    mutable bool	m_thumbnail_building;
   };
   
   inline const char* convert_2_string(CtVideo::AutoGainMode mode)
@@ -203,6 +273,42 @@ namespace lima
   {
     return os << convert_2_string(mode);
   }
+  inline const char* convert_2_string(CtVideo::StreamEncoding encoding)
+  {
+    const char *name;
+    switch(encoding)
+      {
+      case CtVideo::NO_ENCODING: name = "NONE";break;
+      case CtVideo::JPEG: name = "JPEG";break;
+      case CtVideo::LZ4: name = "LZ4";break;
+      default:
+	name = "UNKNOWN";
+	break;
+      }
+    return name;
+  }
+  inline void convert_from_string(const std::string& val,
+				  CtVideo::StreamEncoding& encoding)
+  {
+    std::string buffer = val;
+    std::transform(buffer.begin(),buffer.end(),
+		   buffer.begin(),::tolower);
+    
+    if(buffer == "none") encoding = CtVideo::NO_ENCODING;
+    else if(buffer == "jpeg") encoding = CtVideo::JPEG;
+    else if(buffer == "lz4") encoding = CtVideo::LZ4;
+    else
+      {
+	std::ostringstream msg;
+	msg << "StreamEncoding can't be:" << DEB_VAR1(val);
+	throw LIMA_EXC(Common,InvalidValue,msg.str());
+      }
+  }
+  inline std::ostream& operator<<(std::ostream &os,
+				  CtVideo::StreamEncoding encoding)
+  {
+    return os << convert_2_string(encoding);
+  }
   inline std::ostream& operator<<(std::ostream &os,
 				  const CtVideo::Parameters& params)
     {
@@ -213,7 +319,11 @@ namespace lima
 	 << "auto_gain_mode=" << convert_2_string(params.auto_gain_mode) << ", "
 	 << "mode=" << convert_2_string(params.mode) << ", "
 	 << "roi=" << params.roi << ", "
-	 << "bin=" << params.bin
+	 << "bin=" << params.bin << ", "
+	 << "stream_encoding=" << convert_2_string(params.stream_encoding) << ", "
+	 << "stream_jpeg_quality=" << params.stream_jpeg_quality << ", "
+	 << "stream_max_rate=" << params.stream_max_rate << ", "
+	 << "stream_max_bandwidth=" << params.stream_max_bandwidth
 	 << ">";
       return os;
     }
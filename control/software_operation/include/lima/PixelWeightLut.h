@@ -0,0 +1,122 @@
+//###########################################################################
+// This file is part of LImA, a Library for Image Acquisition
+//
+// Copyright (C) : 2009-2011
+// European Synchrotron Radiation Facility
+// BP 220, Grenoble 38043
+// FRANCE
+//
+// This is free software; you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation; either version 3 of the License, or
+// (at your option) any later version.
+//
+// This software is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program; if not, see <http://www.gnu.org/licenses/>.
+//###########################################################################
+#ifndef __PIXELWEIGHTLUT_H
+#define __PIXELWEIGHTLUT_H
+
+#include <vector>
+
+#include "lima/LimaCompatibility.h"
+#include "lima/SizeUtils.h"
+#include "lima/ThreadUtils.h"
+
+#include "processlib/Data.h"
+
+namespace lima
+{
+  /** @brief sparse pixel to bin weight matrix (CSR, one row per bin)
+   *
+   *  The weights of an arc geometry are computed once per image size
+   *  and shared through get(), every frame is then reduced with a
+   *  sparse-dense product over the pixels of the arc only.
+   *  Pixel (x,y) is centered on (x,y) and, with a subSampling of n,
+   *  split in n x n points each counting for 1/n² in the bin it falls in.
+   *  Angles are in degrees from the x axis toward the y axis (image
+   *  coordinates) and the arc goes from the start to the end angle.
+   */
+  class LIMACORE_API PixelWeightLut
+  {
+  public:
+    enum Profile {INTEGRAL,	///< one bin, the whole arc
+		  RADIAL,	///< bins between rayon1 and rayon2
+		  AZIMUTHAL};	///< bins between the start and end angle
+
+    struct LIMACORE_API Geometry
+    {
+      Geometry();
+      Geometry(const ArcRoi& roi,Profile profile,int nbBins,
+	       int subSampling,int width,int height);
+
+      bool operator <(const Geometry&) const;
+
+      ArcRoi	roi;
+      Profile	profile;
+      int	nbBins;
+      int	subSampling;
+      int	width;
+      int	height;
+    };
+
+    struct Stats
+    {
+      double	sum;		///< weighted sum
+      double	sum2;		///< weighted sum of squares
+      double	weight;		///< sum of the weights
+      double	min;		///< over pixels with a weight
+      double	max;
+    };
+
+    /** @brief the lut of a geometry, built or from the cache.
+     *  the caller owns a reference, to be released with unref()
+     */
+    static PixelWeightLut* get(const Geometry&);
+    /** @brief a new lut, not shared through the cache,
+     *  for owners keeping their lut across frames
+     */
+    static PixelWeightLut* create(const Geometry&);
+    static void clearCache();
+
+    void ref();
+    void unref();
+
+    const Geometry& getGeometry() const {return m_geometry;}
+    int getNbPixels() const {return m_pixels.size();}
+
+    /** @brief weighted mean of each bin (0 if no pixel), pixels where
+     *  mask (if not empty) is 0 are excluded
+     *  @return false if the data type or size is not managed
+     */
+    bool profile(const Data& src,const Data& mask,double *bins) const;
+    /** @brief statistics of the first bin
+     */
+    bool stats(const Data& src,const Data& mask,Stats& stats) const;
+
+  private:
+    PixelWeightLut(const Geometry&);
+    ~PixelWeightLut();
+
+    void _build();
+    bool _check(const Data& src,const Data& mask) const;
+    template<class INPUT>
+    void _profile(const INPUT *src,const char *mask,double *bins) const;
+    template<class INPUT>
+    void _stats(const INPUT *src,const char *mask,Stats&) const;
+
+    Geometry		m_geometry;
+    std::vector<int>	m_bin_offsets;	///< nbBins + 1, in m_pixels
+    std::vector<int>	m_pixels;	///< pixel index, sorted in a bin
+    std::vector<float>	m_weights;
+    std::vector<double>	m_bin_weights;	///< sum of the weights of a bin
+    Mutex		m_lock;
+    int			m_ref_count;
+  };
+}
+#endif
@@ -50,6 +50,18 @@ namespace lima
     void setEndSinkTaskCallback(TaskEventCallback *aCbk);
 
     void addTo(TaskMgr&,int begin_stage,int &last_link_task,int &last_sink_task);
+
+    /** Consecutive stages with only a background substraction,
+     * a flatfield correction or a standard mask are run as one
+     * SoftOpCorrectionChain task (default).
+     */
+    void setFuseCorrections(bool fuse);
+    void getFuseCorrections(bool &fuse) const;
+
+    /** Threads the tiled operations split a frame between,
+     * NULL == the ones shared by the process (default).
+     */
+    void setTileWorkers(TileWorkers *workers);
     
     void isTaskActive(bool &linkTaskFlag,bool &sinkTaskFlag) const;
     void prepare();
@@ -60,9 +72,15 @@ namespace lima
     
     TaskEventCallback	*m_end_link_callback;
     TaskEventCallback   *m_end_sink_callback;
+    bool		m_fuse_corrections;
+    typedef std::map<stage,SoftOpCorrectionChain*> CorrectionChains;
+    CorrectionChains	m_correction_chains; // by first stage
+    TileWorkers*	m_tile_workers;
 
     void _checkIfPossible(SoftOpId aSoftOpId,
 			  int stage);
+    bool _isCorrectionStage(Stage2Instance::const_iterator) const;
+    void _clearCorrectionChains();
     mutable Cond	m_cond;
   };
 }
@@ -50,6 +50,10 @@ namespace lima
 
     virtual bool addTo(TaskMgr&,int stage) = 0;
     virtual void prepare() = 0;
+    /** @brief threads to split a frame between, NULL == the ones
+     *  shared by the process. Only used by the tiled operations.
+     */
+    virtual void setTileWorkers(TileWorkers*) {}
   };
 
   enum SoftOpId
@@ -93,8 +97,11 @@ namespace lima
     SoftOpBaseClass*	m_opt;
   };
   
+  class _CorrectionTask;
+
   class LIMACORE_API SoftOpBackgroundSubstraction : public SoftOpBaseClass
   {
+    friend class _CorrectionTask;
   public:
     SoftOpBackgroundSubstraction();
     virtual ~SoftOpBackgroundSubstraction();
@@ -106,6 +113,8 @@ namespace lima
     virtual void prepare() {};
   private:
     Tasks::BackgroundSubstraction *m_opt;
+    Data			m_background;
+    int				m_version; // of the image
   };
 
   class LIMACORE_API SoftOpBinning : public SoftOpBaseClass
@@ -142,6 +151,7 @@ namespace lima
 
   class LIMACORE_API SoftOpFlatfieldCorrection : public SoftOpBaseClass
   {
+    friend class _CorrectionTask;
   public:
     SoftOpFlatfieldCorrection();
     virtual ~SoftOpFlatfieldCorrection();
@@ -153,6 +163,9 @@ namespace lima
     virtual void prepare() {};
   private:
     Tasks::FlatfieldCorrection *m_opt;
+    Data			m_flatfield;
+    bool			m_normalize;
+    int				m_version; // of the image
   };
 
   class LIMACORE_API SoftOpFlip : public SoftOpBaseClass
@@ -172,6 +185,7 @@ namespace lima
 
   class LIMACORE_API SoftOpMask : public SoftOpBaseClass
   {
+    friend class _CorrectionTask;
   public:
     enum Type {STANDARD,DUMMY};
     SoftOpMask();
@@ -185,6 +199,36 @@ namespace lima
     virtual void prepare() {};
   private:
     Tasks::Mask *m_opt;
+    Data	m_mask;
+    int		m_version; // of the image
+  };
+
+  /** @brief consecutive background substraction, flatfield correction
+   *  and standard mask stages, run by SoftOpExternalMgr as one link task
+   *  which reads and writes each pixel once.
+   *  The images are prepared once, SoftOpExternalMgr keeps the chain
+   *  until its operations or their images change.
+   */
+  class LIMACORE_API SoftOpCorrectionChain
+  {
+  public:
+    explicit SoftOpCorrectionChain(TileWorkers *workers = NULL);
+    ~SoftOpCorrectionChain();
+
+    static bool isFusable(const SoftOpInstance&);
+    void add(const SoftOpInstance&);
+    /** @brief the chain was built from these instances, in this order,
+     *  and none of their images was set since.
+     */
+    bool isUpToDate(const std::list<SoftOpInstance>&) const;
+    bool addTo(TaskMgr&,int stage);
+
+  private:
+    SoftOpCorrectionChain(const SoftOpCorrectionChain&);
+    SoftOpCorrectionChain& operator=(const SoftOpCorrectionChain&);
+
+    _CorrectionTask*		m_task;
+    std::list<SoftOpBaseClass*>	m_ops;
   };
 
   template <class Manager, class Task>
@@ -324,10 +368,15 @@ namespace lima
     {
       for (NameMapIterator i = begin(); i != end(); ++i)
 	aMgr.addSinkTask(stage, i->second.second);
-      ++m_counter_status;
+      incCounterStatus();
       return !m_manager_tasks.empty();
     }
 
+    void incCounterStatus()
+    {
+      ++m_counter_status;
+    }
+
     int getCounterStatus() const
     {
       return m_counter_status;
@@ -349,9 +398,12 @@ namespace lima
     std::string m_compat_format;
   };
 
+  class _RoiSweepTask;
+
   class LIMACORE_API SoftOpRoiCounter : public SoftOpBaseClass
   {
     DEB_CLASS_NAMESPC(DebModControl,"SoftwareOperation","SoftOpRoiCounter");
+    friend class _RoiSweepTask;
   public:
     typedef std::pair<int,std::list<Tasks::RoiCounterResult> > RoiIdAndResults;
     typedef std::pair<int,Roi> RoiIdAndRoi;
@@ -362,6 +414,38 @@ namespace lima
     typedef std::pair<std::string,Tasks::RoiCounterTask*> RoiNameAndTask;
     typedef std::list<RoiNameAndTask> RoiNameAndTaskList;
 
+    /** How the counters of the rectangular rois are computed.
+     * PER_ROI: one processlib task per roi, each scanning its own rectangle.
+     * SINGLE_PASS: one row sweep over the image updates all rectangular
+     * rois together (sum, sum of squares, min and max per roi segment),
+     * each pixel is read once whatever the number of overlapping rois,
+     * plus O(segments.log(segments)) per row for the segment tables.
+     * Each arc roi keeps the PixelWeightLut of its pixels.
+     * Lut and mask rois are always computed by their own task.
+     */
+    enum Engine {PER_ROI,SINGLE_PASS};
+
+    /** Counters of several frames, one contiguous array per statistic.
+     * Arrays have one row per roi (in names order) and one column per
+     * frame, so a row is the time series of a roi.
+     * Sequences are monotonic for the lifetime of the SoftOpRoiCounter,
+     * a frame gets the sequence number once all its rois are counted.
+     */
+    struct LIMACORE_API CounterColumns
+    {
+      CounterColumns() : firstSequence(0),nextSequence(0) {}
+
+      long long			firstSequence; ///< sequence of the first column
+      long long			nextSequence; ///< cursor for the next read
+      std::list<std::string>	names;	///< roi of each row
+      Data			frameNumbers; ///< Data::INT32 [nb frames]
+      Data			sum;	///< Data::DOUBLE [nb rois x nb frames]
+      Data			average;
+      Data			std;
+      Data			minValue;
+      Data			maxValue;
+    };
+
     SoftOpRoiCounter();
     virtual ~SoftOpRoiCounter();
 
@@ -394,6 +478,12 @@ namespace lima
     void getTasks(RoiNameAndTaskList&);
 
     void readCounters(int from,std::list<RoiNameAndResults> &result) const;
+    /** Counters of the frames from fromSequence (included), only the rois
+     * defined at the acquisition start and the last getBufferSize() frames
+     * are kept.
+     */
+    void readCounterColumns(long long fromSequence,
+			    CounterColumns& columns) const;
 
     void removeRois(const std::list<std::string>& names);
     void clearAllRois();		/* clear all roi */
@@ -406,6 +496,9 @@ namespace lima
 
     void setBufferSize(int size);
     void getBufferSize(int &size) const;
+
+    void setEngine(Engine engine);
+    void getEngine(Engine& engine) const;
     
   protected:
     virtual bool addTo(TaskMgr&,int stage);
@@ -417,8 +510,17 @@ namespace lima
     typedef TaskMap::NameMapIterator NameMapIterator;
     typedef TaskMap::NameMapConstIterator NameMapConstIterator;
 
+    class _CounterRing;
+    class _CounterRingCbk;
+    typedef std::map<std::string,_CounterRingCbk*> RingCbkMap;
+    class _ArcLut;
+    typedef std::map<std::string,_ArcLut*> ArcLutMap;
+
     void _get_or_create(const std::string& roi_name,
 			SoftManager *&, SoftTask *&);
+    void _remove_ring_cbk(RingCbkMap::iterator);
+    void _clear_sweep_task();
+    void _remove_arc_lut(const std::string& roi_name);
 
     template <SoftTask::type roi_type, class R>
     void _get_rois_of_type(std::list<std::pair<std::string, R> >& names_rois) const;
@@ -428,6 +530,11 @@ namespace lima
     TaskMap			m_task_manager;
     int				m_history_size;
     Data			m_mask;
+    Engine			m_engine;
+    _CounterRing*		m_ring;
+    RingCbkMap			m_ring_cbks;
+    _RoiSweepTask*		m_sweep_task; // until the rois change
+    ArcLutMap			m_arc_luts;
     mutable Cond		m_cond;
   };
 
@@ -542,6 +649,8 @@ namespace lima
 #endif
 
 
+  class _ArcProfileTask;
+
   class LIMACORE_API SoftOpRoi2Spectrum : public SoftOpBaseClass
   {
     DEB_CLASS_NAMESPC(DebModControl,"SoftwareOperation","SoftOpRoi2Spectrum");
@@ -554,6 +663,25 @@ namespace lima
     typedef std::pair<std::string,int> RoiNameAndMode;
     typedef std::list<RoiNameAndTask> RoiNameAndTaskList;
 
+    enum ProfileMode {RADIAL,AZIMUTHAL};
+    /** 1D integrated profile of an arc: the weighted mean intensity of
+     * nbBins radial or azimuthal bins, each pixel split in
+     * subSampling x subSampling points (see PixelWeightLut).
+     */
+    struct LIMACORE_API ArcProfile
+    {
+      ArcProfile() : mode(RADIAL),nbBins(1),subSampling(1) {}
+      ArcProfile(const ArcRoi& aRoi,ProfileMode aMode,int aNbBins,
+		 int aSubSampling = 1) :
+	roi(aRoi),mode(aMode),nbBins(aNbBins),subSampling(aSubSampling) {}
+
+      ArcRoi		roi;
+      ProfileMode	mode;
+      int		nbBins;
+      int		subSampling;
+    };
+    typedef std::pair<std::string,ArcProfile> RoiNameAndArcProfile;
+
     SoftOpRoi2Spectrum();
     virtual ~SoftOpRoi2Spectrum();
 
@@ -580,6 +708,9 @@ namespace lima
     void setRoiModes(const std::list<RoiNameAndMode>& names_modes);
     void getRoiModes(std::list<RoiNameAndMode>& roi_modes) const;
 
+    void updateArcProfiles(const std::list<RoiNameAndArcProfile>&);
+    void getArcProfiles(std::list<RoiNameAndArcProfile>&) const;
+
     void getNames(std::list<std::string>& roi_names) const;
     void getTasks(RoiNameAndTaskList&);
 
@@ -608,11 +739,13 @@ namespace lima
     typedef NameTaskMap<SoftManager, SoftTask> TaskMap;
     typedef TaskMap::NameMapIterator NameMapIterator;
     typedef TaskMap::NameMapConstIterator NameMapConstIterator;
+    typedef NameTaskMap<SoftManager, _ArcProfileTask> ArcTaskMap;
 
     void _get_or_create(const std::string& roi_name,
 			SoftManager *&, SoftTask *&);
 
     TaskMap			m_task_manager;
+    ArcTaskMap			m_arc_task_manager;
     int				m_history_size;
     //Data			m_mask;
     mutable Cond		m_cond;
@@ -792,10 +925,36 @@ namespace lima
     SinkTaskBase* m_sink_task;
   };
 
+  class _MultiPeakTask;
+
   class LIMACORE_API SoftOpPeakFinder : public SoftOpBaseClass
   {
   public:
-    enum ComputingMode {MAXIMUM,CM};
+    /** MAXIMUM and CM give one peak per frame (processlib task).
+     * MULTI groups the pixels above the threshold in 8-connected
+     * components, each component of at least getMinPeakSize() pixels
+     * is a peak. The frame is labelled in stripes, by the tile workers
+     * given by SoftOpExternalMgr (by default the threads shared by the
+     * software operations), and the components cut by the stripe seams
+     * are merged.
+     */
+    enum ComputingMode {MAXIMUM,CM,MULTI};
+
+    /** A peak found in MULTI mode
+     */
+    struct LIMACORE_API Peak
+    {
+      Peak() : frameNumber(-1),x(0.),y(0.),
+	       intensity(0.),maxIntensity(0.),size(0) {}
+
+      int	frameNumber;
+      double	x;		///< intensity weighted centroid
+      double	y;
+      double	intensity;	///< integrated intensity
+      double	maxIntensity;
+      int	size;		///< number of pixels
+    };
+
     SoftOpPeakFinder();
     virtual ~SoftOpPeakFinder();
     
@@ -807,13 +966,25 @@ namespace lima
     void getBufferSize(int &size) const;
 
     void readPeaks(std::list<Tasks::PeakFinderResult> &result) const;
+    /** MULTI mode peaks of the frames from fromFrame (included), ordered
+     * by frame then by position of their first pixel. Only the last
+     * getBufferSize() frames are kept.
+     */
+    void readPeaks(int fromFrame,std::list<Peak> &peaks) const;
 
     void setComputingMode( ComputingMode);
     void getComputingMode( ComputingMode&) const;
 
+    void setThreshold(double threshold);
+    void getThreshold(double &threshold) const;
+
+    void setMinPeakSize(int nb_pixels);
+    void getMinPeakSize(int &nb_pixels) const;
+
   protected:
     virtual bool addTo(TaskMgr&,int stage);
-    virtual void prepare() {};
+    virtual void prepare();
+    virtual void setTileWorkers(TileWorkers*);
   private:
     typedef Tasks::PeakFinderTask SoftTask;
     typedef Tasks::PeakFinderManager SoftManager;
@@ -825,6 +996,8 @@ namespace lima
     int				m_history_size;
     //    LinkTask *m_opt;
     Tasks::PeakFinderTask *m_opt;
+    ComputingMode		m_mode;
+    _MultiPeakTask*		m_multi_task;
     mutable Cond		m_cond;
     
   };
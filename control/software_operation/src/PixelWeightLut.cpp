@@ -0,0 +1,371 @@
+//###########################################################################
+// This file is part of LImA, a Library for Image Acquisition
+//
+// Copyright (C) : 2009-2011
+// European Synchrotron Radiation Facility
+// BP 220, Grenoble 38043
+// FRANCE
+//
+// This is free software; you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation; either version 3 of the License, or
+// (at your option) any later version.
+//
+// This software is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program; if not, see <http://www.gnu.org/licenses/>.
+//###########################################################################
+#include "lima/PixelWeightLut.h"
+
+#include <algorithm>
+#include <cmath>
+#include <map>
+
+using namespace lima;
+
+static const int MAX_CACHED_LUTS = 32;
+
+struct _CacheEntry
+{
+  PixelWeightLut*	lut;
+  unsigned long		stamp;	// last use
+};
+typedef std::map<PixelWeightLut::Geometry,_CacheEntry> _Cache;
+
+struct _LutEntry
+{
+  int	bin;
+  int	pixel;
+  float	weight;
+};
+
+static Mutex		_cache_lock;
+static _Cache		_cache;
+static unsigned long	_cache_stamp = 0;
+
+//		    ******** PixelWeightLut::Geometry ********
+PixelWeightLut::Geometry::Geometry() :
+  profile(INTEGRAL),nbBins(1),subSampling(1),width(0),height(0)
+{
+}
+
+PixelWeightLut::Geometry::Geometry(const ArcRoi& aRoi,Profile aProfile,
+				   int aNbBins,int aSubSampling,
+				   int aWidth,int aHeight) :
+  roi(aRoi),profile(aProfile),
+  nbBins(std::max(aNbBins,1)),subSampling(std::max(aSubSampling,1)),
+  width(aWidth),height(aHeight)
+{
+  if(profile == INTEGRAL)
+    nbBins = 1;
+}
+
+bool PixelWeightLut::Geometry::operator <(const Geometry& o) const
+{
+  double key[12],okey[12];
+  const Geometry *geometries[2] = {this,&o};
+  double *keys[2] = {key,okey};
+  for(int i = 0;i < 2;++i)
+    {
+      const Geometry& g = *geometries[i];
+      double *k = keys[i];
+      g.roi.getCenter(k[0],k[1]);
+      g.roi.getRayons(k[2],k[3]);
+      g.roi.getAngles(k[4],k[5]);
+      k[6] = g.profile,k[7] = g.nbBins,k[8] = g.subSampling;
+      k[9] = g.width,k[10] = g.height,k[11] = 0.;
+    }
+  return std::lexicographical_compare(key,key + 12,okey,okey + 12);
+}
+
+//		    ******** PixelWeightLut ********
+PixelWeightLut* PixelWeightLut::get(const Geometry& geometry)
+{
+  AutoMutex aLock(_cache_lock);
+  _Cache::iterator i = _cache.find(geometry);
+  if(i == _cache.end())
+    {
+      // the build may be long, don't block the other geometries
+      aLock.unlock();
+      PixelWeightLut *lut = create(geometry);
+      PixelWeightLut *oldest_lut = NULL;
+      aLock.lock();
+      i = _cache.find(geometry);
+      if(i != _cache.end())	// built meanwhile
+	oldest_lut = lut;
+      else
+	{
+	  if(int(_cache.size()) >= MAX_CACHED_LUTS)
+	    {
+	      _Cache::iterator oldest = _cache.begin();
+	      for(_Cache::iterator j = _cache.begin();j != _cache.end();++j)
+		if(j->second.stamp < oldest->second.stamp)
+		  oldest = j;
+	      oldest_lut = oldest->second.lut;
+	      _cache.erase(oldest);
+	    }
+	  _CacheEntry entry;
+	  entry.lut = lut;
+	  i = _cache.insert(_Cache::value_type(geometry,entry)).first;
+	}
+      i->second.stamp = ++_cache_stamp;
+      i->second.lut->ref();
+      lut = i->second.lut;
+      aLock.unlock();
+      if(oldest_lut)
+	oldest_lut->unref();
+      return lut;
+    }
+  i->second.stamp = ++_cache_stamp;
+  i->second.lut->ref();
+  return i->second.lut;
+}
+
+PixelWeightLut* PixelWeightLut::create(const Geometry& geometry)
+{
+  return new PixelWeightLut(geometry);
+}
+
+void PixelWeightLut::clearCache()
+{
+  AutoMutex aLock(_cache_lock);
+  for(_Cache::iterator i = _cache.begin();i != _cache.end();++i)
+    i->second.lut->unref();
+  _cache.clear();
+}
+
+PixelWeightLut::PixelWeightLut(const Geometry& geometry) :
+  m_geometry(geometry),
+  m_ref_count(1)
+{
+  _build();
+}
+
+PixelWeightLut::~PixelWeightLut()
+{
+}
+
+void PixelWeightLut::ref()
+{
+  AutoMutex aLock(m_lock);
+  ++m_ref_count;
+}
+
+void PixelWeightLut::unref()
+{
+  AutoMutex aLock(m_lock);
+  if(--m_ref_count)
+    return;
+  aLock.unlock();
+  delete this;
+}
+
+/** @brief pixel weights of each bin, from the sub pixel sampling
+ */
+void PixelWeightLut::_build()
+{
+  const Geometry& g = m_geometry;
+  double center_x,center_y,rayon1,rayon2,start,end;
+  g.roi.getCenter(center_x,center_y);
+  g.roi.getRayons(rayon1,rayon2);
+  g.roi.getAngles(start,end);
+  if(rayon1 > rayon2)
+    std::swap(rayon1,rayon2);
+  double span = fmod(end - start,360.);
+  if(span <= 0.)
+    span += 360.;
+
+  int nb_bins = g.nbBins;
+  m_bin_offsets.assign(nb_bins + 1,0);
+  m_bin_weights.assign(nb_bins,0.);
+  if(g.roi.isEmpty() || rayon2 <= rayon1)
+    return;
+
+  int x_begin = std::max(0,int(floor(center_x - rayon2)));
+  int x_end = std::min(g.width,int(ceil(center_x + rayon2)) + 1);
+  int y_begin = std::max(0,int(floor(center_y - rayon2)));
+  int y_end = std::min(g.height,int(ceil(center_y + rayon2)) + 1);
+
+  std::vector<_LutEntry> entries;
+  std::vector<std::pair<int,int> > pixel_bins; // bin, nb points
+  int n = g.subSampling;
+  double step = 1. / n,point_weight = 1. / (n * n);
+  double rad2deg = 180. / M_PI;
+  for(int y = y_begin;y < y_end;++y)
+    for(int x = x_begin;x < x_end;++x)
+      {
+	pixel_bins.clear();
+	for(int sy = 0;sy < n;++sy)
+	  {
+	    double dy = y - 0.5 + (sy + 0.5) * step - center_y;
+	    for(int sx = 0;sx < n;++sx)
+	      {
+		double dx = x - 0.5 + (sx + 0.5) * step - center_x;
+		double r = sqrt(dx * dx + dy * dy);
+		if(r < rayon1 || r >= rayon2)
+		  continue;
+		double angle = fmod(atan2(dy,dx) * rad2deg - start,360.);
+		if(angle < 0.)
+		  angle += 360.;
+		if(angle >= span)
+		  continue;
+
+		int bin;
+		switch(g.profile)
+		  {
+		  case RADIAL:
+		    bin = int((r - rayon1) / (rayon2 - rayon1) * nb_bins); break;
+		  case AZIMUTHAL:
+		    bin = int(angle / span * nb_bins); break;
+		  default:
+		    bin = 0; break;
+		  }
+		bin = std::min(bin,nb_bins - 1);
+		unsigned int k = 0;
+		while(k < pixel_bins.size() && pixel_bins[k].first != bin) ++k;
+		if(k == pixel_bins.size())
+		  pixel_bins.push_back(std::pair<int,int>(bin,0));
+		++pixel_bins[k].second;
+	      }
+	  }
+	for(unsigned int k = 0;k < pixel_bins.size();++k)
+	  {
+	    _LutEntry entry = {pixel_bins[k].first,y * g.width + x,
+			   float(pixel_bins[k].second * point_weight)};
+	    entries.push_back(entry);
+	    ++m_bin_offsets[entry.bin + 1];
+	  }
+      }
+
+  // counting sort by bin, pixels stay in memory order inside a bin
+  for(int b = 0;b < nb_bins;++b)
+    m_bin_offsets[b + 1] += m_bin_offsets[b];
+  std::vector<int> positions(m_bin_offsets.begin(),m_bin_offsets.end() - 1);
+  m_pixels.resize(entries.size());
+  m_weights.resize(entries.size());
+  for(std::vector<_LutEntry>::iterator i = entries.begin();i != entries.end();++i)
+    {
+      int position = positions[i->bin]++;
+      m_pixels[position] = i->pixel;
+      m_weights[position] = i->weight;
+      m_bin_weights[i->bin] += i->weight;
+    }
+}
+
+bool PixelWeightLut::_check(const Data& src,const Data& mask) const
+{
+  if(src.dimensions.size() != 2 ||
+     src.dimensions[0] != m_geometry.width ||
+     src.dimensions[1] != m_geometry.height)
+    return false;
+  return mask.empty() || (mask.depth() == 1 &&
+			  mask.dimensions == src.dimensions);
+}
+
+/** @brief sparse-dense product of a bin, with four independent sums
+ *  to hide the latency of the indexed loads
+ */
+template<class INPUT>
+static inline double _bin_sum(const INPUT *src,const int *pixels,
+			      const float *weights,int nb)
+{
+  double sum0 = 0.,sum1 = 0.,sum2 = 0.,sum3 = 0.;
+  int i = 0;
+  for(;i + 4 <= nb;i += 4)
+    {
+      sum0 += weights[i] * double(src[pixels[i]]);
+      sum1 += weights[i + 1] * double(src[pixels[i + 1]]);
+      sum2 += weights[i + 2] * double(src[pixels[i + 2]]);
+      sum3 += weights[i + 3] * double(src[pixels[i + 3]]);
+    }
+  for(;i < nb;++i)
+    sum0 += weights[i] * double(src[pixels[i]]);
+  return (sum0 + sum1) + (sum2 + sum3);
+}
+
+template<class INPUT>
+void PixelWeightLut::_profile(const INPUT *src,const char *mask,
+			      double *bins) const
+{
+  int nb_bins = m_geometry.nbBins;
+  for(int b = 0;b < nb_bins;++b)
+    {
+      int begin = m_bin_offsets[b],nb = m_bin_offsets[b + 1] - begin;
+      const int *pixels = &m_pixels[0] + begin;
+      const float *weights = &m_weights[0] + begin;
+      double sum,weight;
+      if(!mask)
+	{
+	  sum = nb ? _bin_sum(src,pixels,weights,nb) : 0.;
+	  weight = m_bin_weights[b];
+	}
+      else
+	{
+	  sum = weight = 0.;
+	  for(int i = 0;i < nb;++i)
+	    if(mask[pixels[i]])
+	      sum += weights[i] * double(src[pixels[i]]),weight += weights[i];
+	}
+      bins[b] = weight > 0. ? sum / weight : 0.;
+    }
+}
+
+template<class INPUT>
+void PixelWeightLut::_stats(const INPUT *src,const char *mask,
+			    Stats& stats) const
+{
+  stats.sum = stats.sum2 = stats.weight = 0.;
+  stats.min = stats.max = 0.;
+  bool first = true;
+  for(int i = m_bin_offsets[0];i < m_bin_offsets[1];++i)
+    {
+      int pixel = m_pixels[i];
+      if(mask && !mask[pixel])
+	continue;
+      double value = src[pixel],weight = m_weights[i];
+      stats.sum += weight * value;
+      stats.sum2 += weight * value * value;
+      stats.weight += weight;
+      if(first || value < stats.min) stats.min = value;
+      if(first || value > stats.max) stats.max = value;
+      first = false;
+    }
+}
+
+#define LUT_DISPATCH(func,...)						\
+  switch(src.type)							\
+    {									\
+    case Data::UINT8: func((const unsigned char*)src.data(),__VA_ARGS__); break; \
+    case Data::INT8: func((const char*)src.data(),__VA_ARGS__); break;	\
+    case Data::UINT16: func((const unsigned short*)src.data(),__VA_ARGS__); break; \
+    case Data::INT16: func((const short*)src.data(),__VA_ARGS__); break; \
+    case Data::UINT32: func((const unsigned int*)src.data(),__VA_ARGS__); break; \
+    case Data::INT32: func((const int*)src.data(),__VA_ARGS__); break;	\
+    case Data::FLOAT: func((const float*)src.data(),__VA_ARGS__); break; \
+    case Data::DOUBLE: func((const double*)src.data(),__VA_ARGS__); break; \
+    default: return false;						\
+    }
+
+bool PixelWeightLut::profile(const Data& src,const Data& mask,
+			     double *bins) const
+{
+  if(!_check(src,mask))
+    return false;
+  const char *maskPt = (const char*)mask.data();
+  LUT_DISPATCH(_profile,maskPt,bins);
+  return true;
+}
+
+bool PixelWeightLut::stats(const Data& src,const Data& mask,
+			   Stats& stats) const
+{
+  if(!_check(src,mask))
+    return false;
+  const char *maskPt = (const char*)mask.data();
+  LUT_DISPATCH(_stats,maskPt,stats);
+  return true;
+}
@@ -50,12 +50,15 @@ static SoftOpKey getSoftOpKey(SoftOpId anId)
 
 SoftOpExternalMgr::SoftOpExternalMgr() :
   m_end_link_callback(NULL),
-  m_end_sink_callback(NULL)
+  m_end_sink_callback(NULL),
+  m_fuse_corrections(true),
+  m_tile_workers(NULL)
 {
 }
 
 SoftOpExternalMgr::~SoftOpExternalMgr()
 {
+  _clearCorrectionChains();
   if(m_end_link_callback)
     m_end_link_callback->unref();
   if(m_end_sink_callback)
@@ -108,6 +111,7 @@ void SoftOpExternalMgr::addOp(SoftOpId aSoftOpId,
 
   AutoMutex aLock(m_cond.mutex());
   _checkIfPossible(aSoftOpId,aStage);
+  _clearCorrectionChains();
   SoftOpInstance newInstance(getSoftOpKey(aSoftOpId),anAlias);
   
   switch(aSoftOpId)
@@ -158,6 +162,7 @@ void SoftOpExternalMgr::addOp(SoftOpId aSoftOpId,
     default:
       THROW_CTL_ERROR(InvalidValue) << "Not yet managed";
     }
+  newInstance.m_opt->setTileWorkers(m_tile_workers);
   std::pair<Stage2Instance::iterator,bool> aResult = 
     m_stage2instance.insert(std::pair<stage,std::list<SoftOpInstance> >(aStage,std::list<SoftOpInstance>()));
   aResult.first->second.push_back(newInstance);
@@ -175,6 +180,7 @@ void SoftOpExternalMgr::delOp(const alias &anAlias)
 	{
 	  if(k->m_alias == anAlias)
 	    {
+	      _clearCorrectionChains();
 	      delete k->m_opt;
 	      i->second.erase(k);
 	      if(i->second.empty())
@@ -238,6 +244,34 @@ void SoftOpExternalMgr::addTo(TaskMgr &aTaskMgr,
   for(Stage2Instance::iterator i = m_stage2instance.begin();
       i != m_stage2instance.end();++i,++nextStage)
     {
+      if(m_fuse_corrections && _isCorrectionStage(i))
+	{
+	  Stage2Instance::iterator next = i;
+	  if(++next != m_stage2instance.end() && _isCorrectionStage(next))
+	    {
+	      int first_stage = i->first;
+	      std::list<SoftOpInstance> aCorrections(1,i->second.front());
+	      for(;next != m_stage2instance.end() && _isCorrectionStage(next);
+		  i = next++)
+		aCorrections.push_back(next->second.front());
+
+	      SoftOpCorrectionChain *&aChainPt = m_correction_chains[first_stage];
+	      if(!aChainPt || !aChainPt->isUpToDate(aCorrections))
+		{
+		  DEB_TRACE() << "Fuse corrections from stage " << first_stage
+			      << " up to stage " << i->first;
+		  delete aChainPt;
+		  aChainPt = new SoftOpCorrectionChain(m_tile_workers);
+		  for(std::list<SoftOpInstance>::const_iterator k =
+			aCorrections.begin();k != aCorrections.end();++k)
+		    aChainPt->add(*k);
+		}
+	      aChainPt->addTo(aTaskMgr,nextStage);
+	      last_link_task = nextStage;
+	      continue;
+	    }
+	}
+
       for(std::list<SoftOpInstance>::const_iterator k = i->second.begin();
 	  k != i->second.end();++k)
 	{
@@ -267,6 +301,56 @@ void SoftOpExternalMgr::addTo(TaskMgr &aTaskMgr,
   DEB_RETURN() << DEB_VAR2(last_link_task,last_sink_task);
 }
 
+void SoftOpExternalMgr::setFuseCorrections(bool fuse)
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR1(fuse);
+
+  AutoMutex aLock(m_cond.mutex());
+  m_fuse_corrections = fuse;
+  _clearCorrectionChains();
+}
+
+void SoftOpExternalMgr::getFuseCorrections(bool &fuse) const
+{
+  AutoMutex aLock(m_cond.mutex());
+  fuse = m_fuse_corrections;
+}
+
+void SoftOpExternalMgr::setTileWorkers(TileWorkers *workers)
+{
+  DEB_MEMBER_FUNCT();
+
+  AutoMutex aLock(m_cond.mutex());
+  m_tile_workers = workers;
+  _clearCorrectionChains();
+  for(Stage2Instance::iterator i = m_stage2instance.begin();
+      i != m_stage2instance.end();++i)
+    for(std::list<SoftOpInstance>::iterator k = i->second.begin();
+	k != i->second.end();++k)
+      k->m_opt->setTileWorkers(workers);
+}
+
+/** @brief the stage only holds a correction which can be fused,
+ *  sink tasks would need the intermediate image.
+ */
+bool SoftOpExternalMgr::_isCorrectionStage(Stage2Instance::const_iterator i) const
+{
+  return i->second.size() == 1 &&
+    SoftOpCorrectionChain::isFusable(i->second.front());
+}
+
+/** @brief the fused chains are built again by the next addTo,
+ *  the frames being processed keep their task
+ */
+void SoftOpExternalMgr::_clearCorrectionChains()
+{
+  for(CorrectionChains::iterator i = m_correction_chains.begin();
+      i != m_correction_chains.end();++i)
+    delete i->second;
+  m_correction_chains.clear();
+}
+
 void SoftOpExternalMgr::_checkIfPossible(SoftOpId aSoftOpId,
 					 int stage)
 {
@@ -20,15 +20,49 @@
 // along with this program; if not, see <http://www.gnu.org/licenses/>.
 //###########################################################################
 #include "lima/SoftOpId.h"
+#include "lima/PixelWeightLut.h"
 using namespace lima;
 #include "processlib/BackgroundSubstraction.h"
 
+#include <algorithm>
+#include <cmath>
+#include <limits>
+#include <vector>
+#include <map>
+#ifdef __unix
+#include <unistd.h>
+#endif
+
+/** persistent threads shared by the tiled software operations of the
+ *  process. A frame which finds them busy is processed by its own
+ *  thread, so concurrent frames never wait for each other.
+ */
+static const int MAX_WORKER_THREADS = 8;
+static TileWorkers *_soft_op_workers = NULL;
+
+static void _init_soft_op_workers()
+{
+  int nb_threads = 1;
+#ifdef __unix
+  nb_threads = int(sysconf(_SC_NPROCESSORS_ONLN));
+#endif
+  nb_threads = std::max(1,std::min(nb_threads,MAX_WORKER_THREADS));
+  _soft_op_workers = new TileWorkers(nb_threads - 1);
+}
+
+static TileWorkers& _get_soft_op_workers()
+{
+  EXEC_ONCE(_init_soft_op_workers());
+  return *_soft_op_workers;
+}
+
 //-------------------- BACKGROUND SUBSTRACTION --------------------
 				   
 /** @brief small wrapper around BackgroundSubstraction Task
  */
 SoftOpBackgroundSubstraction::SoftOpBackgroundSubstraction() : 
-  SoftOpBaseClass()
+  SoftOpBaseClass(),
+  m_version(0)
 {
   m_opt = new Tasks::BackgroundSubstraction();
   m_opt->setProcessingInPlace(false);
@@ -42,6 +76,8 @@ SoftOpBackgroundSubstraction::~SoftOpBackgroundSubstraction()
 void SoftOpBackgroundSubstraction::setBackgroundImage(Data &anImage)
 {
   m_opt->setBackgroundImageData(anImage);
+  m_background = anImage;
+  ++m_version;
 }
 
 bool SoftOpBackgroundSubstraction::addTo(TaskMgr &aMgr,int stage)
@@ -124,7 +160,9 @@ void SoftOpBpm::prepare()
 /** @brief small wrapper around FlatfieldCorrection Task
  */
 SoftOpFlatfieldCorrection::SoftOpFlatfieldCorrection() : 
-  SoftOpBaseClass()
+  SoftOpBaseClass(),
+  m_normalize(true),
+  m_version(0)
 {
   m_opt = new Tasks::FlatfieldCorrection();
   m_opt->setProcessingInPlace(false);
@@ -138,6 +176,9 @@ SoftOpFlatfieldCorrection::~SoftOpFlatfieldCorrection()
 void SoftOpFlatfieldCorrection::setFlatFieldImage(Data &aData,bool normalize)
 {
   m_opt->setFlatFieldImageData(aData,normalize);
+  m_flatfield = aData;
+  m_normalize = normalize;
+  ++m_version;
 }
 
 bool SoftOpFlatfieldCorrection::addTo(TaskMgr &aMgr,int stage)
@@ -186,7 +227,8 @@ bool SoftOpFlip::addTo(TaskMgr &aMgr,int stage)
 /** @brief small wrapper around Mask Task
  */
 SoftOpMask::SoftOpMask() : 
-  SoftOpBaseClass()
+  SoftOpBaseClass(),
+  m_version(0)
 {
   m_opt = new Tasks::Mask();
   m_opt->setProcessingInPlace(false);
@@ -200,6 +242,8 @@ SoftOpMask::~SoftOpMask()
 void SoftOpMask::setMaskImage(Data &mask)
 {
   m_opt->setMaskImageData(mask);
+  m_mask = mask;
+  ++m_version;
 }
 
 void SoftOpMask::setType(SoftOpMask::Type aType)
@@ -222,28 +266,1026 @@ bool SoftOpMask::addTo(TaskMgr &aMgr,int stage)
   return true;
 }
 
+//-------------------- CORRECTION CHAIN --------------------
+
+/** @brief background substraction, flatfield correction and mask in
+ *  one pass.
+ *
+ *  The frame is cut in tiles shared by the software operation threads.
+ *  A tile is read by blocks which stay in the L1 cache while each correction is
+ *  applied, in the stage order, by its own loop over the block:
+ *   - background: value > background ? value - background : 0
+ *   - flatfield: value * gain, with gain = 1 / flatfield (or
+ *     mean / flatfield when normalized) and 0 on null flatfield pixels
+ *   - mask: value if the mask pixel is set, else 0
+ *  The value is converted to the frame type after each correction, as
+ *  done by the separated tasks. Frames which don't match the correction
+ *  images are given to the original tasks, one after the other.
+ */
+class lima::_CorrectionTask : public LinkTask
+{
+public:
+  enum {TILE_SIZE = 64 * 1024,BLOCK_SIZE = 1024};
+  enum Type {BACKGROUND,FLATFIELD,MASK};
+
+  _CorrectionTask(TileWorkers *workers) :
+    LinkTask(false),m_workers(workers) {}
+
+  virtual ~_CorrectionTask()
+  {
+    for(std::vector<_Op>::iterator i = m_ops.begin();i != m_ops.end();++i)
+      i->task->unref();
+  }
+
+  void add(SoftOpBackgroundSubstraction &op)
+  {
+    _Op &anOp = _add(BACKGROUND,op.m_opt,op.m_background,op.m_version);
+    anOp.image = op.m_background;
+  }
+
+  void add(SoftOpFlatfieldCorrection &op)
+  {
+    _Op &anOp = _add(FLATFIELD,op.m_opt,op.m_flatfield,op.m_version);
+    if(op.m_flatfield.empty())
+      return;
+    Data flat = op.m_flatfield.cast(Data::DOUBLE);
+    const double *flatPt = (const double*)flat.data();
+    int nb_pixels = _nbPixels(flat);
+    double mean = 1.;
+    if(op.m_normalize)
+      {
+	double sum = 0.;
+	for(int i = 0;i < nb_pixels;++i)
+	  sum += flatPt[i];
+	mean = nb_pixels ? sum / nb_pixels : 1.;
+      }
+    anOp.gain.resize(nb_pixels);
+    for(int i = 0;i < nb_pixels;++i)
+      anOp.gain[i] = flatPt[i] != 0. ? mean / flatPt[i] : 0.;
+  }
+
+  void add(SoftOpMask &op)
+  {
+    _Op &anOp = _add(MASK,op.m_opt,op.m_mask,op.m_version);
+    if(op.m_mask.empty())
+      return;
+    Data mask = op.m_mask.cast(Data::DOUBLE);
+    const double *maskPt = (const double*)mask.data();
+    int nb_pixels = _nbPixels(mask);
+    anOp.keep.resize(nb_pixels);
+    for(int i = 0;i < nb_pixels;++i)
+      anOp.keep[i] = maskPt[i] != 0.;
+  }
+
+  /** @brief none of the images was set since the task was built
+   */
+  bool isUpToDate() const
+  {
+    for(std::vector<_Op>::const_iterator i = m_ops.begin();i != m_ops.end();++i)
+      if(*i->version != i->built_version)
+	return false;
+    return true;
+  }
+
+  virtual Data process(Data &aData)
+  {
+    if(!_isManaged(aData))
+      {
+	Data aResult = aData;
+	for(std::vector<_Op>::iterator i = m_ops.begin();i != m_ops.end();++i)
+	  aResult = i->task->process(aResult);
+	return aResult;
+      }
+
+    Data aNewData = aData;
+    if(!_processingInPlaceFlag)
+      {
+	aNewData = aData.mask();
+	Buffer *aNewBuffer = new Buffer(aData.size());
+	aNewData.setBuffer(aNewBuffer);
+	aNewBuffer->unref();
+      }
+    switch(aData.type)
+      {
+      case Data::UINT8:	 _correct<unsigned char>(aData,aNewData); break;
+      case Data::INT8:	 _correct<char>(aData,aNewData); break;
+      case Data::UINT16: _correct<unsigned short>(aData,aNewData); break;
+      case Data::INT16:	 _correct<short>(aData,aNewData); break;
+      case Data::UINT32: _correct<unsigned int>(aData,aNewData); break;
+      case Data::INT32:	 _correct<int>(aData,aNewData); break;
+      case Data::FLOAT:	 _correct<float>(aData,aNewData); break;
+      case Data::DOUBLE: _correct<double>(aData,aNewData); break;
+      default: break;
+      }
+    return aNewData;
+  }
+
+private:
+  struct _Op
+  {
+    Type		type;
+    Data		image;	// background
+    std::vector<double>	gain;	// flatfield
+    std::vector<char>	keep;	// mask
+    std::vector<int>	dimensions;
+    LinkTask*		task;
+    const int*		version; // of the operation image
+    int			built_version;
+  };
+
+  template<class INPUT>
+  class _Job : public TileWorkers::Job
+  {
+  public:
+    _Job(const std::vector<_Op> &ops,const Data &src,Data &dst) :
+      m_ops(ops),
+      m_src((const INPUT*)src.data()),m_dst((INPUT*)dst.data()),
+      m_nb_pixels(_nbPixels(src)) {}
+
+    int nbTiles() const {return (m_nb_pixels + TILE_SIZE - 1) / TILE_SIZE;}
+
+    virtual void process(int tile)
+    {
+      int end = std::min(m_nb_pixels,(tile + 1) * int(TILE_SIZE));
+      double block[BLOCK_SIZE];
+      for(int begin = tile * TILE_SIZE;begin < end;begin += BLOCK_SIZE)
+	{
+	  int nb = std::min(end - begin,int(BLOCK_SIZE));
+	  const INPUT *src = m_src + begin;
+	  for(int i = 0;i < nb;++i)
+	    block[i] = src[i];
+	  for(typename std::vector<_Op>::const_iterator op = m_ops.begin();
+	      op != m_ops.end();++op)
+	    switch(op->type)
+	      {
+	      case BACKGROUND:
+		if(!op->image.empty())
+		  {
+		    const INPUT *bg = (const INPUT*)op->image.data() + begin;
+		    for(int i = 0;i < nb;++i)
+		      {
+			double value = block[i],background = bg[i];
+			block[i] = value > background ? value - background : 0.;
+		      }
+		  }
+		break;
+	      case FLATFIELD:
+		if(!op->gain.empty())
+		  {
+		    const double *gain = &op->gain[begin];
+		    for(int i = 0;i < nb;++i)
+		      block[i] = INPUT(block[i] * gain[i]);
+		  }
+		break;
+	      case MASK:
+		if(!op->keep.empty())
+		  {
+		    const char *keep = &op->keep[begin];
+		    for(int i = 0;i < nb;++i)
+		      block[i] = keep[i] ? block[i] : 0.;
+		  }
+		break;
+	      }
+	  INPUT *dst = m_dst + begin;
+	  for(int i = 0;i < nb;++i)
+	    dst[i] = INPUT(block[i]);
+	}
+    }
+
+  private:
+    const std::vector<_Op>&	m_ops;
+    const INPUT*		m_src;
+    INPUT*			m_dst;
+    int				m_nb_pixels;
+  };
+
+  static int _nbPixels(const Data &aData)
+  {
+    int nb_pixels = 1;
+    for(unsigned int i = 0;i < aData.dimensions.size();++i)
+      nb_pixels *= aData.dimensions[i];
+    return aData.dimensions.empty() ? 0 : nb_pixels;
+  }
+
+  _Op& _add(Type type,LinkTask *task,const Data &image,const int &version)
+  {
+    _Op anOp;
+    anOp.type = type;
+    anOp.dimensions = image.dimensions;
+    anOp.task = task;
+    anOp.version = &version;
+    anOp.built_version = version;
+    task->ref();
+    m_ops.push_back(anOp);
+    return m_ops.back();
+  }
+
+  bool _isManaged(const Data &aData) const
+  {
+    if(aData.dimensions.size() != 2 || aData.empty())
+      return false;
+    for(std::vector<_Op>::const_iterator i = m_ops.begin();i != m_ops.end();++i)
+      {
+	bool unset = i->image.empty() && i->gain.empty() && i->keep.empty();
+	if(unset)
+	  continue;
+	if(i->dimensions != aData.dimensions ||
+	   (i->type == BACKGROUND && i->image.type != aData.type))
+	  return false;
+      }
+    return true;
+  }
+
+  template<class INPUT>
+  void _correct(Data &src,Data &dst)
+  {
+    _Job<INPUT> job(m_ops,src,dst);
+    TileWorkers &workers = m_workers ? *m_workers : _get_soft_op_workers();
+    workers.run(job,job.nbTiles());
+  }
+
+  std::vector<_Op>	m_ops;
+  TileWorkers*		m_workers;
+};
+
+SoftOpCorrectionChain::SoftOpCorrectionChain(TileWorkers *workers) :
+  m_task(new _CorrectionTask(workers))
+{
+}
+
+SoftOpCorrectionChain::~SoftOpCorrectionChain()
+{
+  m_task->unref();
+}
+
+/** @brief the instance is a correction which can be fused
+ */
+bool SoftOpCorrectionChain::isFusable(const SoftOpInstance &anInstance)
+{
+  switch(anInstance.m_key.m_id)
+    {
+    case BACKGROUNDSUBSTRACTION:
+    case FLATFIELDCORRECTION:
+      return true;
+    case MASK:
+      {
+	SoftOpMask::Type aType;
+	static_cast<SoftOpMask*>(anInstance.m_opt)->getType(aType);
+	return aType == SoftOpMask::STANDARD;
+      }
+    default:
+      return false;
+    }
+}
+
+/** @brief add the correction of the next stage
+ */
+void SoftOpCorrectionChain::add(const SoftOpInstance &anInstance)
+{
+  m_ops.push_back(anInstance.m_opt);
+  switch(anInstance.m_key.m_id)
+    {
+    case BACKGROUNDSUBSTRACTION:
+      m_task->add(*static_cast<SoftOpBackgroundSubstraction*>(anInstance.m_opt));
+      break;
+    case FLATFIELDCORRECTION:
+      m_task->add(*static_cast<SoftOpFlatfieldCorrection*>(anInstance.m_opt));
+      break;
+    case MASK:
+      m_task->add(*static_cast<SoftOpMask*>(anInstance.m_opt));
+      break;
+    default:
+      break;
+    }
+}
+
+bool SoftOpCorrectionChain::isUpToDate(const std::list<SoftOpInstance> &instances) const
+{
+  if(instances.size() != m_ops.size())
+    return false;
+  std::list<SoftOpBaseClass*>::const_iterator op = m_ops.begin();
+  for(std::list<SoftOpInstance>::const_iterator i = instances.begin();
+      i != instances.end();++i,++op)
+    if(i->m_opt != *op)
+      return false;
+  return m_task->isUpToDate();
+}
+
+bool SoftOpCorrectionChain::addTo(TaskMgr &aMgr,int stage)
+{
+  aMgr.setLinkTask(stage,m_task);
+  return true;
+}
+
 //-------------------- ROI COUNTERS --------------------
 
+/** @brief columnar history of the roi counters.
+ *
+ *  One ring of getBufferSize() frames per statistic and per roi
+ *  (column), filled in any order by the counter tasks. A frame is
+ *  published, i.e. gets a sequence number, when all the live columns
+ *  have reported it; frames still incomplete when the ring wraps are
+ *  published as they are, missing values being NaN.
+ */
+class SoftOpRoiCounter::_CounterRing
+{
+public:
+  enum {SUM,AVERAGE,STD,MIN,MAX,NB_STATS};
+
+  _CounterRing() : m_nb_live(0),m_capacity(0),
+		   m_first_pending(0),m_last_frame(-1),m_seq_base(0) {}
+
+  void reset(const std::list<std::string>& names,int capacity)
+  {
+    AutoMutex aLock(m_mutex);
+    m_seq_base += m_first_pending;
+    m_first_pending = 0;
+    m_last_frame = -1;
+    m_names = names;
+    m_nb_live = names.size();
+    m_live.assign(m_nb_live,true);
+    m_capacity = std::max(capacity,1);
+    int nb_cells = m_nb_live * m_capacity;
+    for(int i = 0;i < NB_STATS;++i)
+      m_stats[i].assign(nb_cells,0.);
+    m_cell_frames.assign(nb_cells,-1);
+    m_row_frames.assign(m_capacity,-1);
+    m_row_counts.assign(m_capacity,0);
+  }
+
+  void setResult(int column,const Tasks::RoiCounterResult& result)
+  {
+    AutoMutex aLock(m_mutex);
+    int frame = result.frameNumber;
+    if(column < 0 || column >= int(m_live.size()) || !m_live[column] ||
+       frame < m_first_pending)
+      return;
+    if(frame >= m_first_pending + m_capacity) // wrap, drop the oldest
+      _skip(frame - m_capacity + 1);
+
+    int row = frame % m_capacity;
+    if(m_row_frames[row] != frame)
+      {
+	m_row_frames[row] = frame;
+	m_last_frame = std::max(m_last_frame,frame);
+	m_row_counts[row] = 0;
+	double nan = std::numeric_limits<double>::quiet_NaN();
+	for(unsigned int c = 0;c < m_live.size();++c)
+	  for(int i = 0;i < NB_STATS;++i)
+	    m_stats[i][c * m_capacity + row] = nan;
+      }
+    int cell = column * m_capacity + row;
+    if(m_cell_frames[cell] == frame) // already reported
+      return;
+    m_cell_frames[cell] = frame;
+    m_stats[SUM][cell] = result.sum;
+    m_stats[AVERAGE][cell] = result.average;
+    m_stats[STD][cell] = result.std;
+    m_stats[MIN][cell] = result.minValue;
+    m_stats[MAX][cell] = result.maxValue;
+    ++m_row_counts[row];
+    _publish();
+  }
+
+  /** @brief a roi was removed during the acquisition
+   */
+  void removeColumn(int column)
+  {
+    AutoMutex aLock(m_mutex);
+    if(column < 0 || column >= int(m_live.size()) || !m_live[column])
+      return;
+    m_live[column] = false;
+    --m_nb_live;
+    for(int frame = m_first_pending;frame < m_first_pending + m_capacity;
+	++frame)
+      {
+	int row = frame % m_capacity;
+	if(m_row_frames[row] == frame &&
+	   m_cell_frames[column * m_capacity + row] == frame)
+	  --m_row_counts[row];
+      }
+    _publish();
+  }
+
+  void read(long long fromSequence,CounterColumns& columns) const
+  {
+    AutoMutex aLock(m_mutex);
+    // published frames which rows are not yet taken by pending ones
+    long long end = m_seq_base + m_first_pending;
+    long long start = std::max(m_seq_base,
+			       m_seq_base + m_last_frame + 1 - m_capacity);
+    start = std::max(start,std::min(fromSequence,end));
+    int nb_frames = int(end - start);
+    int nb_columns = m_names.size();
+
+    columns.firstSequence = start;
+    columns.nextSequence = end;
+    columns.names = m_names;
+    columns.frameNumbers = _newData(Data::INT32,nb_frames,1);
+    Data *stats[NB_STATS] = {&columns.sum,&columns.average,&columns.std,
+			     &columns.minValue,&columns.maxValue};
+    for(int i = 0;i < NB_STATS;++i)
+      *stats[i] = _newData(Data::DOUBLE,nb_frames,nb_columns);
+    if(!nb_frames)
+      return;
+
+    // at most two contiguous chunks per ring row
+    int first_frame = int(start - m_seq_base);
+    int first_row = first_frame % m_capacity;
+    int nb_first = std::min(nb_frames,m_capacity - first_row);
+    int *frameNumbers = (int*)columns.frameNumbers.data();
+    for(int f = 0;f < nb_frames;++f)
+      frameNumbers[f] = first_frame + f;
+    for(int i = 0;i < NB_STATS;++i)
+      {
+	double *dst = (double*)stats[i]->data();
+	for(int c = 0;c < nb_columns;++c,dst += nb_frames)
+	  {
+	    const double *src = &m_stats[i][c * m_capacity];
+	    memcpy(dst,src + first_row,nb_first * sizeof(double));
+	    memcpy(dst + nb_first,src,(nb_frames - nb_first) * sizeof(double));
+	  }
+      }
+  }
+
+private:
+  /** @brief publish the pending frames before first_pending as they are,
+   *  rows still holding a previous frame are invalidated, never
+   *  published with the values of that frame.
+   */
+  void _skip(int first_pending)
+  {
+    double nan = std::numeric_limits<double>::quiet_NaN();
+    int nb_rows = std::min(first_pending - m_first_pending,m_capacity);
+    for(int frame = first_pending - nb_rows;frame < first_pending;++frame)
+      {
+	int row = frame % m_capacity;
+	if(m_row_frames[row] == frame)
+	  continue;
+	m_row_frames[row] = -1;
+	m_row_counts[row] = 0;
+	for(unsigned int c = 0;c < m_live.size();++c)
+	  {
+	    int cell = c * m_capacity + row;
+	    m_cell_frames[cell] = -1;
+	    for(int i = 0;i < NB_STATS;++i)
+	      m_stats[i][cell] = nan;
+	  }
+      }
+    m_first_pending = first_pending;
+  }
+
+  void _publish()
+  {
+    for(;;)
+      {
+	int row = m_first_pending % m_capacity;
+	if(m_row_frames[row] != m_first_pending ||
+	   m_row_counts[row] < m_nb_live)
+	  break;
+	++m_first_pending;
+      }
+  }
+
+  static Data _newData(Data::TYPE type,int width,int height)
+  {
+    Data aData;
+    aData.type = type;
+    aData.dimensions.push_back(width);
+    aData.dimensions.push_back(height);
+    Buffer *aBuffer = new Buffer(std::max(aData.size(),1));
+    aData.setBuffer(aBuffer);
+    aBuffer->unref();
+    return aData;
+  }
+
+  mutable Mutex			m_mutex;
+  std::list<std::string>	m_names;
+  std::vector<bool>		m_live;
+  int				m_nb_live;
+  int				m_capacity;
+  std::vector<double>		m_stats[NB_STATS]; // [column][row]
+  std::vector<int>		m_cell_frames;	// frame held by each cell
+  std::vector<int>		m_row_frames;	// frame held by each row
+  std::vector<int>		m_row_counts;	// live columns reported
+  int				m_first_pending; // first unpublished frame
+  int				m_last_frame; // last frame with a row
+  long long			m_seq_base; // sequence of frame 0
+};
+
+/** @brief give the results of a roi task to the ring
+ */
+class SoftOpRoiCounter::_CounterRingCbk : public TaskEventCallback
+{
+public:
+  _CounterRingCbk(_CounterRing *ring,SoftManager *mgr) :
+    m_ring(ring),m_mgr(mgr),m_column(-1) {}
+
+  virtual void finished(Data& aData)
+  {
+    Tasks::RoiCounterResult result = m_mgr->getResult(0.,aData.frameNumber);
+    if(result.errorCode == SoftManager::OK)
+      setResult(result);
+  }
+
+  void setResult(const Tasks::RoiCounterResult& result)
+  {
+    AutoMutex aLock(m_mutex);
+    if(m_ring)
+      m_ring->setResult(m_column,result);
+  }
+
+  void setColumn(int column)
+  {
+    AutoMutex aLock(m_mutex);
+    m_column = column;
+  }
+
+  /** @brief the roi is removed, @return its column
+   */
+  int detach()
+  {
+    AutoMutex aLock(m_mutex);
+    m_ring = NULL;
+    return m_column;
+  }
+
+private:
+  Mutex		m_mutex;
+  _CounterRing*	m_ring;
+  SoftManager*	m_mgr;		// owned by the task
+  int		m_column;
+};
+
+/** @brief PixelWeightLut of an arc roi (pixels which center is inside
+ *  the arc), kept by the roi counter for the roi lifetime so it is
+ *  only built again when the image size changes.
+ */
+class SoftOpRoiCounter::_ArcLut
+{
+public:
+  _ArcLut(const ArcRoi& roi) : m_roi(roi),m_lut(NULL),m_ref_count(1) {}
+
+  void ref()
+  {
+    AutoMutex aLock(m_lock);
+    ++m_ref_count;
+  }
+
+  void unref()
+  {
+    AutoMutex aLock(m_lock);
+    if(--m_ref_count)
+      return;
+    aLock.unlock();
+    delete this;
+  }
+
+  /** @brief lut of the image size, the caller owns a reference
+   */
+  PixelWeightLut* get(int width,int height)
+  {
+    PixelWeightLut::Geometry geometry(m_roi,PixelWeightLut::INTEGRAL,
+				      1,1,width,height);
+    AutoMutex aLock(m_lock);
+    if(m_lut && m_lut->getGeometry().width == width &&
+       m_lut->getGeometry().height == height)
+      {
+	m_lut->ref();
+	return m_lut;
+      }
+    aLock.unlock();
+
+    PixelWeightLut *lut = PixelWeightLut::create(geometry);
+    lut->ref();
+
+    aLock.lock();
+    PixelWeightLut *old_lut = m_lut;
+    m_lut = lut;
+    aLock.unlock();
+    if(old_lut)
+      old_lut->unref();
+    return lut;
+  }
+
+private:
+  ~_ArcLut()
+  {
+    if(m_lut)
+      m_lut->unref();
+  }
+
+  Mutex			m_lock;
+  ArcRoi		m_roi;
+  PixelWeightLut*	m_lut;	// of the last image size
+  int			m_ref_count;
+};
+
+/** @brief all rectangular and arc roi counters of a frame.
+ *
+ *  Arc rois are reduced through the PixelWeightLut of their _ArcLut,
+ *  without recomputing the geometry.
+ *
+ *  The x limits of the rois cut each row in segments. For every row
+ *  crossed by at least one roi, the pixels are read once to get the
+ *  sum, sum of squares, pixel count, min and max of each segment, then
+ *  prefix sums (and a sparse table for min/max) over the segments give
+ *  the contribution of the row to every active roi in constant time.
+ *  A row costs its covered pixels, O(segments.log(segments)) for the
+ *  tables and O(1) per active roi.
+ *  Rois which can't be computed this way (outside of the image, unknown
+ *  data type or mask) are given to their own RoiCounterTask.
+ *
+ *  The task is kept by SoftOpRoiCounter until the rois change, so it may
+ *  process several frames at once: the segment layout of an image size
+ *  is computed once and never modified, the sums are local to process().
+ */
+class lima::_RoiSweepTask : public SinkTaskBase
+{
+public:
+  typedef Tasks::RoiCounterTask Task;
+  typedef Tasks::RoiCounterManager Manager;
+  typedef SoftOpRoiCounter::_CounterRingCbk RingCbk;
+  typedef SoftOpRoiCounter::_ArcLut ArcLut;
+
+  _RoiSweepTask(const Data &mask) : m_mask(mask) {}
+  virtual ~_RoiSweepTask()
+  {
+    for(std::vector<_Roi>::iterator i = m_rois.begin();i != m_rois.end();++i)
+      {
+	i->task->unref();
+	i->mgr->unref();
+	i->cbk->unref();
+	if(i->lut) i->lut->unref();
+      }
+    for(LayoutMap::iterator i = m_layouts.begin();i != m_layouts.end();++i)
+      delete i->second;
+  }
+
+  void addRoi(Task *task,Manager *mgr,RingCbk *cbk)
+  {
+    _Roi roi;
+    int width,height;
+    task->getRoi(roi.x0,roi.y0,width,height);
+    roi.x1 = roi.x0 + width,roi.y1 = roi.y0 + height;
+    roi.arc = false;
+    roi.lut = NULL;
+    roi.task = task,roi.mgr = mgr,roi.cbk = cbk;
+    task->ref(),mgr->ref(),cbk->ref();
+    m_rois.push_back(roi);
+  }
+
+  void addArcRoi(Task *task,Manager *mgr,RingCbk *cbk,ArcLut *lut)
+  {
+    _Roi roi;
+    roi.arc = true;
+    roi.lut = lut;
+    roi.task = task,roi.mgr = mgr,roi.cbk = cbk;
+    task->ref(),mgr->ref(),cbk->ref(),lut->ref();
+    m_rois.push_back(roi);
+  }
+
+  bool empty() const {return m_rois.empty();}
+
+  virtual void process(Data &aData)
+  {
+    if(aData.dimensions.size() != 2)
+      {
+	for(std::vector<_Roi>::iterator i = m_rois.begin();
+	    i != m_rois.end();++i)
+	  if(i->arc)
+	    _process_arc(*i,aData);
+	  else
+	    _process_task(*i,aData);
+	return;
+      }
+
+    const _Layout &layout = _getLayout(aData.dimensions[0],
+				       aData.dimensions[1]);
+    for(std::vector<int>::const_iterator i = layout.arcs.begin();
+	i != layout.arcs.end();++i)
+      _process_arc(m_rois[*i],aData);
+    for(std::vector<int>::const_iterator i = layout.others.begin();
+	i != layout.others.end();++i)
+      _process_task(m_rois[*i],aData);
+    if(layout.sweep.empty()) return;
+
+    switch(aData.type)
+      {
+      case Data::UINT8:	 _sweep<unsigned char>(aData,layout); break;
+      case Data::INT8:	 _sweep<char>(aData,layout); break;
+      case Data::UINT16: _sweep<unsigned short>(aData,layout); break;
+      case Data::INT16:	 _sweep<short>(aData,layout); break;
+      case Data::UINT32: _sweep<unsigned int>(aData,layout); break;
+      case Data::INT32:	 _sweep<int>(aData,layout); break;
+      case Data::FLOAT:	 _sweep<float>(aData,layout); break;
+      case Data::DOUBLE: _sweep<double>(aData,layout); break;
+      default:
+	for(std::vector<int>::const_iterator i = layout.sweep.begin();
+	    i != layout.sweep.end();++i)
+	  _process_task(m_rois[*i],aData);
+	break;
+      }
+  }
+
+private:
+  struct _Roi
+  {
+    bool	arc;
+    ArcLut*	lut;
+    int		x0,y0,x1,y1;
+    Task*	task;
+    Manager*	mgr;
+    RingCbk*	cbk;
+  };
+
+  /** how the rois are computed on an image size */
+  struct _Layout
+  {
+    std::vector<int>	arcs;	// index in m_rois
+    std::vector<int>	others;
+    std::vector<int>	sweep;	// sorted by top row
+    std::vector<int>	first_seg,last_seg; // of sweep, [first_seg,last_seg)
+    std::vector<int>	limits;	// segment limits
+    std::vector<int>	log2;
+    int			nb_levels;
+    int			y_end;
+  };
+  typedef std::map<std::pair<int,int>,_Layout*> LayoutMap;
+
+  /** per frame counters of a swept roi */
+  struct _Acc
+  {
+    double	sum,sum2,nb_pixels,min,max;
+  };
+
+  struct _CompareTop
+  {
+    _CompareTop(const std::vector<_Roi> &rois) : m_rois(rois) {}
+    bool operator()(int a,int b) const
+    {
+      return m_rois[a].y0 < m_rois[b].y0;
+    }
+    const std::vector<_Roi> &m_rois;
+  };
+
+  const _Layout& _getLayout(int width,int height)
+  {
+    std::pair<int,int> key(width,height);
+    AutoMutex aLock(m_lock);
+    LayoutMap::iterator i = m_layouts.find(key);
+    if(i != m_layouts.end())
+      return *i->second;
+    aLock.unlock();
+
+    _Layout *layout = _newLayout(width,height);
+
+    aLock.lock();
+    std::pair<LayoutMap::iterator,bool> result =
+      m_layouts.insert(LayoutMap::value_type(key,layout));
+    if(!result.second)
+      delete layout;		// built meanwhile by another frame
+    return *result.first->second;
+  }
+
+  _Layout *_newLayout(int width,int height) const
+  {
+    _Layout *layout = new _Layout();
+    bool managed = m_mask.empty() ||
+      (m_mask.depth() == 1 && m_mask.dimensions.size() == 2 &&
+       m_mask.dimensions[0] == width && m_mask.dimensions[1] == height);
+    for(unsigned int i = 0;i < m_rois.size();++i)
+      {
+	const _Roi &roi = m_rois[i];
+	if(roi.arc)
+	  layout->arcs.push_back(i);
+	else if(managed && roi.x0 >= 0 && roi.y0 >= 0 && roi.x0 < roi.x1 &&
+		roi.y0 < roi.y1 && roi.x1 <= width && roi.y1 <= height)
+	  layout->sweep.push_back(i);
+	else
+	  layout->others.push_back(i);
+      }
+    std::sort(layout->sweep.begin(),layout->sweep.end(),_CompareTop(m_rois));
+
+    std::vector<int> &limits = layout->limits;
+    for(std::vector<int>::iterator i = layout->sweep.begin();
+	i != layout->sweep.end();++i)
+      limits.push_back(m_rois[*i].x0),limits.push_back(m_rois[*i].x1);
+    std::sort(limits.begin(),limits.end());
+    limits.erase(std::unique(limits.begin(),limits.end()),limits.end());
+    int nb_segs = limits.empty() ? 0 : limits.size() - 1;
+
+    layout->y_end = 0;
+    for(std::vector<int>::iterator i = layout->sweep.begin();
+	i != layout->sweep.end();++i)
+      {
+	const _Roi &roi = m_rois[*i];
+	layout->first_seg.push_back(std::lower_bound(limits.begin(),
+						     limits.end(),roi.x0) -
+				    limits.begin());
+	layout->last_seg.push_back(std::lower_bound(limits.begin(),
+						    limits.end(),roi.x1) -
+				   limits.begin());
+	layout->y_end = std::max(layout->y_end,roi.y1);
+      }
+
+    layout->nb_levels = 1;
+    while((1 << layout->nb_levels) <= nb_segs) ++layout->nb_levels;
+    layout->log2.assign(nb_segs + 1,0);
+    for(int i = 2;i <= nb_segs;++i)
+      layout->log2[i] = layout->log2[i / 2] + 1;
+    return layout;
+  }
+
+  static void _process_task(_Roi &roi,Data &aData)
+  {
+    roi.task->process(aData);
+    roi.cbk->finished(aData);
+  }
+
+  void _process_arc(_Roi &roi,Data &aData)
+  {
+    if(aData.dimensions.size() != 2)
+      return _process_task(roi,aData);
+
+    PixelWeightLut *lut = roi.lut->get(aData.dimensions[0],
+				       aData.dimensions[1]);
+    PixelWeightLut::Stats stats;
+    bool managed = lut->stats(aData,m_mask,stats);
+    lut->unref();
+    if(!managed)
+      return _process_task(roi,aData);
+
+    Tasks::RoiCounterResult result;
+    result.frameNumber = aData.frameNumber;
+    result.sum = stats.sum;
+    if(stats.weight > 0.)
+      {
+	result.average = stats.sum / stats.weight;
+	double variance = stats.sum2 / stats.weight -
+	  result.average * result.average;
+	result.std = variance > 0. ? sqrt(variance) : 0.;
+      }
+    else
+      result.average = result.std = 0.;
+    result.minValue = stats.min;
+    result.maxValue = stats.max;
+    roi.mgr->setResult(result);
+    roi.cbk->setResult(result);
+  }
+
+  template<class INPUT>
+  void _sweep(Data &aData,const _Layout &layout)
+  {
+    const double inf = std::numeric_limits<double>::infinity();
+    int width = aData.dimensions[0];
+    const std::vector<int> &limits = layout.limits;
+    const std::vector<int> &log2 = layout.log2;
+    int nb_segs = limits.size() - 1;
+    int nb_levels = layout.nb_levels;
+    int nb_rois = layout.sweep.size();
+
+    std::vector<_Acc> accs(nb_rois);
+    for(std::vector<_Acc>::iterator i = accs.begin();i != accs.end();++i)
+      {
+	i->sum = i->sum2 = i->nb_pixels = 0.;
+	i->min = inf,i->max = -inf;
+      }
+    std::vector<double> sums(nb_segs + 1),sums2(nb_segs + 1);
+    std::vector<double> counts(nb_segs + 1);
+    std::vector<double> mins(nb_levels * nb_segs),maxs(nb_levels * nb_segs);
+
+    const INPUT *src = (const INPUT*)aData.data();
+    const char *mask = (const char*)m_mask.data();
+    std::vector<int> active;	// position in layout.sweep
+    int next = 0;
+    for(int y = m_rois[layout.sweep[0]].y0;y < layout.y_end;++y)
+      {
+	for(unsigned int i = 0;i < active.size();)
+	  if(m_rois[layout.sweep[active[i]]].y1 <= y)
+	    active[i] = active.back(),active.pop_back();
+	  else
+	    ++i;
+	for(;next < nb_rois && m_rois[layout.sweep[next]].y0 == y;++next)
+	  active.push_back(next);
+	if(active.empty())
+	  {
+	    if(next == nb_rois) break;
+	    y = m_rois[layout.sweep[next]].y0 - 1;
+	    continue;
+	  }
+
+	// one read of the row, per segment
+	const INPUT *line = src + long(y) * width;
+	const char *mask_line = mask ? mask + long(y) * width : NULL;
+	for(int seg = 0;seg < nb_segs;++seg)
+	  {
+	    double sum = 0.,sum2 = 0.,count = 0.,min = inf,max = -inf;
+	    for(int x = limits[seg];x < limits[seg + 1];++x)
+	      {
+		if(mask_line && !mask_line[x]) continue;
+		double value = line[x];
+		sum += value,sum2 += value * value,count += 1.;
+		if(value < min) min = value;
+		if(value > max) max = value;
+	      }
+	    sums[seg + 1] = sums[seg] + sum;
+	    sums2[seg + 1] = sums2[seg] + sum2;
+	    counts[seg + 1] = counts[seg] + count;
+	    mins[seg] = min,maxs[seg] = max;
+	  }
+	for(int level = 1;level < nb_levels;++level)
+	  {
+	    int half = 1 << (level - 1);
+	    double *min_level = &mins[level * nb_segs];
+	    double *max_level = &maxs[level * nb_segs];
+	    const double *min_prev = min_level - nb_segs;
+	    const double *max_prev = max_level - nb_segs;
+	    for(int seg = 0;seg + 2 * half <= nb_segs;++seg)
+	      {
+		min_level[seg] = std::min(min_prev[seg],min_prev[seg + half]);
+		max_level[seg] = std::max(max_prev[seg],max_prev[seg + half]);
+	      }
+	  }
+
+	for(std::vector<int>::iterator i = active.begin();i != active.end();++i)
+	  {
+	    _Acc &acc = accs[*i];
+	    int first = layout.first_seg[*i],last = layout.last_seg[*i];
+	    acc.sum += sums[last] - sums[first];
+	    acc.sum2 += sums2[last] - sums2[first];
+	    acc.nb_pixels += counts[last] - counts[first];
+	    int level = log2[last - first];
+	    int offset = level * nb_segs;
+	    int second = last - (1 << level);
+	    acc.min = std::min(acc.min,std::min(mins[offset + first],
+						mins[offset + second]));
+	    acc.max = std::max(acc.max,std::max(maxs[offset + first],
+						maxs[offset + second]));
+	  }
+      }
+
+    for(int i = 0;i < nb_rois;++i)
+      {
+	const _Acc &acc = accs[i];
+	_Roi &roi = m_rois[layout.sweep[i]];
+	Tasks::RoiCounterResult result;
+	result.frameNumber = aData.frameNumber;
+	if(acc.nb_pixels > 0.)
+	  {
+	    result.sum = acc.sum;
+	    result.average = acc.sum / acc.nb_pixels;
+	    double variance = acc.sum2 / acc.nb_pixels -
+	      result.average * result.average;
+	    result.std = variance > 0. ? sqrt(variance) : 0.;
+	    result.minValue = acc.min;
+	    result.maxValue = acc.max;
+	  }
+	else
+	  result.sum = result.average = result.std =
+	    result.minValue = result.maxValue = 0.;
+	roi.mgr->setResult(result);
+	roi.cbk->setResult(result);
+      }
+  }
+
+  Data			m_mask;
+  std::vector<_Roi>	m_rois;
+  Mutex			m_lock;
+  LayoutMap		m_layouts;
+};
+
 SoftOpRoiCounter::SoftOpRoiCounter() : 
   SoftOpBaseClass(),
-  m_history_size(DEFAULT_HISTORY_SIZE)
+  m_history_size(DEFAULT_HISTORY_SIZE),
+  m_engine(PER_ROI),
+  m_ring(new _CounterRing()),
+  m_sweep_task(NULL)
 {
   m_task_manager.setCompatFormat("roi_%d");
 }
 
 SoftOpRoiCounter::~SoftOpRoiCounter()
 {
+  _clear_sweep_task();
+  while(!m_arc_luts.empty())
+    _remove_arc_lut(m_arc_luts.begin()->first);
+  while(!m_ring_cbks.empty())
+    _remove_ring_cbk(m_ring_cbks.begin());
+  delete m_ring;
 }
 
 void SoftOpRoiCounter::updateRois(const std::list<RoiNameAndRoi> &named_rois)
 {
   AutoMutex aLock(m_cond.mutex());
+  _clear_sweep_task();
   for(std::list<RoiNameAndRoi>::const_iterator i = named_rois.begin();
       i != named_rois.end();++i)
     {
       SoftManager *aCounterMgrPt;
       SoftTask *aCounterTaskPt;
       _get_or_create(i->first,aCounterMgrPt,aCounterTaskPt);
+      _remove_arc_lut(i->first);
       //update
       const Point &aOri = i->second.getTopLeft();
       const Size &aSize = i->second.getSize();
@@ -254,6 +1296,7 @@ void SoftOpRoiCounter::updateRois(const std::list<RoiNameAndRoi> &named_rois)
 void SoftOpRoiCounter::updateArcRois(const std::list<RoiNameAndArcRoi>& named_arc)
 {
   AutoMutex aLock(m_cond.mutex());
+  _clear_sweep_task();
   for(std::list<RoiNameAndArcRoi>::const_iterator i = named_arc.begin();
       i != named_arc.end();++i)
     {
@@ -272,15 +1315,19 @@ void SoftOpRoiCounter::updateArcRois(const std::list<RoiNameAndArcRoi>& named_ar
 				 rayon1,rayon2,
 				 start,end);
       aCounterTaskPt->setMask(m_mask);
+      _remove_arc_lut(i->first);
+      m_arc_luts[i->first] = new _ArcLut(i->second);
     }
 }
 void SoftOpRoiCounter::setLut(const std::string& name,
 			      const Point& origin,Data& lut)
 {
   AutoMutex aLock(m_cond.mutex());
+  _clear_sweep_task();
   SoftManager *aCounterMgrPt;
   SoftTask *aCounterTaskPt;
   _get_or_create(name,aCounterMgrPt,aCounterTaskPt);
+  _remove_arc_lut(name);
   aCounterTaskPt->setLut(origin.x,origin.y,lut);
   aCounterTaskPt->setMask(m_mask);
 }
@@ -288,9 +1335,11 @@ void SoftOpRoiCounter::setLutMask(const std::string& name,
 				  const Point& origin,Data& mask)
 {
   AutoMutex aLock(m_cond.mutex());
+  _clear_sweep_task();
   SoftManager *aCounterMgrPt;
   SoftTask *aCounterTaskPt;
   _get_or_create(name,aCounterMgrPt,aCounterTaskPt);
+  _remove_arc_lut(name);
   aCounterTaskPt->setLutMask(origin.x,origin.y,mask);
   aCounterTaskPt->setMask(m_mask);
 }
@@ -328,6 +1377,15 @@ void SoftOpRoiCounter::getNames(std::list<std::string>& roi_names) const
 void SoftOpRoiCounter::removeRois(const std::list<std::string>& names)
 {
   AutoMutex aLock(m_cond.mutex());
+  _clear_sweep_task();
+  for(std::list<std::string>::const_iterator i = names.begin();
+      i != names.end();++i)
+    {
+      RingCbkMap::iterator cbk = m_ring_cbks.find(*i);
+      if(cbk != m_ring_cbks.end())
+	_remove_ring_cbk(cbk);
+      _remove_arc_lut(*i);
+    }
   m_task_manager.remove(names);
 }
 
@@ -336,6 +1394,11 @@ void SoftOpRoiCounter::removeRois(const std::list<std::string>& names)
 void SoftOpRoiCounter::clearAllRois()
 {
   AutoMutex aLock(m_cond.mutex());
+  _clear_sweep_task();
+  while(!m_ring_cbks.empty())
+    _remove_ring_cbk(m_ring_cbks.begin());
+  while(!m_arc_luts.empty())
+    _remove_arc_lut(m_arc_luts.begin()->first);
   m_task_manager.clearAll();
 }
 
@@ -359,6 +1422,7 @@ int SoftOpRoiCounter::getCounterStatus() const
 void SoftOpRoiCounter::setMask(Data& aMask)
 {
   AutoMutex aLock(m_cond.mutex());
+  _clear_sweep_task();
   for(NameMapIterator i = m_task_manager.begin();
        i != m_task_manager.end();++i)
       i->second.second->setMask(aMask);
@@ -380,6 +1444,18 @@ void SoftOpRoiCounter::getBufferSize(int& size) const
   size = m_history_size;
 }
 
+void SoftOpRoiCounter::setEngine(Engine engine)
+{
+  AutoMutex aLock(m_cond.mutex());
+  m_engine = engine;
+}
+
+void SoftOpRoiCounter::getEngine(Engine& engine) const
+{
+  AutoMutex aLock(m_cond.mutex());
+  engine = m_engine;
+}
+
 void SoftOpRoiCounter::readCounters(int from,
 				    std::list<RoiNameAndResults>& result) const
 {
@@ -393,10 +1469,50 @@ void SoftOpRoiCounter::readCounters(int from,
   }
 }
 
+void SoftOpRoiCounter::readCounterColumns(long long fromSequence,
+					  CounterColumns& columns) const
+{
+  m_ring->read(fromSequence,columns);
+}
+
 bool SoftOpRoiCounter::addTo(TaskMgr &aMgr,int stage)
 {
   AutoMutex aLock(m_cond.mutex());
-  return m_task_manager.addTo(aMgr, stage);
+  if(m_engine == PER_ROI)
+    return m_task_manager.addTo(aMgr, stage);
+
+  bool new_sweep_task = !m_sweep_task;
+  if(new_sweep_task)
+    m_sweep_task = new _RoiSweepTask(m_mask);
+  for(NameMapIterator i = m_task_manager.begin();
+      i != m_task_manager.end();++i)
+    {
+      SoftTask *task = i->second.second;
+      SoftTask::type roi_type;
+      task->getType(roi_type);
+      if(roi_type != SoftTask::SQUARE && roi_type != SoftTask::ARC)
+	aMgr.addSinkTask(stage,task);
+      else if(!new_sweep_task)
+	continue;
+      else if(roi_type == SoftTask::SQUARE)
+	m_sweep_task->addRoi(task,i->second.first,m_ring_cbks[i->first]);
+      else
+	{
+	  _ArcLut *&lut = m_arc_luts[i->first];
+	  if(!lut)		// arc set directly on the task
+	    {
+	      double x,y,rayon1,rayon2,start,end;
+	      task->getArcMask(x,y,rayon1,rayon2,start,end);
+	      lut = new _ArcLut(ArcRoi(x,y,rayon1,rayon2,start,end));
+	    }
+	  m_sweep_task->addArcRoi(task,i->second.first,m_ring_cbks[i->first],
+				  lut);
+	}
+    }
+  if(!m_sweep_task->empty())
+    aMgr.addSinkTask(stage,m_sweep_task);
+  m_task_manager.incCounterStatus();
+  return m_task_manager.size() > 0;
 }
 
 void SoftOpRoiCounter::prepare()
@@ -406,6 +1522,14 @@ void SoftOpRoiCounter::prepare()
       i != m_task_manager.end();++i)
      i->second.first->resetHistory();
   m_task_manager.prepareCounterStatus();
+
+  std::list<std::string> names;
+  m_task_manager.getNames(names);
+  m_ring->reset(names,m_history_size);
+  int column = 0;
+  for(std::list<std::string>::iterator i = names.begin();
+      i != names.end();++i,++column)
+    m_ring_cbks[*i]->setColumn(column);
 }
 
 void SoftOpRoiCounter::_get_or_create(const std::string& roi_name,
@@ -418,13 +1542,114 @@ void SoftOpRoiCounter::_get_or_create(const std::string& roi_name,
     aCounterTaskPt = new SoftTask(*aCounterMgrPt);
     TaskMap::ManagerAndTask man_task(aCounterMgrPt, aCounterTaskPt);
     m_task_manager.insert(roi_name, man_task);
+    _CounterRingCbk *cbk = new _CounterRingCbk(m_ring,aCounterMgrPt);
+    aCounterTaskPt->setEventCallback(cbk);
+    m_ring_cbks[roi_name] = cbk;
   } else {
     aCounterMgrPt = i->second.first;
     aCounterTaskPt = i->second.second;
   }
 }
+
+/** @brief drop the single pass task, rebuilt by the next addTo
+ *  frames already given to it keep it until they are processed
+ */
+void SoftOpRoiCounter::_clear_sweep_task()
+{
+  if(m_sweep_task)
+    m_sweep_task->unref();
+  m_sweep_task = NULL;
+}
+
+void SoftOpRoiCounter::_remove_arc_lut(const std::string& roi_name)
+{
+  ArcLutMap::iterator i = m_arc_luts.find(roi_name);
+  if(i == m_arc_luts.end())
+    return;
+  i->second->unref();
+  m_arc_luts.erase(i);
+}
+
+void SoftOpRoiCounter::_remove_ring_cbk(RingCbkMap::iterator i)
+{
+  _CounterRingCbk *cbk = i->second;
+  m_ring->removeColumn(cbk->detach());
+  cbk->unref();
+  m_ring_cbks.erase(i);
+}
 //-------------------- ROI TO SPECTRUM --------------------
 
+/** @brief integrated profile of an arc, through its cached PixelWeightLut
+ */
+class lima::_ArcProfileTask : public SinkTaskBase
+{
+public:
+  typedef Tasks::Roi2SpectrumManager Manager;
+  typedef SoftOpRoi2Spectrum::ArcProfile ArcProfile;
+
+  _ArcProfileTask(Manager &mgr) : m_mgr(mgr),m_lut(NULL)
+  {
+    m_mgr.ref();
+  }
+  virtual ~_ArcProfileTask()
+  {
+    if(m_lut) m_lut->unref();
+    m_mgr.unref();
+  }
+
+  void setProfile(const ArcProfile& profile)
+  {
+    AutoMutex aLock(m_lock);
+    m_profile = profile;
+  }
+
+  void getProfile(ArcProfile& profile) const
+  {
+    AutoMutex aLock(m_lock);
+    profile = m_profile;
+  }
+
+  virtual void process(Data &aData)
+  {
+    if(aData.dimensions.size() != 2)
+      return;
+
+    AutoMutex aLock(m_lock);
+    PixelWeightLut::Geometry geometry(m_profile.roi,
+				      m_profile.mode == SoftOpRoi2Spectrum::AZIMUTHAL ?
+				      PixelWeightLut::AZIMUTHAL :
+				      PixelWeightLut::RADIAL,
+				      m_profile.nbBins,m_profile.subSampling,
+				      aData.dimensions[0],aData.dimensions[1]);
+    if(!m_lut || m_lut->getGeometry() < geometry ||
+       geometry < m_lut->getGeometry())
+      {
+	if(m_lut) m_lut->unref();
+	m_lut = PixelWeightLut::get(geometry);
+      }
+    PixelWeightLut *lut = m_lut;
+    lut->ref();
+    aLock.unlock();
+
+    Tasks::Roi2SpectrumResult result;
+    result.frameNumber = aData.frameNumber;
+    result.spectrum.type = Data::DOUBLE;
+    result.spectrum.dimensions.push_back(geometry.nbBins);
+    Buffer *aBuffer = new Buffer(result.spectrum.size());
+    result.spectrum.setBuffer(aBuffer);
+    aBuffer->unref();
+    if(lut->profile(aData,Data(),(double*)result.spectrum.data()))
+      m_mgr.setResult(result);
+    lut->unref();
+  }
+
+private:
+  Manager&		m_mgr;
+  mutable Mutex		m_lock;
+  ArcProfile		m_profile;
+  PixelWeightLut*	m_lut;	// of the last image size
+};
+
 SoftOpRoi2Spectrum::SoftOpRoi2Spectrum() : 
   SoftOpBaseClass(),
   m_history_size(DEFAULT_HISTORY_SIZE)
@@ -444,6 +1669,8 @@ void SoftOpRoi2Spectrum::updateRois(const std::list<RoiNameAndRoi> &named_rois)
     {
       SoftManager *aRoi2SpectrumMgrPt;
       SoftTask *aRoi2SpectrumTaskPt;
+      std::list<std::string> arc_name(1,i->first);
+      m_arc_task_manager.remove(arc_name);
       _get_or_create(i->first,aRoi2SpectrumMgrPt,aRoi2SpectrumTaskPt);
       //update
       const Point &aOri = i->second.getTopLeft();
@@ -464,6 +1691,43 @@ void SoftOpRoi2Spectrum::getRois(std::list<RoiNameAndRoi>& named_rois) const
       named_rois.push_back(name_roi);
     }
 }
+void SoftOpRoi2Spectrum::updateArcProfiles(const std::list<RoiNameAndArcProfile>&
+					   named_profiles)
+{
+  AutoMutex aLock(m_cond.mutex());
+  for(std::list<RoiNameAndArcProfile>::const_iterator i = named_profiles.begin();
+      i != named_profiles.end();++i)
+    {
+      if(i->second.roi.isEmpty()) continue;
+      std::list<std::string> roi_name(1,i->first);
+      m_task_manager.remove(roi_name);
+
+      _ArcProfileTask *anArcTaskPt;
+      ArcTaskMap::NameMapIterator named_arc = m_arc_task_manager.find(i->first);
+      if(named_arc == m_arc_task_manager.end())
+	{
+	  SoftManager *aMgrPt = new SoftManager(m_history_size);
+	  anArcTaskPt = new _ArcProfileTask(*aMgrPt);
+	  ArcTaskMap::ManagerAndTask man_task(aMgrPt,anArcTaskPt);
+	  m_arc_task_manager.insert(i->first,man_task);
+	}
+      else
+	anArcTaskPt = named_arc->second.second;
+      anArcTaskPt->setProfile(i->second);
+    }
+}
+void SoftOpRoi2Spectrum::getArcProfiles(std::list<RoiNameAndArcProfile>&
+					named_profiles) const
+{
+  AutoMutex aLock(m_cond.mutex());
+  for(ArcTaskMap::NameMapConstIterator i = m_arc_task_manager.begin();
+      i != m_arc_task_manager.end();++i)
+    {
+      ArcProfile profile;
+      i->second.second->getProfile(profile);
+      named_profiles.push_back(RoiNameAndArcProfile(i->first,profile));
+    }
+}
 void SoftOpRoi2Spectrum::getTasks(RoiNameAndTaskList& l)
 {
   AutoMutex aLock(m_cond.mutex());
@@ -473,11 +1737,13 @@ void SoftOpRoi2Spectrum::getNames(std::list<std::string>& roi_names) const
 {
   AutoMutex aLock(m_cond.mutex());
   m_task_manager.getNames(roi_names);
+  m_arc_task_manager.getNames(roi_names);
 }
 void SoftOpRoi2Spectrum::removeRois(const std::list<std::string>& names)
 {
   AutoMutex aLock(m_cond.mutex());
   m_task_manager.remove(names);
+  m_arc_task_manager.remove(names);
 }
 
 /** @brief remove all roi
@@ -486,6 +1752,7 @@ void SoftOpRoi2Spectrum::clearAllRois()
 {
   AutoMutex aLock(m_cond.mutex());
   m_task_manager.clearAll();
+  m_arc_task_manager.clearAll();
 }
 
 void SoftOpRoi2Spectrum::getRoiModes(std::list<RoiNameAndMode>& roi_modes) const
@@ -545,6 +1812,9 @@ void SoftOpRoi2Spectrum::setBufferSize(int size)
   for(NameMapIterator i = m_task_manager.begin();
       i != m_task_manager.end();++i)
     i->second.first->resizeHistory(size);
+  for(ArcTaskMap::NameMapIterator i = m_arc_task_manager.begin();
+      i != m_arc_task_manager.end();++i)
+    i->second.first->resizeHistory(size);
   m_history_size = size;
 }
 
@@ -566,18 +1836,32 @@ void SoftOpRoi2Spectrum::readCounters(int from,
       RoiNameAndResults &name_res = result.back();
       i->second.first->getHistory(name_res.second, from);
     }
+  for(ArcTaskMap::NameMapConstIterator i = m_arc_task_manager.begin();
+      i != m_arc_task_manager.end();++i)
+    {
+      typedef std::list<Tasks::Roi2SpectrumResult> ResultList;
+      result.push_back(RoiNameAndResults(i->first, ResultList()));
+      RoiNameAndResults &name_res = result.back();
+      i->second.first->getHistory(name_res.second, from);
+    }
 }
 
 void SoftOpRoi2Spectrum::createImage(std::string roi_name, int& from,
 				     Data& aData) const
 {
   AutoMutex aLock(m_cond.mutex());
+  SoftManager *aMgrPt;
   NameMapConstIterator i = m_task_manager.find(roi_name);
-  if(i == m_task_manager.end())
+  ArcTaskMap::NameMapConstIterator arc = m_arc_task_manager.find(roi_name);
+  if(i != m_task_manager.end())
+    aMgrPt = i->second.first;
+  else if(arc != m_arc_task_manager.end())
+    aMgrPt = arc->second.first;
+  else
     return;
 
   std::list<Tasks::Roi2SpectrumResult> aResult;
-  i->second.first->getHistory(aResult,from);
+  aMgrPt->getHistory(aResult,from);
   if(aResult.empty())
     return;
 
@@ -601,7 +1885,11 @@ void SoftOpRoi2Spectrum::createImage(std::string roi_name, int& from,
 bool SoftOpRoi2Spectrum::addTo(TaskMgr &aMgr,int stage)
 {
   AutoMutex aLock(m_cond.mutex());
-  return m_task_manager.addTo(aMgr, stage);
+  bool added = m_task_manager.addTo(aMgr, stage);
+  for(ArcTaskMap::NameMapIterator i = m_arc_task_manager.begin();
+      i != m_arc_task_manager.end();++i, added = true)
+    aMgr.addSinkTask(stage,i->second.second);
+  return added;
 }
 
 void SoftOpRoi2Spectrum::prepare()
@@ -610,6 +1898,9 @@ void SoftOpRoi2Spectrum::prepare()
   for(NameMapIterator i = m_task_manager.begin();
       i != m_task_manager.end();++i)
     i->second.first->resetHistory();
+  for(ArcTaskMap::NameMapIterator i = m_arc_task_manager.begin();
+      i != m_arc_task_manager.end();++i)
+    i->second.first->resetHistory();
   m_task_manager.prepareCounterStatus();
 }
 
@@ -775,9 +2066,388 @@ bool SoftUserSinkTask::addTo(TaskMgr &aMgr,int stage)
 
 //-------------------- PEAK FINDER --------------------
 
+/** @brief sums of the pixels of one connected component
+ */
+struct _PeakSum
+{
+  _PeakSum() : size(0),sum(0.),sum_x(0.),sum_y(0.),sum_ix(0.),sum_iy(0.),
+	       max(-std::numeric_limits<double>::infinity()) {}
+
+  void add(int x,int y,double value)
+  {
+    ++size;
+    sum += value;
+    sum_x += x,sum_y += y;
+    sum_ix += value * x,sum_iy += value * y;
+    if(value > max) max = value;
+  }
+
+  void merge(const _PeakSum &other)
+  {
+    size += other.size;
+    sum += other.sum;
+    sum_x += other.sum_x,sum_y += other.sum_y;
+    sum_ix += other.sum_ix,sum_iy += other.sum_iy;
+    if(other.max > max) max = other.max;
+  }
+
+  int		size;
+  double	sum,sum_x,sum_y,sum_ix,sum_iy,max;
+};
+
+typedef std::map<int,_PeakSum> _PeakSums; // by component root
+
+/** @brief labelling of one frame, in stripes of rows.
+ *
+ *  A component is a tree of pixel indexes, linked to the smallest one
+ *  (its first pixel). In the LABEL phase a stripe only links its own
+ *  pixels, mergeSeams() then links the components cut by the stripe
+ *  borders and the ACCUMULATE phase only reads the trees.
+ */
+template<class INPUT>
+class _PeakLabelJob : public TileWorkers::Job
+{
+public:
+  enum Phase {LABEL,ACCUMULATE};
+
+  _PeakLabelJob(const Data &aData,const Data &mask,double threshold,
+		int nb_tiles,std::vector<int> &parent) :
+    m_phase(LABEL),
+    m_src((const INPUT*)aData.data()),
+    m_mask((const char*)mask.data()),
+    m_width(aData.dimensions[0]),m_height(aData.dimensions[1]),
+    m_threshold(threshold),
+    m_rows((m_height + nb_tiles - 1) / nb_tiles),
+    m_parent(parent),
+    m_sums(nb_tiles)
+  {
+    // every pixel is written by _label, no need to clear
+    m_parent.resize(long(m_width) * m_height);
+  }
+
+  void setPhase(Phase phase) {m_phase = phase;}
+
+  virtual void process(int tile)
+  {
+    int y0 = tile * m_rows;
+    int y1 = std::min(m_height,y0 + m_rows);
+    if(y0 >= y1)
+      return;
+    if(m_phase == LABEL)
+      _label(y0,y1);
+    else
+      _accumulate(m_sums[tile],y0,y1);
+  }
+
+  void mergeSeams()
+  {
+    for(int y = m_rows;y < m_height;y += m_rows)
+      for(int x = 0;x < m_width;++x)
+	{
+	  int i = y * m_width + x;
+	  if(m_parent[i] < 0)
+	    continue;
+	  for(int dx = -1;dx <= 1;++dx)
+	    if(x + dx >= 0 && x + dx < m_width &&
+	       m_parent[i - m_width + dx] >= 0)
+	      _union(i - m_width + dx,i);
+	}
+  }
+
+  void getPeaks(int frameNumber,int min_size,
+		std::vector<SoftOpPeakFinder::Peak> &peaks) const
+  {
+    _PeakSums sums;
+    for(typename std::vector<_PeakSums>::const_iterator t = m_sums.begin();
+	t != m_sums.end();++t)
+      for(_PeakSums::const_iterator i = t->begin();i != t->end();++i)
+	sums[i->first].merge(i->second);
+
+    for(_PeakSums::const_iterator i = sums.begin();i != sums.end();++i)
+      {
+	const _PeakSum &sum = i->second;
+	if(sum.size < min_size)
+	  continue;
+	SoftOpPeakFinder::Peak peak;
+	peak.frameNumber = frameNumber;
+	if(sum.sum != 0.)
+	  peak.x = sum.sum_ix / sum.sum,peak.y = sum.sum_iy / sum.sum;
+	else
+	  peak.x = sum.sum_x / sum.size,peak.y = sum.sum_y / sum.size;
+	peak.intensity = sum.sum;
+	peak.maxIntensity = sum.max;
+	peak.size = sum.size;
+	peaks.push_back(peak);
+      }
+  }
+
+private:
+  bool _isPeakPixel(int i) const
+  {
+    return (!m_mask || m_mask[i]) && double(m_src[i]) > m_threshold;
+  }
+
+  int _find(int i)
+  {
+    while(m_parent[i] != i)
+      {
+	m_parent[i] = m_parent[m_parent[i]];
+	i = m_parent[i];
+      }
+    return i;
+  }
+
+  int _root(int i) const
+  {
+    while(m_parent[i] != i)
+      i = m_parent[i];
+    return i;
+  }
+
+  void _union(int a,int b)
+  {
+    a = _find(a),b = _find(b);
+    if(a < b)
+      m_parent[b] = a;
+    else if(b < a)
+      m_parent[a] = b;
+  }
+
+  void _label(int y0,int y1)
+  {
+    for(int y = y0;y < y1;++y)
+      for(int x = 0,i = y * m_width;x < m_width;++x,++i)
+	{
+	  if(!_isPeakPixel(i))
+	    {
+	      m_parent[i] = -1;
+	      continue;
+	    }
+	  m_parent[i] = i;
+	  if(x > 0 && m_parent[i - 1] >= 0)
+	    _union(i - 1,i);
+	  if(y == y0)
+	    continue;
+	  for(int dx = -1;dx <= 1;++dx)
+	    if(x + dx >= 0 && x + dx < m_width &&
+	       m_parent[i - m_width + dx] >= 0)
+	      _union(i - m_width + dx,i);
+	}
+    // flatten, the roots have the smallest indexes
+    for(int i = y0 * m_width;i < y1 * m_width;++i)
+      if(m_parent[i] >= 0)
+	m_parent[i] = m_parent[m_parent[i]];
+  }
+
+  void _accumulate(_PeakSums &sums,int y0,int y1) const
+  {
+    int last_root = -1;
+    _PeakSum *last_sum = NULL;
+    for(int y = y0;y < y1;++y)
+      for(int x = 0,i = y * m_width;x < m_width;++x,++i)
+	{
+	  if(m_parent[i] < 0)
+	    continue;
+	  int root = _root(i);
+	  if(root != last_root)
+	    last_root = root,last_sum = &sums[root];
+	  last_sum->add(x,y,m_src[i]);
+	}
+  }
+
+  Phase			m_phase;
+  const INPUT*		m_src;
+  const char*		m_mask;
+  int			m_width;
+  int			m_height;
+  double		m_threshold;
+  int			m_rows;		// per stripe
+  std::vector<int>&	m_parent;	// -1 below threshold
+  std::vector<_PeakSums> m_sums;	// per stripe
+};
+
+/** @brief SoftOpPeakFinder MULTI mode, keeps the peaks of the last
+ *  frames.
+ */
+class lima::_MultiPeakTask : public SinkTaskBase
+{
+public:
+  typedef SoftOpPeakFinder::Peak Peak;
+  enum {MIN_TILE_PIXELS = 64 * 1024};
+
+  _MultiPeakTask(int history_size) :
+    m_threshold(0.),m_min_size(1),m_last_frame(-1),m_workers(NULL)
+  {
+    resizeHistory(history_size);
+  }
+
+  virtual ~_MultiPeakTask()
+  {
+    for(unsigned int i = 0;i < m_free_labels.size();++i)
+      delete m_free_labels[i];
+  }
+
+  void setMask(const Data &mask)
+  {
+    AutoMutex aLock(m_mutex);
+    m_mask = mask;
+  }
+
+  void setThreshold(double threshold)
+  {
+    AutoMutex aLock(m_mutex);
+    m_threshold = threshold;
+  }
+
+  void setWorkers(TileWorkers *workers)
+  {
+    AutoMutex aLock(m_mutex);
+    m_workers = workers;
+  }
+
+  double getThreshold() const
+  {
+    AutoMutex aLock(m_mutex);
+    return m_threshold;
+  }
+
+  void setMinSize(int nb_pixels)
+  {
+    AutoMutex aLock(m_mutex);
+    m_min_size = nb_pixels;
+  }
+
+  int getMinSize() const
+  {
+    AutoMutex aLock(m_mutex);
+    return m_min_size;
+  }
+
+  void resizeHistory(int size)
+  {
+    AutoMutex aLock(m_mutex);
+    size = std::max(size,1);
+    m_frames.assign(size,-1);
+    m_peaks.assign(size,std::vector<Peak>());
+    m_last_frame = -1;
+  }
+
+  void reset()
+  {
+    AutoMutex aLock(m_mutex);
+    m_frames.assign(m_frames.size(),-1);
+    for(unsigned int i = 0;i < m_peaks.size();++i)
+      m_peaks[i].clear();
+    m_last_frame = -1;
+  }
+
+  void getPeaks(int fromFrame,std::list<Peak> &peaks) const
+  {
+    AutoMutex aLock(m_mutex);
+    int capacity = m_frames.size();
+    int first = std::max(fromFrame,m_last_frame + 1 - capacity);
+    for(int frame = std::max(first,0);frame <= m_last_frame;++frame)
+      {
+	int slot = frame % capacity;
+	if(m_frames[slot] == frame)
+	  peaks.insert(peaks.end(),m_peaks[slot].begin(),m_peaks[slot].end());
+      }
+  }
+
+  virtual void process(Data &aData)
+  {
+    AutoMutex aLock(m_mutex);
+    Data mask = m_mask;
+    double threshold = m_threshold;
+    int min_size = m_min_size;
+    aLock.unlock();
+
+    std::vector<Peak> peaks;
+    if(aData.dimensions.size() == 2 &&
+       (mask.empty() || (mask.depth() == 1 &&
+			 mask.dimensions == aData.dimensions)))
+      switch(aData.type)
+	{
+	case Data::UINT8:  _find<unsigned char>(aData,mask,threshold,min_size,peaks); break;
+	case Data::INT8:   _find<char>(aData,mask,threshold,min_size,peaks); break;
+	case Data::UINT16: _find<unsigned short>(aData,mask,threshold,min_size,peaks); break;
+	case Data::INT16:  _find<short>(aData,mask,threshold,min_size,peaks); break;
+	case Data::UINT32: _find<unsigned int>(aData,mask,threshold,min_size,peaks); break;
+	case Data::INT32:  _find<int>(aData,mask,threshold,min_size,peaks); break;
+	case Data::FLOAT:  _find<float>(aData,mask,threshold,min_size,peaks); break;
+	case Data::DOUBLE: _find<double>(aData,mask,threshold,min_size,peaks); break;
+	default: break;
+	}
+
+    aLock.lock();
+    int frame = aData.frameNumber;
+    int capacity = m_frames.size();
+    if(frame < 0 || frame <= m_last_frame - capacity)
+      return;
+    int slot = frame % capacity;
+    m_frames[slot] = frame;
+    m_peaks[slot].swap(peaks);
+    m_last_frame = std::max(m_last_frame,frame);
+  }
+
+private:
+  /** @brief a labels buffer of a previous frame, one per frame
+   *  processed at the same time
+   */
+  std::vector<int>* _takeLabels()
+  {
+    AutoMutex aLock(m_mutex);
+    if(m_free_labels.empty())
+      return new std::vector<int>();
+    std::vector<int> *labels = m_free_labels.back();
+    m_free_labels.pop_back();
+    return labels;
+  }
+
+  void _releaseLabels(std::vector<int> *labels)
+  {
+    AutoMutex aLock(m_mutex);
+    m_free_labels.push_back(labels);
+  }
+
+  template<class INPUT>
+  void _find(Data &aData,const Data &mask,double threshold,int min_size,
+	     std::vector<Peak> &peaks)
+  {
+    AutoMutex aLock(m_mutex);
+    TileWorkers &workers = m_workers ? *m_workers : _get_soft_op_workers();
+    aLock.unlock();
+    int height = aData.dimensions[1];
+    long nb_pixels = long(aData.dimensions[0]) * height;
+    long nb_tiles = std::min(long(workers.getNbThreads() + 1),
+			     nb_pixels / MIN_TILE_PIXELS);
+    nb_tiles = std::max(1L,std::min(nb_tiles,long(height)));
+
+    std::vector<int> *labels = _takeLabels();
+    _PeakLabelJob<INPUT> job(aData,mask,threshold,int(nb_tiles),*labels);
+    workers.run(job,nb_tiles);
+    job.mergeSeams();
+    job.setPhase(_PeakLabelJob<INPUT>::ACCUMULATE);
+    workers.run(job,nb_tiles);
+    job.getPeaks(aData.frameNumber,min_size,peaks);
+    _releaseLabels(labels);
+  }
+
+  mutable Mutex			m_mutex;
+  Data				m_mask;
+  double			m_threshold;
+  int				m_min_size;
+  std::vector<int>		m_frames;	// frame held by each slot
+  std::vector<std::vector<Peak> > m_peaks;
+  int				m_last_frame;
+  std::vector<std::vector<int>*> m_free_labels;
+  TileWorkers*			m_workers;
+};
+
 SoftOpPeakFinder::SoftOpPeakFinder() : 
   SoftOpBaseClass(),
-  m_history_size(DEFAULT_HISTORY_SIZE)
+  m_history_size(DEFAULT_HISTORY_SIZE),
+  m_mode(MAXIMUM)
 {
   SoftManager *aCounterMgrPt;
   SoftTask *aCounterTaskPt;
@@ -785,20 +2455,38 @@ SoftOpPeakFinder::SoftOpPeakFinder() :
   aCounterTaskPt = new SoftTask(*aCounterMgrPt);
   TaskMap::ManagerAndTask man_task(aCounterMgrPt, aCounterTaskPt);
   m_task_manager.insert("my_name",man_task);
+  m_multi_task = new _MultiPeakTask(m_history_size);
 }
 
 SoftOpPeakFinder::~SoftOpPeakFinder()
 {
+  m_multi_task->unref();
   m_opt->unref();
 }
 void SoftOpPeakFinder::setMask(Data& aMask)
 {
+  m_multi_task->setMask(aMask);
+}
+
+void SoftOpPeakFinder::setTileWorkers(TileWorkers *workers)
+{
+  m_multi_task->setWorkers(workers);
 }
 
 bool SoftOpPeakFinder::addTo(TaskMgr &aMgr,int stage)
 {
   AutoMutex aLock(m_cond.mutex());
-  return m_task_manager.addTo(aMgr, stage);
+  if(m_mode != MULTI)
+    return m_task_manager.addTo(aMgr, stage);
+
+  aMgr.addSinkTask(stage,m_multi_task);
+  m_task_manager.incCounterStatus();
+  return true;
+}
+
+void SoftOpPeakFinder::prepare()
+{
+  m_multi_task->reset();
 }
 
 void SoftOpPeakFinder::clearCounterStatus()
@@ -826,6 +2514,7 @@ void SoftOpPeakFinder::setBufferSize(int size)
   for(NameMapIterator i = m_task_manager.begin();
       i != m_task_manager.end();++i)
     i->second.first->resizeHistory(size);
+  m_multi_task->resizeHistory(size);
   m_history_size = size;
 }
 
@@ -844,8 +2533,17 @@ void SoftOpPeakFinder::readPeaks(std::list<Tasks::PeakFinderResult>& result) con
   }
 }
 
+void SoftOpPeakFinder::readPeaks(int fromFrame,std::list<Peak>& peaks) const
+{
+  m_multi_task->getPeaks(fromFrame,peaks);
+}
+
 void SoftOpPeakFinder::setComputingMode(ComputingMode aComputingMode)
 {
+  AutoMutex aLock(m_cond.mutex());
+  m_mode = aComputingMode;
+  if(aComputingMode == SoftOpPeakFinder::MULTI)
+    return;
   for(NameMapConstIterator i = m_task_manager.begin(); i != m_task_manager.end();++i) {
     i->second.second->setComputingMode(aComputingMode == SoftOpPeakFinder::MAXIMUM ?
 				       Tasks::PeakFinderTask::MAXIMUM : Tasks::PeakFinderTask::CM );
@@ -854,6 +2552,12 @@ void SoftOpPeakFinder::setComputingMode(ComputingMode aComputingMode)
 
 void SoftOpPeakFinder::getComputingMode(ComputingMode &aComputingMode) const
 {
+  AutoMutex aLock(m_cond.mutex());
+  if(m_mode == SoftOpPeakFinder::MULTI)
+    {
+      aComputingMode = m_mode;
+      return;
+    }
   Tasks::PeakFinderTask::ComputingMode aMode;
   for(NameMapConstIterator i = m_task_manager.begin(); i != m_task_manager.end();++i) {
     i->second.second->getComputingMode(aMode); 
@@ -861,3 +2565,23 @@ void SoftOpPeakFinder::getComputingMode(ComputingMode &aComputingMode) const
   aComputingMode = aMode == Tasks::PeakFinderTask::MAXIMUM ?
     SoftOpPeakFinder::MAXIMUM : SoftOpPeakFinder::CM;
 }
+
+void SoftOpPeakFinder::setThreshold(double threshold)
+{
+  m_multi_task->setThreshold(threshold);
+}
+
+void SoftOpPeakFinder::getThreshold(double &threshold) const
+{
+  threshold = m_multi_task->getThreshold();
+}
+
+void SoftOpPeakFinder::setMinPeakSize(int nb_pixels)
+{
+  m_multi_task->setMinSize(nb_pixels);
+}
+
+void SoftOpPeakFinder::getMinPeakSize(int &nb_pixels) const
+{
+  nb_pixels = m_multi_task->getMinSize();
+}
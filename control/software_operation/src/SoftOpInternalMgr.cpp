@@ -27,6 +27,188 @@ using namespace lima;
 #include "processlib/SoftRoi.h"
 #include "processlib/Rotation.h"
 
+#include <algorithm>
+#include <limits>
+#include <vector>
+
+template<class INPUT> struct _BinSum {typedef long long type;};
+template<> struct _BinSum<unsigned long long> {typedef unsigned long long type;};
+template<> struct _BinSum<float> {typedef double type;};
+template<> struct _BinSum<double> {typedef double type;};
+
+/** @brief binning, flip, rotation and software roi in one pass.
+ *
+ *  Each pixel of the output roi is mapped back, through the rotation
+ *  and the flip, to its bin in the input frame, so only the pixels
+ *  kept by the roi are read and the intermediate images are never
+ *  built. Bins are summed and saturated to the pixel type.
+ *  Frames of other types or dimensions, or which roi is outside of the
+ *  output, are given to the separated tasks.
+ */
+class _GeometryTask : public LinkTask
+{
+public:
+  _GeometryTask(const Bin &aBin,const Flip &aFlip,RotationMode aRotation,
+		const Roi &aRoi,const std::vector<LinkTask*> &tasks) :
+    LinkTask(false),
+    m_bin_x(aBin.getX()),m_bin_y(aBin.getY()),
+    m_flip(aFlip),m_rotation(aRotation),m_roi(aRoi),m_tasks(tasks)
+  {
+    // factors are given in the rotated frame
+    if(m_rotation == Rotation_90 || m_rotation == Rotation_270)
+      std::swap(m_bin_x,m_bin_y);
+    for(std::vector<LinkTask*>::iterator i = m_tasks.begin();
+	i != m_tasks.end();++i)
+      (*i)->ref();
+  }
+
+  virtual ~_GeometryTask()
+  {
+    for(std::vector<LinkTask*>::iterator i = m_tasks.begin();
+	i != m_tasks.end();++i)
+      (*i)->unref();
+  }
+
+  virtual Data process(Data &aData)
+  {
+    switch(aData.type)
+      {
+      case Data::UINT8:	 return _process<unsigned char>(aData);
+      case Data::INT8:	 return _process<char>(aData);
+      case Data::UINT16: return _process<unsigned short>(aData);
+      case Data::INT16:	 return _process<short>(aData);
+      case Data::UINT32: return _process<unsigned int>(aData);
+      case Data::INT32:	 return _process<int>(aData);
+      case Data::UINT64: return _process<unsigned long long>(aData);
+      case Data::INT64:	 return _process<long long>(aData);
+      case Data::FLOAT:	 return _process<float>(aData);
+      case Data::DOUBLE: return _process<double>(aData);
+      default:		 return _processTasks(aData);
+      }
+  }
+
+private:
+  Data _processTasks(Data &aData)
+  {
+    Data aResult = aData;
+    for(std::vector<LinkTask*>::iterator i = m_tasks.begin();
+	i != m_tasks.end();++i)
+      aResult = (*i)->process(aResult);
+    return aResult;
+  }
+
+  template<class INPUT>
+  static INPUT _saturate(typename _BinSum<INPUT>::type value)
+  {
+    if(std::numeric_limits<INPUT>::is_integer)
+      {
+	if(value > typename _BinSum<INPUT>::type(std::numeric_limits<INPUT>::max()))
+	  return std::numeric_limits<INPUT>::max();
+	if(value < typename _BinSum<INPUT>::type(std::numeric_limits<INPUT>::min()))
+	  return std::numeric_limits<INPUT>::min();
+      }
+    return INPUT(value);
+  }
+
+  template<class INPUT>
+  Data _process(Data &aData)
+  {
+    if(aData.dimensions.size() != 2)
+      return _processTasks(aData);
+
+    int width = aData.dimensions[0];
+    // binned (and flipped) frame
+    int bin_width = width / m_bin_x;
+    int bin_height = aData.dimensions[1] / m_bin_y;
+    bool swapped = m_rotation == Rotation_90 || m_rotation == Rotation_270;
+    int out_width = swapped ? bin_height : bin_width;
+    int out_height = swapped ? bin_width : bin_height;
+
+    Roi aRoi = m_roi.isActive() ? m_roi :
+      Roi(Point(0,0),Size(out_width,out_height));
+    Point tl = aRoi.getTopLeft();
+    Point br = aRoi.getBottomRight();
+    if(br.x >= out_width || br.y >= out_height) // can't be cut
+      return _processTasks(aData);
+
+    int roi_width = br.x - tl.x + 1;
+    int roi_height = br.y - tl.y + 1;
+    Data aNewData = aData.mask();
+    aNewData.dimensions[0] = roi_width;
+    aNewData.dimensions[1] = roi_height;
+    Buffer *aNewBuffer = new Buffer(aNewData.size());
+    aNewData.setBuffer(aNewBuffer);
+    aNewBuffer->unref();
+
+    // binned pixel of an output pixel (x,y):
+    // (x0 + x * dxx + y * dxy,y0 + x * dyx + y * dyy)
+    int x0,y0,dxx,dxy,dyx,dyy;
+    _origin(tl,bin_width,bin_height,x0,y0,dxx,dxy,dyx,dyy);
+
+    const INPUT *src = (const INPUT*)aData.data();
+    INPUT *dst = (INPUT*)aNewData.data();
+    for(int y = 0;y < roi_height;++y)
+      {
+	int bx = x0 + y * dxy,by = y0 + y * dyy;
+	for(int x = 0;x < roi_width;++x,bx += dxx,by += dyx)
+	  {
+	    const INPUT *bin = src + long(by) * m_bin_y * width + bx * m_bin_x;
+	    if(m_bin_x == 1 && m_bin_y == 1)
+	      {
+		*dst++ = *bin;
+		continue;
+	      }
+	    typename _BinSum<INPUT>::type sum = 0;
+	    for(int j = 0;j < m_bin_y;++j,bin += width)
+	      for(int i = 0;i < m_bin_x;++i)
+		sum += bin[i];
+	    *dst++ = _saturate<INPUT>(sum);
+	  }
+      }
+    return aNewData;
+  }
+
+  /** @brief binned pixel of the roi top left and its steps along the
+   *  output x and y
+   */
+  void _origin(const Point &tl,int bin_width,int bin_height,
+	       int &x0,int &y0,int &dxx,int &dxy,int &dyx,int &dyy) const
+  {
+    // unrotate
+    switch(m_rotation)
+      {
+      case Rotation_90:		// (x,y) -> (h - 1 - y,x)
+	x0 = tl.y,y0 = bin_height - 1 - tl.x;
+	dxx = 0,dxy = 1,dyx = -1,dyy = 0;
+	break;
+      case Rotation_180:	// (x,y) -> (w - 1 - x,h - 1 - y)
+	x0 = bin_width - 1 - tl.x,y0 = bin_height - 1 - tl.y;
+	dxx = -1,dxy = 0,dyx = 0,dyy = -1;
+	break;
+      case Rotation_270:	// (x,y) -> (y,w - 1 - x)
+	x0 = bin_width - 1 - tl.y,y0 = tl.x;
+	dxx = 0,dxy = -1,dyx = 1,dyy = 0;
+	break;
+      default:
+	x0 = tl.x,y0 = tl.y;
+	dxx = 1,dxy = 0,dyx = 0,dyy = 1;
+	break;
+      }
+    // unflip
+    if(m_flip.x)
+      x0 = bin_width - 1 - x0,dxx = -dxx,dxy = -dxy;
+    if(m_flip.y)
+      y0 = bin_height - 1 - y0,dyx = -dyx,dyy = -dyy;
+  }
+
+  int				m_bin_x;
+  int				m_bin_y;
+  Flip				m_flip;
+  RotationMode			m_rotation;
+  Roi				m_roi;
+  std::vector<LinkTask*>	m_tasks;
+};
+
 SoftOpInternalMgr::SoftOpInternalMgr() :
   m_reconstruction_task(NULL),m_end_callback(NULL)
 {
@@ -108,10 +290,11 @@ void SoftOpInternalMgr::addTo(TaskMgr &aTaskMgr,
       ++aLastStage;
     }
 
-  Tasks::Binning *aBinTaskPt = NULL;
+  // geometric tasks, in the processing order
+  std::vector<LinkTask*> aGeometryTasks;
   if(m_bin.getX() > 1 || m_bin.getY() > 1)
     {
-      aBinTaskPt = new Tasks::Binning();
+      Tasks::Binning *aBinTaskPt = new Tasks::Binning();
       if(m_rotation == Rotation_90 || m_rotation == Rotation_270)
 	{
 	  aBinTaskPt->mXFactor = m_bin.getY();
@@ -122,12 +305,9 @@ void SoftOpInternalMgr::addTo(TaskMgr &aTaskMgr,
 	  aBinTaskPt->mXFactor = m_bin.getX();
 	  aBinTaskPt->mYFactor = m_bin.getY();
 	}
-      aTaskMgr.setLinkTask(aLastStage,aBinTaskPt);
-      aBinTaskPt->unref();
-      ++aLastStage;
+      aGeometryTasks.push_back(aBinTaskPt);
     }
 
-  Tasks::Flip *aFlipTaskPt = NULL;
   if(m_flip.x || m_flip.y)
     {
       Tasks::Flip::FLIP_MODE aMode = Tasks::Flip::FLIP_NONE;
@@ -138,14 +318,11 @@ void SoftOpInternalMgr::addTo(TaskMgr &aTaskMgr,
       else
 	aMode = Tasks::Flip::FLIP_Y;
       
-      aFlipTaskPt = new Tasks::Flip();
+      Tasks::Flip *aFlipTaskPt = new Tasks::Flip();
       aFlipTaskPt->setFlip(aMode);
-      aTaskMgr.setLinkTask(aLastStage,aFlipTaskPt);
-      aFlipTaskPt->unref();
-      ++aLastStage;
+      aGeometryTasks.push_back(aFlipTaskPt);
     }
   
-  Tasks::Rotation *aRotationTaskPt = NULL;
   if(m_rotation != Rotation_0)
     {
       Tasks::Rotation::Type aMode;
@@ -155,33 +332,44 @@ void SoftOpInternalMgr::addTo(TaskMgr &aTaskMgr,
 	case Rotation_270: aMode = Tasks::Rotation::R_270;break;
 	default: aMode = Tasks::Rotation::R_90;break;
 	}
-      aRotationTaskPt = new Tasks::Rotation();
+      Tasks::Rotation *aRotationTaskPt = new Tasks::Rotation();
       aRotationTaskPt->setType(aMode);
-      aTaskMgr.setLinkTask(aLastStage,aRotationTaskPt);
-      aRotationTaskPt->unref();
-      ++aLastStage;
+      aGeometryTasks.push_back(aRotationTaskPt);
     }
-  Tasks::SoftRoi *aSoftRoiTaskPt = NULL;
+
   if(m_roi.isActive())
     {
       Point topl= m_roi.getTopLeft();
       Point botr= m_roi.getBottomRight();
-      aSoftRoiTaskPt = new Tasks::SoftRoi();
+      Tasks::SoftRoi *aSoftRoiTaskPt = new Tasks::SoftRoi();
       aSoftRoiTaskPt->setRoi(topl.x, botr.x, topl.y, botr.y);
-      aTaskMgr.setLinkTask(aLastStage,aSoftRoiTaskPt);
-      aSoftRoiTaskPt->unref();
+      aGeometryTasks.push_back(aSoftRoiTaskPt);
+    }
+
+  // several of them are done at once, only reading the roi pixels
+  LinkTask *aLastTaskPt = NULL;
+  if(aGeometryTasks.size() > 1)
+    {
+      aLastTaskPt = new _GeometryTask(m_bin,m_flip,m_rotation,m_roi,
+				      aGeometryTasks);
+      aTaskMgr.setLinkTask(aLastStage,aLastTaskPt);
+      aLastTaskPt->unref();
       ++aLastStage;
     }
+  else if(!aGeometryTasks.empty())
+    {
+      aLastTaskPt = aGeometryTasks.front();
+      aTaskMgr.setLinkTask(aLastStage,aLastTaskPt);
+      ++aLastStage;
+    }
+  for(std::vector<LinkTask*>::iterator i = aGeometryTasks.begin();
+      i != aGeometryTasks.end();++i)
+    (*i)->unref();
+
   bool removeReconstructionTaskCallback = true;
   //Check now what is the last task to add a callback
-  if(aSoftRoiTaskPt)
-    aSoftRoiTaskPt->setEventCallback(m_end_callback);
-  else if(aRotationTaskPt)
-    aRotationTaskPt->setEventCallback(m_end_callback);
-  else if(aFlipTaskPt)
-    aFlipTaskPt->setEventCallback(m_end_callback);
-  else if(aBinTaskPt)
-    aBinTaskPt->setEventCallback(m_end_callback);
+  if(aLastTaskPt)
+    aLastTaskPt->setEventCallback(m_end_callback);
   else if(m_reconstruction_task)
     m_reconstruction_task->setEventCallback(m_end_callback),removeReconstructionTaskCallback = false;
 
@@ -189,4 +377,3 @@ void SoftOpInternalMgr::addTo(TaskMgr &aTaskMgr,
   if(m_reconstruction_task && removeReconstructionTaskCallback)
     m_reconstruction_task->setEventCallback(NULL);
 }
-
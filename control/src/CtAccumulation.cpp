@@ -22,10 +22,19 @@
 #include "lima/CtAccumulation.h"
 #include "lima/CtAcquisition.h"
 #include "lima/CtBuffer.h"
+#include "lima/CtThreadPools.h"
+#include "lima/MemUtils.h"
+#include "CtAccumulation_Kernels.h"
 #include "processlib/SinkTask.h"
 #ifndef __unix
 #include "SinkTaskMgr.i"
 #endif
+
+#include <algorithm>
+#include <cstring>
+#include <map>
+#include <vector>
+
 using namespace lima;
 /****************************************************************************
 CtAccumulation::_ImageReady4AccCallback
@@ -39,154 +48,247 @@ void CtAccumulation::_ImageReady4AccCallback::finished(Data &aData)
 }
 
 /*********************************************************************************
-			   calculation task
+			   accumulation buffer pool
 *********************************************************************************/
-template<class INPUT>
-static long long _calc_saturated_image_n_counter(const Data &src,Data &dst,
-						 const Data &mask,long long pixelThresholdValue)
-{
-  const INPUT *aSrcPt,*aEndPt;
-  aSrcPt = (const INPUT*)src.data();
-  int pixelnb = src.dimensions[0] * src.dimensions[1];
-  aEndPt = aSrcPt + pixelnb;
-  long long saturatedCounter = 0;
-  unsigned short *saturatedImagePt = (unsigned short*)dst.data();
-  const char *maskPt = (const char*)mask.data();
-  while(aSrcPt < aEndPt)
-    {
-      INPUT pixelValue = *aSrcPt;
-      if((!maskPt || *maskPt) &&
-	 pixelValue > pixelThresholdValue)
-	{
-	  ++(*saturatedImagePt);
-	  ++saturatedCounter;
-	}
-      ++aSrcPt,++saturatedImagePt;
-      if(maskPt) ++maskPt;
-    }
-  return saturatedCounter;
-}
-
-class CtAccumulation::_CalcSaturatedTask : public SinkTask<CtAccumulation::_CounterResult>
+/** @brief recycle the accumulation and saturated image buffers.
+ *
+ *  The pool is the destroy callback of the Buffers it gives, so memory
+ *  comes back to it when the last Data using it is released.
+ *  It outlives CtAccumulation until all its buffers are back.
+ */
+class CtAccumulation::_BufferPool : public Buffer::Callback
 {
-  DEB_CLASS_NAMESPC(DebModControl,"Calculate saturated pixel","Control");
+  DEB_CLASS_NAMESPC(DebModControl,"Accumulation::_BufferPool","Control");
 public:
-  _CalcSaturatedTask(_CalcSaturatedTaskMgr &mgr,CtAccumulation &acc_cnt,Data &dst) :
-    SinkTask<CtAccumulation::_CounterResult>(mgr),
-    m_cnt(acc_cnt),
-    m_dst(dst)
- {}
+  enum {ALIGNMENT = 64,MAX_IDLE = 4};
 
-  virtual void process(Data &aData)
+  _BufferPool() : m_closing(false) {}
+
+  Buffer* getBuffer(int size)
   {
     DEB_MEMBER_FUNCT();
-    DEB_PARAM() << DEB_VAR1(aData);
-    AutoMutex aLock(m_cnt.m_cond.mutex());
-    long long pixelThresholdValue = m_cnt.m_pars.pixelThresholdValue;
-    aLock.unlock();
-
-    CtAccumulation::_CounterResult result(aData.frameNumber);
-    Data &mask = m_cnt.m_calc_mask;
+    DEB_PARAM() << DEB_VAR1(size);
 
-    if(aData.dimensions != m_dst.dimensions)
+    AutoMutex aLock(m_mutex);
+    MemBuffer *mem = NULL;
+    IdleList &idle = m_idle[size];
+    if(!idle.empty())
       {
-      	DEB_ERROR() << "Saturated image size is != form data src";
-	return;
+	mem = idle.front();
+	idle.pop_front();
       }
+    aLock.unlock();
 
-    if(!mask.empty())
+    if(!mem)
       {
-	if(mask.depth() != 1)
+	mem = new MemBuffer();
+	try
 	  {
-	    DEB_ERROR() << "mask should by an unsigned/signed char";
-	    return;
+	    mem->alloc(size,ALIGNMENT);
 	  }
-	if(mask.dimensions != aData.dimensions)
+	catch(...)
 	  {
-	    DEB_ERROR() << "mask size is != with data size";
-	    return;
+	    delete mem;
+	    throw;
 	  }
       }
 
-    switch(aData.type)
+    Buffer *buffer = new Buffer();
+    buffer->data = mem->getPtr();
+    buffer->callback = this;
+
+    aLock.lock();
+    m_used[buffer->data] = mem;
+    return buffer;
+  }
+
+  virtual void destroy(void *dataPt)
+  {
+    AutoMutex aLock(m_mutex);
+    UsedMap::iterator i = m_used.find(dataPt);
+    if(i == m_used.end())
+      return;
+    MemBuffer *mem = i->second;
+    m_used.erase(i);
+
+    bool delete_pool = false;
+    if(m_closing)
+      {
+	delete mem;
+	delete_pool = m_used.empty();
+      }
+    else
+      {
+	IdleList &idle = m_idle[mem->getSize()];
+	if(idle.size() < MAX_IDLE)
+	  idle.push_back(mem);
+	else
+	  delete mem;
+      }
+    aLock.unlock();
+
+    if(delete_pool)
+      delete this;
+  }
+
+  /** @brief free the idle buffers (i.e: frame size changed)
+   */
+  void clear()
+  {
+    AutoMutex aLock(m_mutex);
+    IdleMap::iterator i,end = m_idle.end();
+    for(i = m_idle.begin();i != end;++i)
+      {
+	IdleList::iterator j,jend = i->second.end();
+	for(j = i->second.begin();j != jend;++j)
+	  delete *j;
+      }
+    m_idle.clear();
+  }
+
+  /** @brief the owner is gone, delete when all buffers are back
+   */
+  void release()
+  {
+    clear();
+    AutoMutex aLock(m_mutex);
+    m_closing = true;
+    bool delete_pool = m_used.empty();
+    aLock.unlock();
+
+    if(delete_pool)
+      delete this;
+  }
+
+private:
+  typedef std::list<MemBuffer*> IdleList;
+  typedef std::map<int,IdleList> IdleMap;
+  typedef std::map<void*,MemBuffer*> UsedMap;
+
+  Mutex		m_mutex;
+  IdleMap	m_idle;
+  UsedMap	m_used;
+  bool		m_closing;
+};
+
+/*********************************************************************************
+			     accumulation tile job
+*********************************************************************************/
+/** @brief one accumulation/saturation pass over a frame,
+ *  split in tiles of TILE_SIZE pixels
+ */
+class _AccJob : public TileWorkers::Job
+{
+public:
+  enum {TILE_SIZE = 64 * 1024};
+
+  _AccJob(CtAccumulation::Mode mode,Data &src,Data &acc,Data &aux,
+	  Data *saturatedImg,const Data &mask,
+	  long long pixelThresholdValue,int nbFrames) :
+    m_mode(mode),
+    m_type(src.type),
+    m_src(src.data()),
+    m_acc(acc.data()),
+    m_aux((double*)aux.data()),
+    m_sat(saturatedImg ? (unsigned short*)saturatedImg->data() : NULL),
+    m_mask((const char*)mask.data()),
+    m_threshold(pixelThresholdValue),
+    m_nb_frames(nbFrames),
+    m_nb_pixels(src.dimensions[0] * src.dimensions[1])
+  {
+    m_counters.resize(nbTiles(),0);
+  }
+
+  int nbTiles() const
+  {
+    return (m_nb_pixels + TILE_SIZE - 1) / TILE_SIZE;
+  }
+
+  long long saturatedCounter() const
+  {
+    long long saturatedCounter = 0;
+    for(unsigned int i = 0;i < m_counters.size();++i)
+      saturatedCounter += m_counters[i];
+    return saturatedCounter;
+  }
+
+  virtual void process(int tile)
+  {
+    int first_pixel = tile * TILE_SIZE;
+    int nb_pixels = std::min(int(TILE_SIZE),m_nb_pixels - first_pixel);
+    long long &counter = m_counters[tile];
+    switch(m_type)
       {
       case Data::UINT8:
-	result.value = 
-	  _calc_saturated_image_n_counter<unsigned char>(aData,m_dst,
-							  mask,pixelThresholdValue);
-	break;
+	counter = _process<unsigned char>(first_pixel,nb_pixels); break;
       case Data::INT8:
-	result.value = 
-	  _calc_saturated_image_n_counter<char>(aData,m_dst,
-						mask,pixelThresholdValue);
-	break;
+	counter = _process<char>(first_pixel,nb_pixels); break;
       case Data::UINT16:
-	result.value = 
-	  _calc_saturated_image_n_counter<unsigned short>(aData,m_dst,
-							  mask,pixelThresholdValue);
-	break;
+	counter = _process<unsigned short>(first_pixel,nb_pixels); break;
       case Data::INT16:
-	result.value = 
-	  _calc_saturated_image_n_counter<short>(aData,m_dst,
-						 mask,pixelThresholdValue);
-	break;
+	counter = _process<short>(first_pixel,nb_pixels); break;
       case Data::UINT32:
-	result.value = 
-	  _calc_saturated_image_n_counter<unsigned int>(aData,m_dst,
-							mask,pixelThresholdValue);
-	break;
+	counter = _process<unsigned int>(first_pixel,nb_pixels); break;
       case Data::INT32:
-	result.value = 
-	  _calc_saturated_image_n_counter<int>(aData,m_dst,
-					       mask,pixelThresholdValue);
-	break;
+	counter = _process<int>(first_pixel,nb_pixels); break;
       default:
-	DEB_ERROR() << "Wrong image type to calculate saturated image";
-	return;
+	break;
       }
-    _mgr.setResult(result);
-    m_cnt._callIfNeedThresholdCallback(aData,result.value);
   }
-private:
-  CtAccumulation& 	m_cnt;
-  Data			m_dst;
-};
 
-class CtAccumulation::_CalcEndCBK : public TaskEventCallback
-{
-  DEB_CLASS_NAMESPC(DebModControl,"_CalcEndCBK","Control");
-public:
-  _CalcEndCBK(CtAccumulation &cnt) : m_cnt(cnt) {}
-  virtual void finished(Data &aData)
+private:
+  template<class INPUT>
+  long long _process(int first_pixel,int nb_pixels)
   {
-    AutoMutex Lock(m_cnt.m_cond.mutex());
-    if(m_cnt.m_calc_pending_data.empty())
-      {
-	m_cnt.m_calc_ready = true;
-	m_cnt.m_cond.broadcast(); // in case of waiting for m_calc_ready
-      }
-    else
+    const INPUT *src = (const INPUT*)m_src + first_pixel;
+    unsigned short *sat = m_sat ? m_sat + first_pixel : NULL;
+    const char *mask = m_mask ? m_mask + first_pixel : NULL;
+    double *aux = m_aux ? m_aux + first_pixel : NULL;
+    bool first = m_nb_frames == 1;
+    switch(m_mode)
       {
-	std::pair<Data,Data> values = m_cnt.m_calc_pending_data.front();
-	m_cnt.m_calc_pending_data.pop_front();
-
-	_CalcSaturatedTask *calcTaskPt = new _CalcSaturatedTask(*m_cnt.m_calc_mgr,
-								m_cnt,values.second);
-	calcTaskPt->setEventCallback(m_cnt.m_calc_end);
-	TaskMgr *aCalcMgrPt = new TaskMgr();
-	aCalcMgrPt->addSinkTask(0,calcTaskPt);
-	calcTaskPt->unref();
-	aCalcMgrPt->setInputData(values.first);
-	PoolThreadMgr::get().addProcess(aCalcMgrPt);
+      case CtAccumulation::SUM:
+	return _acc_n_saturated(src,(int*)m_acc + first_pixel,sat,mask,
+				nb_pixels,m_threshold,first);
+      case CtAccumulation::SUM_FLOAT:
+	_acc_sum_double(src,(double*)m_acc + first_pixel,nb_pixels,
+			m_nb_frames);
+	break;
+      case CtAccumulation::MEAN:
+	_acc_welford(src,(double*)m_acc + first_pixel,(double*)NULL,
+		     nb_pixels,m_nb_frames);
+	break;
+      case CtAccumulation::VARIANCE:
+      case CtAccumulation::STD:
+	_acc_welford(src,(double*)m_acc + first_pixel,aux,
+		     nb_pixels,m_nb_frames);
+	break;
+      case CtAccumulation::MIN:
+      case CtAccumulation::MAX:
+	_acc_min_max(src,(INPUT*)m_acc + first_pixel,nb_pixels,m_nb_frames,
+		     m_mode == CtAccumulation::MAX);
+	break;
       }
+    return sat ? _calc_saturated(src,sat,mask,nb_pixels,m_threshold,first) : 0;
   }
-private:
-  CtAccumulation& m_cnt;
+
+  CtAccumulation::Mode	m_mode;
+  Data::TYPE		m_type;
+  const void*		m_src;
+  void*			m_acc;
+  double*		m_aux;
+  unsigned short*	m_sat;
+  const char*		m_mask;
+  long long		m_threshold;
+  int			m_nb_frames;
+  int			m_nb_pixels;
+  std::vector<long long> m_counters;
 };
 
 //	     ******** CtAccumulation::Parameters ********
 CtAccumulation::Parameters::Parameters() : 
   pixelThresholdValue(2^16),
+  mode(SUM),
   savingFlag(false),
   savePrefix("saturated_")
 {
@@ -213,6 +315,7 @@ public:
   
     accumulation_setting.set("active",pars.active);
     accumulation_setting.set("pixelThresholdValue",pars.pixelThresholdValue);
+    accumulation_setting.set("mode",convert_2_string(pars.mode));
     accumulation_setting.set("savingFlag",pars.savingFlag);
     accumulation_setting.set("savePrefix",pars.savePrefix);
   }
@@ -224,6 +327,9 @@ public:
     accumulation_setting.get("active",pars.active);
     accumulation_setting.get("pixelThresholdValue",
 			     pars.pixelThresholdValue);
+    std::string str_mode;
+    if(accumulation_setting.get("mode",str_mode))
+      convert_from_string(str_mode,pars.mode);
     accumulation_setting.get("savingFlag",pars.savingFlag);
     accumulation_setting.get("savePrefix",pars.savePrefix);
 
@@ -238,23 +344,26 @@ private:
 CtAccumulation::CtAccumulation(CtControl &ct) : 
   m_buffers_size(16),
   m_ct(ct),
-  m_calc_ready(true),
+  m_calc_running(0),
   m_threshold_cb(NULL),
-  m_last_acc_frame_nb(-1),
-  m_last_continue_flag(true)
+  m_last_continue_flag(true),
+  m_last_acc_slot(-1),
+  m_next_acc_frame_nb(0),
+  m_delivering(false),
+  m_mode(SUM)
 {
-  m_calc_end = new _CalcEndCBK(*this);
   m_calc_mgr = new _CalcSaturatedTaskMgr();
+  m_buffer_pool = new _BufferPool();
 }
 
 CtAccumulation::~CtAccumulation()
 {
   AutoMutex aLock(m_cond.mutex());
-  while(!m_calc_ready)
+  while(m_calc_running)
     m_cond.wait();
 
-  m_calc_end->unref();
   m_calc_mgr->unref();
+  m_buffer_pool->release();
 }
 
 void CtAccumulation::setParameters(const Parameters &pars)
@@ -262,7 +371,7 @@ void CtAccumulation::setParameters(const Parameters &pars)
   DEB_MEMBER_FUNCT();
 
   AutoMutex aLock(m_cond.mutex());
-  while(!m_calc_ready)
+  while(m_calc_running)
     m_cond.wait();
 
   m_pars = pars;
@@ -310,6 +419,24 @@ void CtAccumulation::getPixelThresholdValue(long long &pixelThresholdValue) cons
   DEB_RETURN() << DEB_VAR1(pixelThresholdValue);
 }
 
+void CtAccumulation::setMode(Mode mode)
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR1(mode);
+
+  AutoMutex aLock(m_cond.mutex());
+  m_pars.mode = mode;
+}
+
+void CtAccumulation::getMode(Mode &mode) const
+{
+  DEB_MEMBER_FUNCT();
+
+  AutoMutex aLock(m_cond.mutex());
+  mode = m_pars.mode;
+  DEB_RETURN() << DEB_VAR1(mode);
+}
+
 void CtAccumulation::getBufferSize(int &aBufferSize) const
 { 
   DEB_MEMBER_FUNCT();
@@ -389,7 +516,9 @@ void CtAccumulation::readSaturatedImageCounter(Data &saturatedImage,long frameNu
       //No more into buffer list
       if(frameNumber < oldestFrameNumber || frameNumber > lastFrameId)
 	THROW_CTL_ERROR(Error) << "Frame " << frameNumber << " not more available";
-      else
+      // partial sums not yet reduced
+      _AccSlotMap::iterator i = m_acc_slots.find(frameNumber);
+      if(i == m_acc_slots.end() || i->second.completed)
 	saturatedImage = m_saturated_images[frameNumber - oldestFrameNumber];
     }
   DEB_RETURN() << DEB_VAR1(saturatedImage);
@@ -448,7 +577,7 @@ void CtAccumulation::setMask(Data &mask)
   DEB_PARAM() << DEB_VAR1(mask);
 
   AutoMutex aLock(m_cond.mutex());
-  while(!m_calc_ready)
+  while(m_calc_running)
     m_cond.wait();
 
   m_calc_mask = mask.mask();
@@ -460,7 +589,7 @@ void CtAccumulation::registerThresholdCallback(ThresholdCallback &cb)
   DEB_PARAM() << DEB_VAR2(&cb, m_threshold_cb);
 
   AutoMutex aLock(m_cond.mutex());
-  while(!m_calc_ready)
+  while(m_calc_running)
     m_cond.wait();
 
   if(m_threshold_cb)
@@ -475,7 +604,7 @@ void CtAccumulation::unregisterThresholdCallback(ThresholdCallback &cb)
   DEB_PARAM() << DEB_VAR2(&cb, m_threshold_cb);
 
   AutoMutex aLock(m_cond.mutex());
-  while(!m_calc_ready)
+  while(m_calc_running)
     m_cond.wait();
   
   if(m_threshold_cb != &cb)
@@ -484,31 +613,6 @@ void CtAccumulation::unregisterThresholdCallback(ThresholdCallback &cb)
   m_threshold_cb = NULL;
 }
 
-void CtAccumulation::_calcSaturatedImageNCounters(Data &src,Data &dst)
-{
-  DEB_MEMBER_FUNCT();
-  DEB_PARAM() << DEB_VAR2(src,dst);
-
-  Data copiedSrc = src.copy();
-  AutoMutex Lock(m_cond.mutex());
-  if(m_calc_ready)
-    {
-      m_calc_ready = false;
-
-      _CalcSaturatedTask *calcTaskPt = new _CalcSaturatedTask(*m_calc_mgr,*this,dst);
-      calcTaskPt->setEventCallback(m_calc_end);
-      TaskMgr *aCalcMgrPt = new TaskMgr();
-      aCalcMgrPt->addSinkTask(0,calcTaskPt);
-      calcTaskPt->unref();
-      aCalcMgrPt->setInputData(copiedSrc);
-      PoolThreadMgr::get().addProcess(aCalcMgrPt);
-    }
-  else
-    {
-      std::pair<Data,Data> values(copiedSrc,dst);
-      m_calc_pending_data.push_back(values);
-    }
-}
 void CtAccumulation::_callIfNeedThresholdCallback(Data &aData,long long value)
 {
   DEB_MEMBER_FUNCT();
@@ -526,6 +630,7 @@ void CtAccumulation::prepare()
   AutoMutex aLock(m_cond.mutex());
   m_datas.clear();
   m_saturated_images.clear();
+  m_buffer_pool->clear();
   CtBuffer *buffer = m_ct.buffer();
   buffer->getNumber(m_buffers_size);
   CtAcquisition *acquisition = m_ct.acquisition();
@@ -535,7 +640,10 @@ void CtAccumulation::prepare()
 
   m_calc_mgr->resizeHistory(m_buffers_size * acc_nframes);
   m_last_continue_flag = true;
-  m_last_acc_frame_nb = -1;
+  m_acc_slots.clear();
+  m_last_acc_slot = -1;
+  m_next_acc_frame_nb = 0;
+  m_mode = m_pars.mode;
 }
 /** @brief this is an internal call from CtBuffer in case of accumulation
  */
@@ -550,7 +658,7 @@ bool CtAccumulation::_newFrameReady(Data &aData)
   m_ct.m_op_int->addTo(*mgr,internal_stage);
 
   if(internal_stage)
-    PoolThreadMgr::get().addProcess(mgr);
+    m_ct.threadPools()->addProcess(CtThreadPools::Processing,mgr);
   else
     {
       delete mgr;
@@ -559,6 +667,11 @@ bool CtAccumulation::_newFrameReady(Data &aData)
   return m_last_continue_flag;
 }
 /** @brief this is an internal call at the end of internal process or from CtBuffer
+ *
+ *  Sub frames may come in any order from several threads: each one is
+ *  added into a partial sum not used by an other thread. The thread
+ *  bringing the last sub frame of an accumulated frame reduces the
+ *  partial sums, then accumulated frames are given in order to CtControl.
  */
 bool CtAccumulation::_newBaseFrameReady(Data &aData)
 {
@@ -568,68 +681,257 @@ bool CtAccumulation::_newBaseFrameReady(Data &aData)
   CtAcquisition *acq = m_ct.acquisition();
   int nb_acc_frame;
   acq->getAccNbFrames(nb_acc_frame);
+  int accFrameNumber = aData.frameNumber / nb_acc_frame;
+
   AutoMutex aLock(m_cond.mutex());
-  while(aData.frameNumber != (m_last_acc_frame_nb + 1))
-    m_cond.wait();
+  _AccSlot &slot = _getAccSlot(accFrameNumber,aData,m_pars.active);
+  bool active = !slot.partials.front().saturated.empty();
+
+  _AccPartialList::iterator partial,end = slot.partials.end();
+  for(partial = slot.partials.begin();partial != end;++partial)
+    if(!partial->busy)
+      break;
+  if(partial == end)		// all in use, a new partial sum
+    {
+      partial = slot.partials.insert(end,_newAccPartial(aData,accFrameNumber,
+							active));
+      DEB_TRACE() << "New partial sum for " << DEB_VAR2(accFrameNumber,
+							 slot.partials.size());
+    }
+  partial->busy = true;
+  int nbFrames = ++partial->nb_frames;
+  Data accFrame = partial->acc;
+  Data aux = partial->aux;
+  Data saturatedImg = partial->saturated;
+  if(active)
+    ++m_calc_running;
+  Data mask = m_calc_mask;
+  long long pixelThresholdValue = m_pars.pixelThresholdValue;
+  aLock.unlock();
 
-  bool active = m_pars.active;
-  if(!(aData.frameNumber % nb_acc_frame)) // new Data has to be created
+  long long saturatedCounter;
+  try
     {
-      int nextFrameNumber;
-      if(m_datas.empty())	// Init (first Frame)
-	nextFrameNumber = 0;
-      else
-	nextFrameNumber = m_datas.back().frameNumber + 1;
+      saturatedCounter = _accFrame(aData,accFrame,aux,saturatedImg,mask,
+				   pixelThresholdValue,nbFrames);
+    }
+  catch(...)
+    {
+      aLock.lock();
+      partial->busy = false;
+      if(active)
+	--m_calc_running;
+      m_cond.broadcast();
+      throw;
+    }
+
+  if(active && saturatedCounter >= 0)
+    {
+      CtAccumulation::_CounterResult result(aData.frameNumber);
+      result.value = saturatedCounter;
+      m_calc_mgr->setResult(result);
+      _callIfNeedThresholdCallback(aData,saturatedCounter);
+    }
+
+  aLock.lock();
+  partial->busy = false;
+  if(active)
+    --m_calc_running;
+  m_cond.broadcast();
+
+  if(++slot.nb_received == nb_acc_frame)
+    {
+      // no other thread can use this slot anymore
+      aLock.unlock();
+      _reduceAccSlot(slot);
+      aLock.lock();
+      slot.completed = true;
+    }
+  _deliverAccFrames(aLock);
+
+  return m_last_continue_flag;
+}
 
-      Data newData;
-      newData.type = Data::INT32;
-      newData.dimensions = aData.dimensions;
-      newData.frameNumber = nextFrameNumber;
-      newData.timestamp = aData.timestamp;
-      newData.buffer = new Buffer(newData.size());
-      memset(newData.data(),0,newData.size());
-      m_datas.push_back(newData);
+/** @brief get the slot of an accumulated frame, creating it
+ *  and the previous ones if needed so that m_datas stays in order
+ *  This methode should be call under Lock
+ */
+CtAccumulation::_AccSlot& 
+CtAccumulation::_getAccSlot(int accFrameNumber,const Data &aData,bool active)
+{
+  DEB_MEMBER_FUNCT();
+
+  for(;m_last_acc_slot < accFrameNumber;++m_last_acc_slot)
+    {
+      int frameNumber = m_last_acc_slot + 1;
+      DEB_TRACE() << "New accumulated frame " << DEB_VAR1(frameNumber);
+      _AccSlot &slot = m_acc_slots[frameNumber];
+      _AccPartial partial = _newAccPartial(aData,frameNumber,active);
+      slot.partials.push_back(partial);
+      switch(m_mode)
+	{
+	case SUM: case MIN: case MAX:
+	  slot.result = partial.acc; break;
+	default:
+	  // published before the frame completes, so never expose
+	  // the previous content of the pool buffer
+	  slot.result = _newAccData(Data::FLOAT,aData,frameNumber);
+	  memset(slot.result.data(),0,slot.result.size());
+	  break;
+	}
 
+      m_datas.push_back(slot.result);
       if(long(m_datas.size()) > m_buffers_size)
 	m_datas.pop_front();
 
-      // create also the new image for saturated counters
+      // keep also the image for saturated counters
       if(active)
 	{
-	  Data newSatImg;
-	  newSatImg.type = Data::UINT16;
-	  newSatImg.dimensions = aData.dimensions;
-	  newSatImg.frameNumber = nextFrameNumber;
-	  newSatImg.timestamp = aData.timestamp;
-	  newSatImg.buffer = new Buffer(newSatImg.size());
-	  memset(newSatImg.data(),0,newSatImg.size());
-	  m_saturated_images.push_back(newSatImg);
-
+	  m_saturated_images.push_back(partial.saturated);
 	  if(long(m_saturated_images.size()) > m_buffers_size)
 	    m_saturated_images.pop_front();
 	}
+    }
+
+  _AccSlotMap::iterator i = m_acc_slots.find(accFrameNumber);
+  if(i == m_acc_slots.end())
+    THROW_CTL_ERROR(Error) << "Accumulated frame " << accFrameNumber
+			   << " already delivered";
+  return i->second;
+}
 
+/** @brief reduce all partial sums of the slot into the first one,
+ *  then compute the accumulated frame for the float modes
+ */
+void CtAccumulation::_reduceAccSlot(_AccSlot &slot)
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR1(slot.partials.size());
+
+  _AccPartial &result = slot.partials.front();
+  int nb_items = result.acc.dimensions[0] * result.acc.dimensions[1];
+  _AccPartialList::iterator i = slot.partials.begin(),end = slot.partials.end();
+  for(++i;i != end;++i)
+    {
+      switch(m_mode)
+	{
+	case SUM:
+	  _addFrame((const int*)i->acc.data(),(int*)result.acc.data(),nb_items);
+	  break;
+	case SUM_FLOAT:
+	  _addFrame((const double*)i->acc.data(),(double*)result.acc.data(),
+		    nb_items);
+	  break;
+	case MEAN:
+	case VARIANCE:
+	case STD:
+	  _mergeWelford((const double*)i->acc.data(),(const double*)i->aux.data(),
+			i->nb_frames,
+			(double*)result.acc.data(),(double*)result.aux.data(),
+			result.nb_frames,nb_items);
+	  break;
+	case MIN:
+	case MAX:
+	  {
+	    bool max = m_mode == MAX;
+	    void *src = i->acc.data(),*dst = result.acc.data();
+	    switch(result.acc.type)
+	      {
+	      case Data::UINT8:
+		_minMaxFrame((unsigned char*)src,(unsigned char*)dst,nb_items,max);
+		break;
+	      case Data::INT8:
+		_minMaxFrame((char*)src,(char*)dst,nb_items,max);
+		break;
+	      case Data::UINT16:
+		_minMaxFrame((unsigned short*)src,(unsigned short*)dst,nb_items,max);
+		break;
+	      case Data::INT16:
+		_minMaxFrame((short*)src,(short*)dst,nb_items,max);
+		break;
+	      case Data::UINT32:
+		_minMaxFrame((unsigned int*)src,(unsigned int*)dst,nb_items,max);
+		break;
+	      default:
+		_minMaxFrame((int*)src,(int*)dst,nb_items,max);
+		break;
+	      }
+	  }
+	  break;
+	}
+      result.nb_frames += i->nb_frames;
+      if(!result.saturated.empty())
+	_addFrame((const unsigned short*)i->saturated.data(),
+		  (unsigned short*)result.saturated.data(),nb_items);
     }
-  Data accFrame = m_datas.back();
-  Data saturatedImg;
-  if(active)
-    saturatedImg = m_saturated_images.back();
-  aLock.unlock();
+  // give back the partial buffers to the pool
+  slot.partials.resize(1);
 
-  if(active)
-    _calcSaturatedImageNCounters(aData,saturatedImg);
+  if(slot.result.buffer == result.acc.buffer)
+    return;
+
+  float *dst = (float*)slot.result.data();
+  switch(m_mode)
+    {
+    case VARIANCE:
+    case STD:
+      _finalVariance((const double*)result.aux.data(),result.nb_frames,
+		     m_mode == STD,dst,nb_items);
+      break;
+    default:			// SUM_FLOAT,MEAN
+      {
+	const double *acc = (const double*)result.acc.data();
+	for(int j = 0;j < nb_items;++j)
+	  dst[j] = float(acc[j]);
+      }
+      break;
+    }
+  // the state buffers are not needed anymore
+  result.acc = Data();
+  result.aux = Data();
+}
 
-  _accFrame(aData,accFrame);
+/** @brief give the completed accumulated frames, in order, to CtControl.
+ *  Only one thread delivers at a time, the others just leave
+ *  their completed frames.
+ *  This methode should be call under Lock
+ */
+void CtAccumulation::_deliverAccFrames(AutoMutex &aLock)
+{
+  DEB_MEMBER_FUNCT();
 
-  if(!((aData.frameNumber + 1) % nb_acc_frame))
-    m_last_continue_flag = m_ct.newFrameReady(accFrame);
+  if(m_delivering)
+    return;
+  m_delivering = true;
 
-  aLock.lock();
-  m_last_acc_frame_nb = aData.frameNumber;
-  m_cond.broadcast();
+  _AccSlotMap::iterator i;
+  while((i = m_acc_slots.find(m_next_acc_frame_nb)) != m_acc_slots.end() &&
+	i->second.completed)
+    {
+      Data accFrame = i->second.result;
+      m_acc_slots.erase(i);
+      ++m_next_acc_frame_nb;
+      aLock.unlock();
 
-  return m_last_continue_flag;
+      bool continueFlag;
+      try
+	{
+	  continueFlag = m_ct.newFrameReady(accFrame);
+	}
+      catch(...)
+	{
+	  aLock.lock();
+	  m_delivering = false;
+	  throw;
+	}
+
+      aLock.lock();
+      m_last_continue_flag = continueFlag;
+    }
+
+  m_delivering = false;
 }
+
 /** @brief retrived the image from the buffer
     @param frameNumber == acquisition image id
     @return aReturnData the associated data
@@ -657,33 +959,114 @@ void CtAccumulation::getFrame(Data &aReturnData,int frameNumber)
 }
 
 
-template <class SrcType, class DstType> 
-void accumulateFrame(void *src_ptr,void *dst_ptr,int nb_items)
+/** @brief new accumulation or saturated image buffer, from the pool
+ */
+Data CtAccumulation::_newAccData(Data::TYPE type,const Data &aData,
+				 int frameNumber)
+{
+  Data newData;
+  newData.type = type;
+  newData.dimensions = aData.dimensions;
+  newData.frameNumber = frameNumber;
+  newData.timestamp = aData.timestamp;
+  newData.buffer = m_buffer_pool->getBuffer(newData.size());
+  return newData;
+}
+
+/** @brief new partial sum buffers for the running mode
+ */
+CtAccumulation::_AccPartial 
+CtAccumulation::_newAccPartial(const Data &aData,int frameNumber,bool active)
+{
+  _AccPartial partial;
+  switch(m_mode)
+    {
+    case SUM:
+      partial.acc = _newAccData(Data::INT32,aData,frameNumber); break;
+    case MIN: case MAX:
+      partial.acc = _newAccData(aData.type,aData,frameNumber); break;
+    default:
+      partial.acc = _newAccData(Data::DOUBLE,aData,frameNumber); break;
+    }
+  if(m_mode == VARIANCE || m_mode == STD)
+    partial.aux = _newAccData(Data::DOUBLE,aData,frameNumber);
+  if(active)
+    partial.saturated = _newAccData(Data::UINT16,aData,frameNumber);
+  return partial;
+}
+
+/** @brief type of the accumulated frames for a sub frame type
+ *  (mode of the prepared acquisition, as used by the data path)
+ */
+ImageType CtAccumulation::_getImageType(ImageType srcType) const
 {
-  SrcType *sp  = (SrcType *) src_ptr;
-  DstType *dp = (DstType *) dst_ptr;
-	
-  for(int i = nb_items;i;--i,++sp,++dp)
-    *dp += *sp;
+  AutoMutex aLock(m_cond.mutex());
+  switch(m_mode)
+    {
+    case SUM: return Bpp32S;
+    case MIN: case MAX: return srcType;
+    default: return Bpp32F;
+    }
 }
 
-void CtAccumulation::_accFrame(Data &src,Data &dst)
+/** @brief add src into the partial sum dst (and aux) of the running mode
+ *  and, if saturatedImg is not empty, count/mark the pixels above
+ *  pixelThresholdValue, in a single pass
+ *  @param nbFrames the number of sub frames in dst including src
+ *  @return the number of saturated pixels, -1 if not calculated
+ */
+long long CtAccumulation::_accFrame(Data &src,Data &dst,Data &aux,
+				    Data &saturatedImg,const Data &mask,
+				    long long pixelThresholdValue,
+				    int nbFrames)
 {
   DEB_MEMBER_FUNCT();
-  DEB_PARAM() << DEB_VAR2(src,dst);
+  DEB_PARAM() << DEB_VAR4(src,dst,saturatedImg,nbFrames);
 
-  int nb_items = src.dimensions[0] * src.dimensions[1];
   switch(src.type)
     {
-    case Data::UINT8: 	accumulateFrame<unsigned char,int>	(src.data(),dst.data(),nb_items);break;
-    case Data::INT8: 	accumulateFrame<char,int>		(src.data(),dst.data(),nb_items);break;
-    case Data::UINT16: 	accumulateFrame<unsigned short,int>	(src.data(),dst.data(),nb_items);break;
-    case Data::INT16: 	accumulateFrame<short,int>		(src.data(),dst.data(),nb_items);break;
-    case Data::UINT32: 	accumulateFrame<unsigned int,int>	(src.data(),dst.data(),nb_items);break;
-    case Data::INT32: 	accumulateFrame<int,int>		(src.data(),dst.data(),nb_items);break;
+    case Data::UINT8: case Data::INT8:
+    case Data::UINT16: case Data::INT16:
+    case Data::UINT32: case Data::INT32:
+      break;
     default:
       THROW_CTL_ERROR(Error) << "Data type for accumulation is not yet managed";
     }
+  if((m_mode == MIN || m_mode == MAX) && src.type != dst.type)
+    THROW_CTL_ERROR(Error) << "Sub frame type changed during accumulation";
+
+  bool firstFrame = nbFrames == 1;
+  bool calcSaturated = !saturatedImg.empty();
+  if(calcSaturated && saturatedImg.dimensions != src.dimensions)
+    {
+      DEB_ERROR() << "Saturated image size is != form data src";
+      calcSaturated = false;
+    }
+  if(calcSaturated && !mask.empty())
+    {
+      if(mask.depth() != 1)
+	{
+	  DEB_ERROR() << "mask should by an unsigned/signed char";
+	  calcSaturated = false;
+	}
+      else if(mask.dimensions != src.dimensions)
+	{
+	  DEB_ERROR() << "mask size is != with data size";
+	  calcSaturated = false;
+	}
+    }
+  if(!calcSaturated && !saturatedImg.empty() && firstFrame)
+    memset(saturatedImg.data(),0,saturatedImg.size());
+
+  _AccJob job(m_mode,src,dst,aux,calcSaturated ? &saturatedImg : NULL,mask,
+	      pixelThresholdValue,nbFrames);
+  TileWorkers& aWorkers =
+    m_ct.threadPools()->getTileWorkers(CtThreadPools::Processing);
+  aWorkers.run(job,job.nbTiles());
+
+  long long saturatedCounter = calcSaturated ? job.saturatedCounter() : -1;
+  DEB_RETURN() << DEB_VAR1(saturatedCounter);
+  return saturatedCounter;
 }
 
 #ifdef WITH_CONFIG
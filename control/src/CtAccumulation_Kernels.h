@@ -0,0 +1,394 @@
+//###########################################################################
+// This file is part of LImA, a Library for Image Acquisition
+//
+// Copyright (C) : 2009-2011
+// European Synchrotron Radiation Facility
+// BP 220, Grenoble 38043
+// FRANCE
+//
+// This is free software; you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation; either version 3 of the License, or
+// (at your option) any later version.
+//
+// This software is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program; if not, see <http://www.gnu.org/licenses/>.
+//###########################################################################
+#ifndef CTACCUMULATION_KERNELS_H
+#define CTACCUMULATION_KERNELS_H
+
+#include <algorithm>
+#include <cmath>
+#include <cstring>
+#include <limits>
+
+#if defined(__GNUC__) && (defined(__x86_64__) || defined(__i386__))
+#include <immintrin.h>
+#endif
+
+namespace lima {
+
+/*********************************************************************************
+		     fused accumulation/saturation kernels
+*********************************************************************************/
+/** @brief threshold test prepared for the vectorized kernels
+ *
+ *  value is the threshold clamped to the INPUT range, unsigned 32 bit
+ *  pixels are compared as signed after flipping their sign bit (bias).
+ */
+struct _AccThreshold
+{
+  int	value;
+  int	bias;
+  bool	never;		///< no pixel can be above
+  bool	always;		///< all pixels are above
+};
+
+template<class INPUT>
+static _AccThreshold _acc_threshold(long long pixelThresholdValue)
+{
+  _AccThreshold t;
+  long long min_val = std::numeric_limits<INPUT>::min();
+  long long max_val = std::numeric_limits<INPUT>::max();
+  t.never = pixelThresholdValue >= max_val;
+  t.always = pixelThresholdValue < min_val;
+  t.bias = (sizeof(INPUT) == 4 && !std::numeric_limits<INPUT>::is_signed) ?
+    int(0x80000000) : 0;
+  long long value = (t.never || t.always) ? 0 : pixelThresholdValue;
+  t.value = int((unsigned int)value ^ (unsigned int)t.bias);
+  return t;
+}
+
+/** @brief accumulate src into acc and, if sat, count the pixels
+ *  above threshold and increment them in the saturated image.
+ *
+ *  On the first frame of an accumulation acc and sat are overwritten,
+ *  so they don't have to be cleared.
+ */
+template<class INPUT>
+static long long _acc_n_saturated_scalar(const INPUT *src,int *acc,
+					 unsigned short *sat,const char *mask,
+					 int nb_pixels,long long threshold,
+					 bool first)
+{
+  long long saturatedCounter = 0;
+  for(int i = 0;i < nb_pixels;++i)
+    {
+      INPUT pixelValue = src[i];
+      acc[i] = (first ? 0 : acc[i]) + pixelValue;
+      if(sat)
+	{
+	  int saturated = (!mask || mask[i]) && pixelValue > threshold;
+	  sat[i] = (first ? 0 : sat[i]) + saturated;
+	  saturatedCounter += saturated;
+	}
+    }
+  return saturatedCounter;
+}
+
+#if defined(__GNUC__) && (defined(__x86_64__) || defined(__i386__)) && \
+    (__GNUC__ > 4 || (__GNUC__ == 4 && __GNUC_MINOR__ >= 9))
+#define ACC_X86_SIMD
+
+// --- load and widen 4 (SSE4.1) or 8 (AVX2) pixels to 32 bit lanes
+#define SSE41 __attribute__((target("sse4.1")))
+#define AVX2 __attribute__((target("avx2")))
+
+SSE41 static inline __m128i _acc_load4(const unsigned char *p)
+{
+  int v; memcpy(&v,p,sizeof(v));
+  return _mm_cvtepu8_epi32(_mm_cvtsi32_si128(v));
+}
+SSE41 static inline __m128i _acc_load4(const char *p)
+{
+  int v; memcpy(&v,p,sizeof(v));
+  return _mm_cvtepi8_epi32(_mm_cvtsi32_si128(v));
+}
+SSE41 static inline __m128i _acc_load4(const unsigned short *p)
+{ return _mm_cvtepu16_epi32(_mm_loadl_epi64((const __m128i*)p)); }
+SSE41 static inline __m128i _acc_load4(const short *p)
+{ return _mm_cvtepi16_epi32(_mm_loadl_epi64((const __m128i*)p)); }
+SSE41 static inline __m128i _acc_load4(const unsigned int *p)
+{ return _mm_loadu_si128((const __m128i*)p); }
+SSE41 static inline __m128i _acc_load4(const int *p)
+{ return _mm_loadu_si128((const __m128i*)p); }
+
+AVX2 static inline __m256i _acc_load8(const unsigned char *p)
+{ return _mm256_cvtepu8_epi32(_mm_loadl_epi64((const __m128i*)p)); }
+AVX2 static inline __m256i _acc_load8(const char *p)
+{ return _mm256_cvtepi8_epi32(_mm_loadl_epi64((const __m128i*)p)); }
+AVX2 static inline __m256i _acc_load8(const unsigned short *p)
+{ return _mm256_cvtepu16_epi32(_mm_loadu_si128((const __m128i*)p)); }
+AVX2 static inline __m256i _acc_load8(const short *p)
+{ return _mm256_cvtepi16_epi32(_mm_loadu_si128((const __m128i*)p)); }
+AVX2 static inline __m256i _acc_load8(const unsigned int *p)
+{ return _mm256_loadu_si256((const __m256i*)p); }
+AVX2 static inline __m256i _acc_load8(const int *p)
+{ return _mm256_loadu_si256((const __m256i*)p); }
+
+/** @brief vectorized kernel, 8 pixels per iteration.
+ *  Return the number of pixels done, the caller finishes the tail.
+ */
+template<class INPUT>
+SSE41 static int _acc_n_saturated_sse41(const INPUT *src,int *acc,
+					unsigned short *sat,const char *mask,
+					int nb_pixels,const _AccThreshold &t,
+					bool first,long long &saturatedCounter)
+{
+  const __m128i zero = _mm_setzero_si128();
+  const __m128i thr = _mm_set1_epi32(t.value);
+  const __m128i bias = _mm_set1_epi32(t.bias);
+  const __m128i force_or = _mm_set1_epi32(t.always ? -1 : 0);
+  const __m128i force_and = _mm_set1_epi32(t.never ? 0 : -1);
+  int i = 0;
+  for(;i + 8 <= nb_pixels;i += 8)
+    {
+      __m128i v0 = _acc_load4(src + i),v1 = _acc_load4(src + i + 4);
+      __m128i *accPt = (__m128i*)(acc + i);
+      __m128i a0 = first ? v0 : _mm_add_epi32(_mm_loadu_si128(accPt),v0);
+      __m128i a1 = first ? v1 : _mm_add_epi32(_mm_loadu_si128(accPt + 1),v1);
+      _mm_storeu_si128(accPt,a0);
+      _mm_storeu_si128(accPt + 1,a1);
+      if(!sat)
+	continue;
+
+      __m128i m0 = _mm_cmpgt_epi32(_mm_xor_si128(v0,bias),thr);
+      __m128i m1 = _mm_cmpgt_epi32(_mm_xor_si128(v1,bias),thr);
+      __m128i m = _mm_packs_epi32(m0,m1);
+      m = _mm_and_si128(_mm_or_si128(m,force_or),force_and);
+      if(mask)
+	{
+	  __m128i masked = _mm_loadl_epi64((const __m128i*)(mask + i));
+	  masked = _mm_cmpeq_epi16(_mm_cvtepi8_epi16(masked),zero);
+	  m = _mm_andnot_si128(masked,m);
+	}
+      __m128i *satPt = (__m128i*)(sat + i);
+      __m128i s = first ? zero : _mm_loadu_si128(satPt);
+      _mm_storeu_si128(satPt,_mm_sub_epi16(s,m));
+      saturatedCounter += __builtin_popcount(_mm_movemask_epi8(m)) / 2;
+    }
+  return i;
+}
+
+/** @brief same as above with AVX2, 16 pixels per iteration
+ */
+template<class INPUT>
+AVX2 static int _acc_n_saturated_avx2(const INPUT *src,int *acc,
+				      unsigned short *sat,const char *mask,
+				      int nb_pixels,const _AccThreshold &t,
+				      bool first,long long &saturatedCounter)
+{
+  const __m256i zero = _mm256_setzero_si256();
+  const __m256i thr = _mm256_set1_epi32(t.value);
+  const __m256i bias = _mm256_set1_epi32(t.bias);
+  const __m256i force_or = _mm256_set1_epi32(t.always ? -1 : 0);
+  const __m256i force_and = _mm256_set1_epi32(t.never ? 0 : -1);
+  int i = 0;
+  for(;i + 16 <= nb_pixels;i += 16)
+    {
+      __m256i v0 = _acc_load8(src + i),v1 = _acc_load8(src + i + 8);
+      __m256i *accPt = (__m256i*)(acc + i);
+      __m256i a0 = first ? v0 : _mm256_add_epi32(_mm256_loadu_si256(accPt),v0);
+      __m256i a1 = first ? v1 : _mm256_add_epi32(_mm256_loadu_si256(accPt + 1),v1);
+      _mm256_storeu_si256(accPt,a0);
+      _mm256_storeu_si256(accPt + 1,a1);
+      if(!sat)
+	continue;
+
+      __m256i m0 = _mm256_cmpgt_epi32(_mm256_xor_si256(v0,bias),thr);
+      __m256i m1 = _mm256_cmpgt_epi32(_mm256_xor_si256(v1,bias),thr);
+      // packs works on 128 bit lanes, restore the pixel order
+      __m256i m = _mm256_permute4x64_epi64(_mm256_packs_epi32(m0,m1),0xd8);
+      m = _mm256_and_si256(_mm256_or_si256(m,force_or),force_and);
+      if(mask)
+	{
+	  __m128i masked8 = _mm_loadu_si128((const __m128i*)(mask + i));
+	  __m256i masked = _mm256_cmpeq_epi16(_mm256_cvtepi8_epi16(masked8),zero);
+	  m = _mm256_andnot_si256(masked,m);
+	}
+      __m256i *satPt = (__m256i*)(sat + i);
+      __m256i s = first ? zero : _mm256_loadu_si256(satPt);
+      _mm256_storeu_si256(satPt,_mm256_sub_epi16(s,m));
+      saturatedCounter += __builtin_popcount((unsigned int)_mm256_movemask_epi8(m)) / 2;
+    }
+  return i;
+}
+
+#undef SSE41
+#undef AVX2
+#endif //ACC_X86_SIMD
+
+enum _AccKernel {ACC_SCALAR,ACC_SSE41,ACC_AVX2};
+
+/** @brief the fastest fused kernel this cpu can run
+ */
+static inline _AccKernel _acc_kernel()
+{
+#ifdef ACC_X86_SIMD
+  if(__builtin_cpu_supports("avx2"))
+    return ACC_AVX2;
+  else if(__builtin_cpu_supports("sse4.1"))
+    return ACC_SSE41;
+#endif
+  return ACC_SCALAR;
+}
+
+/** @brief fused accumulation/saturation of nb_pixels with kernel,
+ *  the vectorized kernels leave their tail to the scalar one
+ */
+template<class INPUT>
+static long long _acc_n_saturated(const INPUT *src,int *acc,
+				  unsigned short *sat,const char *mask,
+				  int nb_pixels,long long pixelThresholdValue,
+				  bool first,_AccKernel kernel = _acc_kernel())
+{
+  long long saturatedCounter = 0;
+  int done = 0;
+#ifdef ACC_X86_SIMD
+  _AccThreshold t = _acc_threshold<INPUT>(pixelThresholdValue);
+  switch(kernel)
+    {
+    case ACC_AVX2:
+      done = _acc_n_saturated_avx2(src,acc,sat,mask,nb_pixels,t,first,
+				   saturatedCounter);
+      break;
+    case ACC_SSE41:
+      done = _acc_n_saturated_sse41(src,acc,sat,mask,nb_pixels,t,first,
+				    saturatedCounter);
+      break;
+    default:
+      break;
+    }
+#endif
+  saturatedCounter += 
+    _acc_n_saturated_scalar(src + done,acc + done,sat ? sat + done : NULL,
+			    mask ? mask + done : NULL,nb_pixels - done,
+			    pixelThresholdValue,first);
+  return saturatedCounter;
+}
+
+/** @brief statistical reductions, scalar.
+ *  count is the number of sub frames in acc including this one,
+ *  on the first one acc (and m2) are overwritten.
+ */
+template<class INPUT>
+static void _acc_sum_double(const INPUT *src,double *acc,int nb_pixels,
+			    int count)
+{
+  for(int i = 0;i < nb_pixels;++i)
+    acc[i] = (count == 1 ? 0. : acc[i]) + src[i];
+}
+
+/** @brief Welford running mean and sum of squared differences (if m2)
+ */
+template<class INPUT>
+static void _acc_welford(const INPUT *src,double *mean,double *m2,
+			 int nb_pixels,int count)
+{
+  if(count == 1)
+    {
+      for(int i = 0;i < nb_pixels;++i)
+	mean[i] = src[i];
+      if(m2)
+	memset(m2,0,nb_pixels * sizeof(double));
+      return;
+    }
+
+  double inv_count = 1. / count;
+  for(int i = 0;i < nb_pixels;++i)
+    {
+      double value = src[i];
+      double delta = value - mean[i];
+      mean[i] += delta * inv_count;
+      if(m2)
+	m2[i] += delta * (value - mean[i]);
+    }
+}
+
+template<class INPUT>
+static void _acc_min_max(const INPUT *src,INPUT *acc,int nb_pixels,
+			 int count,bool max)
+{
+  if(count == 1)
+    memcpy(acc,src,nb_pixels * sizeof(INPUT));
+  else if(max)
+    for(int i = 0;i < nb_pixels;++i)
+      acc[i] = std::max(acc[i],src[i]);
+  else
+    for(int i = 0;i < nb_pixels;++i)
+      acc[i] = std::min(acc[i],src[i]);
+}
+
+/** @brief saturated image and counter alone, for the modes
+ *  which don't use the fused sum kernel
+ */
+template<class INPUT>
+static long long _calc_saturated(const INPUT *src,unsigned short *sat,
+				 const char *mask,int nb_pixels,
+				 long long pixelThresholdValue,bool first)
+{
+  long long saturatedCounter = 0;
+  for(int i = 0;i < nb_pixels;++i)
+    {
+      int saturated = (!mask || mask[i]) && src[i] > pixelThresholdValue;
+      sat[i] = (first ? 0 : sat[i]) + saturated;
+      saturatedCounter += saturated;
+    }
+  return saturatedCounter;
+}
+
+/*********************************************************************************
+			    partial sums reduction
+*********************************************************************************/
+template <class T>
+static void _addFrame(const T *src,T *dst,int nb_items)
+{
+  for(int i = 0;i < nb_items;++i)
+    dst[i] += src[i];
+}
+
+template <class T>
+static void _minMaxFrame(const T *src,T *dst,int nb_items,bool max)
+{
+  for(int i = 0;i < nb_items;++i)
+    dst[i] = max ? std::max(dst[i],src[i]) : std::min(dst[i],src[i]);
+}
+
+/** @brief merge the mean (and m2) of nb_b sub frames into the ones
+ *  of nb_a sub frames (Chan et al. parallel variance)
+ */
+static inline void _mergeWelford(const double *mean_b,const double *m2_b,
+				 int nb_b,double *mean_a,double *m2_a,int nb_a,
+				 int nb_items)
+{
+  double nb = nb_a + nb_b;
+  for(int i = 0;i < nb_items;++i)
+    {
+      double delta = mean_b[i] - mean_a[i];
+      mean_a[i] += delta * nb_b / nb;
+      if(m2_a)
+	m2_a[i] += m2_b[i] + delta * delta * nb_a * nb_b / nb;
+    }
+}
+
+/** @brief unbiased variance, or standard deviation if std_flag,
+ *  of nb_frames sub frames from their sum of squared differences
+ */
+static inline void _finalVariance(const double *m2,int nb_frames,
+				  bool std_flag,float *dst,int nb_items)
+{
+  for(int i = 0;i < nb_items;++i)
+    {
+      double value = nb_frames > 1 ? m2[i] / (nb_frames - 1) : 0.;
+      dst[i] = float(std_flag ? sqrt(value) : value);
+    }
+}
+
+} // namespace lima
+
+#endif // CTACCUMULATION_KERNELS_H
@@ -21,12 +21,16 @@
 //###########################################################################
 #include <string>
 #include <sstream>
+#include <algorithm>
 
 #include "lima/CtControl.h"
 #include "lima/CtSaving.h"
 #ifdef WITH_SPS_IMAGE
 #include "lima/CtSpsImage.h"
 #endif
+#ifdef WITH_SHM_RING
+#include "lima/CtShmRing.h"
+#endif
 #include "lima/CtAcquisition.h"
 #include "lima/CtImage.h"
 #include "lima/CtBuffer.h"
@@ -34,6 +38,7 @@
 #include "lima/CtAccumulation.h"
 #include "lima/CtVideo.h"
 #include "lima/CtEvent.h"
+#include "lima/CtThreadPools.h"
 #ifdef WITH_CONFIG
 #include "lima/CtConfig.h"
 #endif
@@ -42,7 +47,7 @@
 
 #include "lima/HwReconstructionCtrlObj.h"
 
-#include "processlib/PoolThreadMgr.h"
+#include "processlib/TaskMgr.h"
 
 using namespace lima;
 
@@ -291,10 +296,12 @@ CtControl::CtControl(HwInterface *hw) :
   m_images_buffer_size(16),
   m_policy(All), m_ready(false),
   m_autosave(false), m_running(false),
+  m_overrun_shedding(false), m_consumers_shed(false),
   m_reconstruction_cbk(NULL)
 {
   DEB_CONSTRUCTOR();
 
+  m_ct_thread_pools = new CtThreadPools();
   m_ct_acq= new CtAcquisition(hw);
   m_ct_image= new CtImage(hw,*this);
   m_ct_buffer= new CtBuffer(hw);
@@ -314,6 +321,12 @@ CtControl::CtControl(HwInterface *hw) :
   m_ct_sps_image = new CtSpsImage();
 #endif
 
+#ifdef WITH_SHM_RING
+  //Shared memory frame ring
+  m_ct_shm_ring = new CtShmRing();
+  m_shm_ring_active_flag = false;
+#endif
+
 #ifdef WITH_CONFIG
   m_ct_config = new CtConfig(*this);
 
@@ -338,6 +351,9 @@ CtControl::CtControl(HwInterface *hw) :
 
   m_op_int = new SoftOpInternalMgr();
   m_op_ext = new SoftOpExternalMgr();
+  TileWorkers& aWorkers =
+    m_ct_thread_pools->getTileWorkers(CtThreadPools::Processing);
+  m_op_ext->setTileWorkers(&aWorkers);
 
   m_soft_op_error_handler = new SoftOpErrorHandler(*this);
 
@@ -356,8 +372,7 @@ CtControl::~CtControl()
   DEB_DESTRUCTOR();
 
   DEB_TRACE() << "Waiting for all threads to finish their tasks";
-  PoolThreadMgr& pool_thread_mgr = PoolThreadMgr::get();
-  pool_thread_mgr.wait();
+  m_ct_thread_pools->wait();
 
   for(ImageStatusThreadList::iterator i = m_img_status_thread_list.begin();
       i != m_img_status_thread_list.end();++i)
@@ -378,6 +393,9 @@ CtControl::~CtControl()
 #ifdef WITH_SPS_IMAGE
   delete m_ct_sps_image;
 #endif
+#ifdef WITH_SHM_RING
+  delete m_ct_shm_ring;
+#endif
 #ifdef WITH_CONFIG
   delete m_ct_config;
 #endif
@@ -393,6 +411,8 @@ CtControl::~CtControl()
   delete m_op_ext;
 
   delete m_soft_op_error_handler;
+
+  delete m_ct_thread_pools;
 }
 
 void CtControl::setApplyPolicy(ApplyPolicy policy)
@@ -411,6 +431,27 @@ void CtControl::getApplyPolicy(ApplyPolicy &policy) const
 
   DEB_RETURN() << DEB_VAR1(policy);
 }
+/** @brief stop feeding the display and the video while the frame
+    buffers are nearly full, so processing and saving get the cpu back
+ */
+void CtControl::setOverrunShedding(bool active)
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR1(active);
+
+  AutoMutex aLock(m_cond.mutex());
+  m_overrun_shedding = active;
+}
+
+void CtControl::getOverrunShedding(bool& active) const
+{
+  DEB_MEMBER_FUNCT();
+
+  AutoMutex aLock(m_cond.mutex());
+  active = m_overrun_shedding;
+
+  DEB_RETURN() << DEB_VAR1(active);
+}
 
 void CtControl::prepareAcq()
 {
@@ -498,10 +539,21 @@ void CtControl::prepareAcq()
     
     m_ct_sps_image->prepare(dim);
   }
+#endif
+#ifdef WITH_SHM_RING
+  m_shm_ring_active_flag = m_ct_shm_ring->isActive();
+  if(m_shm_ring_active_flag)
+  {
+    FrameDim dim;
+    m_ct_image->getImageDim(dim);
+
+    m_ct_shm_ring->prepare(dim);
+  }
 #endif
   m_images_ready.clear();
   m_base_images_ready.clear();
   m_images_buffer.clear();
+  m_consumers_shed = false;
   m_ct_video->_prepareAcq();
   m_ct_event->_prepareAcq();
 
@@ -514,6 +566,9 @@ void CtControl::prepareAcq()
       m_op_ext_sink_task_active ||
 #ifdef WITH_SPS_IMAGE
       m_display_active_flag ||
+#endif
+#ifdef WITH_SHM_RING
+      m_shm_ring_active_flag ||
 #endif
       m_ct_video->isActive()))
     THROW_CTL_ERROR(Error) << "Can't have any software operation if Hardware saving is active";
@@ -612,7 +667,7 @@ void CtControl::abortAcq(AcqStatus acq_status, ErrorCode error_code,
   mgr->addSinkTask(0, abort_task);
   abort_task->unref();
   
-  PoolThreadMgr::get().addProcess(mgr);
+  m_ct_thread_pools->addProcess(CtThreadPools::Processing,mgr);
 }
 
 
@@ -682,12 +737,41 @@ void CtControl::ReadBaseImage(Data &aReturnData,long frameNumber,
   readBlock(aReturnData, frameNumber, readBlockLen, true);
 }
 
+void CtControl::ReadBlock(DataBlock &aReturnBlock,long frameNumber,
+			  long readBlockLen)
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR2(frameNumber, readBlockLen);
+  readBlock(aReturnBlock, frameNumber, readBlockLen, false);
+}
+
+void CtControl::ReadBaseBlock(DataBlock &aReturnBlock,long frameNumber,
+			      long readBlockLen)
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR2(frameNumber, readBlockLen);
+  readBlock(aReturnBlock, frameNumber, readBlockLen, true);
+}
+
 void CtControl::readBlock(Data &aReturnData,long frameNumber,long readBlockLen,
 			  bool baseImage)
 {
   DEB_MEMBER_FUNCT();
   DEB_PARAM() << DEB_VAR3(frameNumber, readBlockLen, baseImage);
 
+  DataBlock aBlock;
+  readBlock(aBlock, frameNumber, readBlockLen, baseImage);
+  aBlock.materialize(aReturnData);
+
+  DEB_RETURN() << DEB_VAR1(aReturnData);
+}
+
+void CtControl::readBlock(DataBlock &aReturnBlock,long frameNumber,
+			  long readBlockLen,bool baseImage)
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR3(frameNumber, readBlockLen, baseImage);
+
   FrameDim imgDim;
   m_ct_image->getImageDim(imgDim);
 
@@ -732,14 +816,7 @@ void CtControl::readBlock(Data &aReturnData,long frameNumber,long readBlockLen,
     THROW_CTL_ERROR(Error) << "Frame(s) not available yet";
   aLock.unlock();
 
-  bool one_block = (readBlockLen == 1);
-  if (concatNbFrames > 1) {
-    long firstBuffer = frameNumber / concatNbFrames;
-    long lastBuffer = (frameNumber + readBlockLen - 1) / concatNbFrames;
-    one_block = (firstBuffer == lastBuffer);
-  }
-
-  char *p = NULL;
+  aReturnBlock.clear();
   long framesRead = 0; 
   while (framesRead < readBlockLen) {
     int nbFrames = 1;
@@ -761,29 +838,13 @@ void CtControl::readBlock(Data &aReturnData,long frameNumber,long readBlockLen,
 			     << "HwBuffer dim (" << auxData.size() << "): "
 			     << DEB_VAR1(auxData);
 
-    if (one_block) {
-      aReturnData = auxData;
-    } else {
-      if (p == NULL) {
-	aReturnData = auxData;
-	Buffer *buffer = new Buffer(imageSize * readBlockLen);
-	aReturnData.setBuffer(buffer);
-	if (readBlockLen > 1) {
-	  if (aReturnData.dimensions.size() == 2)
-	    aReturnData.dimensions.push_back(readBlockLen);
-	  else
-	    aReturnData.dimensions[2] = readBlockLen;
-	}
-	p = (char *) aReturnData.data();
-      }
-      memcpy(p, auxData.data(), imageSize * nbFrames);
-      p += imageSize * nbFrames;
-    }
-
+    aReturnBlock.addSegment(auxData, nbFrames);
+    frameNumber += nbFrames;
     framesRead += nbFrames;
   }
 
-  DEB_RETURN() << DEB_VAR1(aReturnData);
+  DEB_RETURN() << DEB_VAR2(aReturnBlock.getNbSegments(),
+			   aReturnBlock.getNbFrames());
 }
 
 void CtControl::readOneImageBuffer(Data &aReturnData,long frameNumber, 
@@ -841,8 +902,7 @@ void CtControl::reset()
   m_ct_saving->clear();
 
   DEB_TRACE() << "Suspending task threads";
-  PoolThreadMgr& pool_thread_mgr = PoolThreadMgr::get();
-  pool_thread_mgr.abort();
+  m_ct_thread_pools->abort();
  
   DEB_TRACE() << "Reseting hardware";
   m_hw->reset(HwInterface::SoftReset);
@@ -862,6 +922,10 @@ void CtControl::reset()
 #ifdef WITH_SPS_IMAGE
   DEB_TRACE() << "Reseting display";
   m_ct_sps_image->reset();
+#endif
+#ifdef WITH_SHM_RING
+  DEB_TRACE() << "Reseting shared memory ring";
+  m_ct_shm_ring->reset();
 #endif
   resetStatus(false);
   m_status.AcquisitionStatus = AcqReady;
@@ -909,7 +973,7 @@ bool CtControl::newFrameReady(Data& fdata)
       m_op_ext->addTo(*mgr, internal_stage, last_link, last_sink);
 
       if (internal_stage || (last_link >= 0) || (last_sink >= 0))
-	PoolThreadMgr::get().addProcess(mgr);
+	m_ct_thread_pools->addProcess(CtThreadPools::Processing,mgr);
       else
 	delete mgr;
       if (!internal_stage)
@@ -953,17 +1017,23 @@ void CtControl::newBaseImageReady(Data &aData)
   else
     m_base_images_ready.insert(aData);
 
+  bool consumers_shed = m_consumers_shed;
   aLock.unlock();
 
   if(m_autosave && !m_op_ext_link_task_active)
     newFrameToSave(aData);
 
 #ifdef WITH_SPS_IMAGE
-  if(m_display_active_flag)
+  if(m_display_active_flag && !consumers_shed)
     m_ct_sps_image->frameReady(aData);
 #endif
+#ifdef WITH_SHM_RING
+  if(m_shm_ring_active_flag)
+    m_ct_shm_ring->frameReady(aData);
+#endif
 
-  m_ct_video->frameReady(aData);
+  if(!consumers_shed)
+    m_ct_video->frameReady(aData);
 
   for(ImageStatusThreadList::iterator i = m_img_status_thread_list.begin();
       i != m_img_status_thread_list.end();++i)
@@ -1107,6 +1177,10 @@ void CtControl::unregisterImageStatusCallback(ImageStatusCallback& cb)
 }
 
 /** @brief this methode check if an overrun 
+ *
+ *  Before the frame buffers are full, the display and the video can be
+ *  shed and the frames waiting to be saved moved to the saving overflow
+ *  tier; the overrun is only declared once these are not enough.
  *  @warning this methode is call under lock
  */
 bool CtControl::_checkOverrun(Data &aData)
@@ -1124,10 +1198,30 @@ bool CtControl::_checkOverrun(Data &aData)
 
   long nb_buffers;
   m_ct_buffer->getNumber(nb_buffers);
+  // the overflow tier starts when a quarter of the buffers are left
+  long high_water = nb_buffers - std::max(nb_buffers / 4,1L);
   
   CtSaving::SavingMode mode;
   m_ct_saving->getSavingMode(mode);
 
+  bool consumers_shed = (m_overrun_shedding &&
+			 ((imageToProcess >= high_water) ||
+			  (mode != CtSaving::Manual &&
+			   imageToSave >= high_water)));
+  if(consumers_shed != m_consumers_shed)
+    DEB_WARNING() << (consumers_shed ? "Shedding" : "Restoring")
+		  << " display and video: " << DEB_VAR3(imageToProcess,
+							imageToSave,
+							nb_buffers);
+  m_consumers_shed = consumers_shed;
+
+  // spilled frames do not hold a frame buffer any more
+  // the spill thread writes them, a frame leaves its buffer once written
+  if(mode != CtSaving::Manual && m_ct_saving->_isSpillActive())
+    imageToSave -= m_ct_saving->_markSpill(imageToSave,
+					   imageStatus.LastImageSaved,
+					   high_water);
+
   bool overrunFlag = false;
   ErrorCode error_code = NoError;
   if(imageToProcess >= nb_buffers) // Process overrun
@@ -1221,6 +1315,123 @@ void CtControl::Status::reset()
   ImageCounters.reset();
 }
 
+// ----------------------------------------------------------------------------
+// class DataBlock
+// ----------------------------------------------------------------------------
+CtControl::DataBlock::DataBlock() :
+  m_nb_frames(0),
+  m_frame_size(0)
+{
+  DEB_CONSTRUCTOR();
+}
+
+void CtControl::DataBlock::clear()
+{
+  DEB_MEMBER_FUNCT();
+
+  m_segments.clear();
+  m_first_frames.clear();
+  m_nb_frames = 0;
+  m_frame_size = 0;
+}
+
+void CtControl::DataBlock::addSegment(const Data& data, int nb_frames)
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR2(data, nb_frames);
+
+  if ((data.dimensions.size() < 2) || (nb_frames < 1))
+    THROW_CTL_ERROR(InvalidValue) << "Invalid segment: "
+				  << DEB_VAR2(data, nb_frames);
+  int frame_size = data.dimensions[0] * data.dimensions[1] * data.depth();
+  if (m_segments.empty())
+    m_frame_size = frame_size;
+  else if (frame_size != m_frame_size)
+    THROW_CTL_ERROR(InvalidValue) << "Segment frame size mismatch: "
+				  << DEB_VAR2(frame_size, m_frame_size);
+  if (frame_size * nb_frames > data.size())
+    THROW_CTL_ERROR(InvalidValue) << "Segment too small: "
+				  << DEB_VAR2(data, nb_frames);
+
+  // the Data copy shares (and holds) the frame buffer
+  m_segments.push_back(data);
+  m_first_frames.push_back(m_nb_frames);
+  m_nb_frames += nb_frames;
+}
+
+int CtControl::DataBlock::getNbFrames() const
+{
+  return m_nb_frames;
+}
+
+int CtControl::DataBlock::getFrameSize() const
+{
+  return m_frame_size;
+}
+
+int CtControl::DataBlock::getNbSegments() const
+{
+  return m_segments.size();
+}
+
+const Data& CtControl::DataBlock::getSegment(int segment) const
+{
+  DEB_MEMBER_FUNCT();
+  if ((segment < 0) || (segment >= getNbSegments()))
+    THROW_CTL_ERROR(InvalidValue) << "Invalid " << DEB_VAR1(segment);
+  return m_segments[segment];
+}
+
+int CtControl::DataBlock::getSegmentNbFrames(int segment) const
+{
+  DEB_MEMBER_FUNCT();
+  if ((segment < 0) || (segment >= getNbSegments()))
+    THROW_CTL_ERROR(InvalidValue) << "Invalid " << DEB_VAR1(segment);
+  int next_first = ((segment + 1) < getNbSegments()) ? 
+    m_first_frames[segment + 1] : m_nb_frames;
+  return next_first - m_first_frames[segment];
+}
+
+void *CtControl::DataBlock::getFramePtr(int frame) const
+{
+  DEB_MEMBER_FUNCT();
+  if ((frame < 0) || (frame >= m_nb_frames))
+    THROW_CTL_ERROR(InvalidValue) << "Invalid " << DEB_VAR1(frame);
+  std::vector<int>::const_iterator it = 
+    std::upper_bound(m_first_frames.begin(), m_first_frames.end(), frame);
+  int segment = (it - m_first_frames.begin()) - 1;
+  char *ptr = (char *) m_segments[segment].data();
+  return ptr + long(frame - m_first_frames[segment]) * m_frame_size;
+}
+
+void CtControl::DataBlock::materialize(Data& data) const
+{
+  DEB_MEMBER_FUNCT();
+
+  if (m_segments.empty())
+    THROW_CTL_ERROR(Error) << "Empty data block";
+
+  data = m_segments[0];
+  if (m_segments.size() == 1)
+    return;
+
+  Buffer *buffer = new Buffer(m_frame_size * m_nb_frames);
+  data.setBuffer(buffer);
+  buffer->unref();
+  if (data.dimensions.size() == 2)
+    data.dimensions.push_back(m_nb_frames);
+  else
+    data.dimensions[2] = m_nb_frames;
+
+  char *p = (char *) data.data();
+  for (int i = 0; i < getNbSegments(); ++i) {
+    long segment_size = long(getSegmentNbFrames(i)) * m_frame_size;
+    memcpy(p, m_segments[i].data(), segment_size);
+    p += segment_size;
+  }
+  DEB_RETURN() << DEB_VAR1(data);
+}
+
 // ----------------------------------------------------------------------------
 // class ImageStatus
 // ----------------------------------------------------------------------------
@@ -1266,12 +1477,16 @@ CtSaving* 		CtControl::saving() 		{ return m_ct_saving; }
 #ifdef WITH_SPS_IMAGE
 CtSpsImage* 	CtControl::display() 			{ return m_ct_sps_image; }
 #endif
+#ifdef WITH_SHM_RING
+CtShmRing* 		CtControl::shmRing() 		{ return m_ct_shm_ring; }
+#endif
 CtImage* 		CtControl::image() 		{ return m_ct_image; }
 CtBuffer* 		CtControl::buffer() 		{ return m_ct_buffer; }
 CtAccumulation* 	CtControl::accumulation() 	{ return m_ct_accumulation; }
 CtVideo*		CtControl::video()		{ return m_ct_video;}
 CtShutter* 		CtControl::shutter() 		{ return m_ct_shutter; }
 CtEvent* 		CtControl::event()		{ return m_ct_event; }
+CtThreadPools*		CtControl::threadPools()	{ return m_ct_thread_pools; }
 #ifdef WITH_CONFIG
 CtConfig*		CtControl::config()		{ return m_ct_config; }
 #endif
@@ -22,6 +22,7 @@
 
 #include "lima/CtImage.h"
 #include "lima/CtAcquisition.h"
+#include "lima/CtAccumulation.h"
 #include "lima/CtSaving.h"
 
 using namespace lima;
@@ -599,7 +600,9 @@ void CtImage::getImageType(ImageType& type) const
 	CtAcquisition *acq = m_ct.acquisition();
 	AcqMode mode;
 	acq->getAcqMode(mode);
-	type= mode == Accumulation ? Bpp32S : m_img_type;
+	type= m_img_type;
+	if(mode == Accumulation)
+		type= m_ct.accumulation()->_getImageType(m_img_type);
 
 	DEB_RETURN() << DEB_VAR1(type);
 }
@@ -616,7 +619,9 @@ void CtImage::getImageDim(FrameDim& dim) const
 	CtAcquisition *acq = m_ct.acquisition();
 	AcqMode mode;
 	acq->getAcqMode(mode);
-	ImageType imageType = mode == Accumulation ? Bpp32S : m_img_type;
+	ImageType imageType = m_img_type;
+	if(mode == Accumulation)
+		imageType = m_ct.accumulation()->_getImageType(m_img_type);
 	dim= FrameDim(m_sw->getSize(), imageType);
 
 	SWAP_DIM_IF_ROTATION(dim);
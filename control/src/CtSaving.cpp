@@ -19,7 +19,9 @@
 // You should have received a copy of the GNU General Public License
 // along with this program; if not, see <http://www.gnu.org/licenses/>.
 //###########################################################################
+#include <cerrno>
 #include <cmath>
+#include <cstring>
 #include <sstream>
 #include <sys/types.h>
 #include <sys/stat.h>
@@ -27,6 +29,8 @@
 
 #ifdef __linux__ 
 #include <dirent.h>
+#include <fcntl.h>
+#include <cstdlib>
 #include <sys/statvfs.h>
 #else
 #include <direct.h>
@@ -36,6 +40,7 @@
 #include "CtSaving_Edf.h"
 #include "lima/CtAcquisition.h"
 #include "lima/CtBuffer.h"
+#include "lima/CtThreadPools.h"
 
 #ifdef WITH_NXS_SAVING
 #include "CtSaving_Nxs.h"
@@ -60,30 +65,448 @@
 #include "processlib/TaskMgr.h"
 #include "processlib/SinkTask.h"
 
+#ifdef WITH_EDFGZ_SAVING
+#include <zlib.h>
+#endif
+
+#ifdef WITH_LZ4_SAVING
+#include <lz4hc.h>
+#endif
+
+#ifdef WITH_ZSTD_SAVING
+#include <zstd.h>
+#endif
+
 using namespace lima;
 
 static const char DIR_SEPARATOR = '/';
 
+/** @brief frame header store.
+ *
+ *  Headers are kept in preallocated slots indexed by frame number modulo
+ *  the number of slots (the number of frame buffers). Keys are interned
+ *  with an index, so a slot finds a key in constant time and only keeps
+ *  a key pointer and a value string whose capacity is reused from one
+ *  frame to another. Frames colliding with a slot still in use go to an
+ *  overflow map.
+ *  A header taken for saving swaps its entries with a pooled
+ *  _FrameHeader handed to the writers, which gives back its previous
+ *  storage to the slot: no allocation once the pools are warm.
+ *  The slot methods must be called with the saving lock held.
+ */
+class CtSaving::_FrameHeaderStore
+{
+public:
+  struct Key
+  {
+    std::string		name;
+    int			id;
+  };
+  struct Entry
+  {
+    const Key*		key;
+    std::string		value;
+  };
+
+  class Entries
+  {
+  public:
+    Entries() : m_nb_entries(0) {}
+
+    void set(const Key* key,const std::string& value,bool replace)
+    {
+      if(key->id >= int(m_index.size()))
+	m_index.resize(key->id + 1,-1);
+      int& pos = m_index[key->id];
+      if(pos >= 0)
+	{
+	  if(replace) m_entries[pos].value = value;
+	  return;
+	}
+      if(m_nb_entries == int(m_entries.size()))
+	m_entries.push_back(Entry());
+      pos = m_nb_entries;
+      Entry& entry = m_entries[m_nb_entries++];
+      entry.key = key;
+      entry.value = value;
+    }
+    void copy(const Entries& from)
+    {
+      clear();
+      for(int i = 0;i < from.m_nb_entries;++i)
+	set(from.m_entries[i].key,from.m_entries[i].value,true);
+    }
+    bool has(const std::string& name) const
+    {
+      for(int i = 0;i < m_nb_entries;++i)
+	if(m_entries[i].key->name == name)
+	  return true;
+      return false;
+    }
+    void toHeaderMap(HeaderMap& header,bool replace) const
+    {
+      for(int i = 0;i < m_nb_entries;++i)
+	{
+	  const Entry& entry = m_entries[i];
+	  std::pair<HeaderMap::iterator,bool> result = 
+	    header.insert(HeaderMap::value_type(entry.key->name,entry.value));
+	  if(replace && !result.second)
+	    result.first->second = entry.value;
+	}
+    }
+    void clear()
+    {
+      for(int i = 0;i < m_nb_entries;++i)
+	m_index[m_entries[i].key->id] = -1;
+      m_nb_entries = 0;
+    }
+    void swap(Entries& other)
+    {
+      m_entries.swap(other.m_entries);
+      m_index.swap(other.m_index);
+      std::swap(m_nb_entries,other.m_nb_entries);
+    }
+    int size() const {return m_nb_entries;}
+    const Entry& operator[](int i) const {return m_entries[i];}
+  private:
+    std::vector<Entry>	m_entries;
+    std::vector<int>	m_index;	///< key id -> entry, -1 if not set
+    int			m_nb_entries;
+  };
+
+  class Slot : public Entries
+  {
+  public:
+    Slot() : frame_nr(-1) {}
+    void clear() {frame_nr = -1; Entries::clear();}
+
+    long		frame_nr;
+  };
+
+  /** @brief merged common headers, shared by the frames taken
+   *  until they change
+   */
+  struct Common
+  {
+    Common() : ref(1) {}
+    HeaderMap		header;
+    int			ref;
+  };
+
+  explicit _FrameHeaderStore(int nb_slots) :
+    m_slots(nb_slots),m_common(new Common()) {}
+  ~_FrameHeaderStore();
+
+  const Key* intern(const std::string& name)
+  {
+    AutoMutex aLock(m_key_lock);
+    KeyMap::iterator i = m_keys.find(name);
+    if(i == m_keys.end())
+      {
+	Key key;
+	key.name = name;
+	key.id = int(m_keys.size());
+	i = m_keys.insert(KeyMap::value_type(name,key)).first;
+      }
+    return &i->second;
+  }
+
+  Slot* find(long frame_nr)
+  {
+    Slot& slot = _slot(frame_nr);
+    if(slot.frame_nr == frame_nr)
+      return &slot;
+    OverflowMap::iterator i = m_overflow.find(frame_nr);
+    return (i != m_overflow.end()) ? &i->second : NULL;
+  }
+  const Slot* find(long frame_nr) const
+  {
+    return const_cast<_FrameHeaderStore*>(this)->find(frame_nr);
+  }
+  Slot& get(long frame_nr)
+  {
+    Slot* found = find(frame_nr);
+    if(found)
+      return *found;
+    Slot& slot = _slot(frame_nr);
+    Slot& new_slot = (slot.frame_nr < 0) ? slot : m_overflow[frame_nr];
+    new_slot.frame_nr = frame_nr;
+    return new_slot;
+  }
+  void erase(long frame_nr)
+  {
+    Slot& slot = _slot(frame_nr);
+    if(slot.frame_nr == frame_nr)
+      slot.clear();
+    else
+      m_overflow.erase(frame_nr);
+  }
+  void clear()
+  {
+    for(SlotList::iterator i = m_slots.begin();i != m_slots.end();++i)
+      i->clear();
+    m_overflow.clear();
+  }
+  /** @brief change the number of slots, the stored headers are kept
+   */
+  void resize(int nb_slots)
+  {
+    if(nb_slots < 1 || nb_slots == int(m_slots.size()))
+      return;
+    SlotList old_slots(nb_slots);
+    m_slots.swap(old_slots);
+    OverflowMap old_overflow;
+    m_overflow.swap(old_overflow);
+    for(SlotList::iterator i = old_slots.begin();i != old_slots.end();++i)
+      if(i->frame_nr >= 0)
+	_move(*i);
+    for(OverflowMap::iterator i = old_overflow.begin();
+	i != old_overflow.end();++i)
+      _move(i->second);
+  }
+  /** @brief new common headers, internal ones first
+   */
+  void setCommon(const HeaderMap& internal,const HeaderMap& common)
+  {
+    Common *aCommonPt = new Common();
+    aCommonPt->header = internal;
+    aCommonPt->header.insert(common.begin(),common.end());
+    AutoMutex aLock(m_pool_lock);
+    _unrefCommon(m_common);
+    m_common = aCommonPt;
+  }
+
+  _FrameHeader* take(long frame_nr,bool keep_in_map);
+  void release(_FrameHeader*);
+  HeaderMap* getHeaderMap();
+  void releaseHeaderMap(HeaderMap*);
+  void unrefCommon(Common* common)
+  {
+    AutoMutex aLock(m_pool_lock);
+    _unrefCommon(common);
+  }
+
+private:
+  friend class _FrameHeader;
+  typedef std::vector<Slot> SlotList;
+  typedef std::map<long,Slot> OverflowMap;
+  typedef std::map<std::string,Key> KeyMap;
+
+  Slot& _slot(long frame_nr)
+  {
+    long nb_slots = m_slots.size();
+    return m_slots[((frame_nr % nb_slots) + nb_slots) % nb_slots];
+  }
+  void _move(Slot& from)
+  {
+    Slot& slot = _slot(from.frame_nr);
+    if(slot.frame_nr < 0)
+      std::swap(slot,from);
+    else
+      std::swap(m_overflow[from.frame_nr],from);
+  }
+  void _unrefCommon(Common* common)
+  {
+    if(!--common->ref)
+      delete common;
+  }
+
+  SlotList			m_slots;
+  OverflowMap			m_overflow;
+  Mutex				m_key_lock;
+  KeyMap			m_keys;
+  Mutex				m_pool_lock;
+  Common*			m_common;
+  std::vector<_FrameHeader*>	m_free_headers;
+  std::vector<HeaderMap*>	m_free_maps;
+};
+
+/** @brief header of a frame handed to its save tasks.
+ *
+ *  Each task keeps a reference, the last one gives it back to the
+ *  store. fill() builds the HeaderMap of the writers in a map reused
+ *  from one frame to another: values are assigned in place and only
+ *  keys missing from the previous frame are inserted.
+ */
+class CtSaving::_FrameHeader
+{
+public:
+  _FrameHeader(_FrameHeaderStore& store) :
+    m_store(store),m_common(NULL),m_ref(0) {}
+
+  void ref()
+  {
+    AutoMutex aLock(m_store.m_pool_lock);
+    ++m_ref;
+  }
+  void unref()
+  {
+    m_store.release(this);
+  }
+  _FrameHeaderStore& store() const
+  {
+    return m_store;
+  }
+
+  void fill(HeaderMap& header) const
+  {
+    const HeaderMap& common = m_common->header;
+    size_t nb_keys = common.size();
+    for(HeaderMap::const_iterator i = common.begin();i != common.end();++i)
+      _assign(header,i->first,i->second);
+    for(int i = 0;i < m_entries.size();++i)
+      {
+	const _FrameHeaderStore::Entry& entry = m_entries[i];
+	if(common.find(entry.key->name) == common.end())
+	  ++nb_keys;
+	_assign(header,entry.key->name,entry.value);
+      }
+    // keys of the previous frame which are not in this one
+    if(header.size() != nb_keys)
+      {
+	for(HeaderMap::iterator i = header.begin();i != header.end();)
+	  {
+	    if(common.count(i->first) || m_entries.has(i->first))
+	      ++i;
+	    else
+	      header.erase(i++);
+	  }
+      }
+  }
+
+private:
+  friend class _FrameHeaderStore;
+
+  static void _assign(HeaderMap& header,const std::string& key,
+		      const std::string& value)
+  {
+    HeaderMap::iterator i = header.lower_bound(key);
+    if(i == header.end() || i->first != key)
+      header.insert(i,HeaderMap::value_type(key,value));
+    else
+      i->second = value;
+  }
+
+  _FrameHeaderStore&		m_store;
+  _FrameHeaderStore::Entries	m_entries;
+  _FrameHeaderStore::Common*	m_common;
+  int				m_ref;
+};
+
+CtSaving::_FrameHeaderStore::~_FrameHeaderStore()
+{
+  _unrefCommon(m_common);
+  for(size_t i = 0;i < m_free_headers.size();++i)
+    delete m_free_headers[i];
+  for(size_t i = 0;i < m_free_maps.size();++i)
+    delete m_free_maps[i];
+}
+
+/** @brief header of a frame for its save tasks, with one reference.
+ *
+ *  The slot entries are swapped with the pooled header ones, or copied
+ *  if the header stays in the store.
+ */
+CtSaving::_FrameHeader*
+CtSaving::_FrameHeaderStore::take(long frame_nr,bool keep_in_map)
+{
+  AutoMutex aLock(m_pool_lock);
+  _FrameHeader *aHeaderPt;
+  if(m_free_headers.empty())
+    aHeaderPt = new _FrameHeader(*this);
+  else
+    {
+      aHeaderPt = m_free_headers.back();
+      m_free_headers.pop_back();
+    }
+  aHeaderPt->m_ref = 1;
+  aHeaderPt->m_common = m_common;
+  ++m_common->ref;
+  aLock.unlock();
+
+  Slot* slot = find(frame_nr);
+  if(!slot)
+    return aHeaderPt;
+  if(keep_in_map)
+    aHeaderPt->m_entries.copy(*slot);
+  else
+    {
+      aHeaderPt->m_entries.swap(*slot);
+      erase(frame_nr);
+    }
+  return aHeaderPt;
+}
+
+void CtSaving::_FrameHeaderStore::release(_FrameHeader* header)
+{
+  AutoMutex aLock(m_pool_lock);
+  if(--header->m_ref)
+    return;
+  header->m_entries.clear();
+  _unrefCommon(header->m_common);
+  header->m_common = NULL;
+  m_free_headers.push_back(header);
+}
+
+CtSaving::HeaderMap* CtSaving::_FrameHeaderStore::getHeaderMap()
+{
+  AutoMutex aLock(m_pool_lock);
+  if(m_free_maps.empty())
+    return new HeaderMap();
+  HeaderMap *aHeaderPt = m_free_maps.back();
+  m_free_maps.pop_back();
+  return aHeaderPt;
+}
+
+void CtSaving::_FrameHeaderStore::releaseHeaderMap(HeaderMap* header)
+{
+  AutoMutex aLock(m_pool_lock);
+  m_free_maps.push_back(header);
+}
+
 /** @brief save task class
  */
 class CtSaving::Stream::_SaveTask : public SinkTaskBase
 {
     DEB_CLASS_NAMESPC(DebModControl,"CtSaving::Stream::_SaveTask","Control");
 public:
-  _SaveTask(CtSaving::Stream& stream) 
-    : SinkTaskBase(), m_stream(stream) {}
+  _SaveTask(CtSaving::Stream& stream,CtSaving::_FrameHeader* header) 
+    : SinkTaskBase(), m_stream(stream), m_header(header)
+  {
+    m_header->ref();
+  }
+  virtual ~_SaveTask()
+  {
+    m_header->unref();
+  }
 
   virtual void process(Data &aData)
   {
     DEB_MEMBER_FUNCT();
     DEB_PARAM() << DEB_VAR1(aData);
 
-    m_stream.writeFile(aData, m_header);
+    if(m_ready_time.isSet())
+      m_stream.addQueueTime(Timestamp::now() - m_ready_time);
+
+    CtSaving::_FrameHeaderStore& store = m_header->store();
+    CtSaving::HeaderMap *aHeaderPt = store.getHeaderMap();
+    try
+      {
+	m_header->fill(*aHeaderPt);
+	m_stream.writeFile(aData, *aHeaderPt);
+      }
+    catch(...)
+      {
+	store.releaseHeaderMap(aHeaderPt);
+	throw;
+      }
+    store.releaseHeaderMap(aHeaderPt);
   }
 
-  CtSaving::HeaderMap	 m_header;
+  Timestamp		 m_ready_time;
 private:
   CtSaving::Stream& m_stream;
+  CtSaving::_FrameHeader* m_header;
 };
 /** @brief save callback
  */
@@ -119,20 +542,535 @@ public:
 private:
   Stream &m_stream;
 };
+/** @brief compression task wrapper, measure the compression time
+ */
+class CtSaving::Stream::_CompressionTask : public SinkTaskBase
+{
+public:
+  _CompressionTask(Stream& stream,SinkTaskBase* task) :
+    SinkTaskBase(), m_stream(stream), m_task(task) {}
+  virtual ~_CompressionTask()
+  {
+    m_task->unref();
+  }
+
+  virtual void process(Data &aData)
+  {
+    Timestamp start = Timestamp::now();
+    m_task->process(aData);
+    m_stream.addCompressionTime(Timestamp::now() - start);
+  }
+private:
+  Stream&	m_stream;
+  SinkTaskBase*	m_task;
+};
+/** @brief saving statistic of a stream.
+ *
+ *  Times are accumulated in histograms with 4 bins per octave from 1us,
+ *  percentiles are given with the bin upper edge.
+ */
+class CtSaving::Stream::_Statistic
+{
+public:
+  class Histogram
+  {
+  public:
+    enum {NB_BIN_PER_OCTAVE = 4, NB_BINS = 32 * NB_BIN_PER_OCTAVE};
+    Histogram() {reset();}
+
+    void reset()
+    {
+      m_nb = 0,m_sum = m_max = 0.;
+      std::fill(m_bins,m_bins + NB_BINS,0);
+    }
+    void add(double t)
+    {
+      int bin = 0;
+      if(t > MIN_TIME)
+	bin = std::min(int(ceil(log(t / MIN_TIME) / log(2.) * NB_BIN_PER_OCTAVE)),
+		       int(NB_BINS - 1));
+      ++m_bins[bin];
+      ++m_nb,m_sum += t;
+      if(t > m_max) m_max = t;
+    }
+    double percentile(double p) const
+    {
+      if(!m_nb) return 0.;
+      long limit = long(ceil(p * m_nb));
+      long count = 0;
+      int bin = 0;
+      for(;bin < NB_BINS - 1;++bin)
+	{
+	  count += m_bins[bin];
+	  if(count >= limit) break;
+	}
+      double upper = MIN_TIME * pow(2.,double(bin) / NB_BIN_PER_OCTAVE);
+      return std::min(upper,m_max);
+    }
+    void get(TimeStatistic& stat) const
+    {
+      stat.nb = m_nb;
+      stat.mean = m_nb ? m_sum / m_nb : 0.;
+      stat.max = m_max;
+      stat.p50 = percentile(0.5);
+      stat.p90 = percentile(0.9);
+      stat.p99 = percentile(0.99);
+    }
+  private:
+    static const double MIN_TIME;
+
+    long	m_nb;
+    double	m_sum;
+    double	m_max;
+    long	m_bins[NB_BINS];
+  };
+
+  _Statistic() {reset();}
+
+  void reset()
+  {
+    AutoMutex aLock(m_lock);
+    m_write.reset(),m_compression.reset(),m_queue.reset();
+    m_nb_frames = 0,m_nb_bytes = 0;
+    m_first_ready = m_last_write = Timestamp();
+    m_outstanding = m_max_outstanding = 0;
+  }
+  void frameReady(const Timestamp& ready_time)
+  {
+    AutoMutex aLock(m_lock);
+    if(!m_first_ready.isSet()) m_first_ready = ready_time;
+    if(++m_outstanding > m_max_outstanding)
+      m_max_outstanding = m_outstanding;
+  }
+  void frameWritten(double write_time,long long nb_bytes)
+  {
+    Timestamp now = Timestamp::now();
+    AutoMutex aLock(m_lock);
+    m_write.add(write_time);
+    ++m_nb_frames,m_nb_bytes += nb_bytes;
+    if(!m_first_ready.isSet()) m_first_ready = double(now) - write_time;
+    m_last_write = now;
+    if(m_outstanding > 0) --m_outstanding;
+  }
+  void addCompression(double t)
+  {
+    AutoMutex aLock(m_lock);
+    m_compression.add(t);
+  }
+  void addQueue(double t)
+  {
+    AutoMutex aLock(m_lock);
+    m_queue.add(t);
+  }
+  void get(SavingStatistic& stat) const
+  {
+    AutoMutex aLock(m_lock);
+    stat.nbFrames = m_nb_frames;
+    stat.nbBytes = m_nb_bytes;
+    stat.elapsedTime = m_last_write.isSet() ? double(m_last_write - m_first_ready) : 0.;
+    stat.bytesPerSecond = (stat.elapsedTime > 0.) ?
+      m_nb_bytes / stat.elapsedTime : 0.;
+    m_write.get(stat.writeTime);
+    m_compression.get(stat.compressionTime);
+    m_queue.get(stat.queueTime);
+    stat.outstandingFrames = m_outstanding;
+    stat.maxOutstandingFrames = m_max_outstanding;
+  }
+private:
+  mutable Mutex	m_lock;
+  Histogram	m_write;
+  Histogram	m_compression;
+  Histogram	m_queue;
+  long		m_nb_frames;
+  long long	m_nb_bytes;
+  Timestamp	m_first_ready;
+  Timestamp	m_last_write;
+  long		m_outstanding;
+  long		m_max_outstanding;
+};
+
+const double CtSaving::Stream::_Statistic::Histogram::MIN_TIME = 1e-6;
+
+/** @brief overflow tier of the frames waiting to be saved.
+ *
+ *  When the frame buffers are nearly full, CtControl moves the oldest
+ *  frames waiting to be saved to a scratch file so their buffer can be
+ *  reused; they are read back when the saving catches up. The file is
+ *  used as a ring: the next record goes after the newest one and must
+ *  not reach the oldest one still there. Records are written and
+ *  read outside the store lock, a record being reserved before its
+ *  write and freed after its read. A written frame is only counted as
+ *  detached from the frame buffers once its buffer is released.
+ */
+class CtSaving::_SpillStore
+{
+  DEB_CLASS_NAMESPC(DebModControl,"CtSaving::_SpillStore","Control");
+public:
+  _SpillStore() : m_max_size(1LL << 30), m_fd(-1), m_next_seq(0) {}
+  ~_SpillStore() { close(); }
+
+  void setDirectory(const std::string& directory)
+  {
+    AutoMutex aLock(m_mutex);
+    m_directory = directory;
+  }
+  std::string getDirectory() const
+  {
+    AutoMutex aLock(m_mutex);
+    return m_directory;
+  }
+  void setMaxSize(long long max_size)
+  {
+    AutoMutex aLock(m_mutex);
+    m_max_size = max_size;
+  }
+  long long getMaxSize() const
+  {
+    AutoMutex aLock(m_mutex);
+    return m_max_size;
+  }
+  bool isActive() const
+  {
+    AutoMutex aLock(m_mutex);
+    return m_fd >= 0;
+  }
+  /** @brief create a new scratch file if there is a directory,
+   *  the previous records are dropped
+   */
+  void open()
+  {
+    DEB_MEMBER_FUNCT();
+
+    AutoMutex aLock(m_mutex);
+    _close();
+    if(m_directory.empty() || m_max_size <= 0)
+      return;
+#ifdef __linux__
+    std::string file_name = m_directory + DIR_SEPARATOR + "lima_spill_XXXXXX";
+    std::vector<char> name(file_name.begin(),file_name.end());
+    name.push_back('\0');
+    m_fd = mkstemp(&name[0]);
+    if(m_fd < 0)
+      THROW_CTL_ERROR(Error) << "Can't create spill file in "
+			     << DEB_VAR1(m_directory) << ": "
+			     << strerror(errno);
+    // removed from the directory, the space is released on close
+    unlink(&name[0]);
+    DEB_TRACE() << "Spill file created in " << DEB_VAR1(m_directory);
+#endif
+  }
+  void close()
+  {
+    AutoMutex aLock(m_mutex);
+    _close();
+  }
+  void clear()
+  {
+    AutoMutex aLock(m_mutex);
+    m_records.clear();
+    m_frames.clear();
+    m_detached.clear();
+  }
+  /** @brief write the frame data, false if there is no room left
+   */
+  bool write(const Data& aData)
+  {
+    DEB_MEMBER_FUNCT();
+
+    long long size = aData.size();
+    long long offset;
+    AutoMutex aLock(m_mutex);
+    if(m_fd < 0 || size <= 0 || !_alloc(size,offset))
+      return false;
+    long long seq = m_next_seq++;
+    m_records[seq] = Record(offset,size);
+    aLock.unlock();
+
+    bool ok = _pwrite(aData.data(),size,offset);
+
+    aLock.lock();
+    if(!ok)
+      {
+	DEB_ERROR() << "Spill write failed: " << strerror(errno);
+	m_records.erase(seq);
+	return false;
+      }
+    m_frames[aData.frameNumber] = seq;
+    return true;
+  }
+  /** @brief the written frame no more holds a frame buffer
+   */
+  void detach(long frame_nr)
+  {
+    AutoMutex aLock(m_mutex);
+    if(m_frames.find(frame_nr) != m_frames.end())
+      m_detached.insert(frame_nr);
+  }
+  /** @brief read back the data of a frame in a new buffer
+   */
+  bool read(Data& aData)
+  {
+    DEB_MEMBER_FUNCT();
+
+    AutoMutex aLock(m_mutex);
+    FrameSeqMap::iterator f = m_frames.find(aData.frameNumber);
+    if(f == m_frames.end())
+      return false;
+    long long seq = f->second;
+    m_frames.erase(f);
+    Record record = m_records[seq];
+    aLock.unlock();
+
+    Buffer *aBufferPt = new Buffer(int(record.size));
+    bool ok = _pread(aBufferPt->data,record.size,record.offset);
+    if(ok)
+      aData.setBuffer(aBufferPt);
+    else
+      DEB_ERROR() << "Spill read failed: " << strerror(errno);
+    aBufferPt->unref();
+
+    aLock.lock();
+    m_records.erase(seq);
+    return ok;
+  }
+  /** @brief free the record of a frame without reading it
+   */
+  void discard(long frame_nr)
+  {
+    AutoMutex aLock(m_mutex);
+    FrameSeqMap::iterator f = m_frames.find(frame_nr);
+    if(f == m_frames.end())
+      return;
+    m_records.erase(f->second);
+    m_frames.erase(f);
+    m_detached.erase(frame_nr);
+  }
+  /** @brief number of spilled frames not saved yet, read back or not
+   */
+  int nbDetached(long last_frame_saved)
+  {
+    AutoMutex aLock(m_mutex);
+    m_detached.erase(m_detached.begin(),
+		     m_detached.upper_bound(last_frame_saved));
+    return int(m_detached.size());
+  }
+private:
+  struct Record
+  {
+    Record(long long o = 0,long long s = 0) : offset(o),size(s) {}
+    long long offset;
+    long long size;
+  };
+  typedef std::map<long long,Record> RecordMap;	///< by write order
+  typedef std::map<long,long long> FrameSeqMap;
+
+  bool _alloc(long long size,long long& offset) const
+  {
+    if(size > m_max_size)
+      return false;
+    if(m_records.empty())
+      {
+	offset = 0;
+	return true;
+      }
+    const Record& oldest = m_records.begin()->second;
+    const Record& newest = m_records.rbegin()->second;
+    long long end = newest.offset + newest.size;
+    if(newest.offset < oldest.offset)	// wrapped
+      {
+	offset = end;
+	return end + size <= oldest.offset;
+      }
+    if(end + size <= m_max_size)
+      offset = end;
+    else if(size <= oldest.offset)
+      offset = 0;
+    else
+      return false;
+    return true;
+  }
+  bool _pwrite(const void *buffer,long long size,long long offset)
+  {
+#ifdef __linux__
+    const char *p = (const char*) buffer;
+    while(size > 0)
+      {
+	ssize_t nb_bytes = pwrite(m_fd,p,size,offset);
+	if(nb_bytes < 0 && errno == EINTR)
+	  continue;
+	if(nb_bytes <= 0)
+	  return false;
+	p += nb_bytes,size -= nb_bytes,offset += nb_bytes;
+      }
+    return true;
+#else
+    return false;
+#endif
+  }
+  bool _pread(void *buffer,long long size,long long offset)
+  {
+#ifdef __linux__
+    char *p = (char*) buffer;
+    while(size > 0)
+      {
+	ssize_t nb_bytes = pread(m_fd,p,size,offset);
+	if(nb_bytes < 0 && errno == EINTR)
+	  continue;
+	if(nb_bytes <= 0)
+	  return false;
+	p += nb_bytes,size -= nb_bytes,offset += nb_bytes;
+      }
+    return true;
+#else
+    return false;
+#endif
+  }
+  void _close()
+  {
+#ifdef __linux__
+    if(m_fd >= 0)
+      ::close(m_fd);
+#endif
+    m_fd = -1;
+    m_records.clear();
+    m_frames.clear();
+    m_detached.clear();
+  }
+
+  mutable Mutex		m_mutex;
+  std::string		m_directory;
+  long long		m_max_size;
+  int			m_fd;
+  long long		m_next_seq;
+  RecordMap		m_records;
+  FrameSeqMap		m_frames;
+  std::set<long>	m_detached;
+};
+
+/** @brief writes the frames marked by CtControl to the overflow tier.
+ *
+ *  CtControl only marks, under its lock, how many frames have to leave
+ *  the frame buffers; this thread writes the oldest frames waiting to
+ *  be saved and releases their buffers. The frames being written still
+ *  hold their buffer, so they are not marked again.
+ */
+class CtSaving::_SpillThread : public Thread
+{
+  DEB_CLASS_NAMESPC(DebModControl,"CtSaving::_SpillThread","Control");
+public:
+  _SpillThread(CtSaving& saving) :
+    m_saving(saving),m_nb_marked(0),m_nb_in_flight(0),
+    m_busy(false),m_abort(false),m_quit(false)
+  {
+    start();
+  }
+
+  ~_SpillThread()
+  {
+    AutoMutex aLock(m_cond.mutex());
+    m_quit = true;
+    m_cond.broadcast();
+    aLock.unlock();
+    join();
+  }
+
+  /** @brief mark frames to spill so that at most high_water of the
+   *  nb_to_save frames waiting to be saved hold a frame buffer
+   *  @return the number of frames already detached from the buffers
+   */
+  int mark(long nb_to_save,long last_frame_saved,long high_water)
+  {
+    AutoMutex aLock(m_cond.mutex());
+    int nb_detached = m_saving.m_spill->nbDetached(last_frame_saved);
+    long nb_marked = (nb_to_save - nb_detached - high_water + 1 -
+		      m_nb_in_flight);
+    m_nb_marked = int(std::max(nb_marked,0L));
+    if(m_nb_marked)
+      m_cond.broadcast();
+    return nb_detached;
+  }
+
+  /** @brief end of the write of a frame, detached if its buffer was
+   *  released
+   *  @return false if the writes have to stop
+   */
+  bool frameDone(long frame_nr,bool detached)
+  {
+    AutoMutex aLock(m_cond.mutex());
+    if(detached)
+      m_saving.m_spill->detach(frame_nr);
+    else
+      m_saving.m_spill->discard(frame_nr);
+    if(m_nb_in_flight > 0)
+      --m_nb_in_flight;
+    return !m_abort && !m_quit;
+  }
+
+  /** @brief forget the marked frames and wait for the current writes,
+   *  must be called without the saving lock
+   */
+  void abort()
+  {
+    AutoMutex aLock(m_cond.mutex());
+    m_nb_marked = 0;
+    m_abort = true;
+    while(m_busy)
+      m_cond.wait();
+    m_abort = false;
+  }
+
+protected:
+  virtual void threadFunction()
+  {
+    AutoMutex aLock(m_cond.mutex());
+    while(!m_quit)
+      {
+	if(!m_nb_marked)
+	  {
+	    m_cond.wait();
+	    continue;
+	  }
+	int nb_frames = m_nb_marked;
+	m_nb_marked = 0;
+	m_nb_in_flight = nb_frames;
+	m_busy = true;
+	aLock.unlock();
+
+	m_saving._spillFrames(nb_frames);
+
+	aLock.lock();
+	m_nb_in_flight = 0;
+	m_busy = false;
+	m_cond.broadcast();
+      }
+  }
+
+private:
+  CtSaving&	m_saving;
+  Cond		m_cond;
+  int		m_nb_marked;
+  int		m_nb_in_flight;
+  bool		m_busy;
+  bool		m_abort;
+  bool		m_quit;
+};
+
 /** @brief manual background saving
  */
 class CtSaving::_ManualBackgroundSaveTask : public SinkTaskBase
 {
 public:
   _ManualBackgroundSaveTask(CtSaving& ct_saving,
-			    HeaderMap &aHeader) :
+			    _FrameHeader* aHeader) :
     m_saving(ct_saving),
     m_header(aHeader)
   {
+    m_header->ref();
   }
 
   ~_ManualBackgroundSaveTask()
   {
+    m_header->unref();
     AutoMutex lock(m_saving.m_cond.mutex());
     m_saving.m_ready_flag = true;
     m_saving.m_cond.broadcast();
@@ -144,7 +1082,7 @@ public:
   }
 private:
   CtSaving &m_saving;
-  HeaderMap m_header;
+  _FrameHeader* m_header;
 };
 /** @brief Parameters default constructor
  */
@@ -152,13 +1090,28 @@ CtSaving::Parameters::Parameters()
   : imageType(Bpp8),nextNumber(0), fileFormat(RAW), savingMode(Manual), 
     overwritePolicy(Abort),
     indexFormat("%04d"),framesPerFile(1),
-    nbframes(0)
+    nbframes(0),compressionLevel(-1),ioMode(Buffered),
+    maxConcurrentWritingTask(1)
+{
+}
+
+CtSaving::TimeStatistic::TimeStatistic()
+  : nb(0),mean(0.),max(0.),p50(0.),p90(0.),p99(0.)
+{
+}
+
+CtSaving::SavingStatistic::SavingStatistic()
+  : nbFrames(0),nbBytes(0),elapsedTime(0.),bytesPerSecond(0.),
+    outstandingFrames(0),maxOutstandingFrames(0)
 {
 }
 
 void CtSaving::Parameters::checkValid() const
 {
   DEB_MEMBER_FUNCT();
+  if(maxConcurrentWritingTask < 1)
+    THROW_CTL_ERROR(InvalidValue) << "Max concurrent writing task must be "
+				     "at least 1: " << DEB_VAR1(maxConcurrentWritingTask);
   switch(fileFormat)
     {
 #ifdef WITH_CBF_SAVING
@@ -179,13 +1132,44 @@ void CtSaving::Parameters::checkValid() const
     default:
       break;
     }
+
+  // -1 is the compressor default, the other levels are given as is
+  int max_level;
+  switch(fileFormat)
+    {
+#ifdef WITH_EDFGZ_SAVING
+    case EDFGZ:
+    case HDF5GZ:
+      max_level = Z_BEST_COMPRESSION;break;
+#endif
+#ifdef WITH_LZ4_SAVING
+    case EDFLZ4:
+    case HDF5LZ4:
+      max_level = LZ4HC_CLEVEL_MAX;break;
+#endif
+#ifdef WITH_ZSTD_SAVING
+    case EDFZSTD:
+    case HDF5ZSTD:
+      max_level = ZSTD_maxCLevel();break;
+#endif
+    default:
+      // level not used by the format
+      return;
+    }
+  if((compressionLevel != -1) &&
+     ((compressionLevel < 0) || (compressionLevel > max_level)))
+    THROW_CTL_ERROR(InvalidValue) << "Compression level out of range for "
+				  << convert_2_string(fileFormat) << ": "
+				  << DEB_VAR1(compressionLevel)
+				  << " must be -1 or in [0," << max_level << "]";
 }
 
 
 //@brief constructor
 CtSaving::Stream::Stream(CtSaving& aCtSaving, int idx)
   : m_saving(aCtSaving), m_idx(idx),
-    m_save_cnt(NULL),
+    m_concurrent_writing(false),
+    m_first_file_nb(0),
     m_pars_dirty_flag(false),
     m_active(false),
     m_compression_cbk(NULL)
@@ -195,6 +1179,7 @@ CtSaving::Stream::Stream(CtSaving& aCtSaving, int idx)
   createSaveContainer();
   m_saving_cbk = new _SaveCBK(*this);
   m_compression_cbk = new _CompressionCBK(*this);
+  m_statistic = new _Statistic();
 }
 
 //@brief destructor
@@ -202,9 +1187,10 @@ CtSaving::Stream::~Stream()
 {
   DEB_DESTRUCTOR();
 
-  delete m_save_cnt;
+  _deleteSaveContainers();
   m_saving_cbk->unref();
   m_compression_cbk->unref();
+  delete m_statistic;
 }
 
 const 
@@ -245,7 +1231,7 @@ void CtSaving::Stream::setActive(bool active)
     return;
   
   if (!active)
-    m_save_cnt->close();
+    close();
 
   m_active = active;
 }
@@ -254,18 +1240,87 @@ void CtSaving::Stream::prepare(CtControl& ct)
 {
   DEB_MEMBER_FUNCT();
 
-  if (hasAutoSaveMode())
-    {
-      m_save_cnt->close();
-      updateParameters();
-      checkWriteAccess();
-    }
-  m_save_cnt->prepare(ct);
+  if (hasAutoSaveMode())
+    {
+      close();
+      updateParameters();
+      checkWriteAccess();
+    }
+
+  // files are spread over the writers only in auto saving,
+  // frame numbers give the file index
+  const Parameters& pars = getParameters(Acq);
+  AutoMutex aLock(m_lock);
+  m_concurrent_writing = ((m_save_cnts.size() > 1) && hasAutoSaveMode() &&
+			  (pars.overwritePolicy != Append) &&
+			  (pars.overwritePolicy != MultiSet));
+  m_first_file_nb = std::max(pars.nextNumber,0L);
+  aLock.unlock();
+  DEB_TRACE() << DEB_VAR2(m_concurrent_writing,m_first_file_nb);
+
+  resetSavingStatistic();
+
+  for(SaveContainerList::iterator i = m_save_cnts.begin();
+      i != m_save_cnts.end();++i)
+    (*i)->prepare(ct);
+}
+
+void CtSaving::Stream::close()
+{
+  for(SaveContainerList::iterator i = m_save_cnts.begin();
+      i != m_save_cnts.end();++i)
+    (*i)->close();
+}
+
+void CtSaving::Stream::clear()
+{
+  for(SaveContainerList::iterator i = m_save_cnts.begin();
+      i != m_save_cnts.end();++i)
+    (*i)->clear();
+}
+
+void CtSaving::Stream::getStatistic(std::list<double>& stat_list) const
+{
+  for(SaveContainerList::const_iterator i = m_save_cnts.begin();
+      i != m_save_cnts.end();++i)
+    (*i)->getStatistic(stat_list);
+}
+
+void CtSaving::Stream::setStatisticSize(int size)
+{
+  for(SaveContainerList::iterator i = m_save_cnts.begin();
+      i != m_save_cnts.end();++i)
+    (*i)->setStatisticSize(size);
+}
+
+void CtSaving::Stream::getSavingStatistic(SavingStatistic& stat) const
+{
+  m_statistic->get(stat);
+}
+
+void CtSaving::Stream::resetSavingStatistic()
+{
+  m_statistic->reset();
+}
+
+void CtSaving::Stream::addFrameReady(const Timestamp& ready_time)
+{
+  m_statistic->frameReady(ready_time);
+}
+
+void CtSaving::Stream::addWriteTime(double write_time, long long nb_bytes)
+{
+  m_statistic->frameWritten(write_time, nb_bytes);
+}
+
+void CtSaving::Stream::addCompressionTime(double compression_time)
+{
+  m_statistic->addCompression(compression_time);
 }
 
-void CtSaving::Stream::close()
+void CtSaving::Stream::addQueueTime(double queue_time)
 {
-  m_save_cnt->close();
+  m_statistic->addQueue(queue_time);
 }
 void CtSaving::Stream::updateParameters()
 {
@@ -274,7 +1329,8 @@ void CtSaving::Stream::updateParameters()
   if (!m_pars_dirty_flag)
     return;
 
-  if (m_pars.fileFormat != m_acquisition_pars.fileFormat)
+  if (m_pars.fileFormat != m_acquisition_pars.fileFormat ||
+      m_pars.maxConcurrentWritingTask != m_acquisition_pars.maxConcurrentWritingTask)
     createSaveContainer();
 
   m_acquisition_pars = m_pars;
@@ -322,6 +1378,42 @@ void CtSaving::Stream::createSaveContainer()
 #ifndef WITH_HDF5_SAVING
     THROW_CTL_ERROR(NotSupported) << "Lima is not compiled with the hdf5 "
                                      "saving option, not managed";
+#endif
+    goto common;
+  case HDF5GZ:
+#if !defined(WITH_HDF5_SAVING) || !defined(WITH_EDFGZ_SAVING)
+    THROW_CTL_ERROR(NotSupported) << "Lima is not compiled with the hdf5 "
+                                     "and edf gzip saving options, not managed";
+#endif
+    goto common;
+  case EDFLZ4:
+#ifndef WITH_LZ4_SAVING
+    THROW_CTL_ERROR(NotSupported) << "Lima is not compiled with the lz4 "
+                                     "saving option, not managed";
+#endif
+    goto common;
+  case EDFZSTD:
+#ifndef WITH_ZSTD_SAVING
+    THROW_CTL_ERROR(NotSupported) << "Lima is not compiled with the zstd "
+                                     "saving option, not managed";
+#endif
+    goto common;
+  case HDF5LZ4:
+#if !defined(WITH_HDF5_SAVING) || !defined(WITH_LZ4_SAVING)
+    THROW_CTL_ERROR(NotSupported) << "Lima is not compiled with the hdf5 "
+                                     "and lz4 saving options, not managed";
+#endif
+    goto common;
+  case HDF5BS:
+#if !defined(WITH_HDF5_SAVING) || !defined(WITH_BSLZ4_SAVING)
+    THROW_CTL_ERROR(NotSupported) << "Lima is not compiled with the hdf5 "
+                                     "and bitshuffle saving options, not managed";
+#endif
+    goto common;
+  case HDF5ZSTD:
+#if !defined(WITH_HDF5_SAVING) || !defined(WITH_ZSTD_SAVING)
+    THROW_CTL_ERROR(NotSupported) << "Lima is not compiled with the hdf5 "
+                                     "and zstd saving options, not managed";
 #endif
     goto common;
   case EDFConcat:
@@ -335,65 +1427,134 @@ void CtSaving::Stream::createSaveContainer()
 
 
   common:
-    if (m_save_cnt) {
-      m_save_cnt->close();
-      delete m_save_cnt;
-    }
+    _deleteSaveContainers();
     break;
 
   default:
     THROW_CTL_ERROR(NotSupported) << "File format not yet managed";
   }
 
+  SaveContainer *save_cnt = _newSaveContainer();
+  m_save_cnts.push_back(save_cnt);
+  if (!save_cnt->canWriteConcurrently()) {
+    if (m_pars.maxConcurrentWritingTask > 1)
+      DEB_WARNING() << "Format " << convert_2_string(m_pars.fileFormat)
+		    << " can't be written concurrently, use only one writer";
+    return;
+  }
+  for (int i = 1; i < m_pars.maxConcurrentWritingTask; ++i)
+    m_save_cnts.push_back(_newSaveContainer());
+}
+
+void CtSaving::Stream::_deleteSaveContainers()
+{
+  for(SaveContainerList::iterator i = m_save_cnts.begin();
+      i != m_save_cnts.end();++i)
+    {
+      (*i)->close();
+      delete *i;
+    }
+  m_save_cnts.clear();
+}
+
+CtSaving::SaveContainer* CtSaving::Stream::_newSaveContainer()
+{
+  SaveContainer *save_cnt = NULL;
   switch(m_pars.fileFormat)
   {
   case RAW:
   case EDF:
   case EDFGZ:
+  case EDFLZ4:
+  case EDFZSTD:
   case EDFConcat:
-    m_save_cnt = new SaveContainerEdf(*this,m_pars.fileFormat);
+    save_cnt = new SaveContainerEdf(*this,m_pars.fileFormat);
     break;
 #ifdef WITH_CBF_SAVING
   case CBFFormat:
-    m_save_cnt = new SaveContainerCbf(*this);
+    save_cnt = new SaveContainerCbf(*this);
     m_pars.framesPerFile = 1;
     break;
 #endif
 #ifdef WITH_NXS_SAVING
   case NXS:
-    m_save_cnt = new SaveContainerNxs(*this);
+    save_cnt = new SaveContainerNxs(*this);
     break;
 #endif
 #ifdef WITH_FITS_SAVING
   case FITS:
-    m_save_cnt = new SaveContainerFits(*this);
+    save_cnt = new SaveContainerFits(*this);
     break;
 #endif
 #ifdef WITH_TIFF_SAVING
   case TIFFFormat:
-    m_save_cnt = new SaveContainerTiff(*this);
+    save_cnt = new SaveContainerTiff(*this);
     m_pars.framesPerFile = 1;
     break;
 #endif
 #ifdef WITH_HDF5_SAVING
   case HDF5:
-    m_save_cnt = new SaveContainerHdf5(*this, m_pars.fileFormat);
+  case HDF5GZ:
+  case HDF5LZ4:
+  case HDF5BS:
+  case HDF5ZSTD:
+    save_cnt = new SaveContainerHdf5(*this, m_pars.fileFormat);
     break;
 #endif
   default:
     break;
   }
+  return save_cnt;
 }
 
 void CtSaving::Stream::writeFile(Data& data, HeaderMap& header)
 {
   DEB_MEMBER_FUNCT();
 
-  m_save_cnt->writeFile(data, header);
+  m_save_cnts[getWriterIndex(data.frameNumber)]->writeFile(data, header);
+}
+
+/** @brief writer (container) used for a frame.
+ *
+ *  With concurrent writing, file n is written by writer n % nb_writers,
+ *  so several files can be written at the same time.
+ *  Otherwise all the frames go to the first writer.
+ */
+int CtSaving::Stream::getWriterIndex(long frame_nr) const
+{
+  if (!m_concurrent_writing)
+    return 0;
+  const Parameters& pars = getParameters(Acq);
+  return int((frame_nr / pars.framesPerFile) % long(m_save_cnts.size()));
+}
+
+/** @brief file number to open for a frame
+ */
+long CtSaving::Stream::getFileNumber(long frame_nr) const
+{
+  AutoMutex aLock(m_lock);
+  if (!m_concurrent_writing)
+    return getParameters(Acq).nextNumber;
+  const Parameters& pars = getParameters(Acq);
+  return m_first_file_nb + frame_nr / pars.framesPerFile;
+}
+
+/** @brief update the next file number once a file is closed
+ */
+void CtSaving::Stream::fileClosed(long file_nb)
+{
+  AutoMutex aLock(m_lock);
+  Parameters& pars = getParameters(Acq);
+  if (!m_concurrent_writing)
+    ++pars.nextNumber;
+  else if (file_nb >= pars.nextNumber)
+    pars.nextNumber = file_nb + 1;
 }
 
 
-SinkTaskBase *CtSaving::Stream::getTask(TaskType type, const HeaderMap& header)
+SinkTaskBase *CtSaving::Stream::getTask(TaskType type, _FrameHeader* header,
+				       long frame_nr,
+				       const Timestamp& ready_time)
 {
   DEB_MEMBER_FUNCT();
 
@@ -402,11 +1563,15 @@ SinkTaskBase *CtSaving::Stream::getTask(TaskType type, const HeaderMap& header)
   if (type == Compression) {
     if (!needCompression())
       return NULL;
-    save_task = m_save_cnt->getCompressionTask(header);
+    SaveContainer *save_cnt = m_save_cnts[getWriterIndex(frame_nr)];
+    HeaderMap compression_header;
+    header->fill(compression_header);
+    save_task = new _CompressionTask(*this,
+				     save_cnt->getCompressionTask(compression_header));
     save_task->setEventCallback(m_compression_cbk);
   } else {
-    _SaveTask *real_task = new _SaveTask(*this);
-    real_task->m_header = header;
+    _SaveTask *real_task = new _SaveTask(*this, header);
+    real_task->m_ready_time = ready_time;
     save_task = real_task;
     save_task->setEventCallback(m_saving_cbk);
   }
@@ -468,6 +1633,9 @@ public:
     saving_setting.set("indexFormat",pars.indexFormat);
     saving_setting.set("framesPerFile",pars.framesPerFile);
     saving_setting.set("nbframes",pars.nbframes);
+    saving_setting.set("compressionLevel",pars.compressionLevel);
+    saving_setting.set("ioMode",convert_2_string(pars.ioMode));
+    saving_setting.set("maxConcurrentWritingTask",pars.maxConcurrentWritingTask);
 
     CtSaving::ManagedMode managedmode;
     m_saving.getManagedMode(managedmode);
@@ -513,6 +1681,14 @@ public:
     if(saving_setting.get("nbframes",nbframes))
       pars.nbframes = nbframes;
 
+    saving_setting.get("compressionLevel",pars.compressionLevel);
+
+    std::string strioMode;
+    if(saving_setting.get("ioMode",strioMode))
+      convert_from_string(strioMode,pars.ioMode);
+
+    saving_setting.get("maxConcurrentWritingTask",pars.maxConcurrentWritingTask);
+
     std::string strmanagedmode;
     if(saving_setting.get("managedmode",strmanagedmode))
       {
@@ -532,9 +1708,12 @@ private:
 CtSaving::CtSaving(CtControl &aCtrl) :
   m_ctrl(aCtrl),
   m_stream(NULL),
+  m_common_header_dirty(true),
+  m_frame_headers(new _FrameHeaderStore(16)),
+  m_spill(new _SpillStore()),
+  m_spill_thread(NULL),
   m_ready_flag(true),
   m_need_compression(false),
-  m_nb_save_cbk(0),
   m_end_cbk(NULL),
   m_managed_mode(Software)
 {
@@ -549,6 +1728,8 @@ CtSaving::CtSaving(CtControl &aCtrl) :
 
   resetLastFrameNb();
 
+  m_spill_thread = new _SpillThread(*this);
+
   HwInterface *hw = aCtrl.hwInterface();
 #ifdef __linux__
   m_has_hwsaving = hw->getHwCtrlObj(m_hwsaving);
@@ -570,11 +1751,15 @@ CtSaving::~CtSaving()
 {
   DEB_DESTRUCTOR();
 
+  delete m_spill_thread;
+
   for (int s = 0; s < m_nb_stream; ++s)
     delete m_stream[s];
   delete [] m_stream;
 
   setEndCallback(NULL);
+  delete m_frame_headers;
+  delete m_spill;
   if(m_has_hwsaving)
     {
       m_hwsaving->unregisterCallback(m_new_frame_save_cbk);
@@ -784,6 +1969,102 @@ void CtSaving::getFormat(FileFormat& format, int stream_idx) const
 
   DEB_RETURN() << DEB_VAR1(format);
 }
+/** @brief set the compression level for a saving stream
+ *
+ *  only used by the compressed formats (gzip, lz4, zstd),
+ *  -1 means the compressor default level, otherwise it must be in
+ *  0-9 for gzip, 0-12 for lz4 (>0 is lz4hc) or 0-ZSTD_maxCLevel()
+ *  for zstd, InvalidValue is thrown otherwise
+ */
+void CtSaving::setCompressionLevel(int level, int stream_idx)
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR2(level, stream_idx);
+
+  AutoMutex aLock(m_cond.mutex());
+  Stream& stream = getStream(stream_idx);
+  Parameters pars = stream.getParameters(Auto);
+  pars.compressionLevel = level;
+  stream.setParameters(pars);
+}
+/** @brief get the compression level for a saving stream
+ */
+void CtSaving::getCompressionLevel(int& level, int stream_idx) const
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR1(stream_idx);
+
+  AutoMutex aLock(m_cond.mutex());
+  const Stream& stream = getStream(stream_idx);
+  const Parameters& pars = stream.getParameters(Auto);
+  level = pars.compressionLevel;
+
+  DEB_RETURN() << DEB_VAR1(level);
+}
+/** @brief set how RAW and EDF files are written for a saving stream
+ *
+ *  DropBehind and Direct keep the written data out of the page cache,
+ *  so the acquisition buffers are not evicted at high write rate.
+ */
+void CtSaving::setIOMode(IOMode mode, int stream_idx)
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR2(convert_2_string(mode), stream_idx);
+
+#ifndef __unix
+  if(mode != Buffered)
+    THROW_CTL_ERROR(NotSupported) << "Only buffered io mode is managed";
+#endif
+  AutoMutex aLock(m_cond.mutex());
+  Stream& stream = getStream(stream_idx);
+  Parameters pars = stream.getParameters(Auto);
+  pars.ioMode = mode;
+  stream.setParameters(pars);
+}
+/** @brief get the io mode for a saving stream
+ */
+void CtSaving::getIOMode(IOMode& mode, int stream_idx) const
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR1(stream_idx);
+
+  AutoMutex aLock(m_cond.mutex());
+  const Stream& stream = getStream(stream_idx);
+  const Parameters& pars = stream.getParameters(Auto);
+  mode = pars.ioMode;
+
+  DEB_RETURN() << DEB_VAR1(convert_2_string(mode));
+}
+/** @brief set the number of files a saving stream can write in parallel
+ *
+ *  Only used in auto saving mode, and not with the Append or MultiSet
+ *  overwrite policies. Frames inside a file are still written in order.
+ */
+void CtSaving::setMaxConcurrentWritingTask(int nb, int stream_idx)
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR2(nb, stream_idx);
+
+  AutoMutex aLock(m_cond.mutex());
+  Stream& stream = getStream(stream_idx);
+  Parameters pars = stream.getParameters(Auto);
+  pars.maxConcurrentWritingTask = nb;
+  stream.setParameters(pars);
+}
+/** @brief get the number of files a saving stream can write in parallel
+ */
+void CtSaving::getMaxConcurrentWritingTask(int& nb, int stream_idx) const
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR1(stream_idx);
+
+  AutoMutex aLock(m_cond.mutex());
+  const Stream& stream = getStream(stream_idx);
+  const Parameters& pars = stream.getParameters(Auto);
+  nb = pars.maxConcurrentWritingTask;
+
+  DEB_RETURN() << DEB_VAR1(nb);
+}
 /** @brief return a list of hardware possible saving format
  */
 void CtSaving::getHardwareFormatList(std::list<std::string> &format_list) const
@@ -974,15 +2255,25 @@ void CtSaving::getManagedMode(CtSaving::ManagedMode &mode) const
 }
 
 void CtSaving::_getTaskList(TaskType type, long frame_nr, 
-			    const HeaderMap& header, TaskList& task_list)
+			    _FrameHeader* header, TaskList& task_list)
 {
   DEB_MEMBER_FUNCT();
 
+  Timestamp ready_time;
+  if (type == Save) {
+    FrameTimestampMap::iterator time_it = m_frame_ready_times.find(frame_nr);
+    if (time_it != m_frame_ready_times.end()) {
+      ready_time = time_it->second;
+      m_frame_ready_times.erase(time_it);
+    }
+  }
+
   task_list.clear();
   for (int s = 0; s < m_nb_stream; ++s) {
     Stream& stream = getStream(s);
     if (stream.isActive()) {
-      SinkTaskBase *save_task = stream.getTask(type, header);
+      SinkTaskBase *save_task = stream.getTask(type, header, frame_nr,
+					       ready_time);
       if (save_task)
 	task_list.push_back(save_task);
     }
@@ -992,8 +2283,38 @@ void CtSaving::_getTaskList(TaskType type, long frame_nr,
   if (type == Compression) {
     FrameCbkCountMap::value_type map_pair(frame_nr, nb_cbk);
     m_nb_compression_cbk.insert(map_pair);
-  } else
-    m_nb_save_cbk = nb_cbk;
+  } else {
+    FrameCbkCountMap::value_type map_pair(frame_nr, nb_cbk);
+    m_nb_save_cbk.insert(map_pair);
+  }
+}
+/** @brief check if a frame can be posted to the save tasks.
+ *
+ *  Frames are posted in order. When some frames are still being
+ *  written, the new one is posted only if, for every active stream,
+ *  it goes to an idle writer.
+ */
+bool CtSaving::_canSave(long frame_nr) const
+{
+  if (m_last_frameid_saved != frame_nr - 1)
+    return false;
+  if (m_ready_flag)
+    return true;
+  // manual saving in progress
+  if (m_nb_save_cbk.empty())
+    return false;
+
+  for (int s = 0; s < m_nb_stream; ++s) {
+    const Stream& stream = getStream(s);
+    if (!stream.isActive())
+      continue;
+    int writer = stream.getWriterIndex(frame_nr);
+    FrameCbkCountMap::const_iterator it, end = m_nb_save_cbk.end();
+    for (it = m_nb_save_cbk.begin(); it != end; ++it)
+      if (stream.getWriterIndex(it->first) == writer)
+	return false;
+  }
+  return true;
 }
 /** @brief clear the common header
  */
@@ -1012,6 +2333,7 @@ void CtSaving::resetCommonHeader()
 	THROW_CTL_ERROR(NotSupported) << "Common header is not supported";
     }
   m_common_header.clear();
+  m_common_header_dirty = true;
 }
 /** @brief set the common header.
     This is the header which will be write for all frame for this acquisition
@@ -1032,6 +2354,7 @@ void CtSaving::setCommonHeader(const HeaderMap &header)
 	THROW_CTL_ERROR(NotSupported) << "Common header is not supported";
     }
   m_common_header = header;
+  m_common_header_dirty = true;
 }
 /** @brief replace/add field in the common header
  */
@@ -1051,6 +2374,7 @@ void CtSaving::updateCommonHeader(const HeaderMap &header)
       if(!result.second)
 	result.first->second = i->second;
     }
+  m_common_header_dirty = true;
 }
 /** @brief get the current common header
  */
@@ -1072,6 +2396,7 @@ void CtSaving::addToCommonHeader(const HeaderValue &value)
 
   AutoMutex aLock(m_cond.mutex());
   m_common_header.insert(value);
+  m_common_header_dirty = true;
 }
 /** @brief add/replace a header value in the current frame header
  */
@@ -1080,8 +2405,10 @@ void CtSaving::addToFrameHeader(long frame_nr,const HeaderValue &value)
   DEB_MEMBER_FUNCT();
   DEB_PARAM() << DEB_VAR2(frame_nr,value);
 
+  const _FrameHeaderStore::Key* key = m_frame_headers->intern(value.first);
+
   AutoMutex aLock(m_cond.mutex());
-  m_frame_headers[frame_nr].insert(value);
+  m_frame_headers->get(frame_nr).set(key,value.second,false);
 }
 /** @brief add/replace several value in the current frame header
  */
@@ -1090,17 +2417,19 @@ void CtSaving::updateFrameHeader(long frame_nr,const HeaderMap &header)
   DEB_MEMBER_FUNCT();
   DEB_PARAM() << DEB_VAR2(frame_nr,header);
 
-  AutoMutex aLock(m_cond.mutex());
-  HeaderMap &frameHeader = m_frame_headers[frame_nr];
+  // intern the keys before taking the saving lock
+  std::vector<const _FrameHeaderStore::Key*> keys;
+  keys.reserve(header.size());
   for(HeaderMap::const_iterator i = header.begin();
       i != header.end();++i)
-    {
-      std::pair<HeaderMap::iterator,bool> result= 
-	frameHeader.insert(HeaderMap::value_type(i->first,i->second));
-      //if it exist, update
-      if(!result.second)
-	result.first->second = i->second;
-    }
+    keys.push_back(m_frame_headers->intern(i->first));
+
+  AutoMutex aLock(m_cond.mutex());
+  _FrameHeaderStore::Slot& frameHeader = m_frame_headers->get(frame_nr);
+  std::vector<const _FrameHeaderStore::Key*>::const_iterator k = keys.begin();
+  for(HeaderMap::const_iterator i = header.begin();
+      i != header.end();++i,++k)
+    frameHeader.set(*k,i->second,true); //if it exist, update
   _validateFrameHeader(frame_nr,aLock);
 }
 /** @brief validate a header for a frame.
@@ -1125,26 +2454,24 @@ void CtSaving::_validateFrameHeader(long frame_nr,
 
   FrameMap::iterator frame_iter = m_frame_datas.find(frame_nr);
   bool data_available = (frame_iter != m_frame_datas.end());
-  bool can_save = (m_ready_flag && (m_last_frameid_saved == frame_nr - 1));
+  bool can_save = _canSave(frame_nr);
   if (!data_available || !(m_need_compression || can_save))
     return;
   Data aData = frame_iter->second;
 
-  HeaderMap task_header;
-  FrameHeaderMap::iterator aHeaderIter;
-  aHeaderIter = m_frame_headers.find(frame_nr);
   bool keep_header = m_need_compression;
-  _takeHeader(aHeaderIter, task_header, keep_header);
+  _FrameHeader *task_header = _takeHeader(frame_nr, keep_header);
 
   TaskType task_type = m_need_compression ? Compression : Save;
   TaskList task_list;
   _getTaskList(task_type, frame_nr, task_header, task_list);
+  task_header->unref();
   if (!m_need_compression) {
     m_frame_datas.erase(frame_iter);
     m_ready_flag = false, m_last_frameid_saved = frame_nr;
   }
   aLock.unlock();
-  _postTaskList(aData, task_list);
+  _postTaskList(aData, task_type, task_list);
 }
 /** @brief get the frame header.
 
@@ -1157,9 +2484,9 @@ void CtSaving::getFrameHeader(long frame_nr, HeaderMap& header) const
   DEB_PARAM() << DEB_VAR1(frame_nr);
 
   AutoMutex aLock(m_cond.mutex());
-  FrameHeaderMap::const_iterator i = m_frame_headers.find(frame_nr);
-  if(i != m_frame_headers.end())
-    header.insert(i->second.begin(),i->second.end());
+  const _FrameHeaderStore::Slot* slot = m_frame_headers->find(frame_nr);
+  if(slot)
+    slot->toHeaderMap(header,false);
 
   DEB_RETURN() << DEB_VAR1(header);
 }
@@ -1172,11 +2499,12 @@ void CtSaving::takeFrameHeader(long frame_nr, HeaderMap& header)
   DEB_PARAM() << DEB_VAR1(frame_nr);
 
   AutoMutex aLock(m_cond.mutex());
-  FrameHeaderMap::iterator i = m_frame_headers.find(frame_nr);
-  if(i != m_frame_headers.end())
+  _FrameHeaderStore::Slot* slot = m_frame_headers->find(frame_nr);
+  if(slot)
     {
-      header = i->second;
-      m_frame_headers.erase(i);
+      header.clear();
+      slot->toHeaderMap(header,false);
+      m_frame_headers->erase(frame_nr);
     }
   
   DEB_RETURN() << DEB_VAR1(header);
@@ -1191,7 +2519,7 @@ void CtSaving::removeFrameHeader(long frame_nr)
   DEB_PARAM() << DEB_VAR1(frame_nr);
 
   AutoMutex aLock(m_cond.mutex());
-  m_frame_headers.erase(frame_nr);
+  m_frame_headers->erase(frame_nr);
 }
 /** @brief remove all frame header
  */
@@ -1200,37 +2528,22 @@ void CtSaving::removeAllFrameHeaders()
   DEB_MEMBER_FUNCT();
 
   AutoMutex aLock(m_cond.mutex());
-  m_frame_headers.clear();
+  m_frame_headers->clear();
 }
 
 // Private methodes
 
-void CtSaving::_getCommonHeader(HeaderMap &header)
-{
-  header.insert(m_internal_common_header.begin(),
-		m_internal_common_header.end());
-  header.insert(m_common_header.begin(),m_common_header.end());
-}
-void CtSaving::_takeHeader(FrameHeaderMap::iterator& headerIter, 
-			   HeaderMap& header, bool keep_in_map)
+/** @brief header of a frame for its save tasks, the caller owns
+    one reference.
+ */
+CtSaving::_FrameHeader* CtSaving::_takeHeader(long frame_nr, bool keep_in_map)
 {
-  _getCommonHeader(header);
-
-  if (headerIter == m_frame_headers.end())
-    return;
-
-  HeaderMap &aFrameHeaderMap = headerIter->second;
-  for(HeaderMap::iterator i = aFrameHeaderMap.begin();
-      i != aFrameHeaderMap.end();++i)
+  if(m_common_header_dirty)
     {
-      std::pair<HeaderMap::iterator,bool> result = 
-	header.insert(HeaderMap::value_type(i->first,i->second));
-      if(!result.second)
-	result.first->second = i->second;
+      m_frame_headers->setCommon(m_internal_common_header,m_common_header);
+      m_common_header_dirty = false;
     }
-
-  if(!keep_in_map)
-    m_frame_headers.erase(headerIter);
+  return m_frame_headers->take(frame_nr,keep_in_map);
 }
 
 void CtSaving::resetLastFrameNb()
@@ -1261,12 +2574,14 @@ void CtSaving::resetInternalCommonHeader()
 {
   AutoMutex aLock(m_cond.mutex());
   m_internal_common_header.clear();
+  m_common_header_dirty = true;
 }
 
 void CtSaving::addToInternalCommonHeader(const HeaderValue& value)
 {
   AutoMutex aLock(m_cond.mutex());
   m_internal_common_header.insert(value);
+  m_common_header_dirty = true;
 }
 
 bool CtSaving::_controlIsFault()
@@ -1305,10 +2620,17 @@ void CtSaving::frameReady(Data &aData)
   SavingMode saving_mode = getAcqSavingMode();
   bool auto_header = (saving_mode == AutoHeader);
   long frame_nr = aData.frameNumber;
-  FrameHeaderMap::iterator aHeaderIter;
-  aHeaderIter = m_frame_headers.find(frame_nr);
-  bool header_available = (aHeaderIter != m_frame_headers.end());
-  bool can_save = (m_ready_flag && (m_last_frameid_saved == frame_nr - 1));
+  if (saving_mode != Manual) {
+    Timestamp ready_time = Timestamp::now();
+    m_frame_ready_times[frame_nr] = ready_time;
+    for (int s = 0; s < m_nb_stream; ++s) {
+      Stream& stream = getStream(s);
+      if (stream.isActive())
+	stream.addFrameReady(ready_time);
+    }
+  }
+  bool header_available = !!m_frame_headers->find(frame_nr);
+  bool can_save = _canSave(frame_nr);
   DEB_TRACE() << DEB_VAR5(saving_mode, m_need_compression, can_save,
 			  auto_header, header_available);
   if (!(m_need_compression || can_save) || 
@@ -1318,18 +2640,18 @@ void CtSaving::frameReady(Data &aData)
     return;
   }
 
-  HeaderMap task_header;
   bool keep_header = m_need_compression;
-  _takeHeader(aHeaderIter, task_header, keep_header);
+  _FrameHeader *task_header = _takeHeader(frame_nr, keep_header);
 
   TaskType task_type = m_need_compression ? Compression : Save;
   TaskList task_list;
   _getTaskList(task_type, frame_nr, task_header, task_list);
+  task_header->unref();
   if (!m_need_compression)
     m_ready_flag = false, m_last_frameid_saved = frame_nr;
 
   aLock.unlock();
-  _postTaskList(aData, task_list);
+  _postTaskList(aData, task_type, task_list);
 }
 /** @brief get write statistic
     this is the last write time
@@ -1343,6 +2665,82 @@ void CtSaving::getWriteTimeStatistic(std::list<double> &aReturnList,
   const Stream& stream = getStream(stream_idx);
   stream.getStatistic(aReturnList);
 }
+/** @brief get the saving statistic of a stream
+
+    write speed, write/compression/queue time percentiles and
+    outstanding frames, since the beginning of the acquisition
+    or the last resetSavingStatistic
+ */
+void CtSaving::getSavingStatistic(SavingStatistic& stat,
+				  int stream_idx) const
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR1(stream_idx);
+
+  const Stream& stream = getStream(stream_idx);
+  stream.getSavingStatistic(stat);
+
+  DEB_RETURN() << DEB_VAR1(stat);
+}
+/** @brief reset the saving statistic of a stream,
+    it's also done at each acquisition start
+ */
+void CtSaving::resetSavingStatistic(int stream_idx)
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR1(stream_idx);
+
+  Stream& stream = getStream(stream_idx);
+  stream.resetSavingStatistic();
+}
+/** @brief set the directory of the overflow tier, "" disables it.
+
+    When the frame buffers are nearly full, the oldest frames waiting
+    to be saved are moved to a scratch file in this directory instead
+    of declaring an overrun. It should be a fast local disk. Only used
+    for the software saving without compression, it's taken into
+    account on the next prepareAcq.
+ */
+void CtSaving::setSpillDirectory(const std::string& directory)
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR1(directory);
+
+#ifndef __linux__
+  if (!directory.empty())
+    THROW_CTL_ERROR(NotSupported) << "Spill not supported on this platform";
+#endif
+  m_spill->setDirectory(directory);
+}
+
+void CtSaving::getSpillDirectory(std::string& directory) const
+{
+  DEB_MEMBER_FUNCT();
+
+  directory = m_spill->getDirectory();
+
+  DEB_RETURN() << DEB_VAR1(directory);
+}
+/** @brief set the maximum size in bytes of the overflow tier file
+ */
+void CtSaving::setSpillMaxSize(long long max_size)
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR1(max_size);
+
+  if (max_size <= 0)
+    THROW_CTL_ERROR(InvalidValue) << "Invalid " << DEB_VAR1(max_size);
+  m_spill->setMaxSize(max_size);
+}
+
+void CtSaving::getSpillMaxSize(long long& max_size) const
+{
+  DEB_MEMBER_FUNCT();
+
+  max_size = m_spill->getMaxSize();
+
+  DEB_RETURN() << DEB_VAR1(max_size);
+}
 /** @brief set the size of the write time static list
  */
 void CtSaving::setStatisticHistorySize(int aSize, int stream_idx)
@@ -1392,11 +2790,14 @@ void CtSaving::clear()
     stream.clear();
   }
 
+  m_spill_thread->abort();
   AutoMutex aLock(m_cond.mutex());
-  m_frame_headers.clear();
+  m_frame_headers->clear();
   m_common_header.clear();	// @fix Should we clear common header???
+  m_common_header_dirty = true;
   m_frame_datas.clear();
-  
+  m_frame_ready_times.clear();
+  m_spill->clear();
 }
 
 void CtSaving::close()
@@ -1456,12 +2857,23 @@ void CtSaving::writeFrame(int aFrameNumber, int aNbFrames,bool synchronous)
       m_ctrl.ReadImage(anImage2Save,aFrameNumber,aNbFrames);
 
       // Saving
-      HeaderMap header;
-      FrameHeaderMap::iterator aHeaderIter;
-      aHeaderIter = m_frame_headers.find(anImage2Save.frameNumber);
-      _takeHeader(aHeaderIter, header, false);
+      _FrameHeader *header;
+      {
+	AutoMutex aLock(m_cond.mutex());
+	header = _takeHeader(anImage2Save.frameNumber, false);
+      }
       if(synchronous)
-	_synchronousSaving(anImage2Save,header);
+	{
+	  try
+	    {
+	      _synchronousSaving(anImage2Save,header);
+	    }
+	  catch(...)
+	    {
+	      header->unref();
+	      throw;
+	    }
+	}
       else
 	{
 	  TaskMgr *aSavingManualMgrPt = new TaskMgr();
@@ -1472,8 +2884,10 @@ void CtSaving::writeFrame(int aFrameNumber, int aNbFrames,bool synchronous)
 	  aSavingManualMgrPt->addSinkTask(0,aTaskPt);
 	  aTaskPt->unref();
 	  
-	  PoolThreadMgr::get().addProcess(aSavingManualMgrPt);
+	  m_ctrl.threadPools()->addProcess(CtThreadPools::Saving,
+					   aSavingManualMgrPt);
 	}
+      header->unref();
     }
   else
     {
@@ -1498,8 +2912,10 @@ void CtSaving::_updateParameters()
   }
 }
 
-void CtSaving::_synchronousSaving(Data &anImage2Save,HeaderMap &header)
+void CtSaving::_synchronousSaving(Data &anImage2Save,_FrameHeader* frame_header)
 {
+  HeaderMap header;
+  frame_header->fill(header);
   for (int s = 0; s < m_nb_stream; ++s) {
     Stream& stream = getStream(s);
     if (!stream.isActive())
@@ -1507,7 +2923,8 @@ void CtSaving::_synchronousSaving(Data &anImage2Save,HeaderMap &header)
 
     if(stream.needCompression()) {
       SinkTaskBase *aCompressionTaskPt;
-      aCompressionTaskPt = stream.getTask(Compression, header);
+      aCompressionTaskPt = stream.getTask(Compression, frame_header,
+					  anImage2Save.frameNumber);
       aCompressionTaskPt->setEventCallback(NULL);
       aCompressionTaskPt->process(anImage2Save);
       aCompressionTaskPt->unref();
@@ -1516,14 +2933,24 @@ void CtSaving::_synchronousSaving(Data &anImage2Save,HeaderMap &header)
     stream.writeFile(anImage2Save, header);
   }
 }
-void CtSaving::_postTaskList(Data& aData, const TaskList& task_list)
+void CtSaving::_postTaskList(Data& aData, TaskType type,
+			     const TaskList& task_list)
 {
   DEB_MEMBER_FUNCT();
-  DEB_PARAM() << DEB_VAR2(aData, task_list.size());
+  DEB_PARAM() << DEB_VAR3(aData, type, task_list.size());
+
+  TaskList::const_iterator it, end = task_list.end();
+  // frame moved to the overflow tier
+  if (aData.empty() && !m_spill->read(aData)) {
+    DEB_ERROR() << "Can't read back spilled frame " << aData.frameNumber;
+    for (it = task_list.begin(); it != end; ++it)
+      (*it)->unref();
+    _setSavingError(CtControl::SaveAccessError);
+    return;
+  }
 
   TaskMgr *aSavingMgrPt = new TaskMgr();
 
-  TaskList::const_iterator it, end = task_list.end();
   for (it = task_list.begin(); it != end; ++it) {
     SinkTaskBase *save_task = *it;
     aSavingMgrPt->addSinkTask(0, save_task);
@@ -1531,7 +2958,70 @@ void CtSaving::_postTaskList(Data& aData, const TaskList& task_list)
   }
   aSavingMgrPt->setInputData(aData);
 
-  PoolThreadMgr::get().addProcess(aSavingMgrPt);
+  CtThreadPools::Role role = (type == Compression) ? CtThreadPools::Compression :
+						     CtThreadPools::Saving;
+  m_ctrl.threadPools()->addProcess(role, aSavingMgrPt);
+}
+
+bool CtSaving::_isSpillActive() const
+{
+  AutoMutex aLock(m_cond.mutex());
+  return !m_need_compression && m_spill->isActive();
+}
+/** @brief mark frames waiting to be saved for the overflow tier, so
+    that at most high_water of them hold a frame buffer
+
+    The frames are written by the spill thread, this only signals it.
+    @return the number of frames waiting to be saved which are no more
+    in the frame buffers, i.e. already written and released
+ */
+int CtSaving::_markSpill(long nb_to_save, long last_frame_saved,
+			 long high_water)
+{
+  return m_spill_thread->mark(nb_to_save, last_frame_saved, high_water);
+}
+/** @brief move the oldest frames waiting to be saved to the overflow tier
+
+    Run by the spill thread, the frames are written without the saving
+    lock: a frame posted to the writers meanwhile keeps its buffer and
+    its record is dropped.
+ */
+void CtSaving::_spillFrames(int nb_frames)
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR1(nb_frames);
+
+  std::list<Data> to_spill;
+  AutoMutex aLock(m_cond.mutex());
+  FrameMap::iterator it, end = m_frame_datas.end();
+  for (it = m_frame_datas.begin();
+       it != end && int(to_spill.size()) < nb_frames; ++it)
+    if (!it->second.empty())
+      to_spill.push_back(it->second);
+  aLock.unlock();
+
+  int nb_spilled = 0;
+  std::list<Data>::iterator d, dend = to_spill.end();
+  for (d = to_spill.begin(); d != dend; ++d) {
+    bool written = m_spill->write(*d);
+
+    aLock.lock();
+    FrameMap::iterator frame_iter = m_frame_datas.find(d->frameNumber);
+    bool waiting = (written && (frame_iter != m_frame_datas.end()) &&
+		    (frame_iter->second.buffer == d->buffer));
+    if (waiting)
+      frame_iter->second.releaseBuffer();
+    bool go_on = m_spill_thread->frameDone(d->frameNumber, waiting);
+    aLock.unlock();
+
+    if (waiting)
+      ++nb_spilled;
+    // no room left in the file
+    if (!written || !go_on)
+      break;
+  }
+
+  DEB_TRACE() << DEB_VAR1(nb_spilled);
 }
 
 void CtSaving::_compressionFinished(Data& aData, Stream& stream)
@@ -1547,22 +3037,21 @@ void CtSaving::_compressionFinished(Data& aData, Stream& stream)
     return;
   m_nb_compression_cbk.erase(count_it);
 
-  if (!m_ready_flag || (m_last_frameid_saved != frame_nr - 1)) {
+  if (!_canSave(frame_nr)) {
     FrameMap::value_type map_pair(frame_nr, aData);
     m_frame_datas.insert(map_pair);
     return;
   }
 
-  HeaderMap header;
-  FrameHeaderMap::iterator header_it = m_frame_headers.find(frame_nr);
-  _takeHeader(header_it, header, false);
+  _FrameHeader *header = _takeHeader(frame_nr, false);
 
   TaskList task_list;
   _getTaskList(Save, frame_nr, header, task_list);
+  header->unref();
   m_ready_flag = false,m_last_frameid_saved = frame_nr;
 
   aLock.unlock();
-  _postTaskList(aData, task_list);
+  _postTaskList(aData, Save, task_list);
 }
 
 void CtSaving::_saveFinished(Data &aData, Stream& stream)
@@ -1572,42 +3061,78 @@ void CtSaving::_saveFinished(Data &aData, Stream& stream)
 
   AutoMutex aLock(m_cond.mutex());
 
-  if(--m_nb_save_cbk > 0)
-    return;
+  long frame_nr = aData.frameNumber;
+  FrameCbkCountMap::iterator count_it = m_nb_save_cbk.find(frame_nr);
+  if (count_it != m_nb_save_cbk.end()) {
+    if (--count_it->second > 0)
+      return;
+    m_nb_save_cbk.erase(count_it);
+  }
+
+  // frames may finish out of order with concurrent writing,
+  // only notify the ones before the oldest frame still in progress
+  m_frames_to_notify.insert(frame_nr);
+  long first_in_progress = (m_nb_save_cbk.empty() ? 
+			    m_last_frameid_saved + 1 :
+			    m_nb_save_cbk.begin()->first);
+  std::list<long> saved_frames;
+  while (!m_frames_to_notify.empty() &&
+	 *m_frames_to_notify.begin() < first_in_progress) {
+    saved_frames.push_back(*m_frames_to_notify.begin());
+    m_frames_to_notify.erase(m_frames_to_notify.begin());
+  }
 
   //@todo check if the frame is still available
   if(m_end_cbk) {
     aLock.unlock();
-    m_end_cbk->finished(aData);
+    std::list<long>::iterator it, end = saved_frames.end();
+    for (it = saved_frames.begin(); it != end; ++it) {
+      Data aSavedData;
+      aSavedData.frameNumber = *it;
+      m_end_cbk->finished(aSavedData);
+    }
     aLock.lock();
   }
 
   SavingMode saving_mode = getAcqSavingMode();
   bool auto_saving = (saving_mode == AutoFrame) || (saving_mode == AutoHeader);
 
-  int next_frame = m_last_frameid_saved + 1;
-  FrameMap::iterator nextDataIter = m_frame_datas.find(next_frame);
-  bool data_available = (nextDataIter != m_frame_datas.end());
-  FrameHeaderMap::iterator aHeaderIter = m_frame_headers.find(next_frame);
-  bool header_available = (aHeaderIter != m_frame_headers.end());
-  if (!auto_saving || !data_available || 
-      ((saving_mode == AutoHeader) && !header_available)) {
+  if (m_nb_save_cbk.empty())
     m_ready_flag = true;
+
+  // post as many frames as there are idle writers
+  std::list<std::pair<Data, TaskList> > to_post;
+  while (auto_saving) {
+    int next_frame = m_last_frameid_saved + 1;
+    FrameMap::iterator nextDataIter = m_frame_datas.find(next_frame);
+    bool data_available = (nextDataIter != m_frame_datas.end());
+    bool header_available = !!m_frame_headers->find(next_frame);
+    if (!data_available || 
+	((saving_mode == AutoHeader) && !header_available) ||
+	!_canSave(next_frame))
+      break;
+    Data aNewData = nextDataIter->second;
+
+    _FrameHeader *task_header = _takeHeader(next_frame, false);
+
+    TaskList task_list;
+    _getTaskList(Save, next_frame, task_header, task_list);
+    task_header->unref();
+    m_ready_flag = false, m_last_frameid_saved = next_frame;
+    m_frame_datas.erase(nextDataIter);
+    to_post.push_back(std::pair<Data, TaskList>(aNewData, task_list));
+  }
+
+  if (m_ready_flag) {
     if(m_saving_stop) _close();
     m_cond.signal();
     return;
   }
-  Data aNewData = nextDataIter->second;
-
-  HeaderMap task_header;
-  _takeHeader(aHeaderIter, task_header, false);
-
-  TaskList task_list;
-  _getTaskList(Save, next_frame, task_header, task_list);
-  m_last_frameid_saved = next_frame;
-  m_frame_datas.erase(nextDataIter);
   aLock.unlock();
-  _postTaskList(aNewData, task_list);
+
+  std::list<std::pair<Data, TaskList> >::iterator it, end = to_post.end();
+  for (it = to_post.begin(); it != end; ++it)
+    _postTaskList(it->first, Save, it->second);
 }
 
 /** @brief this methode set the error saving status in CtControl
@@ -1652,10 +3177,19 @@ void CtSaving::_prepare(CtControl& ct)
   else
     DEB_TRACE() << "No auto save activated";
 
+  // one header slot per frame buffer
+  long nb_buffers;
+  ct.buffer()->getNumber(nb_buffers);
+
+  m_spill_thread->abort();
   AutoMutex aLock(m_cond.mutex());
+  m_frame_headers->resize(nb_buffers);
+  m_spill->close();
   if(m_managed_mode == Software)
     {
       m_need_compression = false;
+      if(hasAutoSaveMode())
+	m_spill->open();
 
       //prepare all the active streams
       for (int s = 0; s < m_nb_stream; ++s) {
@@ -1669,7 +3203,9 @@ void CtSaving::_prepare(CtControl& ct)
 	}
       }
 
-      m_nb_save_cbk = 0;
+      m_nb_save_cbk.clear();
+      m_frames_to_notify.clear();
+      m_frame_ready_times.clear();
       m_nb_compression_cbk.clear();
 
       if(m_has_hwsaving)
@@ -1743,7 +3279,7 @@ CtConfig::ModuleTypeCallback* CtSaving::_getConfigHandler()
 
 CtSaving::SaveContainer::SaveContainer(Stream& stream) 
   : m_written_frames(0), m_stream(stream), m_statistic_size(16),
-    m_file_opened(false)
+    m_file_opened(false), m_file_nb(-1)
 {
   DEB_CONSTRUCTOR();
 }
@@ -1763,7 +3299,7 @@ void CtSaving::SaveContainer::writeFile(Data &aData,HeaderMap &aHeader)
 
   const CtSaving::Parameters& pars = m_stream.getParameters(Acq);
 
-  open(pars);
+  open(pars, m_stream.getFileNumber(aData.frameNumber));
   try
     {
       _writeFile(aData,aHeader,pars.fileFormat);
@@ -1841,6 +3377,8 @@ void CtSaving::SaveContainer::writeFile(Data &aData,HeaderMap &aHeader)
   
   DEB_TRACE() << "Write took : " << diff << "s";
 
+  m_stream.addWriteTime(diff, aData.size());
+
   AutoMutex aLock = AutoMutex(m_cond.mutex());
   if(long(m_statistic_list.size()) == m_statistic_size)
     m_statistic_list.pop_front();
@@ -1893,7 +3431,8 @@ void CtSaving::SaveContainer::prepare(CtControl& ct)
   _prepare(ct);			// call inheritance if needed
 }
 
-void CtSaving::SaveContainer::open(const CtSaving::Parameters &pars)
+void CtSaving::SaveContainer::open(const CtSaving::Parameters &pars,
+				   long file_nb)
 {
   DEB_MEMBER_FUNCT();
 
@@ -1901,7 +3440,7 @@ void CtSaving::SaveContainer::open(const CtSaving::Parameters &pars)
     {
 
       std::string aFileName = pars.directory + DIR_SEPARATOR + pars.prefix;
-      long index = pars.nextNumber;
+      long index = m_file_nb = file_nb;
       char idx[64];
       if (index < 0) index = 0;
       snprintf(idx,sizeof(idx),pars.indexFormat.c_str(),index);
@@ -1981,9 +3520,9 @@ void CtSaving::SaveContainer::close()
   _close();
   m_file_opened = false;
   m_written_frames = 0;
-  Parameters& pars = m_stream.getParameters(Acq);
+  const Parameters& pars = m_stream.getParameters(Acq);
   if(pars.overwritePolicy != MultiSet && pars.overwritePolicy != Append)
-    ++pars.nextNumber;
+    m_stream.fileClosed(m_file_nb);
 }
 
 /** @brief check if all file can be written
@@ -21,11 +21,15 @@
 //###########################################################################
 
 #ifdef __unix
+#include <algorithm>
 #include <sys/time.h>
 #include <unistd.h>
 #include <sys/mman.h>
 #include <sys/stat.h>
+#include <sys/uio.h>
 #include <fcntl.h>
+#include <errno.h>
+#include <string.h>
 #else
 #include <time_compat.h>
 #endif
@@ -57,7 +61,8 @@ class SaveContainerEdf::Compression : public SinkTaskBase
   z_stream_s		m_compression_struct;
 public:
   Compression(SaveContainerEdf &save_cnt,
-	      int framesPerFile,const CtSaving::HeaderMap &header) :
+	      int framesPerFile,const CtSaving::HeaderMap &header,
+	      int level = -1) :
     m_container(save_cnt),m_frame_per_file(framesPerFile),m_header(header)
   {
     DEB_CONSTRUCTOR();
@@ -73,7 +78,8 @@ public:
     m_compression_struct.zalloc = NULL;
     m_compression_struct.zfree = NULL;
 
-    if(deflateInit2(&m_compression_struct,Z_DEFAULT_COMPRESSION,
+    if(level < 0) level = Z_DEFAULT_COMPRESSION;
+    if(deflateInit2(&m_compression_struct,level,
 		    Z_DEFLATED,
 		    31,
 		    8,
@@ -145,6 +151,209 @@ public:
 };
 #endif
 
+#ifdef WITH_LZ4_SAVING
+#include <lz4frame.h>
+#include "processlib/SinkTask.h"
+
+/** @brief lz4 frame compression (readable with the lz4 command line)
+ *
+ *  LZ4F_compressBound() counts a whole buffered block, so it is
+ *  above the size of one _BufferHelper even for small chunks: each
+ *  step is compressed into a scratch buffer of that bound, allocated
+ *  once, then appended to the helpers.
+ */
+class SaveContainerEdf::Lz4Compression : public SinkTaskBase
+{
+  DEB_CLASS_NAMESPC(DebModControl,"Lz4 Compression Task","Control");
+
+  static const int INPUT_CHUNK_SIZE = 32 * 1024;
+
+  SaveContainerEdf& 	m_container;
+  int 			m_frame_per_file;
+  CtSaving::HeaderMap 	m_header;
+
+  LZ4F_compressionContext_t	m_ctx;
+  LZ4F_preferences_t		m_prefs;
+  std::vector<char>		m_out;
+public:
+  Lz4Compression(SaveContainerEdf &save_cnt,
+		 int framesPerFile,const CtSaving::HeaderMap &header,
+		 int level) :
+    m_container(save_cnt),m_frame_per_file(framesPerFile),m_header(header)
+  {
+    DEB_CONSTRUCTOR();
+
+    if(LZ4F_isError(LZ4F_createCompressionContext(&m_ctx,LZ4F_VERSION)))
+      THROW_CTL_ERROR(Error) << "Can't init lz4 compression context";
+
+    memset(&m_prefs,0,sizeof(m_prefs));
+    m_prefs.frameInfo.blockSizeID = LZ4F_max64KB;
+    m_prefs.compressionLevel = level < 0 ? 0 : level;
+    m_prefs.autoFlush = 1;
+    m_out.resize(LZ4F_compressBound(INPUT_CHUNK_SIZE,&m_prefs));
+  }
+  ~Lz4Compression()
+  {
+    LZ4F_freeCompressionContext(m_ctx);
+  }
+
+  virtual void process(Data &aData)
+  {
+    DEB_MEMBER_FUNCT();
+
+    std::ostringstream buffer;
+    SaveContainerEdf::_writeEdfHeader(aData,m_header,
+ 				      m_frame_per_file,
+ 				      buffer);
+    ZBufferType *aBufferListPt = new ZBufferType();
+    const std::string& tmpBuffer = buffer.str();
+    try
+      {
+	size_t result = LZ4F_compressBegin(m_ctx,&m_out[0],m_out.size(),
+					   &m_prefs);
+	if(LZ4F_isError(result))
+	  THROW_CTL_ERROR(Error) << "lz4 error: " << LZ4F_getErrorName(result);
+	_append(aBufferListPt,result);
+
+	_compression(tmpBuffer.c_str(),tmpBuffer.size(),aBufferListPt);
+	_compression((char*)aData.data(),aData.size(),aBufferListPt);
+
+	result = LZ4F_compressEnd(m_ctx,&m_out[0],m_out.size(),NULL);
+	if(LZ4F_isError(result))
+	  THROW_CTL_ERROR(Error) << "lz4 error: " << LZ4F_getErrorName(result);
+	_append(aBufferListPt,result);
+      }
+    catch(Exception&)
+      {
+	for(ZBufferType::iterator i = aBufferListPt->begin();
+	    i != aBufferListPt->end();++i)
+	  delete *i;
+	delete aBufferListPt;
+	throw;
+      }
+    m_container._setBuffer(aData.frameNumber,aBufferListPt);
+  }
+
+  void _compression(const char *buffer,int size,ZBufferType* return_buffers)
+  {
+    DEB_MEMBER_FUNCT();
+
+    while(size)
+      {
+	int chunk_size = size > INPUT_CHUNK_SIZE ? INPUT_CHUNK_SIZE : size;
+	size_t result = LZ4F_compressUpdate(m_ctx,&m_out[0],m_out.size(),
+					    buffer,chunk_size,NULL);
+	if(LZ4F_isError(result))
+	  THROW_CTL_ERROR(Error) << "lz4 error: " << LZ4F_getErrorName(result);
+	_append(return_buffers,result);
+	buffer += chunk_size,size -= chunk_size;
+      }
+  }
+
+  /** @brief copy the first size bytes of the scratch buffer to the helpers
+   */
+  void _append(ZBufferType* return_buffers,size_t size)
+  {
+    const char *src = &m_out[0];
+    while(size)
+      {
+	_BufferHelper *out = _getOutBuffer(return_buffers,1);
+	size_t nb_bytes = std::min(size_t(out->available()),size);
+	memcpy(out->buffer + out->used_size,src,nb_bytes);
+	out->used_size += int(nb_bytes);
+	src += nb_bytes,size -= nb_bytes;
+      }
+  }
+};
+#endif
+
+#ifdef WITH_ZSTD_SAVING
+#include <zstd.h>
+#include "processlib/SinkTask.h"
+
+/** @brief zstd compression, one zstd frame per image
+ */
+class SaveContainerEdf::ZstdCompression : public SinkTaskBase
+{
+  DEB_CLASS_NAMESPC(DebModControl,"Zstd Compression Task","Control");
+
+  SaveContainerEdf& 	m_container;
+  int 			m_frame_per_file;
+  CtSaving::HeaderMap 	m_header;
+
+  ZSTD_CCtx*		m_ctx;
+public:
+  ZstdCompression(SaveContainerEdf &save_cnt,
+		  int framesPerFile,const CtSaving::HeaderMap &header,
+		  int level) :
+    m_container(save_cnt),m_frame_per_file(framesPerFile),m_header(header)
+  {
+    DEB_CONSTRUCTOR();
+
+    m_ctx = ZSTD_createCCtx();
+    if(!m_ctx)
+      THROW_CTL_ERROR(Error) << "Can't init zstd compression context";
+    if(level < 0) level = ZSTD_CLEVEL_DEFAULT;
+    ZSTD_CCtx_setParameter(m_ctx,ZSTD_c_compressionLevel,level);
+  }
+  ~ZstdCompression()
+  {
+    ZSTD_freeCCtx(m_ctx);
+  }
+
+  virtual void process(Data &aData)
+  {
+    DEB_MEMBER_FUNCT();
+
+    std::ostringstream buffer;
+    SaveContainerEdf::_writeEdfHeader(aData,m_header,
+ 				      m_frame_per_file,
+ 				      buffer);
+    ZBufferType *aBufferListPt = new ZBufferType();
+    const std::string& tmpBuffer = buffer.str();
+    try
+      {
+	ZSTD_CCtx_reset(m_ctx,ZSTD_reset_session_only);
+	ZSTD_CCtx_setPledgedSrcSize(m_ctx,tmpBuffer.size() + aData.size());
+	_compression(tmpBuffer.c_str(),tmpBuffer.size(),aBufferListPt,
+		     ZSTD_e_continue);
+	_compression((char*)aData.data(),aData.size(),aBufferListPt,
+		     ZSTD_e_end);
+      }
+    catch(Exception&)
+      {
+	for(ZBufferType::iterator i = aBufferListPt->begin();
+	    i != aBufferListPt->end();++i)
+	  delete *i;
+	delete aBufferListPt;
+	throw;
+      }
+    m_container._setBuffer(aData.frameNumber,aBufferListPt);
+  }
+
+  void _compression(const char *buffer,int size,ZBufferType* return_buffers,
+		    ZSTD_EndDirective mode)
+  {
+    DEB_MEMBER_FUNCT();
+
+    ZSTD_inBuffer in = {buffer,size_t(size),0};
+    bool finished;
+    do
+      {
+	_BufferHelper *out_buffer = _getOutBuffer(return_buffers,1);
+	ZSTD_outBuffer out = {out_buffer->buffer + out_buffer->used_size,
+			      size_t(out_buffer->available()),0};
+	size_t remaining = ZSTD_compressStream2(m_ctx,&out,&in,mode);
+	if(ZSTD_isError(remaining))
+	  THROW_CTL_ERROR(Error) << "zstd error: " << ZSTD_getErrorName(remaining);
+	out_buffer->used_size += out.pos;
+	finished = (mode == ZSTD_e_end) ? !remaining : in.pos == in.size;
+      }
+    while(!finished);
+  }
+};
+#endif
+
 
 
 #ifdef WIN32
@@ -233,6 +442,15 @@ SaveContainerEdf::SaveContainerEdf(CtSaving::Stream& stream,
 				   CtSaving::FileFormat format) :
   CtSaving::SaveContainer(stream),
   m_format(format)
+#ifdef __unix
+  ,m_fd(-1),
+  m_io_mode(CtSaving::Buffered),
+  m_block_size(4096),
+  m_staging_used(0),
+  m_file_offset(0),
+  m_synced_offset(0),
+  m_dropped_offset(0)
+#endif
 {
   DEB_CONSTRUCTOR();
 }
@@ -240,12 +458,28 @@ SaveContainerEdf::SaveContainerEdf(CtSaving::Stream& stream,
 SaveContainerEdf::~SaveContainerEdf()
 {
   DEB_DESTRUCTOR();
+#ifdef __unix
+  if(_useFd())
+    ::close(m_fd);
+#endif
 }
 
 bool SaveContainerEdf::_open(const std::string &filename,
 			     std::ios_base::openmode openFlags)
 {
   DEB_MEMBER_FUNCT();
+#ifdef __unix
+  if(m_format == CtSaving::RAW || m_format == CtSaving::EDF)
+    {
+      const CtSaving::Parameters& pars = m_stream.getParameters(CtSaving::Acq);
+      if(pars.ioMode != CtSaving::Buffered)
+	{
+	  m_io_mode = pars.ioMode;
+	  m_current_filename = filename;
+	  return _fdOpen(filename,openFlags);
+	}
+    }
+#endif
   m_fout.clear();
   m_fout.exceptions(std::ios_base::failbit | std::ios_base::badbit);
   m_fout.open(filename.c_str(),openFlags);
@@ -256,6 +490,15 @@ bool SaveContainerEdf::_open(const std::string &filename,
 void SaveContainerEdf::_close()
 {
   DEB_MEMBER_FUNCT();
+
+#ifdef __unix
+  if(_useFd())
+    {
+      DEB_TRACE() << "Close current file";
+      _fdClose();
+      return;
+    }
+#endif
   
   if (!m_fout.is_open()) {
     DEB_TRACE() << "Nothing to do";
@@ -278,8 +521,16 @@ void SaveContainerEdf::_writeFile(Data &aData,
 				  CtSaving::HeaderMap &aHeader,
 				  CtSaving::FileFormat aFormat)
 {
-#ifdef WITH_EDFGZ_SAVING
-  if(aFormat == CtSaving::EDFGZ)
+#ifdef __unix
+  if(_useFd())
+    {
+      _fdWrite(aData,aHeader,aFormat);
+      return;
+    }
+#endif
+  if(aFormat == CtSaving::EDFGZ ||
+     aFormat == CtSaving::EDFLZ4 ||
+     aFormat == CtSaving::EDFZSTD)
     {
       ZBufferType* buffers = _takeBuffer(aData.frameNumber);
       for(ZBufferType::iterator i = buffers->begin();
@@ -292,7 +543,6 @@ void SaveContainerEdf::_writeFile(Data &aData,
     }
   else
     {
-#endif
 
   if(aFormat == CtSaving::EDF)
     {
@@ -341,10 +591,7 @@ void SaveContainerEdf::_writeFile(Data &aData,
 #endif
   m_fout.write((char*)aData.data(),aData.size());
 
-
-#ifdef WITH_EDFGZ_SAVING
     } // else
-#endif
 }
 
 template<class Stream>
@@ -353,7 +600,8 @@ SaveContainerEdf::_writeEdfHeader(Data &aData,
 				  CtSaving::HeaderMap &aHeader,
 				  int framesPerFile,
 				  Stream &sout,
-				  int nbCharReserved)
+				  int nbCharReserved,
+				  int alignment)
 {
   time_t ctime_now;
   time(&ctime_now);
@@ -441,21 +689,286 @@ SaveContainerEdf::_writeEdfHeader(Data &aData,
   long long aEndPosition = sout.tellp();
   
   long long lenght = aEndPosition - aStartPosition + 2;
-  long long finalHeaderLenght = (lenght + 1023) & ~1023; // 1024 alignment
-  snprintf(aBuffer,sizeof(aBuffer),"%*s}\n",int(finalHeaderLenght - lenght),"");
-  sout << aBuffer;
+  long long finalHeaderLenght = (lenght + alignment - 1) / alignment * alignment;
+  sout << std::string(finalHeaderLenght - lenght,' ') << "}\n";
   offset.header_size = finalHeaderLenght;
   return offset;
 }
 
+#ifdef __unix
+/** @brief open the file with a raw file descriptor.
+ *
+ *  Direct mode opens the file with O_DIRECT, every write goes through a
+ *  block aligned staging buffer (or straight from the image when it is
+ *  aligned). DropBehind mode keeps the page cache but flushes and drops
+ *  the written range one frame behind.
+ */
+bool SaveContainerEdf::_fdOpen(const std::string &filename,
+			       std::ios_base::openmode openFlags)
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR2(filename,convert_2_string(m_io_mode));
+
+  bool append = !!(openFlags & std::ios_base::app);
+  int flags = O_RDWR | O_CREAT;
+  if(!append)
+    flags |= O_TRUNC;
+#ifdef O_DIRECT
+  if(m_io_mode == CtSaving::Direct)
+    flags |= O_DIRECT;
+#endif
+  m_fd = ::open(filename.c_str(),flags,0666);
+  if(m_fd < 0)
+    throw std::ios_base::failure(std::string("open: ") + strerror(errno));
+#if !defined(O_DIRECT) && defined(F_NOCACHE)
+  if(m_io_mode == CtSaving::Direct)
+    fcntl(m_fd,F_NOCACHE,1);
+#endif
+
+  struct stat file_stat;
+  long long file_size = 0;
+  m_block_size = 4096;
+  if(!fstat(m_fd,&file_stat))
+    {
+      file_size = file_stat.st_size;
+      long block_size = file_stat.st_blksize;
+      if(block_size >= 512 && !(block_size & (block_size - 1)) &&
+	 !(STAGING_SIZE % block_size))
+	m_block_size = block_size;
+    }
+  DEB_TRACE() << DEB_VAR2(m_block_size,file_size);
+
+  m_file_offset = append ? file_size : 0;
+  m_staging_used = 0;
+  if(m_io_mode == CtSaving::Direct)
+    {
+      m_staging.alloc(STAGING_SIZE,m_block_size);
+      // restart on a block boundary, re-read the partial tail
+      long long tail = m_file_offset % m_block_size;
+      m_file_offset -= tail;
+      if(tail)
+	{
+	  ssize_t nb_read = pread(m_fd,m_staging.getPtr(),m_block_size,
+				  m_file_offset);
+	  if(nb_read < tail)
+	    {
+	      ::close(m_fd),m_fd = -1;
+	      throw std::ios_base::failure("Can't read file tail for appending");
+	    }
+	  m_staging_used = tail;
+	}
+    }
+  m_synced_offset = m_dropped_offset = m_file_offset;
+  return true;
+}
+
+void SaveContainerEdf::_fdClose()
+{
+  DEB_MEMBER_FUNCT();
+  try
+    {
+      if(m_io_mode == CtSaving::Direct)
+	_flushStaging(true);
+      else
+	_dropBehind(true);
+    }
+  catch(...)
+    {
+      ::close(m_fd),m_fd = -1;
+      throw;
+    }
+  ::close(m_fd),m_fd = -1;
+}
+
+void SaveContainerEdf::_fdWrite(Data &aData,
+				CtSaving::HeaderMap &aHeader,
+				CtSaving::FileFormat aFormat)
+{
+  bool direct = m_io_mode == CtSaving::Direct;
+  std::ostringstream header;
+  if(aFormat == CtSaving::EDF)
+    {
+      const CtSaving::Parameters& pars = m_stream.getParameters(CtSaving::Acq);
+      // in direct mode, header is padded up to the block size so
+      // the image stays aligned in the file
+      _writeEdfHeader(aData,aHeader,pars.framesPerFile,header,0,
+		      direct ? m_block_size : 1024);
+    }
+  const std::string& header_str = header.str();
+  const char* data = (const char*)aData.data();
+  long size = aData.size();
+
+  if(direct)
+    {
+      _stage(header_str.data(),header_str.size());
+      long direct_size = size / m_block_size * m_block_size;
+      if(direct_size && !(m_staging_used % m_block_size) &&
+	 !((unsigned long)data % m_block_size))
+	{
+	  // zero copy, image goes straight from its buffer
+	  struct iovec iov[2];
+	  int nb = 0;
+	  if(m_staging_used)
+	    {
+	      iov[nb].iov_base = m_staging.getPtr();
+	      iov[nb].iov_len = m_staging_used;
+	      ++nb;
+	    }
+	  iov[nb].iov_base = (void*)data;
+	  iov[nb].iov_len = direct_size;
+	  ++nb;
+	  _pwritev(iov,nb,m_staging_used + direct_size);
+	  m_staging_used = 0;
+	  data += direct_size,size -= direct_size;
+	}
+      _stage(data,size);
+    }
+  else
+    {
+      struct iovec iov[2];
+      iov[0].iov_base = (void*)header_str.data();
+      iov[0].iov_len = header_str.size();
+      iov[1].iov_base = (void*)data;
+      iov[1].iov_len = size;
+      _pwritev(iov,2,header_str.size() + size);
+      _dropBehind(false);
+    }
+}
+
+void SaveContainerEdf::_stage(const char* data,long size)
+{
+  while(size)
+    {
+      long nb = std::min(size,long(STAGING_SIZE) - m_staging_used);
+      memcpy((char*)m_staging.getPtr() + m_staging_used,data,nb);
+      m_staging_used += nb;
+      data += nb,size -= nb;
+      if(m_staging_used == STAGING_SIZE)
+	_flushStaging(false);
+    }
+}
+/** @brief write the staging buffer.
+ *
+ *  Only whole blocks are written, the remaining tail is kept at the
+ *  beginning of the staging buffer. On final flush, the tail is padded
+ *  to a whole block and the file is truncated back to its real size.
+ */
+void SaveContainerEdf::_flushStaging(bool final)
+{
+  char* staging = (char*)m_staging.getPtr();
+  long aligned_size = m_staging_used / m_block_size * m_block_size;
+  long tail = m_staging_used - aligned_size;
+  if(final && tail)
+    {
+      long long file_size = m_file_offset + m_staging_used;
+      long padded_size = aligned_size + m_block_size;
+      memset(staging + m_staging_used,0,padded_size - m_staging_used);
+      struct iovec iov = {staging,size_t(padded_size)};
+      _pwritev(&iov,1,padded_size);
+      if(ftruncate(m_fd,file_size))
+	throw std::ios_base::failure(std::string("ftruncate: ") + strerror(errno));
+      m_file_offset = file_size;
+      m_staging_used = 0;
+    }
+  else if(aligned_size)
+    {
+      struct iovec iov = {staging,size_t(aligned_size)};
+      _pwritev(&iov,1,aligned_size);
+      if(tail)
+	memmove(staging,staging + aligned_size,tail);
+      m_staging_used = tail;
+    }
+}
+
+void SaveContainerEdf::_pwritev(struct iovec* iov,int nb,long long size)
+{
+  while(size > 0)
+    {
+      ssize_t written = pwritev(m_fd,iov,nb,m_file_offset);
+      if(written < 0)
+	{
+	  if(errno == EINTR) continue;
+	  throw std::ios_base::failure(std::string("write: ") + strerror(errno));
+	}
+      else if(!written)
+	throw std::ios_base::failure("write: no progress");
+
+      m_file_offset += written,size -= written;
+      while(written > 0)
+	{
+	  if(size_t(written) >= iov->iov_len)
+	    written -= iov->iov_len,++iov,--nb;
+	  else
+	    {
+	      iov->iov_base = (char*)iov->iov_base + written;
+	      iov->iov_len -= written;
+	      written = 0;
+	    }
+	}
+    }
+}
+/** @brief start write-back of the last written range and
+ *  drop from the page cache the previous one once on disk.
+ */
+void SaveContainerEdf::_dropBehind(bool wait_all)
+{
+#ifdef __linux__
+  long long end = wait_all ? m_file_offset : m_synced_offset;
+  if(m_file_offset > m_synced_offset)
+    sync_file_range(m_fd,m_synced_offset,m_file_offset - m_synced_offset,
+		    SYNC_FILE_RANGE_WRITE);
+  m_synced_offset = m_file_offset;
+
+  if(end > m_dropped_offset)
+    {
+      sync_file_range(m_fd,m_dropped_offset,end - m_dropped_offset,
+		      SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE |
+		      SYNC_FILE_RANGE_WAIT_AFTER);
+      posix_fadvise(m_fd,m_dropped_offset,end - m_dropped_offset,
+		    POSIX_FADV_DONTNEED);
+      m_dropped_offset = end;
+    }
+#else
+  if(wait_all)
+    fsync(m_fd);
+#endif
+}
+#endif
+
 SinkTaskBase* SaveContainerEdf::getCompressionTask(const CtSaving::HeaderMap& header)
 {
-#ifdef WITH_EDFGZ_SAVING
   const CtSaving::Parameters& pars = m_stream.getParameters(CtSaving::Acq);
-  return new Compression(*this,pars.framesPerFile,header);
-#else
-  return NULL;
+  switch(m_format)
+    {
+#ifdef WITH_EDFGZ_SAVING
+    case CtSaving::EDFGZ:
+      return new Compression(*this,pars.framesPerFile,header,
+			     pars.compressionLevel);
+#endif
+#ifdef WITH_LZ4_SAVING
+    case CtSaving::EDFLZ4:
+      return new Lz4Compression(*this,pars.framesPerFile,header,
+				pars.compressionLevel);
 #endif
+#ifdef WITH_ZSTD_SAVING
+    case CtSaving::EDFZSTD:
+      return new ZstdCompression(*this,pars.framesPerFile,header,
+				 pars.compressionLevel);
+#endif
+    default:
+      return NULL;
+    }
+}
+
+/** @brief return the last buffer of the list if it has at least
+ *  min_size bytes free, a new one otherwise.
+ */
+SaveContainerEdf::_BufferHelper* 
+SaveContainerEdf::_getOutBuffer(ZBufferType* buffers,int min_size)
+{
+  if(buffers->empty() || buffers->back()->available() < min_size)
+    buffers->push_back(new _BufferHelper());
+  return buffers->back();
 }
 
 void SaveContainerEdf::_setBuffer(int frameNumber,
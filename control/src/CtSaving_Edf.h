@@ -23,6 +23,7 @@
 #define CTSAVING_EDF_H
 
 #include "lima/CtSaving.h"
+#include "lima/MemUtils.h"
 
 namespace lima {
 
@@ -31,11 +32,17 @@ namespace lima {
     DEB_CLASS_NAMESPC(DebModControl,"Saving EDF Container","Control");
     class Compression;
     friend class Compression;
+    class Lz4Compression;
+    friend class Lz4Compression;
+    class ZstdCompression;
+    friend class ZstdCompression;
   public:
     struct _BufferHelper
     {
       static const int BUFFER_HELPER_SIZE = 64 * 1024;
       _BufferHelper() : used_size(0) {}
+
+      int available() const {return BUFFER_HELPER_SIZE - used_size;}
       
       int used_size;
       char buffer[BUFFER_HELPER_SIZE];
@@ -46,7 +53,9 @@ namespace lima {
     virtual ~SaveContainerEdf();
     
     virtual bool needParallelCompression() const 
-    {return m_format == CtSaving::EDFGZ;}
+    {return (m_format == CtSaving::EDFGZ ||
+	     m_format == CtSaving::EDFLZ4 ||
+	     m_format == CtSaving::EDFZSTD);}
     virtual SinkTaskBase* getCompressionTask(const CtSaving::HeaderMap&);
 
   protected:
@@ -79,9 +88,25 @@ namespace lima {
     template<class Stream>
       static MmapInfo _writeEdfHeader(Data&,CtSaving::HeaderMap&,
 				      int framesPerFile,Stream&,
-				      int nbCharReserved = 0);
+				      int nbCharReserved = 0,
+				      int alignment = 1024);
     void _setBuffer(int frameNumber,ZBufferType*);
     ZBufferType* _takeBuffer(int dataId);
+    static _BufferHelper* _getOutBuffer(ZBufferType*,int min_size);
+#ifdef __unix
+    /** @brief unbuffered writer used for the Direct and DropBehind io modes
+     */
+    static const int STAGING_SIZE = 4 * 1024 * 1024;
+    bool _useFd() const {return m_fd > -1;}
+    bool _fdOpen(const std::string &filename,
+		 std::ios_base::openmode flags);
+    void _fdClose();
+    void _fdWrite(Data&,CtSaving::HeaderMap&,CtSaving::FileFormat);
+    void _stage(const char* data,long size);
+    void _flushStaging(bool final);
+    void _pwritev(struct iovec*,int nb,long long size);
+    void _dropBehind(bool wait_all);
+#endif
 #ifdef WIN32
     class _OfStream
     {
@@ -115,6 +140,16 @@ namespace lima {
     Mutex			 m_lock;
     MmapInfo			 m_mmap_info;
     std::string			 m_current_filename;
+#ifdef __unix
+    int				 m_fd;
+    CtSaving::IOMode		 m_io_mode;
+    long			 m_block_size;
+    MemBuffer			 m_staging;
+    long			 m_staging_used;
+    long long			 m_file_offset;
+    long long			 m_synced_offset;
+    long long			 m_dropped_offset;
+#endif
   };
 
 }
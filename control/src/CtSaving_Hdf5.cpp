@@ -35,6 +35,7 @@ using namespace std;
 const int RANK_ONE = 1;
 const int RANK_TWO = 2;
 const int RANK_THREE = 3;
+const int DEFLATE_LEVEL = 6;
 
 /* Static function helper*/
 DataType get_h5_type(unsigned char)		{return PredType(PredType::NATIVE_UINT8);}
@@ -123,6 +124,217 @@ static void calculate_chunck(hsize_t* data_size, hsize_t* chunck, int  depth)
        chunck[2] = (hsize_t) ceil(double(data_size[2]) / x_chunk);
 }
 
+#include "processlib/SinkTask.h"
+#ifdef WITH_EDFGZ_SAVING
+#include <zlib.h>
+#endif
+#ifdef WITH_LZ4_SAVING
+#include <lz4.h>
+#include <lz4hc.h>
+#endif
+#ifdef WITH_BSLZ4_SAVING
+#include <bitshuffle.h>
+#endif
+#ifdef WITH_ZSTD_SAVING
+#include <zstd.h>
+#endif
+#if !H5_VERSION_GE(1,10,2)
+#include "H5DOpublic.h"
+#endif
+
+/* registered ids of the hdf5 filter plugins */
+const H5Z_filter_t LZ4_FILTER = 32004;
+const H5Z_filter_t BSHUF_FILTER = 32008;
+const H5Z_filter_t ZSTD_FILTER = 32015;
+const unsigned int BSHUF_LZ4_COMPRESSION = 2;
+
+/** @brief write an already compressed frame as one chunk,
+ *  bypassing the hdf5 filter pipeline
+ */
+static herr_t write_direct_chunk(DataSet &dataset,hsize_t* offset,
+				 SaveContainerHdf5::_ZBuffer &zbuffer)
+{
+#if H5_VERSION_GE(1,10,2)
+       return H5Dwrite_chunk(dataset.getId(),H5P_DEFAULT,0,offset,
+			     zbuffer.used_size,zbuffer.buffer);
+#else
+       return H5DOwrite_chunk(dataset.getId(),H5P_DEFAULT,0,offset,
+			      zbuffer.used_size,zbuffer.buffer);
+#endif
+}
+
+/** @brief big endian helpers for the lz4 and bitshuffle chunk headers
+ */
+static inline void write_uint64_be(char* buffer,unsigned long long value)
+{
+       for(int i = 7;i >= 0;--i,value >>= 8)
+	      buffer[i] = char(value & 0xff);
+}
+
+static inline void write_uint32_be(char* buffer,unsigned int value)
+{
+       for(int i = 3;i >= 0;--i,value >>= 8)
+	      buffer[i] = char(value & 0xff);
+}
+
+/** @brief compression task
+ *
+ *  Compress a full frame into one chunk on the processing pool,
+ *  so the saving thread only has to do the I/O.
+ *  Chunk layouts follow the corresponding hdf5 filter plugin.
+ */
+class SaveContainerHdf5::Compression : public SinkTaskBase
+{
+  DEB_CLASS_NAMESPC(DebModControl,"HDF5 Compression Task","Control");
+
+  SaveContainerHdf5&	m_container;
+  CtSaving::FileFormat	m_format;
+  int			m_level;
+public:
+  Compression(SaveContainerHdf5 &save_cnt,CtSaving::FileFormat format,
+	      int level) :
+    m_container(save_cnt),m_format(format),m_level(level) {}
+
+  virtual void process(Data &aData)
+  {
+    DEB_MEMBER_FUNCT();
+
+    _ZBuffer *aBufferPt = NULL;
+    try
+      {
+	switch(m_format)
+	  {
+#ifdef WITH_EDFGZ_SAVING
+	  case CtSaving::HDF5GZ:
+	    aBufferPt = _deflate(aData);break;
+#endif
+#ifdef WITH_LZ4_SAVING
+	  case CtSaving::HDF5LZ4:
+	    aBufferPt = _lz4(aData);break;
+#endif
+#ifdef WITH_BSLZ4_SAVING
+	  case CtSaving::HDF5BS:
+	    aBufferPt = _bitshuffle_lz4(aData);break;
+#endif
+#ifdef WITH_ZSTD_SAVING
+	  case CtSaving::HDF5ZSTD:
+	    aBufferPt = _zstd(aData);break;
+#endif
+	  default:
+	    THROW_CTL_ERROR(NotSupported) << "Compression not managed for format " 
+					  << convert_2_string(m_format);
+	  }
+      }
+    catch(Exception&)
+      {
+	delete aBufferPt;
+	throw;
+      }
+    m_container._setBuffer(aData.frameNumber,aBufferPt);
+  }
+
+private:
+#ifdef WITH_EDFGZ_SAVING
+  _ZBuffer* _deflate(Data &aData)
+  {
+    DEB_MEMBER_FUNCT();
+
+    uLong src_size = aData.size();
+    uLongf dst_size = compressBound(src_size);
+    _ZBuffer *aBufferPt = new _ZBuffer(dst_size);
+    int level = m_level < 0 ? DEFLATE_LEVEL : m_level;
+    if(compress2((Bytef*)aBufferPt->buffer,&dst_size,
+		 (const Bytef*)aData.data(),src_size,level) != Z_OK)
+      {
+	delete aBufferPt;
+	THROW_CTL_ERROR(Error) << "deflate error";
+      }
+    aBufferPt->used_size = dst_size;
+    return aBufferPt;
+  }
+#endif
+#ifdef WITH_LZ4_SAVING
+  /* chunk = orig size (8 BE) + block size (4 BE) + one block [size (4 BE) + data] */
+  _ZBuffer* _lz4(Data &aData)
+  {
+    DEB_MEMBER_FUNCT();
+
+    int src_size = aData.size();
+    _ZBuffer *aBufferPt = new _ZBuffer(16 + LZ4_compressBound(src_size));
+    char *header = aBufferPt->buffer;
+    write_uint64_be(header,src_size);
+    write_uint32_be(header + 8,src_size);
+
+    char *dst = header + 16;
+    int dst_capacity = aBufferPt->alloc_size - 16;
+    int nb_bytes;
+    if(m_level > 0)
+      nb_bytes = LZ4_compress_HC((const char*)aData.data(),dst,
+				 src_size,dst_capacity,m_level);
+    else
+      nb_bytes = LZ4_compress_default((const char*)aData.data(),dst,
+				      src_size,dst_capacity);
+    if(nb_bytes <= 0)
+      {
+	delete aBufferPt;
+	THROW_CTL_ERROR(Error) << "lz4 compression error";
+      }
+    // an incompressible block is stored as is
+    if(nb_bytes >= src_size)
+      {
+	memcpy(dst,aData.data(),src_size);
+	nb_bytes = src_size;
+      }
+    write_uint32_be(header + 12,nb_bytes);
+    aBufferPt->used_size = 16 + nb_bytes;
+    return aBufferPt;
+  }
+#endif
+#ifdef WITH_BSLZ4_SAVING
+  /* chunk = orig size (8 BE) + block size in bytes (4 BE) + bitshuffle/lz4 blocks */
+  _ZBuffer* _bitshuffle_lz4(Data &aData)
+  {
+    DEB_MEMBER_FUNCT();
+
+    size_t elem_size = aData.depth();
+    size_t nb_elem = aData.size() / elem_size;
+    size_t block_size = bshuf_default_block_size(elem_size);
+    _ZBuffer *aBufferPt = new _ZBuffer(12 + bshuf_compress_lz4_bound(nb_elem,elem_size,
+								       block_size));
+    write_uint64_be(aBufferPt->buffer,aData.size());
+    write_uint32_be(aBufferPt->buffer + 8,block_size * elem_size);
+    int64_t nb_bytes = bshuf_compress_lz4(aData.data(),aBufferPt->buffer + 12,
+					  nb_elem,elem_size,block_size);
+    if(nb_bytes < 0)
+      {
+	delete aBufferPt;
+	THROW_CTL_ERROR(Error) << "bitshuffle compression error: " << nb_bytes;
+      }
+    aBufferPt->used_size = 12 + nb_bytes;
+    return aBufferPt;
+  }
+#endif
+#ifdef WITH_ZSTD_SAVING
+  _ZBuffer* _zstd(Data &aData)
+  {
+    DEB_MEMBER_FUNCT();
+
+    size_t src_size = aData.size();
+    _ZBuffer *aBufferPt = new _ZBuffer(ZSTD_compressBound(src_size));
+    int level = m_level < 0 ? ZSTD_CLEVEL_DEFAULT : m_level;
+    size_t nb_bytes = ZSTD_compress(aBufferPt->buffer,aBufferPt->alloc_size,
+				    aData.data(),src_size,level);
+    if(ZSTD_isError(nb_bytes))
+      {
+	delete aBufferPt;
+	THROW_CTL_ERROR(Error) << "zstd error: " << ZSTD_getErrorName(nb_bytes);
+      }
+    aBufferPt->used_size = nb_bytes;
+    return aBufferPt;
+  }
+#endif
+};
+
 /** @brief saving container
  *
  *  This class manage file saving
@@ -136,6 +348,7 @@ SaveContainerHdf5::SaveContainerHdf5(CtSaving::Stream& stream, CtSaving::FileFor
 
 SaveContainerHdf5::~SaveContainerHdf5() {
 	DEB_DESTRUCTOR();
+	_clear();
 }
 
 void SaveContainerHdf5::_prepare(CtControl& control) {
@@ -405,7 +618,7 @@ void SaveContainerHdf5::_close() {
 
 void SaveContainerHdf5::_writeFile(Data &aData, CtSaving::HeaderMap &aHeader, CtSaving::FileFormat aFormat) {
 	DEB_MEMBER_FUNCT();
-	if (aFormat == CtSaving::HDF5) {
+	if (aFormat == CtSaving::HDF5 || needParallelCompression()) {
 
 		// get the proper data type
 		PredType data_type(PredType::NATIVE_UINT8);
@@ -477,9 +690,18 @@ void SaveContainerHdf5::_writeFile(Data &aData, CtSaving::HeaderMap &aHeader, Ct
 				// Create property list for the dataset and setup chunk size
 				DSetCreatPropList plist;
 				hsize_t chunk_dims[3];
-				// calculate a optimized chunking
-				calculate_chunck(data_dims, chunk_dims, aData.depth());
-				plist.setChunk(RANK_THREE, chunk_dims);
+				if (needParallelCompression()) {
+				        // one frame per chunk, already compressed by the compression task
+				        chunk_dims[0] = 1;
+					chunk_dims[1] = data_dims[1];
+					chunk_dims[2] = data_dims[2];
+					plist.setChunk(RANK_THREE, chunk_dims);
+					_setFilter(plist, aData);
+				} else {
+				        // calculate a optimized chunking
+				        calculate_chunck(data_dims, chunk_dims, aData.depth());
+					plist.setChunk(RANK_THREE, chunk_dims);
+				}
 
 				m_image_dataspace = new DataSpace(RANK_THREE, data_dims, max_dims); // create new dspace
 				m_image_dataset = new DataSet(m_measurement_detector->createDataSet("data", data_type, *m_image_dataspace, plist));
@@ -511,17 +733,27 @@ void SaveContainerHdf5::_writeFile(Data &aData, CtSaving::HeaderMap &aHeader, Ct
 				m_prev_images_written = allocated_dims[0];
 				m_dataset_extended = true;
 			}
-			// write the image data
-			hsize_t slab_dim[3];
-			slab_dim[2] = aData.dimensions[0];
-			slab_dim[1] = aData.dimensions[1];
-			slab_dim[0] = 1;
-			DataSpace slabspace = DataSpace(RANK_THREE, slab_dim);
 			int image_nb = aData.frameNumber % m_nbframes;
 			hsize_t start[] = { m_prev_images_written + image_nb, 0, 0 };
-			hsize_t count[] = { 1, aData.dimensions[1], aData.dimensions[0] };
-			m_image_dataspace->selectHyperslab(H5S_SELECT_SET, count, start);
-			m_image_dataset->write((u_int8_t*) aData.data(), data_type, slabspace, *m_image_dataspace);
+			if (needParallelCompression()) {
+			        // write the compressed chunk as is
+			        _ZBuffer *aBufferPt = _takeBuffer(aData.frameNumber);
+				herr_t status = write_direct_chunk(*m_image_dataset, start, *aBufferPt);
+				delete aBufferPt;
+				if (status < 0)
+				        THROW_CTL_ERROR(Error) << "Direct chunk write failed for frame " 
+							       << aData.frameNumber;
+			} else {
+				// write the image data
+				hsize_t slab_dim[3];
+				slab_dim[2] = aData.dimensions[0];
+				slab_dim[1] = aData.dimensions[1];
+				slab_dim[0] = 1;
+				DataSpace slabspace = DataSpace(RANK_THREE, slab_dim);
+				hsize_t count[] = { 1, aData.dimensions[1], aData.dimensions[0] };
+				m_image_dataspace->selectHyperslab(H5S_SELECT_SET, count, start);
+				m_image_dataset->write((u_int8_t*) aData.data(), data_type, slabspace, *m_image_dataspace);
+			}
 
 		// catch failure caused by the DataSet operations
 		} catch (DataSetIException& error) {
@@ -547,8 +779,71 @@ void SaveContainerHdf5::_writeFile(Data &aData, CtSaving::HeaderMap &aHeader, Ct
 
 void SaveContainerHdf5::_clear()
 {
-	// dont know what to do yet!
-	// Inheritance requires me.
+	AutoMutex aLock(m_lock);
+	for (dataId2ZBufferType::iterator i = m_buffers.begin();
+	     i != m_buffers.end(); ++i)
+		delete i->second;
+	m_buffers.clear();
+}
+
+SinkTaskBase* SaveContainerHdf5::getCompressionTask(const CtSaving::HeaderMap&)
+{
+	const CtSaving::Parameters& pars = m_stream.getParameters(CtSaving::Acq);
+	return new Compression(*this, m_format, pars.compressionLevel);
+}
+
+/** @brief declare on the dataset the filter matching the chunks
+ *  written by the compression task.
+ *
+ *  Plugin filters are optional so the dataset can be created even if
+ *  the plugin is not available to this process, readers still need it.
+ */
+void SaveContainerHdf5::_setFilter(DSetCreatPropList &plist, Data &aData)
+{
+	const CtSaving::Parameters& pars = m_stream.getParameters(CtSaving::Acq);
+	switch (m_format) {
+	case CtSaving::HDF5GZ:
+		plist.setDeflate(pars.compressionLevel < 0 ? DEFLATE_LEVEL : pars.compressionLevel);
+		break;
+	case CtSaving::HDF5LZ4:
+		plist.setFilter(LZ4_FILTER, H5Z_FLAG_OPTIONAL, 0, NULL);
+		break;
+	case CtSaving::HDF5BS: {
+		unsigned int bshuf_opts[] = {0, 0, (unsigned int)aData.depth(), 0, BSHUF_LZ4_COMPRESSION};
+		plist.setFilter(BSHUF_FILTER, H5Z_FLAG_OPTIONAL, 5, bshuf_opts);
+		break;
+	}
+	case CtSaving::HDF5ZSTD: {
+		unsigned int zstd_opts[] = {(unsigned int)(pars.compressionLevel < 0 ? 0 : pars.compressionLevel)};
+		plist.setFilter(ZSTD_FILTER, H5Z_FLAG_OPTIONAL, 1, zstd_opts);
+		break;
+	}
+	default:
+		break;
+	}
+}
+
+void SaveContainerHdf5::_setBuffer(int frameNumber, _ZBuffer* buffer)
+{
+	AutoMutex aLock(m_lock);
+	std::pair<dataId2ZBufferType::iterator,bool> result = 
+	  m_buffers.insert(std::pair<int,_ZBuffer*>(frameNumber, buffer));
+	if (!result.second) {
+		delete result.first->second;
+		result.first->second = buffer;
+	}
+}
+
+SaveContainerHdf5::_ZBuffer* SaveContainerHdf5::_takeBuffer(int dataId)
+{
+	DEB_MEMBER_FUNCT();
+	AutoMutex aLock(m_lock);
+	dataId2ZBufferType::iterator i = m_buffers.find(dataId);
+	if (i == m_buffers.end())
+		THROW_CTL_ERROR(Error) << "No compressed buffer for frame " << dataId;
+	_ZBuffer* aReturnBufferPt = i->second;
+	m_buffers.erase(i);
+	return aReturnBufferPt;
 }
 
 int SaveContainerHdf5::findLastEntry() {
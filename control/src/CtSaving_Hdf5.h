@@ -39,12 +39,40 @@ class HwInterface;
 
 class SaveContainerHdf5: public CtSaving::SaveContainer {
 DEB_CLASS_NAMESPC(DebModControl,"Saving HDF5 Container","Control");
-
+	class Compression;
+	friend class Compression;
 public:
+	/** @brief one compressed frame, written as a single chunk
+	 */
+	struct _ZBuffer
+	{
+	  explicit _ZBuffer(int size) : used_size(0), alloc_size(size)
+	  {buffer = (char*)malloc(size);}
+	  ~_ZBuffer() {free(buffer);}
+
+	  int used_size;
+	  int alloc_size;
+	  char* buffer;
+	};
 
 	SaveContainerHdf5(CtSaving::Stream& stream, CtSaving::FileFormat format);
 	virtual ~SaveContainerHdf5();
 
+	virtual bool needParallelCompression() const
+	{return (m_format == CtSaving::HDF5GZ ||
+		 m_format == CtSaving::HDF5LZ4 ||
+		 m_format == CtSaving::HDF5BS ||
+		 m_format == CtSaving::HDF5ZSTD);}
+	virtual SinkTaskBase* getCompressionTask(const CtSaving::HeaderMap&);
+	/** @brief files can be written in parallel only with a
+	 *  thread-safe build of the hdf5 library
+	 */
+#ifdef H5_HAVE_THREADSAFE
+	virtual bool canWriteConcurrently() const {return true;}
+#else
+	virtual bool canWriteConcurrently() const {return false;}
+#endif
+
 protected:
 	virtual void _prepare(CtControl &control);
 	virtual bool _open(const std::string &filename, std::ios_base::openmode flags);
@@ -53,7 +81,12 @@ protected:
 	virtual void _clear();
 
 private:
+	typedef std::map<int,_ZBuffer*> dataId2ZBufferType;
+
 	int findLastEntry();
+	void _setBuffer(int frameNumber,_ZBuffer*);
+	_ZBuffer* _takeBuffer(int dataId);
+	void _setFilter(DSetCreatPropList&, Data&);
 
 	struct Parameters{
 	  string det_name;
@@ -100,6 +133,7 @@ private:
 	Group *m_entry, *m_measurement_detector, *m_instrument_detector, *m_measurement_detector_info, *m_measurement_detector_parameters;
 	int m_entry_index;
 	string m_entry_name;
+	dataId2ZBufferType m_buffers;
 };
 
 }
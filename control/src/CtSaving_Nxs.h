@@ -37,6 +37,7 @@ namespace lima
 	public:
 	  SaveContainerNxs(CtSaving::Stream& stream);
 	  virtual ~SaveContainerNxs();
+	  virtual bool canWriteConcurrently() const {return false;}
 	protected:
 	  virtual bool _open(const std::string &filename, std::ios_base::openmode flags);
 	  virtual void _close();
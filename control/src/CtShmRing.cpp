@@ -0,0 +1,446 @@
+//###########################################################################
+// This file is part of LImA, a Library for Image Acquisition
+//
+// Copyright (C) : 2009-2011
+// European Synchrotron Radiation Facility
+// BP 220, Grenoble 38043
+// FRANCE
+//
+// This is free software; you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation; either version 3 of the License, or
+// (at your option) any later version.
+//
+// This software is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program; if not, see <http://www.gnu.org/licenses/>.
+//###########################################################################
+#include "lima/CtShmRing.h"
+
+#include <cstring>
+#include <errno.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+
+using namespace lima;
+
+static const char ShmRingMagic[8] = {'L','I','M','A','R','I','N','G'};
+static const long long ShmRingPageSize = 4096;
+
+static inline long long _align(long long size, long long align)
+{
+	return (size + align - 1) / align * align;
+}
+
+static inline CtShmRing::SlotHeader *_getSlot(CtShmRing::Header *header,
+					      long long seq)
+{
+	char *base = (char *) header + header->data_offset;
+	long long slot_nb = seq % header->nb_slots;
+	return (CtShmRing::SlotHeader *) (base + slot_nb * header->slot_size);
+}
+
+static inline std::string _getShmName(const std::string& name)
+{
+	return (name[0] == '/') ? name : "/" + name;
+}
+
+//*********************************************************************
+//* CtShmRing
+//*********************************************************************
+CtShmRing::CtShmRing()
+	: m_active_flag(false), m_nb_slots(DefNbSlots), m_fd(-1),
+	  m_header(NULL), m_map_size(0), m_generation(0)
+{
+	DEB_CONSTRUCTOR();
+}
+
+CtShmRing::~CtShmRing()
+{
+	DEB_DESTRUCTOR();
+	_release();
+}
+
+void CtShmRing::setName(const std::string& name)
+{
+	DEB_MEMBER_FUNCT();
+	DEB_PARAM() << DEB_VAR1(name);
+
+	AutoMutex l(m_lock);
+	if (name == m_name) {
+		DEB_TRACE() << "Nothing to do";
+		return;
+	}
+	if (name.empty() || (name.find('/', 1) != std::string::npos))
+		THROW_CTL_ERROR(InvalidValue) << "Invalid " << DEB_VAR1(name);
+
+	_release();
+	m_name = name;
+}
+
+void CtShmRing::getName(std::string& name) const
+{
+	DEB_MEMBER_FUNCT();
+	AutoMutex l(m_lock);
+	name = m_name;
+	DEB_RETURN() << DEB_VAR1(name);
+}
+
+void CtShmRing::setNbSlots(int nb_slots)
+{
+	DEB_MEMBER_FUNCT();
+	DEB_PARAM() << DEB_VAR1(nb_slots);
+
+	if (nb_slots < 2)
+		THROW_CTL_ERROR(InvalidValue) << "Invalid " 
+					      << DEB_VAR1(nb_slots);
+	AutoMutex l(m_lock);
+	m_nb_slots = nb_slots;
+}
+
+void CtShmRing::getNbSlots(int& nb_slots) const
+{
+	DEB_MEMBER_FUNCT();
+	AutoMutex l(m_lock);
+	nb_slots = m_nb_slots;
+	DEB_RETURN() << DEB_VAR1(nb_slots);
+}
+
+void CtShmRing::prepare(const FrameDim& frame_dim)
+{
+	DEB_MEMBER_FUNCT();
+	DEB_PARAM() << DEB_VAR1(frame_dim);
+
+	int data_type;
+	switch (frame_dim.getImageType()) {
+	case Bpp8:	data_type = Data::UINT8;	break;
+	case Bpp8S:	data_type = Data::INT8;		break;
+	case Bpp10:
+	case Bpp12:
+	case Bpp14:
+	case Bpp16:	data_type = Data::UINT16;	break;
+	case Bpp16S:	data_type = Data::INT16;	break;
+	case Bpp32:	data_type = Data::UINT32;	break;
+	case Bpp32S:	data_type = Data::INT32;	break;
+	case Bpp32F:	data_type = Data::FLOAT;	break;
+	default:
+		THROW_CTL_ERROR(InvalidValue) << "Unknown " 
+					      << DEB_VAR1(frame_dim);
+	}
+
+	AutoMutex l(m_lock);
+	if (m_name.empty())
+		THROW_CTL_ERROR(InvalidValue) << "Must set the ring name first";
+
+	long long slot_size = _align(SlotDataOffset + frame_dim.getMemSize(),
+				     ShmRingPageSize);
+	long long map_size = ShmRingPageSize + m_nb_slots * slot_size;
+	if (map_size != m_map_size)
+		_create(map_size);
+
+	// readers restart when the generation changes
+	Header *header = m_header;
+	memcpy(header->magic, ShmRingMagic, sizeof(header->magic));
+	header->version = Version;
+	header->nb_slots = m_nb_slots;
+	header->slot_size = slot_size;
+	header->data_offset = ShmRingPageSize;
+	header->width = frame_dim.getSize().getWidth();
+	header->height = frame_dim.getSize().getHeight();
+	header->depth = frame_dim.getDepth();
+	header->data_type = data_type;
+	header->write_seq = 0;
+	for (int i = 0; i < m_nb_slots; ++i)
+		_getSlot(header, i)->seq = 0;
+	__sync_synchronize();
+	header->generation = ++m_generation;
+	header->state = Active;
+	__sync_synchronize();
+
+	DEB_TRACE() << DEB_VAR3(m_name, m_nb_slots, slot_size);
+}
+
+void CtShmRing::frameReady(Data& data)
+{
+	DEB_MEMBER_FUNCT();
+	DEB_PARAM() << DEB_VAR1(data);
+
+	AutoMutex l(m_lock);
+	Header *header = m_header;
+	if (!header)
+		THROW_CTL_ERROR(Error) << "Ring not prepared";
+
+	long long size = data.size();
+	if ((data.dimensions.size() < 2) ||
+	    (data.dimensions[0] != header->width) ||
+	    (data.dimensions[1] != header->height) ||
+	    (data.type != header->data_type))
+		THROW_CTL_ERROR(InvalidValue) 
+			<< "Data " << DEB_VAR1(data) << " does not match "
+			<< "ring " << DEB_VAR2(header->width, header->height);
+	if (SlotDataOffset + size > header->slot_size)
+		size = header->slot_size - SlotDataOffset;
+
+	long long seq = header->write_seq;
+	SlotHeader *slot = _getSlot(header, seq);
+	slot->seq = 2 * seq + 1;
+	__sync_synchronize();
+	slot->frame_nb = data.frameNumber;
+	slot->timestamp = data.timestamp;
+	slot->size = size;
+	memcpy((char *) slot + SlotDataOffset, data.data(), size);
+	__sync_synchronize();
+	slot->seq = 2 * seq + 2;
+	__sync_synchronize();
+	header->write_seq = seq + 1;
+}
+
+void CtShmRing::reset()
+{
+	DEB_MEMBER_FUNCT();
+	m_active_flag = false;
+}
+
+void CtShmRing::getNbPublished(long long& nb_frames) const
+{
+	DEB_MEMBER_FUNCT();
+	AutoMutex l(m_lock);
+	nb_frames = m_header ? m_header->write_seq : 0;
+	DEB_RETURN() << DEB_VAR1(nb_frames);
+}
+
+void CtShmRing::_create(long long map_size)
+{
+	DEB_MEMBER_FUNCT();
+	DEB_PARAM() << DEB_VAR1(map_size);
+
+	_release();
+
+	std::string shm_name = _getShmName(m_name);
+	// tell the readers of a previous ring to re-attach
+	int fd = shm_open(shm_name.c_str(), O_RDWR, 0);
+	if (fd >= 0) {
+		struct stat st;
+		if ((fstat(fd, &st) == 0) && (st.st_size >= (long) sizeof(Header))) {
+			void *p = mmap(NULL, sizeof(Header), PROT_READ | PROT_WRITE,
+				       MAP_SHARED, fd, 0);
+			if (p != MAP_FAILED) {
+				Header *old = (Header *) p;
+				old->state = Stale;
+				m_generation = old->generation;
+				munmap(p, sizeof(Header));
+			}
+		}
+		close(fd);
+		shm_unlink(shm_name.c_str());
+	}
+
+	m_fd = shm_open(shm_name.c_str(), O_CREAT | O_EXCL | O_RDWR, 0644);
+	if (m_fd < 0)
+		THROW_CTL_ERROR(Error) << "Error creating " << shm_name << ": "
+				       << strerror(errno);
+	if (ftruncate(m_fd, map_size) < 0) {
+		int err = errno;
+		_release();
+		THROW_CTL_ERROR(Error) << "Error sizing " << shm_name << ": "
+				       << strerror(err);
+	}
+	void *p = mmap(NULL, map_size, PROT_READ | PROT_WRITE, MAP_SHARED, 
+		       m_fd, 0);
+	if (p == MAP_FAILED) {
+		int err = errno;
+		_release();
+		THROW_CTL_ERROR(Error) << "Error mapping " << shm_name << ": "
+				       << strerror(err);
+	}
+	m_header = (Header *) p;
+	m_map_size = map_size;
+}
+
+void CtShmRing::_release()
+{
+	DEB_MEMBER_FUNCT();
+
+	if (m_header) {
+		m_header->state = Stale;
+		munmap(m_header, m_map_size);
+		m_header = NULL;
+		m_map_size = 0;
+	}
+	if (m_fd >= 0) {
+		close(m_fd);
+		shm_unlink(_getShmName(m_name).c_str());
+		m_fd = -1;
+	}
+}
+
+//*********************************************************************
+//* CtShmRing::Reader
+//*********************************************************************
+CtShmRing::Reader::Reader(const std::string& name)
+	: m_name(name), m_header(NULL), m_map_size(0), m_generation(-1),
+	  m_next_seq(0), m_nb_dropped(0)
+{
+	DEB_CONSTRUCTOR();
+	DEB_PARAM() << DEB_VAR1(name);
+}
+
+CtShmRing::Reader::~Reader()
+{
+	DEB_DESTRUCTOR();
+	_detach();
+}
+
+CtShmRing::Reader::Status CtShmRing::Reader::read(Data& data)
+{
+	DEB_MEMBER_FUNCT();
+
+	if (m_header && (m_header->state == Stale))
+		_detach();
+	if (!m_header) {
+		_attach();
+		if (!m_header)
+			return NoFrame;
+	}
+
+	Header *header = m_header;
+	long long generation = header->generation;
+	if (generation != m_generation) {
+		m_generation = generation;
+		m_next_seq = 0;
+		return Restarted;
+	}
+
+	Buffer *buffer = NULL;
+	while (true) {
+		long long write_seq = header->write_seq;
+		__sync_synchronize();
+		if (m_next_seq >= write_seq)
+			break;
+		// the producer already overwrote the oldest frames
+		long long first_seq = write_seq - header->nb_slots;
+		if (m_next_seq < first_seq) {
+			m_nb_dropped += first_seq - m_next_seq;
+			m_next_seq = first_seq;
+		}
+
+		SlotHeader *slot = _getSlot(header, m_next_seq);
+		long long seq = slot->seq;
+		__sync_synchronize();
+		if (seq < 2 * m_next_seq + 2)
+			break;
+		else if (seq == 2 * m_next_seq + 2) {
+			long long size = slot->size;
+			if (!buffer)
+				buffer = new Buffer(header->slot_size -
+						    SlotDataOffset);
+			data.type = Data::TYPE(header->data_type);
+			data.dimensions.clear();
+			data.dimensions.push_back(header->width);
+			data.dimensions.push_back(header->height);
+			data.frameNumber = slot->frame_nb;
+			data.timestamp = slot->timestamp;
+			memcpy(buffer->data, (char *) slot + SlotDataOffset, size);
+			__sync_synchronize();
+			if ((slot->seq == seq) && 
+			    (header->generation == m_generation)) {
+				data.setBuffer(buffer);
+				buffer->unref();
+				++m_next_seq;
+				return FrameRead;
+			}
+		}
+		// lapped while reading
+		++m_nb_dropped;
+		++m_next_seq;
+	}
+
+	if (buffer)
+		buffer->unref();
+	return NoFrame;
+}
+
+long long CtShmRing::Reader::getNbDropped() const
+{
+	return m_nb_dropped;
+}
+
+void CtShmRing::Reader::getFrameDim(FrameDim& frame_dim) const
+{
+	DEB_MEMBER_FUNCT();
+
+	if (!m_header)
+		THROW_CTL_ERROR(Error) << "Ring " << m_name << " not attached";
+
+	ImageType image_type;
+	switch (m_header->data_type) {
+	case Data::UINT8:	image_type = Bpp8;	break;
+	case Data::INT8:	image_type = Bpp8S;	break;
+	case Data::UINT16:	image_type = Bpp16;	break;
+	case Data::INT16:	image_type = Bpp16S;	break;
+	case Data::UINT32:	image_type = Bpp32;	break;
+	case Data::INT32:	image_type = Bpp32S;	break;
+	case Data::FLOAT:	image_type = Bpp32F;	break;
+	default:
+		THROW_CTL_ERROR(Error) << "Invalid " 
+				       << DEB_VAR1(m_header->data_type);
+	}
+	frame_dim = FrameDim(Size(m_header->width, m_header->height),
+			     image_type);
+	DEB_RETURN() << DEB_VAR1(frame_dim);
+}
+
+void CtShmRing::Reader::_attach()
+{
+	DEB_MEMBER_FUNCT();
+
+	std::string shm_name = _getShmName(m_name);
+	int fd = shm_open(shm_name.c_str(), O_RDONLY, 0);
+	if (fd < 0) {
+		DEB_TRACE() << shm_name << " not available: " << strerror(errno);
+		return;
+	}
+
+	struct stat st;
+	void *p = MAP_FAILED;
+	if ((fstat(fd, &st) == 0) && (st.st_size >= ShmRingPageSize))
+		p = mmap(NULL, st.st_size, PROT_READ, MAP_SHARED, fd, 0);
+	close(fd);
+	if (p == MAP_FAILED)
+		return;
+
+	Header *header = (Header *) p;
+	if (header->magic[0] == 0) {
+		DEB_TRACE() << shm_name << " not prepared yet";
+		munmap(p, st.st_size);
+		return;
+	} else if (memcmp(header->magic, ShmRingMagic, 
+			  sizeof(header->magic)) ||
+		   (header->version != Version)) {
+		munmap(p, st.st_size);
+		THROW_CTL_ERROR(Error) << shm_name << " is not a v" << Version 
+				       << " frame ring";
+	}
+
+	m_header = header;
+	m_map_size = st.st_size;
+	m_generation = -1;
+	DEB_TRACE() << "Attached " << shm_name;
+}
+
+void CtShmRing::Reader::_detach()
+{
+	DEB_MEMBER_FUNCT();
+
+	if (!m_header)
+		return;
+	munmap(m_header, m_map_size);
+	m_header = NULL;
+	m_map_size = 0;
+}
@@ -0,0 +1,519 @@
+//###########################################################################
+// This file is part of LImA, a Library for Image Acquisition
+//
+// Copyright (C) : 2009-2011
+// European Synchrotron Radiation Facility
+// BP 220, Grenoble 38043
+// FRANCE
+//
+// This is free software; you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation; either version 3 of the License, or
+// (at your option) any later version.
+//
+// This software is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program; if not, see <http://www.gnu.org/licenses/>.
+//###########################################################################
+#include "lima/CtThreadPools.h"
+#include "lima/Timestamp.h"
+
+#include "processlib/PoolThreadMgr.h"
+#include "processlib/SinkTask.h"
+#include "processlib/TaskMgr.h"
+
+#include <algorithm>
+#include <unistd.h>
+
+#ifdef __linux__
+#include <pthread.h>
+#include <sched.h>
+#endif
+
+using namespace lima;
+
+/** @brief threads created while it exists run on the given cpus
+ *  (they inherit the affinity of their creator)
+ */
+class _AffinityScope
+{
+  DEB_CLASS_NAMESPC(DebModControl,"Thread Pools::_AffinityScope","Control");
+public:
+  _AffinityScope(const std::list<int>& cpus) : m_set(false)
+  {
+    DEB_CONSTRUCTOR();
+    if(cpus.empty())
+      return;
+#ifdef __linux__
+    cpu_set_t aCpuSet;
+    CPU_ZERO(&aCpuSet);
+    for(std::list<int>::const_iterator i = cpus.begin();i != cpus.end();++i)
+      CPU_SET(*i,&aCpuSet);
+    pthread_getaffinity_np(pthread_self(),sizeof(m_old),&m_old);
+    if(pthread_setaffinity_np(pthread_self(),sizeof(aCpuSet),&aCpuSet))
+      THROW_CTL_ERROR(Error) << "Can't set the cpu affinity";
+    m_set = true;
+#else
+    THROW_CTL_ERROR(NotSupported) << "Cpu affinity is not supported";
+#endif
+  }
+
+  ~_AffinityScope()
+  {
+#ifdef __linux__
+    if(m_set)
+      pthread_setaffinity_np(pthread_self(),sizeof(m_old),&m_old);
+#endif
+  }
+
+private:
+  bool		m_set;
+#ifdef __linux__
+  cpu_set_t	m_old;
+#endif
+};
+
+/** @brief number of threads of the tile workers of a pool: the
+ *  dedicated ones or, on the global pool, the cpus (bounded)
+ */
+static int _nb_tile_threads(int nb_threads)
+{
+  if(!nb_threads)
+    {
+#ifdef __unix
+      nb_threads = int(sysconf(_SC_NPROCESSORS_ONLN));
+#else
+      nb_threads = 1;
+#endif
+      if(nb_threads > CtThreadPools::MAX_AUTO_TILE_THREADS)
+	nb_threads = CtThreadPools::MAX_AUTO_TILE_THREADS;
+    }
+  // the calling thread processes tiles too
+  return nb_threads > 1 ? nb_threads - 1 : 0;
+}
+
+class CtThreadPools::_Pool
+{
+  DEB_CLASS_NAMESPC(DebModControl,"Thread Pools::_Pool","Control");
+public:
+  _Pool() : m_mgr(NULL),m_mgr_users(0),m_nb_threads(0),m_latency_sum(0.),
+	    m_tile_workers(_nb_tile_threads(0)) {}
+
+  ~_Pool()
+  {
+    if(m_mgr)
+      {
+	m_mgr->wait();
+	delete m_mgr;
+      }
+  }
+
+  /** @brief post to the dedicated pool, or to the global one
+   */
+  void addProcess(TaskMgr *mgr)
+  {
+    AutoMutex aLock(m_cond.mutex());
+    PoolThreadMgr *aMgrPt = m_nb_threads ? _useMgr() : NULL;
+    aLock.unlock();
+    if(!aMgrPt)
+      {
+	PoolThreadMgr::get().addProcess(mgr);
+	return;
+      }
+    aMgrPt->addProcess(mgr);
+    aLock.lock();
+    _releaseMgr();
+  }
+
+  TileWorkers& tileWorkers() {return m_tile_workers;}
+
+  void setNbThreads(int nb_threads)
+  {
+    DEB_MEMBER_FUNCT();
+    DEB_PARAM() << DEB_VAR1(nb_threads);
+
+    AutoMutex aLock(m_cond.mutex());
+    if(nb_threads > 0)
+      {
+	_AffinityScope anAffinity(m_cpus);
+	if(!m_mgr)
+	  m_mgr = new PoolThreadMgr();
+	m_mgr->setNumberOfThread(nb_threads);
+      }
+    m_nb_threads = nb_threads;
+    PoolThreadMgr *aMgrPt = (!nb_threads && m_mgr) ? _useMgr() : NULL;
+    aLock.unlock();
+    m_tile_workers.setNbThreads(_nb_tile_threads(nb_threads));
+    if(!aMgrPt)
+      return;
+
+    // a dedicated pool given back to the global one is deleted once
+    // its tasks are done, unless it was given threads again meanwhile
+    aMgrPt->wait();
+    aLock.lock();
+    _releaseMgr();
+    while(m_mgr == aMgrPt && !m_nb_threads && m_mgr_users)
+      m_cond.wait();
+    if(m_mgr == aMgrPt && !m_nb_threads)
+      m_mgr = NULL;
+    else
+      aMgrPt = NULL;
+    aLock.unlock();
+    delete aMgrPt;
+  }
+
+  int getNbThreads() const
+  {
+    AutoMutex aLock(m_cond.mutex());
+    return m_nb_threads;
+  }
+
+  void setCpuAffinity(const std::list<int>& cpus)
+  {
+    DEB_MEMBER_FUNCT();
+
+    for(std::list<int>::const_iterator i = cpus.begin();i != cpus.end();++i)
+#ifdef __linux__
+      if(*i < 0 || *i >= CPU_SETSIZE)
+#else
+      if(*i < 0)
+#endif
+	THROW_CTL_ERROR(InvalidValue) << "Invalid cpu: " << *i;
+    AutoMutex aLock(m_cond.mutex());
+    m_cpus = cpus;
+    aLock.unlock();
+    m_tile_workers.setCpuAffinity(cpus);
+  }
+
+  std::list<int> getCpuAffinity() const
+  {
+    AutoMutex aLock(m_cond.mutex());
+    return m_cpus;
+  }
+
+  Timestamp submitted()
+  {
+    AutoMutex aLock(m_cond.mutex());
+    ++m_stats.nbSubmitted;
+    if(++m_stats.nbPending > m_stats.maxPending)
+      m_stats.maxPending = m_stats.nbPending;
+    return Timestamp::now();
+  }
+
+  void finished(double latency)
+  {
+    AutoMutex aLock(m_cond.mutex());
+    ++m_stats.nbFinished;
+    m_latency_sum += latency;
+  }
+
+  /** @brief the task manager is gone: done, failed or thrown
+   */
+  void released()
+  {
+    AutoMutex aLock(m_cond.mutex());
+    if(m_stats.nbPending > 0 && !--m_stats.nbPending)
+      m_cond.broadcast();
+  }
+
+  Stats getStats() const
+  {
+    AutoMutex aLock(m_cond.mutex());
+    Stats aStats = m_stats;
+    aStats.nbThreads = m_nb_threads;
+    if(m_stats.nbFinished)
+      aStats.meanLatency = m_latency_sum / m_stats.nbFinished;
+    return aStats;
+  }
+
+  void resetStats()
+  {
+    AutoMutex aLock(m_cond.mutex());
+    int nbPending = m_stats.nbPending;
+    m_stats = Stats();
+    m_stats.nbPending = m_stats.maxPending = nbPending;
+    m_latency_sum = 0.;
+  }
+
+  /** @brief wait for the task managers posted to this pool, wherever
+   *  they run
+   */
+  void wait()
+  {
+    AutoMutex aLock(m_cond.mutex());
+    while(m_stats.nbPending > 0)
+      m_cond.wait();
+  }
+
+  /** @brief throw the tasks queued in the dedicated pool, if any,
+   *  the one being given back included.
+   *
+   *  The global pool is not one of this pool, CtThreadPools::abort
+   *  handles it.
+   */
+  void abort()
+  {
+    AutoMutex aLock(m_cond.mutex());
+    PoolThreadMgr *aMgrPt = m_mgr ? _useMgr() : NULL;
+    aLock.unlock();
+    if(!aMgrPt)
+      return;
+    aMgrPt->abort();
+    aLock.lock();
+    _releaseMgr();
+  }
+
+private:
+  // the dedicated pool is not deleted while it's used out of the lock,
+  // both should be called with the lock
+  PoolThreadMgr* _useMgr()
+  {
+    ++m_mgr_users;
+    return m_mgr;
+  }
+
+  void _releaseMgr()
+  {
+    if(!--m_mgr_users)
+      m_cond.broadcast();
+  }
+
+  mutable Cond		m_cond;
+  PoolThreadMgr*	m_mgr;
+  int			m_mgr_users;
+  int			m_nb_threads;
+  std::list<int>	m_cpus;
+  Stats			m_stats;
+  double		m_latency_sum;
+  TileWorkers		m_tile_workers;
+};
+
+/** @brief last task of a posted task manager, ends its latency.
+ *
+ *  It's released with its task manager, even if an other task failed
+ *  or if the manager was thrown by an abort, which ends the pending.
+ */
+class CtThreadPools::_EndTask : public SinkTaskBase
+{
+public:
+  _EndTask(_Pool& pool,const Timestamp& start) :
+    m_pool(pool),m_start(start) {}
+
+  virtual ~_EndTask()
+  {
+    m_pool.released();
+  }
+
+  virtual void process(Data&)
+  {
+    m_pool.finished(Timestamp::now() - m_start);
+  }
+
+private:
+  _Pool&	m_pool;
+  Timestamp	m_start;
+};
+
+CtThreadPools::Stats::Stats() :
+  nbThreads(0),nbSubmitted(0),nbFinished(0),
+  nbPending(0),maxPending(0),meanLatency(0.)
+{
+}
+
+CtThreadPools::CtThreadPools() :
+  m_global_pool_shared(false)
+{
+  DEB_CONSTRUCTOR();
+
+  for(int i = 0;i < NB_ROLES;++i)
+    m_pools[i] = new _Pool();
+}
+
+CtThreadPools::~CtThreadPools()
+{
+  DEB_DESTRUCTOR();
+
+  wait();
+  for(int i = 0;i < NB_ROLES;++i)
+    delete m_pools[i];
+}
+
+/** @brief number of threads dedicated to a role.
+ *
+ *  0 gives the role back to the processlib global pool: the dedicated
+ *  pool is waited for, then deleted with its threads.
+ */
+void CtThreadPools::setNbThreads(Role role,int nb_threads)
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR2(role,nb_threads);
+
+  if(nb_threads < 0)
+    THROW_CTL_ERROR(InvalidValue) << "Invalid number of threads: "
+				  << nb_threads;
+  _getPool(role).setNbThreads(nb_threads);
+}
+
+void CtThreadPools::getNbThreads(Role role,int& nb_threads) const
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR1(role);
+
+  nb_threads = _getPool(role).getNbThreads();
+
+  DEB_RETURN() << DEB_VAR1(nb_threads);
+}
+
+/** @brief cpus the dedicated threads of a role run on, empty == all.
+ *
+ *  Only applies to the pool threads started afterwards, so it has to be
+ *  set before setNbThreads(). The tile workers of the role apply it
+ *  right away.
+ */
+void CtThreadPools::setCpuAffinity(Role role,const std::list<int>& cpus)
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR2(role,cpus.size());
+
+  _getPool(role).setCpuAffinity(cpus);
+}
+
+void CtThreadPools::getCpuAffinity(Role role,std::list<int>& cpus) const
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR1(role);
+
+  cpus = _getPool(role).getCpuAffinity();
+}
+
+/** @brief how abort() handles the roles using the global pool.
+ *
+ *  Not shared (default), the global pool is aborted, which also
+ *  throws the tasks posted there by the other CtControl of the process.
+ *  Shared, the tasks this instance posted there are waited for.
+ */
+void CtThreadPools::setGlobalPoolShared(bool shared)
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR1(shared);
+
+  AutoMutex aLock(m_lock);
+  m_global_pool_shared = shared;
+}
+
+void CtThreadPools::getGlobalPoolShared(bool& shared) const
+{
+  DEB_MEMBER_FUNCT();
+
+  AutoMutex aLock(m_lock);
+  shared = m_global_pool_shared;
+
+  DEB_RETURN() << DEB_VAR1(shared);
+}
+
+/** @brief queue depth and latency of the tasks posted for a role.
+ *
+ *  A task manager is pending from its post until it's released, the
+ *  latency is the mean time from its post until its last stage starts.
+ */
+void CtThreadPools::getStats(Role role,Stats& stats) const
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR1(role);
+
+  stats = _getPool(role).getStats();
+
+  DEB_RETURN() << DEB_VAR1(stats);
+}
+
+void CtThreadPools::resetStats()
+{
+  DEB_MEMBER_FUNCT();
+
+  for(int i = 0;i < NB_ROLES;++i)
+    m_pools[i]->resetStats();
+}
+
+/** @brief post a task manager to the pool of a role, the pool owns it
+ */
+void CtThreadPools::addProcess(Role role,TaskMgr* mgr)
+{
+  _Pool& aPool = _getPool(role);
+
+  std::pair<int,LinkTask*> aLastLink(0,(LinkTask*)NULL);
+  std::pair<int,SinkTaskBase*> aLastSink(0,(SinkTaskBase*)NULL);
+  mgr->getLastTask(aLastLink,aLastSink);
+  int aLastStage = std::max(aLastLink.second ? aLastLink.first : -1,
+			    aLastSink.second ? aLastSink.first : -1);
+
+  _EndTask *anEndTaskPt = new _EndTask(aPool,aPool.submitted());
+  mgr->addSinkTask(aLastStage + 1,anEndTaskPt);
+  anEndTaskPt->unref();
+
+  aPool.addProcess(mgr);
+}
+
+/** @brief wait for the task managers posted by this instance,
+ *  the ones running in the global pool included
+ */
+void CtThreadPools::wait()
+{
+  DEB_MEMBER_FUNCT();
+
+  for(int i = 0;i < NB_ROLES;++i)
+    m_pools[i]->wait();
+}
+
+/** @brief throw the queued tasks.
+ *
+ *  The dedicated pools are aborted and, if a role uses it, the global
+ *  pool too, unless it's shared (see setGlobalPoolShared): then the
+ *  tasks this instance posted there are waited for.
+ */
+void CtThreadPools::abort()
+{
+  DEB_MEMBER_FUNCT();
+
+  bool use_global_pool = false;
+  for(int i = 0;i < NB_ROLES;++i)
+    {
+      m_pools[i]->abort();
+      if(!m_pools[i]->getNbThreads())
+	use_global_pool = true;
+    }
+  if(!use_global_pool)
+    return;
+
+  AutoMutex aLock(m_lock);
+  bool shared = m_global_pool_shared;
+  aLock.unlock();
+  DEB_TRACE() << DEB_VAR1(shared);
+  if(shared)
+    wait();
+  else
+    PoolThreadMgr::get().abort();
+}
+
+/** @brief tile workers of a role, to split a frame between threads.
+ *
+ *  They follow the cpu affinity of the role and have its number of
+ *  dedicated threads (the caller being one of them), or the number of
+ *  cpus when the role uses the global pool.
+ */
+TileWorkers& CtThreadPools::getTileWorkers(Role role)
+{
+  return _getPool(role).tileWorkers();
+}
+
+CtThreadPools::_Pool& CtThreadPools::_getPool(Role role) const
+{
+  DEB_MEMBER_FUNCT();
+
+  if(int(role) < 0 || int(role) >= NB_ROLES)
+    THROW_CTL_ERROR(InvalidValue) << "Invalid pool role: " << int(role);
+  return *m_pools[role];
+}
@@ -5,12 +5,23 @@
 #include "lima/CtImage.h"
 #include "lima/CtBuffer.h"
 
-#include "processlib/PoolThreadMgr.h"
+#include "lima/CtThreadPools.h"
 #include "processlib/SinkTask.h"
 #include "processlib/TaskMgr.h"
 #include "processlib/Binning.h"
 #include "processlib/SoftRoi.h"
 
+#include <algorithm>
+#include <csetjmp>
+
+#ifdef WITH_VIDEO_JPEG
+#include <jpeglib.h>
+#endif
+
+#ifdef WITH_LZ4_SAVING
+#include <lz4.h>
+#endif
+
 using namespace lima;
 enum ParModifyMask
   {
@@ -21,6 +32,243 @@ enum ParModifyMask
     PARMODIFYMASK_BIN 		= 1U << 4,
     PARMODIFYMASK_AUTO_GAIN     = 1U << 5,
   };
+// --- stream encoders
+#ifdef WITH_VIDEO_JPEG
+struct _JpegErrorMgr
+{
+  struct jpeg_error_mgr pub;
+  jmp_buf jmp;
+};
+
+static void _jpeg_error_exit(j_common_ptr cinfo)
+{
+  _JpegErrorMgr *err = (_JpegErrorMgr*) cinfo->err;
+  longjmp(err->jmp,1);
+}
+
+/* the encoded image is written directly in the payload, so nothing
+   but the compressor has to be cleaned-up after an error */
+struct _JpegDestMgr
+{
+  struct jpeg_destination_mgr pub;
+  std::string *payload;
+};
+
+static const size_t JPEG_DEST_CHUNK = 64 * 1024;
+
+static void _jpeg_init_destination(j_compress_ptr cinfo)
+{
+  _JpegDestMgr *dest = (_JpegDestMgr*) cinfo->dest;
+  dest->payload->resize(JPEG_DEST_CHUNK);
+  dest->pub.next_output_byte = (JOCTET*) &(*dest->payload)[0];
+  dest->pub.free_in_buffer = dest->payload->size();
+}
+
+// called when the whole payload is full
+static boolean _jpeg_empty_output_buffer(j_compress_ptr cinfo)
+{
+  _JpegDestMgr *dest = (_JpegDestMgr*) cinfo->dest;
+  size_t size = dest->payload->size();
+  dest->payload->resize(size * 2);
+  dest->pub.next_output_byte = (JOCTET*) &(*dest->payload)[size];
+  dest->pub.free_in_buffer = size;
+  return TRUE;
+}
+
+static void _jpeg_term_destination(j_compress_ptr cinfo)
+{
+  _JpegDestMgr *dest = (_JpegDestMgr*) cinfo->dest;
+  dest->payload->resize(dest->payload->size() - dest->pub.free_in_buffer);
+}
+
+template <class T>
+static void _jpeg_scale_row(const T *src,int width,T max_val,
+			    unsigned char *dst)
+{
+  for(int i = 0;i < width;++i)
+    dst[i] = max_val ? (unsigned char)(double(src[i]) * 255. / max_val) : 0;
+}
+
+static void _jpeg_encode(const VideoImage &image,int quality,
+			 std::string &payload)
+{
+  int nb_components;
+  switch(image.mode)
+    {
+    case Y8: case Y16: case Y32:
+      nb_components = 1; break;
+    case RGB24: case BGR24:
+      nb_components = 3; break;
+    default:
+      throw LIMA_CTL_EXC(NotSupported,"JPEG encoding not supported for "
+			 "this video mode");
+    }
+
+  // grey levels are scaled on the image max
+  unsigned int max_val = 0;
+  if(image.mode == Y16)
+    {
+      const unsigned short *p = (const unsigned short*) image.buffer;
+      max_val = *std::max_element(p,p + image.width * image.height);
+    }
+  else if(image.mode == Y32)
+    {
+      const unsigned int *p = (const unsigned int*) image.buffer;
+      max_val = *std::max_element(p,p + image.width * image.height);
+    }
+
+  std::vector<unsigned char> row(image.width * nb_components);
+
+  // no local variable is modified between setjmp and longjmp
+  struct jpeg_compress_struct cinfo;
+  _JpegErrorMgr jerr;
+  _JpegDestMgr dest;
+  cinfo.err = jpeg_std_error(&jerr.pub);
+  jerr.pub.error_exit = _jpeg_error_exit;
+  dest.pub.init_destination = _jpeg_init_destination;
+  dest.pub.empty_output_buffer = _jpeg_empty_output_buffer;
+  dest.pub.term_destination = _jpeg_term_destination;
+  dest.payload = &payload;
+  if(setjmp(jerr.jmp))
+    {
+      jpeg_destroy_compress(&cinfo);
+      payload.clear();
+      throw LIMA_CTL_EXC(Error,"JPEG encoding failed");
+    }
+
+  jpeg_create_compress(&cinfo);
+  cinfo.dest = &dest.pub;
+  cinfo.image_width = image.width;
+  cinfo.image_height = image.height;
+  cinfo.input_components = nb_components;
+  cinfo.in_color_space = (nb_components == 1) ? JCS_GRAYSCALE : JCS_RGB;
+  jpeg_set_defaults(&cinfo);
+  jpeg_set_quality(&cinfo,quality,TRUE);
+  jpeg_start_compress(&cinfo,TRUE);
+
+  int line_size = int(image.width * image.depth());
+  while(cinfo.next_scanline < cinfo.image_height)
+    {
+      const char *src = image.buffer + cinfo.next_scanline * line_size;
+      JSAMPROW row_ptr = &row[0];
+      switch(image.mode)
+	{
+	case Y8: case RGB24:
+	  row_ptr = (JSAMPROW) src; break;
+	case Y16:
+	  _jpeg_scale_row((const unsigned short*) src,image.width,
+			  (unsigned short) max_val,&row[0]);
+	  break;
+	case Y32:
+	  _jpeg_scale_row((const unsigned int*) src,image.width,
+			  max_val,&row[0]);
+	  break;
+	default:		// BGR24
+	  for(int i = 0;i < image.width * 3;i += 3)
+	    {
+	      row[i] = src[i + 2];
+	      row[i + 1] = src[i + 1];
+	      row[i + 2] = src[i];
+	    }
+	  break;
+	}
+      jpeg_write_scanlines(&cinfo,&row_ptr,1);
+    }
+
+  jpeg_finish_compress(&cinfo);
+  jpeg_destroy_compress(&cinfo);
+}
+#endif //WITH_VIDEO_JPEG
+
+#ifdef WITH_LZ4_SAVING
+static void _lz4_encode(const VideoImage &image,std::string &payload)
+{
+  int size = int(image.size() + 0.5);
+  int bound = LZ4_compressBound(size);
+  payload.resize(bound);
+  int compressed_size = LZ4_compress_default(image.buffer,&payload[0],
+					     size,bound);
+  if(compressed_size <= 0)
+    throw LIMA_CTL_EXC(Error,"LZ4 encoding failed");
+  payload.resize(compressed_size);
+}
+#endif //WITH_LZ4_SAVING
+
+// --- thumbnails
+/** @brief 2x2 box average of a (multi channel) image
+ */
+template <class T,class S>
+static void _half_image(const T *src,int width,int channels,
+			int out_width,int out_height,T *dst)
+{
+  int line_size = width * channels;
+  for(int r = 0;r < out_height;++r)
+    {
+      const T *l0 = src + 2 * r * line_size;
+      const T *l1 = l0 + line_size;
+      for(int c = 0;c < out_width;++c,l0 += channels,l1 += channels)
+	for(int ch = 0;ch < channels;++ch,l0++,l1++,dst++)
+	  *dst = T((S(l0[0]) + l0[channels] + l1[0] + l1[channels] + 2) / 4);
+    }
+}
+
+/** @brief reduce an image by 2 in both directions
+ *
+ *  color and bayer modes without a direct reduction are converted
+ *  to luma first (Y8, Y16 for 16 bit bayer), by the given workers
+ */
+static void _reduce_image(const VideoImage &src,VideoImage &dst,
+			  TileWorkers *workers)
+{
+  int out_width = src.width / 2,out_height = src.height / 2;
+  const char *buffer = src.buffer;
+  VideoMode mode = src.mode;
+  std::vector<unsigned char> luma;
+  switch(mode)
+    {
+    case Y8: case Y16: case Y32:
+    case RGB24: case BGR24: case RGB32: case BGR32:
+      break;
+    case Y64:
+      throw LIMA_CTL_EXC(NotSupported,"Can't reduce Y64 video image");
+    default:
+      mode = (mode == BAYER_RG16 || mode == BAYER_BG16) ? Y16 : Y8;
+      luma.resize(src.width * src.height * int(VideoImage::mode_depth(mode)));
+      image2YUV((const unsigned char*)src.buffer,src.width,src.height,
+		src.mode,&luma[0],workers);
+      buffer = (const char*)&luma[0];
+      break;
+    }
+
+  dst.setParams(int(src.frameNumber),out_width,out_height,mode);
+  switch(mode)
+    {
+    case Y8:
+      _half_image<unsigned char,unsigned int>((const unsigned char*)buffer,
+					      src.width,1,out_width,out_height,
+					      (unsigned char*)dst.buffer);
+      break;
+    case Y16:
+      _half_image<unsigned short,unsigned int>((const unsigned short*)buffer,
+					       src.width,1,out_width,out_height,
+					       (unsigned short*)dst.buffer);
+      break;
+    case Y32:
+      _half_image<unsigned int,unsigned long long>((const unsigned int*)buffer,
+						   src.width,1,
+						   out_width,out_height,
+						   (unsigned int*)dst.buffer);
+      break;
+    default:			// RGB/BGR 24/32
+      _half_image<unsigned char,unsigned int>((const unsigned char*)buffer,
+					      src.width,
+					      int(VideoImage::mode_depth(mode)),
+					      out_width,out_height,
+					      (unsigned char*)dst.buffer);
+      break;
+    }
+}
+
 // --- CtVideo::Data2Imagetask
 class CtVideo::_Data2ImageTask : public SinkTaskBase
 {
@@ -39,12 +287,15 @@ public:
     while(anImage->inused)
       m_cnt.m_cond.wait();
     anImage->inused = -1;	// Write Mode
+    m_cnt._invalidate_thumbnails(anImage);
     aLock.unlock();
     
     data2Image(aData,*anImage);
     
     //Check if data is still available
     bool still_available = _check_available(aData);
+    if(still_available)
+      m_cnt._encode_image(*anImage);
 
     aLock.lock();
     anImage->inused = 0;	// Unlock
@@ -88,6 +339,24 @@ private:
   CtVideo &m_cnt;
 };
 
+// --- CtVideo::_EncodeTask
+class CtVideo::_EncodeTask : public SinkTaskBase
+{
+public:
+  _EncodeTask(CtVideo &video,const CtVideo::Image &image,
+	      const VideoImage *video_image) :
+    SinkTaskBase(),m_video(video),m_image(image),m_video_image(video_image) {}
+
+  virtual void process(Data&)
+  {
+    m_video._encode_image(*m_video_image);
+  }
+private:
+  CtVideo&		m_video;
+  CtVideo::Image	m_image;	// keeps m_video_image in use
+  const VideoImage*	m_video_image;
+};
+
 class CtVideo::_videoBackgroundCallback : public TaskEventCallback
 {
 public:
@@ -159,7 +428,10 @@ bool CtVideo::_InternalImageCBK::newImage(char * data,int width,int height,Video
       void *ptr = m_buffer.getFrameBufferPtr(image_counter);
       try
 	{
-	  lima::image2YUV((unsigned char*)data,width,height,mode,(unsigned char*)ptr);
+	  TileWorkers& aWorkers =
+	    m_video.m_ct.threadPools()->getTileWorkers(CtThreadPools::Video);
+	  lima::image2YUV((unsigned char*)data,width,height,mode,
+			  (unsigned char*)ptr,&aWorkers);
 	  HwFrameInfoType frame_info;
 	  frame_info.acq_frame_nb = image_counter;
 	  frame_info.frame_timestamp = now - m_start_time;
@@ -177,7 +449,9 @@ bool CtVideo::_InternalImageCBK::newImage(char * data,int width,int height,Video
   ++m_video.m_image_counter;
   VideoImage *anImage = m_video.m_write_image;
   if(anImage->inused) return true;			// Skip it (Should never happen!)
+  if(!m_video._check_stream_rate()) return true;	// Above stream rate
   anImage->inused = -1;		// Write Mode
+  m_video._invalidate_thumbnails(anImage);
   aLock.unlock();
   
   anImage->setParams(image_counter,width,height,mode);
@@ -191,6 +465,16 @@ bool CtVideo::_InternalImageCBK::newImage(char * data,int width,int height,Video
       m_video.m_write_image = m_video.m_read_image;
       m_video.m_write_image->frameNumber = -1;
       m_video.m_read_image = anImage;
+
+      if(m_video.m_pars.stream_encoding != NO_ENCODING)
+	{
+	  CtVideo::Image anImageWrapper(&m_video,anImage);
+	  aLock.unlock();
+	  m_video._post_encode_image(anImageWrapper);
+	  aLock.lock();
+	}
+      else
+	m_video.m_last_stream_size = int(anImage->size());
    
       if(m_video.m_image_callback)
 	{
@@ -209,7 +493,7 @@ bool CtVideo::_InternalImageCBK::newImage(char * data,int width,int height,Video
 	  mgr->addSinkTask(0,cbk_task);
 	  cbk_task->unref();
 
-	  PoolThreadMgr::get().addProcess(mgr);
+	  m_video.m_ct.threadPools()->addProcess(CtThreadPools::Video,mgr);
 	}
     }
   return true;
@@ -249,6 +533,13 @@ public:
     
     bin_setting.set("x",pars.bin.getX());
     bin_setting.set("y",pars.bin.getY());
+
+    // --- Encoded stream
+    video_setting.set("stream_encoding",
+		      convert_2_string(pars.stream_encoding));
+    video_setting.set("stream_jpeg_quality",pars.stream_jpeg_quality);
+    video_setting.set("stream_max_rate",pars.stream_max_rate);
+    video_setting.set("stream_max_bandwidth",pars.stream_max_bandwidth);
   }
   virtual void restore(const Setting& video_setting)
   {
@@ -289,6 +580,14 @@ public:
 	  pars.roi = Roi(topleft.x,topleft.y,
 			 width,height);
       }
+    // --- Encoded stream
+    std::string str_stream_encoding;
+    if(video_setting.get("stream_encoding",str_stream_encoding))
+      convert_from_string(str_stream_encoding,pars.stream_encoding);
+    video_setting.get("stream_jpeg_quality",pars.stream_jpeg_quality);
+    video_setting.get("stream_max_rate",pars.stream_max_rate);
+    video_setting.get("stream_max_bandwidth",pars.stream_max_bandwidth);
+
     m_video.setParameters(pars);
   }
 private:
@@ -381,6 +680,16 @@ long long CtVideo::Image::frameNumber() const
 {
   return m_image ? m_image->frameNumber : -1;
 }
+// --- CtVideo::EncodedImage
+CtVideo::EncodedImage::EncodedImage() :
+  encoding(NO_ENCODING),
+  width(-1),
+  height(-1),
+  mode(Y8),
+  rawSize(0),
+  frameNumber(-1)
+{
+}
 // --- CtVideo class
 CtVideo::CtVideo(CtControl &ct) :
   m_pars_modify_mask(0),
@@ -392,8 +701,18 @@ CtVideo::CtVideo(CtControl &ct) :
   m_internal_image_callback(NULL),
   m_ct(ct),
   m_stopping_live(false),
-  m_active_flag(false)
+  m_active_flag(false),
+  m_next_stream_time(0.),
+  m_last_stream_size(0),
+  m_encoded_image_callback(NULL),
+  m_thumbnail_building(false)
 {
+  for(int i = 0;i < NB_THUMBNAIL_LEVELS;++i)
+    {
+      m_thumbnails[i] = NULL;
+      m_thumbnail_sources[i] = NULL;
+    }
+
   HwInterface *hw = ct.hwInterface();
   m_has_video = hw->getHwCtrlObj(m_video);
   hw->getHwCtrlObj(m_sync);
@@ -419,6 +738,12 @@ CtVideo::~CtVideo()
   delete m_read_image;
   delete m_write_image;
   delete m_internal_image_callback;
+  for(int i = 0;i < NB_THUMBNAIL_LEVELS;++i)
+    {
+      VideoImageList::iterator j,end = m_thumbnail_pool[i].end();
+      for(j = m_thumbnail_pool[i].begin();j != end;++j)
+	delete *j;
+    }
 }
 
 void CtVideo::setActive(bool aFlag)
@@ -435,8 +760,18 @@ bool CtVideo::isActive() const
 // --- parameters
 void CtVideo::setParameters(const Parameters &pars)
 {
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR1(pars);
+
   //All check
   _check_video_mode(pars.mode);
+  if(!checkStreamEncoding(pars.stream_encoding))
+    THROW_CTL_ERROR(NotSupported) << DEB_VAR1(pars.stream_encoding);
+  _check_stream_mode(pars.stream_encoding,pars.mode);
+  if(pars.stream_jpeg_quality < 1 || pars.stream_jpeg_quality > 100)
+    THROW_CTL_ERROR(InvalidValue) << DEB_VAR1(pars.stream_jpeg_quality);
+  if(pars.stream_max_rate < 0. || pars.stream_max_bandwidth < 0.)
+    THROW_CTL_ERROR(InvalidValue) << "Stream limits should be >= 0.";
 
   AutoMutex aLock(m_cond.mutex());
 
@@ -626,6 +961,7 @@ void CtVideo::setMode(VideoMode aMode)
 {
   _check_video_mode(aMode);
   AutoMutex aLock(m_cond.mutex());
+  _check_stream_mode(m_pars.stream_encoding,aMode);
   m_pars.mode = aMode,m_pars_modify_mask |= PARMODIFYMASK_MODE;
   _apply_params(aLock);
 }
@@ -659,10 +995,154 @@ void CtVideo::getBin(Bin &aBin) const
   aBin = m_pars.bin;
 }
 
+// --- encoded stream
+bool CtVideo::checkStreamEncoding(StreamEncoding encoding) const
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR1(encoding);
+
+  bool check_flag = false;
+  switch(encoding)
+    {
+    case NO_ENCODING:
+      check_flag = true; break;
+#ifdef WITH_VIDEO_JPEG
+    case JPEG:
+      check_flag = true; break;
+#endif
+#ifdef WITH_LZ4_SAVING
+    case LZ4:
+      check_flag = true; break;
+#endif
+    default:
+      break;
+    }
+  DEB_RETURN() << DEB_VAR1(check_flag);
+  return check_flag;
+}
+
+void CtVideo::setStreamEncoding(StreamEncoding encoding)
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR1(encoding);
+
+  if(!checkStreamEncoding(encoding))
+    THROW_CTL_ERROR(NotSupported) << DEB_VAR1(encoding);
+  AutoMutex aLock(m_cond.mutex());
+  _check_stream_mode(encoding,m_pars.mode);
+  m_pars.stream_encoding = encoding;
+}
+
+void CtVideo::getStreamEncoding(StreamEncoding& encoding) const
+{
+  AutoMutex aLock(m_cond.mutex());
+  encoding = m_pars.stream_encoding;
+}
+
+void CtVideo::setStreamJpegQuality(int quality)
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR1(quality);
+
+  if(quality < 1 || quality > 100)
+    THROW_CTL_ERROR(InvalidValue) << "Quality should be between 1 and 100";
+  AutoMutex aLock(m_cond.mutex());
+  m_pars.stream_jpeg_quality = quality;
+}
+
+void CtVideo::getStreamJpegQuality(int& quality) const
+{
+  AutoMutex aLock(m_cond.mutex());
+  quality = m_pars.stream_jpeg_quality;
+}
+
+void CtVideo::setStreamMaxRate(double rate)
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR1(rate);
+
+  if(rate < 0.)
+    THROW_CTL_ERROR(InvalidValue) << "Rate should be >= 0.";
+  AutoMutex aLock(m_cond.mutex());
+  m_pars.stream_max_rate = rate;
+}
+
+void CtVideo::getStreamMaxRate(double& rate) const
+{
+  AutoMutex aLock(m_cond.mutex());
+  rate = m_pars.stream_max_rate;
+}
+
+void CtVideo::setStreamMaxBandwidth(double bandwidth)
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR1(bandwidth);
+
+  if(bandwidth < 0.)
+    THROW_CTL_ERROR(InvalidValue) << "Bandwidth should be >= 0.";
+  AutoMutex aLock(m_cond.mutex());
+  m_pars.stream_max_bandwidth = bandwidth;
+}
+
+void CtVideo::getStreamMaxBandwidth(double& bandwidth) const
+{
+  AutoMutex aLock(m_cond.mutex());
+  bandwidth = m_pars.stream_max_bandwidth;
+}
+
 // --- images
 void CtVideo::getLastImage(CtVideo::Image &anImage) const
 {
   AutoMutex aLock(m_cond.mutex());
+  _update_read_image();
+  CtVideo::Image tmpImage(this,m_read_image);
+  aLock.unlock();
+  
+  anImage = tmpImage;
+}
+/** @brief last image reduced to fit in max_width x max_height
+ *
+ *  The returned image is the full resolution one or a 1/2, 1/4 or 1/8
+ *  reduction, the largest which fits (1/8 if none does).
+ *  Reductions are built once per image on the first request
+ *  and shared by all the clients. max_width or max_height <= 0
+ *  means no limit in that direction.
+ */
+void CtVideo::getLastImage(CtVideo::Image &anImage,
+			   int max_width,int max_height) const
+{
+  DEB_MEMBER_FUNCT();
+  DEB_PARAM() << DEB_VAR2(max_width,max_height);
+
+  AutoMutex aLock(m_cond.mutex());
+  _update_read_image();
+  VideoImage *source = m_read_image;
+  int level = 0;
+  if(source->frameNumber >= 0)
+    for(;level < NB_THUMBNAIL_LEVELS;++level)
+      {
+	int width = source->width >> level,height = source->height >> level;
+	if((max_width <= 0 || width <= max_width) &&
+	   (max_height <= 0 || height <= max_height))
+	  break;
+	if(!(width >> 1) || !(height >> 1))
+	  break;
+      }
+  DEB_TRACE() << DEB_VAR1(level);
+
+  CtVideo::Image sourceImage(this,source); // source can't be rewritten
+  VideoImage *image = level ? _get_thumbnail(source,level,aLock) : source;
+  CtVideo::Image tmpImage(this,image);
+  aLock.unlock();
+
+  anImage = tmpImage;
+}
+
+/** @brief swap to the write image if it's newer and not in use
+ *  This methode should be call under Lock
+ */
+void CtVideo::_update_read_image() const
+{
   if(m_write_image->inused >= 0 && // No writter
      m_write_image->frameNumber >= m_read_image->frameNumber)
     {
@@ -671,10 +1151,92 @@ void CtVideo::getLastImage(CtVideo::Image &anImage) const
       m_write_image = tmp;
       m_write_image->frameNumber = -1;
     }
-  CtVideo::Image tmpImage(this,m_read_image);
+}
+/** @brief get (building it if needed) the thumbnail of source
+ *  at level (1 == 1/2 ...)
+ *
+ *  Missing levels are reduced from the previous one, one client at
+ *  a time, the others wait and use the result.
+ *  This methode should be call under Lock, source must be in use.
+ */
+VideoImage* CtVideo::_get_thumbnail(VideoImage *source,int level,
+				    AutoMutex &aLock) const
+{
+  DEB_MEMBER_FUNCT();
+
+  while(m_thumbnail_building)
+    m_cond.wait();
+
+  int last = level - 1;
+  if(m_thumbnail_sources[last] == source)
+    return m_thumbnails[last];
+
+  int first = last;
+  while(first > 0 && m_thumbnail_sources[first - 1] != source)
+    --first;
+  DEB_TRACE() << "Reducing " << DEB_VAR2(first + 1,level);
+
+  VideoImage *images[NB_THUMBNAIL_LEVELS];
+  for(int i = first;i <= last;++i)
+    {
+      VideoImage *image = NULL;
+      VideoImageList::iterator j,end = m_thumbnail_pool[i].end();
+      for(j = m_thumbnail_pool[i].begin();!image && j != end;++j)
+	if(!(*j)->inused)
+	  image = *j;
+      if(!image)
+	{
+	  image = new VideoImage();
+	  m_thumbnail_pool[i].push_back(image);
+	}
+      image->inused = -1;	// Write Mode
+      images[i] = image;
+      if(m_thumbnails[i] == image)
+	m_thumbnail_sources[i] = NULL;
+    }
+  m_thumbnail_building = true;
   aLock.unlock();
-  
-  anImage = tmpImage;
+
+  TileWorkers& aWorkers =
+    m_ct.threadPools()->getTileWorkers(CtThreadPools::Video);
+  try
+    {
+      for(int i = first;i <= last;++i)
+	{
+	  const VideoImage *from = !i ? source : 
+	    (i == first ? m_thumbnails[i - 1] : images[i - 1]);
+	  _reduce_image(*from,*images[i],&aWorkers);
+	}
+    }
+  catch(...)
+    {
+      aLock.lock();
+      for(int i = first;i <= last;++i)
+	images[i]->inused = 0;
+      m_thumbnail_building = false;
+      m_cond.broadcast();
+      throw;
+    }
+
+  aLock.lock();
+  for(int i = first;i <= last;++i)
+    {
+      images[i]->inused = 0;
+      m_thumbnails[i] = images[i];
+      m_thumbnail_sources[i] = source;
+    }
+  m_thumbnail_building = false;
+  m_cond.broadcast();
+  return m_thumbnails[last];
+}
+/** @brief forget the thumbnails reduced from image
+ *  This methode should be call under Lock
+ */
+void CtVideo::_invalidate_thumbnails(const VideoImage *image)
+{
+  for(int i = 0;i < NB_THUMBNAIL_LEVELS;++i)
+    if(m_thumbnail_sources[i] == image)
+      m_thumbnail_sources[i] = NULL;
 }
 
 void CtVideo::getLastImageCounter(long long &anImageCounter) const
@@ -683,6 +1245,12 @@ void CtVideo::getLastImageCounter(long long &anImageCounter) const
   anImageCounter = m_image_counter;
 }
 
+void CtVideo::getLastEncodedImage(EncodedImage &anImage) const
+{
+  AutoMutex aLock(m_cond.mutex());
+  anImage = m_last_encoded_image;
+}
+
 void CtVideo::registerImageCallback(ImageCallback &cb)
 {
   DEB_MEMBER_FUNCT();
@@ -708,6 +1276,31 @@ void CtVideo::unregisterImageCallback(ImageCallback &cb)
   m_image_callback = NULL;
 }
 
+void CtVideo::registerEncodedImageCallback(EncodedImageCallback &cb)
+{
+  DEB_MEMBER_FUNCT();
+
+  AutoMutex aLock(m_cond.mutex());
+  DEB_PARAM() << DEB_VAR2(&cb, m_encoded_image_callback);
+  
+  if(m_encoded_image_callback)
+    THROW_CTL_ERROR(InvalidValue) << "EncodedImageCallback already registered";
+
+  m_encoded_image_callback = &cb;
+}
+
+void CtVideo::unregisterEncodedImageCallback(EncodedImageCallback &cb)
+{
+  DEB_MEMBER_FUNCT();
+
+  AutoMutex aLock(m_cond.mutex());
+  DEB_PARAM() << DEB_VAR2(&cb, m_encoded_image_callback);
+  if(m_encoded_image_callback != &cb)
+    THROW_CTL_ERROR(InvalidValue) << "EncodedImageCallback not registered"; 
+
+  m_encoded_image_callback = NULL;
+}
+
 // --- video mode
 void CtVideo::getSupportedVideoMode(std::list<VideoMode> &modeList)
 {
@@ -759,18 +1352,20 @@ void CtVideo::frameReady(Data &aData)
   if(!m_has_video)
     {
       AutoMutex aLock(m_cond.mutex());
-      if(m_active_flag)
+      if(!m_active_flag)
+	return;
+      // keep the last frame while a conversion is running, the stream
+      // rate is only checked for the frames which are converted
+      if(!m_ready_flag)
+	m_last_data = aData;
+      // drop the frames above the stream rate before any conversion
+      else if(_check_stream_rate())
 	{
-	  if(m_ready_flag)
-	    {
-	      m_ready_flag = false;
-	      Bin aBin = m_pars.bin;
-	      Roi aRoi = m_pars.roi;
-	      aLock.unlock();
-	      _data_2_image(aData,aBin,aRoi);
-	    }
-	  else
-	    m_last_data = aData;
+	  m_ready_flag = false;
+	  Bin aBin = m_pars.bin;
+	  Roi aRoi = m_pars.roi;
+	  aLock.unlock();
+	  _data_2_image(aData,aBin,aRoi);
 	}
     }
 }
@@ -804,17 +1399,17 @@ void CtVideo::_data_2_image(Data &aData,Bin &aBin,Roi &aRoi)
   anImageCopy->addSinkTask(runLevel,m_data_2_image_task);
   anImageCopy->setInputData(aData);
   
-  PoolThreadMgr::get().addProcess(anImageCopy);
+  m_ct.threadPools()->addProcess(CtThreadPools::Video,anImageCopy);
 }
 
 void CtVideo::_data2image_finnished(Data&)
 {
   DEB_MEMBER_FUNCT();
   AutoMutex aLock(m_cond.mutex());
-  if(!m_last_data.empty())
+  Data aData = m_last_data;
+  m_last_data = Data();
+  if(!aData.empty() && m_active_flag && _check_stream_rate())
     {
-      Data aData = m_last_data;
-      m_last_data = Data();
       Bin aBin = m_pars.bin;
       Roi aRoi = m_pars.roi;
       aLock.unlock();
@@ -910,6 +1505,27 @@ void CtVideo::_check_video_mode(VideoMode aMode)
     }
 }
 
+/** @brief JPEG is only encoded from grey or 24 bit RGB images,
+ *  the other video modes can't be streamed with it
+ */
+void CtVideo::_check_stream_mode(StreamEncoding encoding,VideoMode aMode)
+{
+  DEB_MEMBER_FUNCT();
+
+  if(encoding != JPEG)
+    return;
+
+  switch(aMode)
+    {
+    case Y8: case Y16: case Y32:
+    case RGB24: case BGR24:
+      break;
+    default:
+      THROW_CTL_ERROR(NotSupported) << "JPEG stream encoding not supported "
+				       "for video mode: " << DEB_VAR1(aMode);
+    }
+}
+
 /** @brief an Acquisition will start so,
  *  we have to stop video mode
  */ 
@@ -957,10 +1573,102 @@ void CtVideo::_prepareAcq()
   m_read_image->frameNumber = -1;
   m_write_image->frameNumber = -1;
 
+  m_next_stream_time = 0.;
+  m_last_stream_size = 0;
+  m_last_encoded_image = EncodedImage();
+
   CtBuffer* buffer = m_ct.buffer();
   buffer->getNumber(m_data_2_image_task->m_nb_buffer);
 }
 
+/** @brief check if a new image can be streamed now
+ *  The interval between images is given by the max rate and by the
+ *  time the last image takes at the max bandwidth.
+ *  This methode should be call under Lock
+ */
+bool CtVideo::_check_stream_rate()
+{
+  double now = Timestamp::now();
+  if(now < m_next_stream_time)
+    return false;
+
+  double interval = 0.;
+  if(m_pars.stream_max_rate > 0.)
+    interval = 1. / m_pars.stream_max_rate;
+  if(m_pars.stream_max_bandwidth > 0.)
+    interval = std::max(interval,
+			m_last_stream_size / m_pars.stream_max_bandwidth);
+  m_next_stream_time = now + interval;
+  return true;
+}
+
+void CtVideo::_encode_image(const VideoImage &image)
+{
+  DEB_MEMBER_FUNCT();
+
+  AutoMutex aLock(m_cond.mutex());
+  StreamEncoding encoding = m_pars.stream_encoding;
+#ifdef WITH_VIDEO_JPEG
+  int quality = m_pars.stream_jpeg_quality;
+#endif
+  if(encoding == NO_ENCODING)
+    {
+      m_last_stream_size = int(image.size());
+      return;
+    }
+  aLock.unlock();
+
+  EncodedImage anEncodedImage;
+  anEncodedImage.encoding = encoding;
+  anEncodedImage.width = image.width;
+  anEncodedImage.height = image.height;
+  anEncodedImage.mode = image.mode;
+  anEncodedImage.rawSize = int(image.size() + 0.5);
+  anEncodedImage.frameNumber = image.frameNumber;
+  try
+    {
+      switch(encoding)
+	{
+#ifdef WITH_VIDEO_JPEG
+	case JPEG:
+	  _jpeg_encode(image,quality,anEncodedImage.payload); break;
+#endif
+#ifdef WITH_LZ4_SAVING
+	case LZ4:
+	  _lz4_encode(image,anEncodedImage.payload); break;
+#endif
+	default:
+	  THROW_CTL_ERROR(NotSupported) << DEB_VAR1(encoding);
+	}
+    }
+  catch(Exception &exc)
+    {
+      DEB_ERROR() << "Stream encoding failed: " << exc.getErrMsg();
+      return;
+    }
+
+  aLock.lock();
+  m_last_stream_size = anEncodedImage.payload.size();
+  m_last_encoded_image = anEncodedImage;
+  EncodedImageCallback *cb = m_encoded_image_callback;
+  aLock.unlock();
+
+  if(cb)
+    cb->newEncodedImage(anEncodedImage);
+}
+
+void CtVideo::_post_encode_image(const Image &anImage)
+{
+  DEB_MEMBER_FUNCT();
+
+  _EncodeTask *encode_task = new _EncodeTask(*this,anImage,anImage.m_image);
+  TaskMgr *mgr = new TaskMgr();
+  mgr->addSinkTask(0,encode_task);
+  encode_task->unref();
+
+  m_ct.threadPools()->addProcess(CtThreadPools::Video,mgr);
+}
+
 void CtVideo::_startAcqTime()
 {
   if(m_internal_image_callback)
@@ -989,4 +1697,8 @@ void CtVideo::Parameters::reset()
   mode = Y8;
   roi.reset();
   bin.reset();
+  stream_encoding = CtVideo::NO_ENCODING;
+  stream_jpeg_quality = 80;
+  stream_max_rate = 0.;
+  stream_max_bandwidth = 0.;
 }
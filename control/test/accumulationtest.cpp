@@ -0,0 +1,324 @@
+//###########################################################################
+// This file is part of LImA, a Library for Image Acquisition
+//
+// Copyright (C) : 2009-2011
+// European Synchrotron Radiation Facility
+// BP 220, Grenoble 38043
+// FRANCE
+//
+// This is free software; you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation; either version 3 of the License, or
+// (at your option) any later version.
+//
+// This software is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program; if not, see <http://www.gnu.org/licenses/>.
+//###########################################################################
+#include <iostream>
+#include <vector>
+#include <algorithm>
+#include <cmath>
+#include <limits>
+#include <cstdlib>
+#include "CtAccumulation_Kernels.h"
+
+using namespace std;
+using namespace lima;
+
+static const char *kernel_name(_AccKernel kernel)
+{
+	switch (kernel) {
+	case ACC_SSE41:	return "sse4.1";
+	case ACC_AVX2:	return "avx2";
+	default:	return "scalar";
+	}
+}
+
+/** int pixels are kept small enough for the sums of a few frames
+ *  not to overflow
+ */
+template <class INPUT>
+static bool small_int()
+{
+	return numeric_limits<INPUT>::is_signed && sizeof(INPUT) == 4;
+}
+
+template <class INPUT>
+static long long pixel_min()
+{
+	return small_int<INPUT>() ? -(1 << 27) : numeric_limits<INPUT>::min();
+}
+
+template <class INPUT>
+static long long pixel_max()
+{
+	return small_int<INPUT>() ? (1 << 27) - 1 :
+		numeric_limits<INPUT>::max();
+}
+
+/** random pixels over the whole pixel range
+ */
+template <class INPUT>
+static INPUT random_pixel()
+{
+	unsigned int r = (unsigned int)(rand()) << 16 ^ (unsigned int)(rand());
+	if (small_int<INPUT>())
+		return INPUT(int(r >> 4) - (1 << 27));
+	return INPUT(r);
+}
+
+/** the frames are accumulated by tiles of random size, as the tile
+ *  workers split them, the result must be the scalar one on the
+ *  whole frame
+ */
+template <class INPUT>
+static int check_kernel(_AccKernel kernel, const char *type_name,
+			int nb_pixels, long long threshold, bool with_sat,
+			bool with_mask)
+{
+	const int nb_frames = 3;
+	vector<INPUT> src(nb_pixels);
+	vector<char> mask(nb_pixels);
+	vector<int> ref_acc(nb_pixels), acc(nb_pixels, -1);
+	vector<unsigned short> ref_sat(nb_pixels), sat(nb_pixels, 0xffff);
+	for (int i = 0; i < nb_pixels; ++i)
+		mask[i] = rand() % 4 != 0;
+	const char *maskPt = with_mask ? &mask[0] : NULL;
+
+	long long ref_counter = 0, counter = 0;
+	for (int frame = 0; frame < nb_frames; ++frame) {
+		for (int i = 0; i < nb_pixels; ++i)
+			src[i] = random_pixel<INPUT>();
+		// some pixels around the threshold
+		for (int i = 0; i < nb_pixels; i += 5) {
+			long long value = threshold + (rand() % 3) - 1;
+			if (value >= pixel_min<INPUT>() &&
+			    value <= pixel_max<INPUT>())
+				src[i] = INPUT(value);
+		}
+		bool first = frame == 0;
+		ref_counter += _acc_n_saturated(&src[0], &ref_acc[0],
+						with_sat ? &ref_sat[0] : NULL,
+						maskPt, nb_pixels, threshold,
+						first, ACC_SCALAR);
+		for (int start = 0, size; start < nb_pixels; start += size) {
+			size = min(nb_pixels - start, 1 + rand() % 100);
+			counter += _acc_n_saturated(&src[start], &acc[start],
+						    with_sat ? &sat[start] : NULL,
+						    maskPt ? maskPt + start : NULL,
+						    size, threshold, first,
+						    kernel);
+		}
+	}
+
+	bool ok = (acc == ref_acc) && (counter == ref_counter) &&
+		(!with_sat || sat == ref_sat);
+	if (ok)
+		return 0;
+	cout << kernel_name(kernel) << " " << type_name
+	     << ": nb_pixels=" << nb_pixels << " threshold=" << threshold
+	     << " sat=" << with_sat << " mask=" << with_mask
+	     << " counter=" << counter << " expected " << ref_counter
+	     << ": FAILED" << endl;
+	return 1;
+}
+
+template <class INPUT>
+static int check_type(_AccKernel kernel, const char *type_name)
+{
+	// vector widths, their tails and odd frame widths
+	static const int sizes[] = {1, 3, 7, 8, 15, 16, 17, 31, 33, 257,
+				    61 * 47};
+	long long min_val = numeric_limits<INPUT>::min();
+	long long max_val = numeric_limits<INPUT>::max();
+	// threshold under, at, in and over the INPUT range
+	long long thresholds[] = {min_val - 1, min_val, (min_val + max_val) / 2,
+				  max_val / 3, max_val - 1, max_val,
+				  max_val + 1};
+	int nb_errors = 0;
+	for (unsigned int s = 0; s < sizeof(sizes) / sizeof(int); ++s)
+		for (unsigned int t = 0;
+		     t < sizeof(thresholds) / sizeof(long long); ++t)
+			for (int flags = 0; flags < 4; ++flags)
+				nb_errors += check_kernel<INPUT>(kernel,
+							type_name, sizes[s],
+							thresholds[t],
+							flags & 1, flags & 2);
+	return nb_errors;
+}
+
+/** each vectorized kernel the cpu runs against the scalar one
+ */
+static int check_kernels()
+{
+	int nb_errors = 0;
+	_AccKernel best = _acc_kernel();
+	for (int k = ACC_SSE41; k <= best; ++k) {
+		_AccKernel kernel = _AccKernel(k);
+		int kernel_errors = 0;
+		kernel_errors += check_type<unsigned char>(kernel, "uint8");
+		kernel_errors += check_type<char>(kernel, "int8");
+		kernel_errors += check_type<unsigned short>(kernel, "uint16");
+		kernel_errors += check_type<short>(kernel, "int16");
+		kernel_errors += check_type<unsigned int>(kernel, "uint32");
+		kernel_errors += check_type<int>(kernel, "int32");
+		cout << kernel_name(kernel) << " accumulation kernel: "
+		     << (kernel_errors ? "FAILED" : "ok") << endl;
+		nb_errors += kernel_errors;
+	}
+	if (best == ACC_SCALAR)
+		cout << "no vectorized accumulation kernel on this cpu" << endl;
+	return nb_errors;
+}
+
+/** a partial sum of some sub frames, as CtAccumulation keeps them
+ */
+template <class INPUT>
+struct Partial
+{
+	Partial(int nb_pixels) : nb_frames(0), mean(nb_pixels),
+				 m2(nb_pixels), min(nb_pixels),
+				 max(nb_pixels) {}
+
+	int nb_frames;
+	vector<double> mean;
+	vector<double> m2;
+	vector<INPUT> min;
+	vector<INPUT> max;
+};
+
+static bool same_value(double a, double b, double scale)
+{
+	return fabs(a - b) <= 1e-9 * max(1., scale);
+}
+
+/** the sub frames come in a random order, each one is added by random
+ *  tiles to one of several partial sums, which are then merged: mean,
+ *  variance, std, min and max must be the ones of a two-pass
+ *  computation over all the sub frames
+ */
+template <class INPUT>
+static int check_statistics(const char *type_name, int nb_sub_frames,
+			    int nb_partials, int nb_pixels)
+{
+	vector<vector<INPUT> > frames(nb_sub_frames,
+				      vector<INPUT>(nb_pixels));
+	vector<int> order(nb_sub_frames);
+	for (int f = 0; f < nb_sub_frames; ++f) {
+		for (int i = 0; i < nb_pixels; ++i)
+			frames[f][i] = random_pixel<INPUT>();
+		order[f] = f;
+	}
+	random_shuffle(order.begin(), order.end());
+
+	nb_partials = min(nb_partials, nb_sub_frames);
+	vector<Partial<INPUT> > partials(nb_partials,
+					 Partial<INPUT>(nb_pixels));
+	for (int f = 0; f < nb_sub_frames; ++f) {
+		// each partial sum gets at least one sub frame
+		Partial<INPUT>& p = partials[f < nb_partials ? f :
+					     rand() % nb_partials];
+		const INPUT *src = &frames[order[f]][0];
+		int count = ++p.nb_frames;
+		for (int start = 0, size; start < nb_pixels; start += size) {
+			size = min(nb_pixels - start, 1 + rand() % 100);
+			_acc_welford(src + start, &p.mean[start],
+				     &p.m2[start], size, count);
+			_acc_min_max(src + start, &p.min[start], size, count,
+				     false);
+			_acc_min_max(src + start, &p.max[start], size, count,
+				     true);
+		}
+	}
+
+	Partial<INPUT>& result = partials.front();
+	for (int k = 1; k < nb_partials; ++k) {
+		Partial<INPUT>& p = partials[k];
+		_mergeWelford(&p.mean[0], &p.m2[0], p.nb_frames,
+			      &result.mean[0], &result.m2[0],
+			      result.nb_frames, nb_pixels);
+		_minMaxFrame(&p.min[0], &result.min[0], nb_pixels, false);
+		_minMaxFrame(&p.max[0], &result.max[0], nb_pixels, true);
+		result.nb_frames += p.nb_frames;
+	}
+	vector<float> variance(nb_pixels), std_dev(nb_pixels);
+	_finalVariance(&result.m2[0], result.nb_frames, false,
+		       &variance[0], nb_pixels);
+	_finalVariance(&result.m2[0], result.nb_frames, true,
+		       &std_dev[0], nb_pixels);
+
+	int nb_errors = result.nb_frames != nb_sub_frames;
+	for (int i = 0; !nb_errors && i < nb_pixels; ++i) {
+		double sum = 0.;
+		INPUT min_val = frames[0][i], max_val = frames[0][i];
+		for (int f = 0; f < nb_sub_frames; ++f) {
+			sum += frames[f][i];
+			min_val = min(min_val, frames[f][i]);
+			max_val = max(max_val, frames[f][i]);
+		}
+		double mean = sum / nb_sub_frames;
+		double m2 = 0.;
+		for (int f = 0; f < nb_sub_frames; ++f)
+			m2 += (frames[f][i] - mean) * (frames[f][i] - mean);
+		double var = nb_sub_frames > 1 ? m2 / (nb_sub_frames - 1) : 0.;
+
+		bool ok = same_value(result.mean[i], mean, fabs(mean)) &&
+			same_value(result.m2[i], m2, m2 + mean * mean) &&
+			(fabs(variance[i] - var) <= 1e-6 * max(1., var)) &&
+			(fabs(std_dev[i] - sqrt(var)) <=
+			 1e-6 * max(1., sqrt(var))) &&
+			(result.min[i] == min_val) && (result.max[i] == max_val);
+		if (ok)
+			continue;
+		cout << type_name << ": " << nb_sub_frames << " sub frames in "
+		     << nb_partials << " partials, pixel " << i
+		     << ": mean=" << result.mean[i] << " expected " << mean
+		     << ", variance=" << variance[i] << " expected " << var
+		     << ": FAILED" << endl;
+		++nb_errors;
+	}
+	return nb_errors;
+}
+
+template <class INPUT>
+static int check_statistics_type(const char *type_name)
+{
+	static const int nb_sub_frames[] = {1, 2, 5, 16};
+	static const int nb_partials[] = {1, 2, 3, 7};
+	int nb_errors = 0;
+	for (int f = 0; f < 4; ++f)
+		for (int p = 0; p < 4; ++p)
+			nb_errors += check_statistics<INPUT>(type_name,
+							nb_sub_frames[f],
+							nb_partials[p], 61 * 7);
+	return nb_errors;
+}
+
+/** the statistical modes reduction against a two-pass computation
+ */
+static int check_statistics_modes()
+{
+	int nb_errors = 0;
+	nb_errors += check_statistics_type<unsigned char>("uint8");
+	nb_errors += check_statistics_type<char>("int8");
+	nb_errors += check_statistics_type<unsigned short>("uint16");
+	nb_errors += check_statistics_type<short>("int16");
+	nb_errors += check_statistics_type<unsigned int>("uint32");
+	nb_errors += check_statistics_type<int>("int32");
+	cout << "statistical modes: " << (nb_errors ? "FAILED" : "ok") << endl;
+	return nb_errors;
+}
+
+int main(int argc, char *argv[])
+{
+	srand(12345);
+	int nb_errors = 0;
+	nb_errors += check_kernels();
+	nb_errors += check_statistics_modes();
+	return nb_errors ? 1 : 0;
+}
@@ -0,0 +1,333 @@
+//###########################################################################
+// This file is part of LImA, a Library for Image Acquisition
+//
+// Copyright (C) : 2009-2011
+// European Synchrotron Radiation Facility
+// BP 220, Grenoble 38043
+// FRANCE
+//
+// This is free software; you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation; either version 3 of the License, or
+// (at your option) any later version.
+//
+// This software is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program; if not, see <http://www.gnu.org/licenses/>.
+//###########################################################################
+#include <iostream>
+#include <new>
+#include <unistd.h>
+#include "lima/CtThreadPools.h"
+#include "lima/Exceptions.h"
+#include "processlib/TaskMgr.h"
+#include "processlib/LinkTask.h"
+#include "processlib/ProcessExceptions.h"
+
+using namespace std;
+using namespace lima;
+
+/** counts the frames it processed, after a while
+ */
+class SleepTask : public LinkTask
+{
+public:
+	SleepTask(int sleep_us) : LinkTask(true), m_sleep_us(sleep_us),
+				  m_nb_done(0) {}
+
+	virtual Data process(Data& data)
+	{
+		usleep(m_sleep_us);
+		AutoMutex l(m_mutex);
+		++m_nb_done;
+		return data;
+	}
+
+	int nbDone()
+	{
+		AutoMutex l(m_mutex);
+		return m_nb_done;
+	}
+
+private:
+	int m_sleep_us;
+	int m_nb_done;
+	Mutex m_mutex;
+};
+
+class FailingTask : public LinkTask
+{
+public:
+	FailingTask() : LinkTask(true) {}
+
+	virtual Data process(Data&)
+	{
+		throw ProcessException("FailingTask: failed on purpose");
+	}
+};
+
+static void post(CtThreadPools& pools, CtThreadPools::Role role,
+		 LinkTask *task, int nb_frames)
+{
+	for (int frame = 0; frame < nb_frames; ++frame) {
+		Data data;
+		data.type = Data::UINT8;
+		data.dimensions.push_back(4);
+		data.dimensions.push_back(4);
+		data.frameNumber = frame;
+		Buffer *buffer = new Buffer(data.size());
+		data.setBuffer(buffer);
+		buffer->unref();
+
+		TaskMgr *mgr = new TaskMgr();
+		mgr->setInputData(data);
+		mgr->setLinkTask(0, task);
+		pools.addProcess(role, mgr);
+	}
+}
+
+static int check(bool ok, const char *what)
+{
+	cout << what << ": " << (ok ? "ok" : "FAILED") << endl;
+	return ok ? 0 : 1;
+}
+
+/** with a shared global pool, an abort must not throw the tasks an
+ *  other instance posted there
+ */
+static int check_two_instances()
+{
+	const int nb_frames = 20;
+	CtThreadPools a, b;
+	a.setGlobalPoolShared(true);
+	b.setGlobalPoolShared(true);
+	SleepTask *a_task = new SleepTask(10000);
+	SleepTask *b_task = new SleepTask(10000);
+	post(b, CtThreadPools::Processing, b_task, nb_frames);
+	post(a, CtThreadPools::Processing, a_task, nb_frames);
+
+	a.abort();
+	CtThreadPools::Stats a_stats;
+	a.getStats(CtThreadPools::Processing, a_stats);
+	b.wait();
+	CtThreadPools::Stats b_stats;
+	b.getStats(CtThreadPools::Processing, b_stats);
+
+	int nb_errors = 0;
+	nb_errors += check(a_stats.nbPending == 0, "abort ends the pending");
+	nb_errors += check(a_task->nbDone() == nb_frames,
+			   "abort waits for the global pool tasks");
+	nb_errors += check(b_task->nbDone() == nb_frames &&
+			   b_stats.nbFinished == nb_frames &&
+			   b_stats.nbPending == 0,
+			   "abort keeps the other instance tasks");
+	a_task->unref();
+	b_task->unref();
+	return nb_errors;
+}
+
+/** by default, an abort throws the tasks queued in the global pool
+ */
+static int check_global_abort()
+{
+	const int nb_frames = 50;
+	CtThreadPools pools;
+	SleepTask *task = new SleepTask(10000);
+	post(pools, CtThreadPools::Processing, task, nb_frames);
+
+	pools.abort();
+	pools.wait();
+	CtThreadPools::Stats stats;
+	pools.getStats(CtThreadPools::Processing, stats);
+
+	int nb_errors = 0;
+	nb_errors += check(stats.nbPending == 0 &&
+			   task->nbDone() < nb_frames,
+			   "abort throws the global pool tasks");
+	task->unref();
+	return nb_errors;
+}
+
+/** giving a dedicated pool back waits for its tasks
+ */
+static int check_give_back()
+{
+	const int nb_frames = 20;
+	CtThreadPools pools;
+	pools.setNbThreads(CtThreadPools::Saving, 2);
+	SleepTask *task = new SleepTask(10000);
+	post(pools, CtThreadPools::Saving, task, nb_frames);
+
+	pools.setNbThreads(CtThreadPools::Saving, 0);
+	CtThreadPools::Stats stats;
+	pools.getStats(CtThreadPools::Saving, stats);
+
+	int nb_errors = 0;
+	nb_errors += check(stats.nbThreads == 0 && stats.nbPending == 0 &&
+			   task->nbDone() == nb_frames,
+			   "dedicated pool given back");
+	task->unref();
+	return nb_errors;
+}
+
+/** the tasks thrown from a dedicated pool are no more pending
+ */
+static int check_dedicated_abort()
+{
+	const int nb_frames = 20;
+	CtThreadPools pools;
+	pools.setNbThreads(CtThreadPools::Saving, 1);
+	SleepTask *task = new SleepTask(10000);
+	post(pools, CtThreadPools::Saving, task, nb_frames);
+
+	pools.abort();
+	CtThreadPools::Stats stats;
+	pools.getStats(CtThreadPools::Saving, stats);
+
+	int nb_errors = 0;
+	nb_errors += check(stats.nbThreads == 1 &&
+			   stats.nbSubmitted == nb_frames &&
+			   stats.nbPending == 0 &&
+			   stats.nbFinished == task->nbDone(),
+			   "dedicated pool abort");
+	task->unref();
+	return nb_errors;
+}
+
+/** a failing task manager ends its pending too
+ */
+static int check_failure()
+{
+	CtThreadPools pools;
+	FailingTask *task = new FailingTask();
+	post(pools, CtThreadPools::Processing, task, 3);
+
+	pools.wait();
+	CtThreadPools::Stats stats;
+	pools.getStats(CtThreadPools::Processing, stats);
+	task->unref();
+	return check(stats.nbSubmitted == 3 && stats.nbPending == 0,
+		     "failed tasks are no more pending");
+}
+
+class CountJob : public TileWorkers::Job
+{
+public:
+	CountJob(int nb_tiles) : m_tiles(nb_tiles, 0) {}
+
+	virtual void process(int tile)
+	{
+		++m_tiles[tile];
+	}
+
+	bool allDoneOnce() const
+	{
+		for (unsigned int i = 0; i < m_tiles.size(); ++i)
+			if (m_tiles[i] != 1)
+				return false;
+		return true;
+	}
+
+private:
+	vector<int> m_tiles;
+};
+
+/** the tile workers of a role follow its threads and affinity
+ */
+static int check_tile_workers()
+{
+	CtThreadPools pools;
+	int nb_errors = 0;
+
+	pools.setNbThreads(CtThreadPools::Compression, 3);
+	TileWorkers& workers =
+		pools.getTileWorkers(CtThreadPools::Compression);
+	nb_errors += check(workers.getNbThreads() == 2,
+			   "tile workers of dedicated threads");
+
+	pools.setNbThreads(CtThreadPools::Compression, 0);
+	int nb_cpus = int(sysconf(_SC_NPROCESSORS_ONLN));
+	nb_cpus = min(nb_cpus, int(CtThreadPools::MAX_AUTO_TILE_THREADS));
+	nb_errors += check(workers.getNbThreads() == nb_cpus - 1,
+			   "tile workers of the global pool");
+
+	list<int> cpus(1, 0), role_cpus;
+	pools.setCpuAffinity(CtThreadPools::Video, cpus);
+	pools.getCpuAffinity(CtThreadPools::Video, role_cpus);
+	TileWorkers& video_workers =
+		pools.getTileWorkers(CtThreadPools::Video);
+	nb_errors += check(role_cpus == cpus &&
+			   video_workers.getCpuAffinity() == cpus,
+			   "tile workers affinity");
+
+	CountJob job(64);
+	video_workers.run(job, 64);
+	nb_errors += check(job.allDoneOnce(), "tile workers run");
+	return nb_errors;
+}
+
+/** throws on some tiles, a lima Exception or bad_alloc
+ */
+class FailingJob : public TileWorkers::Job
+{
+public:
+	FailingJob(bool bad_alloc) : m_bad_alloc(bad_alloc) {}
+
+	virtual void process(int tile)
+	{
+		usleep(100);
+		if (tile % 7 != 3)
+			return;
+		if (m_bad_alloc)
+			throw std::bad_alloc();
+		throw LIMA_COM_EXC(InvalidValue, "FailingJob: failed on purpose");
+	}
+
+private:
+	bool m_bad_alloc;
+};
+
+/** a failing tile is thrown by run, which leaves the workers ready
+ *  for the next job
+ */
+static int check_tile_job_failure()
+{
+	TileWorkers workers(3);
+	int nb_errors = 0;
+	for (int i = 0; i < 20; ++i) {
+		bool bad_alloc = i % 2;
+		FailingJob failing(bad_alloc);
+		bool lima_thrown = false, bad_alloc_thrown = false;
+		try {
+			workers.run(failing, 64);
+		} catch (Exception& e) {
+			lima_thrown = e.getErrType() == InvalidValue;
+		} catch (std::bad_alloc&) {
+			bad_alloc_thrown = true;
+		}
+		CountJob job(64);
+		workers.run(job, 64);
+		if ((bad_alloc ? bad_alloc_thrown : lima_thrown) &&
+		    job.allDoneOnce())
+			continue;
+		++nb_errors;
+	}
+	return check(!nb_errors, "tile workers job failure");
+}
+
+int main(int argc, char *argv[])
+{
+	int nb_errors = 0;
+	nb_errors += check_two_instances();
+	nb_errors += check_global_abort();
+	nb_errors += check_give_back();
+	nb_errors += check_dedicated_abort();
+	nb_errors += check_failure();
+	nb_errors += check_tile_workers();
+	nb_errors += check_tile_job_failure();
+	return nb_errors ? 1 : 0;
+}
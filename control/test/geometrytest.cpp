@@ -0,0 +1,243 @@
+//###########################################################################
+// This file is part of LImA, a Library for Image Acquisition
+//
+// Copyright (C) : 2009-2011
+// European Synchrotron Radiation Facility
+// BP 220, Grenoble 38043
+// FRANCE
+//
+// This is free software; you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation; either version 3 of the License, or
+// (at your option) any later version.
+//
+// This software is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program; if not, see <http://www.gnu.org/licenses/>.
+//###########################################################################
+#include <iostream>
+#include <cstdlib>
+#include <cstring>
+#include <limits>
+#include "lima/SoftOpInternalMgr.h"
+#include "lima/SizeUtils.h"
+#include "processlib/TaskMgr.h"
+#include "processlib/Binning.h"
+#include "processlib/Flip.h"
+#include "processlib/Rotation.h"
+#include "processlib/SoftRoi.h"
+
+using namespace std;
+using namespace lima;
+
+static const int WIDTH = 38;
+static const int HEIGHT = 27;
+
+/** random pixels over the whole type range, so that bins saturate
+ */
+template <class T>
+static void fill_random(Data& data)
+{
+	T *p = (T *) data.data();
+	for (int i = 0; i < WIDTH * HEIGHT; ++i) {
+		unsigned long long r = 0;
+		for (int j = 0; j < 4; ++j)
+			r = (r << 16) ^ (unsigned long long)(rand());
+		if (numeric_limits<T>::is_integer)
+			p[i] = T(r);
+		else
+			p[i] = T(double(rand()) / RAND_MAX * 2e6 - 1e6);
+	}
+}
+
+static Data random_frame(Data::TYPE type)
+{
+	Data data;
+	data.type = type;
+	data.dimensions.push_back(WIDTH);
+	data.dimensions.push_back(HEIGHT);
+	Buffer *buffer = new Buffer(data.size());
+	data.setBuffer(buffer);
+	buffer->unref();
+
+	switch (type) {
+	case Data::UINT8:	fill_random<unsigned char>(data); break;
+	case Data::INT8:	fill_random<char>(data); break;
+	case Data::UINT16:	fill_random<unsigned short>(data); break;
+	case Data::INT16:	fill_random<short>(data); break;
+	case Data::UINT32:	fill_random<unsigned int>(data); break;
+	case Data::INT32:	fill_random<int>(data); break;
+	case Data::FLOAT:	fill_random<float>(data); break;
+	default:		fill_random<double>(data); break;
+	}
+	return data;
+}
+
+static Data apply(LinkTask *task, Data& data)
+{
+	Data result = task->process(data);
+	task->unref();
+	return result;
+}
+
+/** the separated processlib tasks, as SoftOpInternalMgr gives them
+ *  when only one of the operations is active
+ */
+static Data process_separated(Data data, const Bin& bin, const Flip& flip,
+			      RotationMode rotation, const Roi& roi)
+{
+	bool swapped = (rotation == Rotation_90) || (rotation == Rotation_270);
+	if (bin.getX() > 1 || bin.getY() > 1) {
+		Tasks::Binning *task = new Tasks::Binning();
+		task->mXFactor = swapped ? bin.getY() : bin.getX();
+		task->mYFactor = swapped ? bin.getX() : bin.getY();
+		data = apply(task, data);
+	}
+	if (flip.x || flip.y) {
+		Tasks::Flip *task = new Tasks::Flip();
+		task->setFlip(flip.x && flip.y ? Tasks::Flip::FLIP_ALL :
+			      flip.x ? Tasks::Flip::FLIP_X :
+			      Tasks::Flip::FLIP_Y);
+		data = apply(task, data);
+	}
+	if (rotation != Rotation_0) {
+		Tasks::Rotation *task = new Tasks::Rotation();
+		task->setType(rotation == Rotation_90 ? Tasks::Rotation::R_90 :
+			      rotation == Rotation_180 ? Tasks::Rotation::R_180 :
+			      Tasks::Rotation::R_270);
+		data = apply(task, data);
+	}
+	if (roi.isActive()) {
+		Point tl = roi.getTopLeft(), br = roi.getBottomRight();
+		Tasks::SoftRoi *task = new Tasks::SoftRoi();
+		task->setRoi(tl.x, br.x, tl.y, br.y);
+		data = apply(task, data);
+	}
+	return data;
+}
+
+static Data process_internal(Data data, const Bin& bin, const Flip& flip,
+			     RotationMode rotation, const Roi& roi)
+{
+	SoftOpInternalMgr internal_mgr;
+	internal_mgr.setBin(bin);
+	internal_mgr.setFlip(flip);
+	internal_mgr.setRotation(rotation);
+	internal_mgr.setRoi(roi);
+
+	TaskMgr *mgr = new TaskMgr();
+	mgr->setInputData(data);
+	int last_stage;
+	internal_mgr.addTo(*mgr, last_stage);
+	Data result = mgr->syncProcess();
+	delete mgr;
+	return result;
+}
+
+static bool same_frame(const Data& a, const Data& b)
+{
+	return (a.type == b.type) && (a.dimensions == b.dimensions) &&
+		(a.size() == b.size()) &&
+		!memcmp(a.data(), b.data(), a.size());
+}
+
+static const char *type_name(Data::TYPE type)
+{
+	switch (type) {
+	case Data::UINT8:	return "uint8";
+	case Data::INT8:	return "int8";
+	case Data::UINT16:	return "uint16";
+	case Data::INT16:	return "int16";
+	case Data::UINT32:	return "uint32";
+	case Data::INT32:	return "int32";
+	case Data::FLOAT:	return "float";
+	default:		return "double";
+	}
+}
+
+/** the fused geometry task must give exactly the frame of the
+ *  separated tasks
+ */
+static int check_case(Data::TYPE type, const Bin& bin, const Flip& flip,
+		      RotationMode rotation, int roi_nb)
+{
+	// output frame, the bin is given in the rotated frame
+	bool swapped = (rotation == Rotation_90) || (rotation == Rotation_270);
+	int bin_width = WIDTH / (swapped ? bin.getY() : bin.getX());
+	int bin_height = HEIGHT / (swapped ? bin.getX() : bin.getY());
+	int out_width = swapped ? bin_height : bin_width;
+	int out_height = swapped ? bin_width : bin_height;
+	Roi roi;
+	switch (roi_nb) {
+	case 1:		// inside
+		roi = Roi(1, 2, out_width / 2, out_height / 3);
+		break;
+	case 2:		// bottom right corner
+		roi = Roi(out_width - 3, out_height - 2, 3, 2);
+		break;
+	case 3:		// whole frame
+		roi = Roi(0, 0, out_width, out_height);
+		break;
+	}
+
+	Data frame = random_frame(type);
+	Data expected = process_separated(frame.copy(), bin, flip, rotation,
+					  roi);
+	Data result = process_internal(frame.copy(), bin, flip, rotation, roi);
+	if (same_frame(expected, result))
+		return 0;
+	cout << type_name(type) << " bin=" << bin << " flip=" << flip
+	     << " rotation=" << rotation << " roi=" << roi << ": FAILED"
+	     << endl;
+	return 1;
+}
+
+/** every bin, flip, rotation and roi of the integer and float types
+ */
+static int check_geometry()
+{
+	static const Data::TYPE types[] = {
+		Data::UINT8, Data::INT8, Data::UINT16, Data::INT16,
+		Data::UINT32, Data::INT32, Data::FLOAT, Data::DOUBLE,
+	};
+	static const int bins[][2] = {{1, 1}, {2, 2}, {1, 2}, {3, 1}, {4, 3}};
+	static const RotationMode rotations[] = {
+		Rotation_0, Rotation_90, Rotation_180, Rotation_270,
+	};
+	const int nb_types = sizeof(types) / sizeof(types[0]);
+	const int nb_bins = sizeof(bins) / sizeof(bins[0]);
+
+	int nb_errors = 0;
+	for (int t = 0; t < nb_types; ++t) {
+		for (int b = 0; b < nb_bins; ++b) {
+			Bin bin(bins[b][0], bins[b][1]);
+			for (int f = 0; f < 4; ++f) {
+				Flip flip((f & 1) != 0, (f & 2) != 0);
+				for (int r = 0; r < 4; ++r) {
+					RotationMode rotation = rotations[r];
+					bool identity = (b == 0) && (f == 0) &&
+						(rotation == Rotation_0);
+					// roi 0 is no roi
+					for (int roi_nb = identity; roi_nb < 4;
+					     ++roi_nb)
+						nb_errors += check_case(types[t],
+									bin, flip,
+									rotation,
+									roi_nb);
+				}
+			}
+		}
+	}
+	cout << "fused geometry: " << (nb_errors ? "FAILED" : "ok") << endl;
+	return nb_errors;
+}
+
+int main(int argc, char *argv[])
+{
+	srand(4321);
+	return check_geometry() ? 1 : 0;
+}
@@ -20,12 +20,135 @@
 // along with this program; if not, see <http://www.gnu.org/licenses/>.
 //###########################################################################
 #include <iostream>
+#include <cmath>
 #include "lima/SoftOpExternalMgr.h"
 #include "lima/SizeUtils.h"
+#include "processlib/TaskMgr.h"
 
 using namespace std;
 using namespace lima;
 
+typedef list<SoftOpRoiCounter::RoiNameAndResults> RoiResultList;
+
+static SoftOpRoiCounter *add_roi_counters(SoftOpExternalMgr& op_ext_mgr,
+					  SoftOpRoiCounter::Engine engine)
+{
+	SoftOpInstance roi_cnt_op_inst;
+	op_ext_mgr.addOp(ROICOUNTERS, "RoiCounters", 0, roi_cnt_op_inst);
+	SoftOpRoiCounter *roi_cnt_op =
+		static_cast<SoftOpRoiCounter *>(roi_cnt_op_inst.m_opt);
+	roi_cnt_op->setEngine(engine);
+
+	list<SoftOpRoiCounter::RoiNameAndRoi> roi_list;
+	roi_list.push_back(SoftOpRoiCounter::RoiNameAndRoi("full",
+						Roi(0, 0, 64, 48)));
+	roi_list.push_back(SoftOpRoiCounter::RoiNameAndRoi("left",
+						Roi(0, 0, 20, 30)));
+	roi_list.push_back(SoftOpRoiCounter::RoiNameAndRoi("overlap",
+						Roi(10, 5, 30, 20)));
+	roi_list.push_back(SoftOpRoiCounter::RoiNameAndRoi("inside",
+						Roi(12, 8, 3, 4)));
+	roi_list.push_back(SoftOpRoiCounter::RoiNameAndRoi("bottom",
+						Roi(33, 40, 31, 8)));
+	roi_list.push_back(SoftOpRoiCounter::RoiNameAndRoi("pixel",
+						Roi(63, 47, 1, 1)));
+	roi_list.push_back(SoftOpRoiCounter::RoiNameAndRoi("outside",
+						Roi(50, 40, 30, 30)));
+	roi_cnt_op->updateRois(roi_list);
+
+	list<SoftOpRoiCounter::RoiNameAndArcRoi> arc_list;
+	arc_list.push_back(SoftOpRoiCounter::RoiNameAndArcRoi("arc",
+				ArcRoi(30.3, 20.4, 5.5, 15.5, 10.5, 120.5)));
+	roi_cnt_op->updateArcRois(arc_list);
+
+	op_ext_mgr.prepare();
+	return roi_cnt_op;
+}
+
+static void process_frame(SoftOpExternalMgr& op_ext_mgr, Data& data)
+{
+	TaskMgr *mgr = new TaskMgr();
+	mgr->setInputData(data);
+	int last_link_task, last_sink_task;
+	op_ext_mgr.addTo(*mgr, 0, last_link_task, last_sink_task);
+	mgr->syncProcess();
+	delete mgr;
+}
+
+static bool same_value(double a, double b)
+{
+	return fabs(a - b) <= 1e-9 * max(1., fabs(a));
+}
+
+/** the single pass engine must give the results of one task per roi
+ */
+static int check_single_pass()
+{
+	SoftOpExternalMgr per_roi_mgr, single_pass_mgr;
+	SoftOpRoiCounter *per_roi =
+		add_roi_counters(per_roi_mgr, SoftOpRoiCounter::PER_ROI);
+	SoftOpRoiCounter *single_pass =
+		add_roi_counters(single_pass_mgr, SoftOpRoiCounter::SINGLE_PASS);
+
+	const int nb_frames = 3;
+	for (int frame = 0; frame < nb_frames; ++frame) {
+		Data data;
+		data.type = Data::UINT16;
+		data.dimensions.push_back(64);
+		data.dimensions.push_back(48);
+		data.frameNumber = frame;
+		Buffer *buffer = new Buffer(data.size());
+		data.setBuffer(buffer);
+		buffer->unref();
+		unsigned short *p = (unsigned short *) data.data();
+		for (int i = 0; i < 64 * 48; ++i)
+			p[i] = (i * 7919 + frame * 104729) % 4093;
+
+		process_frame(per_roi_mgr, data);
+		process_frame(single_pass_mgr, data);
+	}
+
+	RoiResultList expected, results;
+	per_roi->readCounters(0, expected);
+	single_pass->readCounters(0, results);
+	if (expected.size() != results.size()) {
+		cout << "single pass: " << results.size() << " rois, expected "
+		     << expected.size() << endl;
+		return 1;
+	}
+
+	int nb_errors = 0;
+	RoiResultList::const_iterator e, r;
+	for (e = expected.begin(), r = results.begin(); e != expected.end();
+	     ++e, ++r) {
+		if (int(e->second.size()) != nb_frames ||
+		    int(r->second.size()) != nb_frames) {
+			cout << e->first << ": " << r->second.size()
+			     << " frames, expected " << e->second.size() << endl;
+			++nb_errors;
+			continue;
+		}
+		list<Tasks::RoiCounterResult>::const_iterator ei, ri;
+		for (ei = e->second.begin(), ri = r->second.begin();
+		     ei != e->second.end(); ++ei, ++ri) {
+			if (ei->frameNumber == ri->frameNumber &&
+			    same_value(ei->sum, ri->sum) &&
+			    same_value(ei->average, ri->average) &&
+			    same_value(ei->std, ri->std) &&
+			    same_value(ei->minValue, ri->minValue) &&
+			    same_value(ei->maxValue, ri->maxValue))
+				continue;
+			cout << e->first << " frame " << ei->frameNumber
+			     << ": sum=" << ri->sum << " expected " << ei->sum
+			     << endl;
+			++nb_errors;
+		}
+	}
+	cout << "single pass vs per roi: "
+	     << (nb_errors ? "FAILED" : "ok") << endl;
+	return nb_errors ? 1 : 0;
+}
+
 int main(int argc, char *argv[])
 {
 	cout << "Hello!" << endl;
@@ -56,6 +179,6 @@ int main(int argc, char *argv[])
 		cout << "roi_check=" << roi_check << endl;
 	}
 
-	return 0;
+	return check_single_pass();
 
 }
@@ -0,0 +1,202 @@
+//###########################################################################
+// This file is part of LImA, a Library for Image Acquisition
+//
+// Copyright (C) : 2009-2011
+// European Synchrotron Radiation Facility
+// BP 220, Grenoble 38043
+// FRANCE
+//
+// This is free software; you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation; either version 3 of the License, or
+// (at your option) any later version.
+//
+// This software is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program; if not, see <http://www.gnu.org/licenses/>.
+//###########################################################################
+#include "SimulatorInterface.h"
+#include "lima/CtControl.h"
+#include "lima/CtAcquisition.h"
+#include "lima/CtSaving.h"
+#include "lima/CtImage.h"
+
+#include <iostream>
+#include <fstream>
+#include <sstream>
+#include <cstdio>
+#include <cstdlib>
+#include <dirent.h>
+#include <unistd.h>
+
+using namespace lima;
+using namespace lima::Simulator;
+using namespace std;
+
+// a continuous acquisition has 16 frame buffers
+static const int NB_FRAMES = 48;
+
+/** acquire NB_FRAMES frames and save them in directory.
+ *  With header_after, the frames wait for their header until the end
+ *  of the acquisition, so they have to leave the frame buffers.
+ *  @return true if the acquisition did not fail and all were saved
+ */
+static bool acquire_and_save(const string& directory, bool header_after,
+			     const string& spill_directory)
+{
+	Camera simu;
+	simu.getFrameBuilder()->setGrowFactor(0.05);
+	Interface hw(simu);
+	CtControl ct(&hw);
+
+	CtSaving *save = ct.saving();
+	save->setDirectory(directory);
+	save->setPrefix("spill_");
+	save->setSuffix(".raw");
+	save->setFormat(CtSaving::RAW);
+	save->setFramesPerFile(1);
+	save->setSavingMode(header_after ? CtSaving::AutoHeader :
+					   CtSaving::AutoFrame);
+	save->setSpillDirectory(spill_directory);
+
+	Bin bin(4, 4);
+	ct.image()->setBin(bin);
+
+	CtAcquisition *acq = ct.acquisition();
+	acq->setAcqMode(Single);
+	acq->setAcqExpoTime(0.02);
+	acq->setAcqNbFrames(0);
+
+	ct.prepareAcq();
+	ct.startAcq();
+
+	CtControl::Status status;
+	CtControl::ImageStatus img_status;
+	do {
+		usleep(10000);
+		ct.getStatus(status);
+		ct.getImageStatus(img_status);
+	} while ((status.AcquisitionStatus != AcqFault) &&
+		 (img_status.LastImageAcquired < NB_FRAMES - 1));
+	ct.stopAcq();
+	if (status.AcquisitionStatus == AcqFault) {
+		cout << "acquisition failed: " << status << endl;
+		return false;
+	}
+
+	// the first one through validateFrameHeader, the next ones
+	// through the end of the previous save
+	for (int i = 0; header_after && (i < NB_FRAMES); ++i) {
+		CtSaving::HeaderMap header;
+		ostringstream value;
+		value << i;
+		header["frame"] = value.str();
+		save->updateFrameHeader(i, header);
+	}
+
+	for (int i = 0; i < 1000; ++i) {
+		ct.getImageStatus(img_status);
+		if (img_status.LastImageSaved >= NB_FRAMES - 1)
+			return true;
+		usleep(10000);
+	}
+	cout << "frames not saved: " << img_status << endl;
+	return false;
+}
+
+static string file_name(const string& directory, int frame)
+{
+	char index[16];
+	snprintf(index, sizeof(index), "%04d", frame);
+	return directory + "/spill_" + index + ".raw";
+}
+
+static bool read_file(const string& name, string& content)
+{
+	ifstream file(name.c_str(), ios::binary);
+	ostringstream buffer;
+	buffer << file.rdbuf();
+	content = buffer.str();
+	return file.good() && !content.empty();
+}
+
+static string make_directory()
+{
+	char name[] = "/tmp/spilltest_XXXXXX";
+	if (!mkdtemp(name)) {
+		perror("mkdtemp");
+		exit(1);
+	}
+	return name;
+}
+
+static void remove_directory(const string& directory)
+{
+	DIR *dir = opendir(directory.c_str());
+	if (dir) {
+		struct dirent *entry;
+		while ((entry = readdir(dir)) != NULL)
+			if (entry->d_name[0] != '.')
+				unlink((directory + "/" + entry->d_name).c_str());
+		closedir(dir);
+	}
+	rmdir(directory.c_str());
+}
+
+/** the frames read back from the overflow tier must be saved as the
+ *  ones which stayed in the frame buffers
+ */
+static int check_spill()
+{
+	string ref_dir = make_directory();
+	string spill_save_dir = make_directory();
+	string no_spill_dir = make_directory();
+	string spill_dir = make_directory();
+	int nb_errors = 0;
+
+	if (!acquire_and_save(ref_dir, false, "")) {
+		cout << "reference acquisition: FAILED" << endl;
+		++nb_errors;
+	}
+	if (acquire_and_save(no_spill_dir, true, "")) {
+		cout << "waiting headers without spill: no overrun, FAILED"
+		     << endl;
+		++nb_errors;
+	}
+	if (!acquire_and_save(spill_save_dir, true, spill_dir)) {
+		cout << "waiting headers with spill: FAILED" << endl;
+		++nb_errors;
+	}
+
+	for (int frame = 0; !nb_errors && (frame < NB_FRAMES); ++frame) {
+		string ref, spilled;
+		if (!read_file(file_name(ref_dir, frame), ref) ||
+		    !read_file(file_name(spill_save_dir, frame), spilled) ||
+		    (ref != spilled)) {
+			cout << "frame " << frame << ": FAILED" << endl;
+			++nb_errors;
+		}
+	}
+	cout << "spill and read back: " << (nb_errors ? "FAILED" : "ok")
+	     << endl;
+
+	remove_directory(ref_dir);
+	remove_directory(spill_save_dir);
+	remove_directory(no_spill_dir);
+	remove_directory(spill_dir);
+	return nb_errors ? 1 : 0;
+}
+
+int main(int argc, char *argv[])
+{
+	try {
+		return check_spill();
+	} catch (Exception e) {
+		cerr << "LIMA Exception:" << e << endl;
+		return 1;
+	}
+}
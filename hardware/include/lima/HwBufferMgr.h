@@ -29,6 +29,7 @@
 
 #include <vector>
 #include <set>
+#include <string>
 
 namespace lima
 {
@@ -59,6 +60,9 @@ class LIMACORE_API BufferAllocMgr
 
 	virtual void clearBuffer(int buffer_nb);
 	virtual void clearAllBuffers();
+
+	// called when a frame is ready in a buffer
+	virtual void setBufferFrameNb(int buffer_nb, int acq_frame_nb) {}
 };
 
 
@@ -66,7 +70,9 @@ class LIMACORE_API BufferAllocMgr
  * \class SoftBufferAllocMgr
  * \brief Simple full software implementation of BufferAllocMgr
  *
- * This classes uses new and delete to allocate the memory buffers
+ * This classes uses new and delete to allocate the memory buffers.
+ * On Linux, the buffers can also be allocated in one region with huge
+ * pages, bound to a NUMA node and prefaulted by several threads.
  *******************************************************************/
 
 class LIMACORE_API SoftBufferAllocMgr : public BufferAllocMgr
@@ -74,9 +80,24 @@ class LIMACORE_API SoftBufferAllocMgr : public BufferAllocMgr
 	DEB_CLASS(DebModHardware, "SoftBufferAllocMgr");
 
  public:
+	enum PageSize {
+		StdPages, HugePages2M, HugePages1G,
+	};
+
 	SoftBufferAllocMgr();
 	virtual ~SoftBufferAllocMgr();
 
+	void setPageSize(PageSize page_size);
+	void getPageSize(PageSize& page_size);
+	// -1 == no binding
+	void setNumaNode(int numa_node);
+	void getNumaNode(int& numa_node);
+	// 0 == one thread per cpu
+	void setNbPrefaultThreads(int nb_threads);
+	void getNbPrefaultThreads(int& nb_threads);
+	// time spent in the last allocBuffers
+	void getAllocTime(double& alloc_time);
+
 	virtual int getMaxNbBuffers(const FrameDim& frame_dim);
 	virtual void allocBuffers(int nb_buffers, 
 				  const FrameDim& frame_dim);
@@ -90,11 +111,152 @@ class LIMACORE_API SoftBufferAllocMgr : public BufferAllocMgr
 	typedef std::vector<MemBuffer *> BufferList;
 	typedef BufferList::const_iterator BufferListCIt;
 
+	bool useRegion() const;
+	void allocRegion(int nb_buffers, int frame_size);
+	void releaseRegion();
+	void prefaultRegion();
+
 	FrameDim m_frame_dim;
 	BufferList m_buffer_list;
+
+	PageSize m_page_size;
+	int m_numa_node;
+	int m_nb_prefault_threads;
+	bool m_options_changed;
+	double m_alloc_time;
+
+	char *m_region;
+	long long m_region_size;
+	long long m_region_stride;
+	int m_region_nb_buffers;
+};
+
+
+#ifdef __unix
+/*******************************************************************
+ * \class MmapBufferAllocMgr
+ * \brief BufferAllocMgr with buffers in a shared memory mapped file
+ *
+ * The buffers are allocated in a file (on tmpfs, hugetlbfs or a local
+ * disk) mapped with MAP_SHARED, so other processes can map the same
+ * file read-only and access the frames without any copy.
+ *
+ * File layout: a Header, followed by the frame index (one long long
+ * per buffer, the acq. frame nb it holds or -1), padded to the file
+ * system block size, then the buffers every buffer_stride bytes.
+ *
+ * A reader can use frame N from buffer b if index[b] == N, and if
+ * last_frame_nb - N < nb_buffers - 1 once it is done with the data
+ * (the buffer may be overwritten otherwise). When generation changes
+ * the file was released and must be re-opened.
+ * MmapBufferReader implements this protocol.
+ *******************************************************************/
+
+class LIMACORE_API MmapBufferAllocMgr : public BufferAllocMgr
+{
+	DEB_CLASS(DebModHardware, "MmapBufferAllocMgr");
+
+ public:
+	struct Header {
+		enum {
+			MAGIC = 0x4c696d61,	// "Lima"
+			VERSION = 1,
+		};
+		int magic;
+		int version;
+		int header_size;	// offset of the first buffer
+		int nb_buffers;
+		int width;
+		int height;
+		int image_type;
+		int depth;
+		long long buffer_size;
+		long long buffer_stride;
+		volatile int generation;
+		volatile long long last_frame_nb;
+	};
+
+	MmapBufferAllocMgr(const std::string& file_name);
+	virtual ~MmapBufferAllocMgr();
+
+	virtual int getMaxNbBuffers(const FrameDim& frame_dim);
+	virtual void allocBuffers(int nb_buffers, 
+				  const FrameDim& frame_dim);
+	virtual const FrameDim& getFrameDim();
+	virtual void getNbBuffers(int& nb_buffers);
+	virtual void releaseBuffers();
+
+	virtual void *getBufferPtr(int buffer_nb);
+
+	virtual void setBufferFrameNb(int buffer_nb, int acq_frame_nb);
+
+	const std::string& getFileName() const
+	{ return m_file_name; }
+
+ private:
+	std::string m_file_name;
+	int m_fd;
+	char *m_map;
+	long long m_map_size;
+	Header *m_header;
+	volatile long long *m_index;
+	FrameDim m_frame_dim;
+	int m_generation;
 };
 
 
+/*******************************************************************
+ * \class MmapBufferReader
+ * \brief Read-only access to the buffers of a MmapBufferAllocMgr
+ *
+ * Maps the buffer file, possibly from another process, checks its
+ * header against the file size and gives access to the frames still
+ * in the buffers. The file is re-opened when the writer releases or
+ * re-allocates its buffers.
+ *******************************************************************/
+
+class LIMACORE_API MmapBufferReader
+{
+	DEB_CLASS(DebModHardware, "MmapBufferReader");
+
+ public:
+	typedef MmapBufferAllocMgr::Header Header;
+
+	MmapBufferReader(const std::string& file_name);
+	~MmapBufferReader();
+
+	// (re-)map the file if needed, false if there is no valid buffer
+	bool update();
+	void close();
+
+	bool isOpen() const
+	{ return m_header != NULL; }
+	const FrameDim& getFrameDim() const
+	{ return m_frame_dim; }
+	int getNbBuffers() const;
+	long long getLastFrameNb() const;
+
+	// frame data, NULL if the frame is not in the buffers;
+	// must be checked with isFrameValid once the data was used
+	const void *getFramePtr(long long frame_nb);
+	bool isFrameValid(long long frame_nb);
+	// copy of the frame data, false if not available or overwritten
+	bool copyFrame(long long frame_nb, void *dest);
+
+ private:
+	int findBuffer(long long frame_nb);
+
+	std::string m_file_name;
+	char *m_map;
+	long long m_map_size;
+	const Header *m_header;
+	const volatile long long *m_index;
+	FrameDim m_frame_dim;
+	int m_generation;
+};
+#endif
+
+
 /*******************************************************************
  * \class BufferCbMgr
  * \brief Abstract class with interface for buffer alloc. and callbacks
@@ -187,6 +349,10 @@ class LIMACORE_API StdBufferCbMgr : public BufferCbMgr
 
 	bool newFrameReady(HwFrameInfoType& frame_info);
 
+	// the current buffers are released
+	void setAllocMgr(BufferAllocMgr& alloc_mgr);
+	BufferAllocMgr& getAllocMgr();
+
  protected:
 	virtual void setFrameCallbackActive(bool cb_active);
 	
@@ -281,6 +447,7 @@ class LIMACORE_API SoftBufferCtrlObj : public HwBufferCtrlObj
 {
  public:
 	SoftBufferCtrlObj();
+	virtual ~SoftBufferCtrlObj();
 
 	virtual void setFrameDim(const FrameDim& frame_dim);
 	virtual void getFrameDim(FrameDim& frame_dim);
@@ -306,6 +473,27 @@ class LIMACORE_API SoftBufferCtrlObj : public HwBufferCtrlObj
 
 	int getNbAcquiredFrames();
 
+	// options of the default allocation (see SoftBufferAllocMgr),
+	// the current buffers are released if they change
+	void setPageSize(SoftBufferAllocMgr::PageSize page_size);
+	void getPageSize(SoftBufferAllocMgr::PageSize& page_size);
+	// -1 == no binding
+	void setNumaNode(int numa_node);
+	void getNumaNode(int& numa_node);
+	// 0 == one thread per cpu
+	void setNbPrefaultThreads(int nb_threads);
+	void getNbPrefaultThreads(int& nb_threads);
+	// time spent in the last allocation
+	void getAllocTime(double& alloc_time);
+
+#ifdef __unix
+	// allocate the buffers in a shared file (see MmapBufferAllocMgr),
+	// an empty file name restores the default allocation.
+	// The current buffers are released
+	void setMmapFile(const std::string& file_name);
+	void getMmapFile(std::string& file_name);
+#endif
+
 	class LIMACORE_API Sync : public HwBufferCtrlObj::Callback
 	{
 		DEB_CLASS(DebModHardware, "SoftBufferCtrlObj::Sync");
@@ -342,10 +530,16 @@ class LIMACORE_API SoftBufferCtrlObj : public HwBufferCtrlObj
 
  protected:
 	SoftBufferAllocMgr 		m_buffer_alloc_mgr;
+#ifdef __unix
+	MmapBufferAllocMgr*		m_mmap_alloc_mgr;
+#endif
 	StdBufferCbMgr 			m_buffer_cb_mgr;
 	BufferCtrlMgr			m_mgr;
 	int				m_acq_frame_nb;
 	HwBufferCtrlObj::Callback* 	m_buffer_callback;
+
+ private:
+	void softAllocOptionChanged();
 };
 
 } // namespace lima
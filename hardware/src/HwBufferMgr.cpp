@@ -20,11 +20,62 @@
 // along with this program; if not, see <http://www.gnu.org/licenses/>.
 //###########################################################################
 #include "lima/HwBufferMgr.h"
+#include "lima/Timestamp.h"
+#include "lima/ThreadUtils.h"
 
 #include <cstring>
 
+#ifdef __unix
+#include <errno.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#endif
+
+#ifdef __linux__
+#include <sys/syscall.h>
+#include <linux/mempolicy.h>
+#ifndef MAP_HUGE_SHIFT
+#define MAP_HUGE_SHIFT 26
+#endif
+#endif
+
 using namespace lima;
 
+#ifdef __linux__
+namespace
+{
+
+class PrefaultThread : public Thread
+{
+public:
+	PrefaultThread(char *ptr, long long size)
+		: m_ptr(ptr), m_size(size)
+	{}
+	virtual ~PrefaultThread()
+	{ 
+		if (hasStarted())
+			join();
+	}
+
+protected:
+	virtual void threadFunction()
+	{ memset(m_ptr, 0, m_size); }
+
+private:
+	char *m_ptr;
+	long long m_size;
+};
+
+inline long long AlignSize(long long size, long long align)
+{
+	return (size + align - 1) / align * align;
+}
+
+}
+#endif
+
 /*******************************************************************
  * \brief BufferAllocMgr destructor
  *******************************************************************/
@@ -60,6 +111,10 @@ void BufferAllocMgr::clearAllBuffers()
  *******************************************************************/
 
 SoftBufferAllocMgr::SoftBufferAllocMgr()
+	: m_page_size(StdPages), m_numa_node(-1), m_nb_prefault_threads(1),
+	  m_options_changed(false), m_alloc_time(0),
+	  m_region(NULL), m_region_size(0), m_region_stride(0),
+	  m_region_nb_buffers(0)
 {
 	DEB_CONSTRUCTOR();
 }
@@ -93,26 +148,37 @@ void SoftBufferAllocMgr::allocBuffers(int nb_buffers,
 
 	int curr_nb_buffers;
 	getNbBuffers(curr_nb_buffers);
-	if ((frame_dim == m_frame_dim) && (nb_buffers == curr_nb_buffers)) {
+	if ((frame_dim == m_frame_dim) && (nb_buffers == curr_nb_buffers) &&
+	    !m_options_changed) {
 		DEB_TRACE() << "Nothing to do";
 		return;
 	}
 
 	releaseBuffers();
 
-	try {
-		m_buffer_list.reserve(nb_buffers);
-		for (int i = 0; i < nb_buffers; ++i) {
-			MemBuffer *buffer = new MemBuffer(frame_size);
-			m_buffer_list.push_back(buffer);
+	Timestamp t0 = Timestamp::now();
+	if (useRegion()) {
+		allocRegion(nb_buffers, frame_size);
+	} else {
+		try {
+			m_buffer_list.reserve(nb_buffers);
+			for (int i = 0; i < nb_buffers; ++i) {
+				MemBuffer *buffer = new MemBuffer(frame_size);
+				m_buffer_list.push_back(buffer);
+			}
+		} catch (...) {
+			DEB_ERROR() << "Error alloc. buffer #" 
+				    << m_buffer_list.size();
+			releaseBuffers();
+			throw;
 		}
-	} catch (...) {
-		DEB_ERROR() << "Error alloc. buffer #" << m_buffer_list.size();
-		releaseBuffers();
-		throw;
 	}
+	m_alloc_time = Timestamp::now() - t0;
+	DEB_TRACE() << "Allocated " << nb_buffers << " buffers in " 
+		    << m_alloc_time << " sec";
 
 	m_frame_dim = frame_dim;
+	m_options_changed = false;
 }
 
 void SoftBufferAllocMgr::releaseBuffers()
@@ -123,9 +189,220 @@ void SoftBufferAllocMgr::releaseBuffers()
 	for (BufferListCIt it = bl.begin(); it != bl.end(); ++it)
 		delete *it;
 	bl.clear();
+	releaseRegion();
 	m_frame_dim = FrameDim();
 }
 
+void SoftBufferAllocMgr::setPageSize(PageSize page_size)
+{
+	DEB_MEMBER_FUNCT();
+	DEB_PARAM() << DEB_VAR1(page_size);
+#ifndef __linux__
+	if (page_size != StdPages)
+		THROW_HW_ERROR(NotSupported) << "Huge pages not supported";
+#endif
+	if (page_size != m_page_size)
+		m_options_changed = true;
+	m_page_size = page_size;
+}
+
+void SoftBufferAllocMgr::getPageSize(PageSize& page_size)
+{
+	DEB_MEMBER_FUNCT();
+	page_size = m_page_size;
+	DEB_RETURN() << DEB_VAR1(page_size);
+}
+
+void SoftBufferAllocMgr::setNumaNode(int numa_node)
+{
+	DEB_MEMBER_FUNCT();
+	DEB_PARAM() << DEB_VAR1(numa_node);
+#ifdef __linux__
+	if ((numa_node < -1) || (numa_node >= 1024))
+		THROW_HW_ERROR(InvalidValue) << "Invalid " 
+					     << DEB_VAR1(numa_node);
+#else
+	if (numa_node != -1)
+		THROW_HW_ERROR(NotSupported) << "NUMA binding not supported";
+#endif
+	if (numa_node != m_numa_node)
+		m_options_changed = true;
+	m_numa_node = numa_node;
+}
+
+void SoftBufferAllocMgr::getNumaNode(int& numa_node)
+{
+	DEB_MEMBER_FUNCT();
+	numa_node = m_numa_node;
+	DEB_RETURN() << DEB_VAR1(numa_node);
+}
+
+void SoftBufferAllocMgr::setNbPrefaultThreads(int nb_threads)
+{
+	DEB_MEMBER_FUNCT();
+	DEB_PARAM() << DEB_VAR1(nb_threads);
+	if (nb_threads < 0)
+		THROW_HW_ERROR(InvalidValue) << "Invalid " 
+					     << DEB_VAR1(nb_threads);
+#ifndef __linux__
+	if (nb_threads != 1)
+		THROW_HW_ERROR(NotSupported) << "Parallel prefault not "
+						"supported";
+#endif
+	if (nb_threads != m_nb_prefault_threads)
+		m_options_changed = true;
+	m_nb_prefault_threads = nb_threads;
+}
+
+void SoftBufferAllocMgr::getNbPrefaultThreads(int& nb_threads)
+{
+	DEB_MEMBER_FUNCT();
+	nb_threads = m_nb_prefault_threads;
+	DEB_RETURN() << DEB_VAR1(nb_threads);
+}
+
+void SoftBufferAllocMgr::getAllocTime(double& alloc_time)
+{
+	DEB_MEMBER_FUNCT();
+	alloc_time = m_alloc_time;
+	DEB_RETURN() << DEB_VAR1(alloc_time);
+}
+
+bool SoftBufferAllocMgr::useRegion() const
+{
+	return ((m_page_size != StdPages) || (m_numa_node != -1) ||
+		(m_nb_prefault_threads != 1));
+}
+
+#ifdef __linux__
+
+void SoftBufferAllocMgr::allocRegion(int nb_buffers, int frame_size)
+{
+	DEB_MEMBER_FUNCT();
+
+	long page_size = sysconf(_SC_PAGESIZE);
+	m_region_stride = AlignSize(frame_size, page_size);
+	long long size = m_region_stride * nb_buffers;
+	void *ptr = MAP_FAILED;
+	int flags = MAP_PRIVATE | MAP_ANONYMOUS;
+
+	if (m_page_size != StdPages) {
+		int shift = (m_page_size == HugePages1G) ? 30 : 21;
+		long long huge_size = AlignSize(size, 1LL << shift);
+		ptr = mmap(NULL, huge_size, PROT_READ | PROT_WRITE,
+			   flags | MAP_HUGETLB | (shift << MAP_HUGE_SHIFT),
+			   -1, 0);
+		if (ptr != MAP_FAILED)
+			size = huge_size;
+		else
+			DEB_WARNING() << "Could not map " << huge_size 
+				      << " bytes of " << (1 << (shift - 20)) 
+				      << " MB huge pages: " << strerror(errno)
+				      << ", using transparent huge pages";
+	}
+
+	if (ptr == MAP_FAILED) {
+		ptr = mmap(NULL, size, PROT_READ | PROT_WRITE, flags, -1, 0);
+		if (ptr == MAP_FAILED)
+			THROW_HW_ERROR(Error) << "Error mapping " << size 
+					      << " bytes: " << strerror(errno);
+		if ((m_page_size != StdPages) &&
+		    (madvise(ptr, size, MADV_HUGEPAGE) < 0))
+			DEB_WARNING() << "madvise(MADV_HUGEPAGE) failed: " 
+				      << strerror(errno);
+	}
+
+	m_region = static_cast<char *>(ptr);
+	m_region_size = size;
+	m_region_nb_buffers = nb_buffers;
+
+	try {
+		if (m_numa_node >= 0) {
+			// bind before the pages are touched
+			const int long_bits = sizeof(unsigned long) * 8;
+			unsigned long node_mask[1024 / long_bits];
+			memset(node_mask, 0, sizeof(node_mask));
+			node_mask[m_numa_node / long_bits] |= 
+				1UL << (m_numa_node % long_bits);
+			if (syscall(SYS_mbind, m_region, m_region_size, 
+				    MPOL_BIND, node_mask, 1024, 0) < 0)
+				THROW_HW_ERROR(Error) << "Error binding buffers "
+						      << "to NUMA node " 
+						      << m_numa_node << ": " 
+						      << strerror(errno);
+		}
+		prefaultRegion();
+	} catch (...) {
+		releaseRegion();
+		throw;
+	}
+
+	DEB_TRACE() << "Mapped " << DEB_VAR3(m_region_size, m_region_stride,
+					     m_region_nb_buffers);
+}
+
+void SoftBufferAllocMgr::prefaultRegion()
+{
+	DEB_MEMBER_FUNCT();
+
+	int nb_threads = m_nb_prefault_threads;
+	if (nb_threads == 0)
+		nb_threads = sysconf(_SC_NPROCESSORS_ONLN);
+	long page_size = sysconf(_SC_PAGESIZE);
+	long long chunk = AlignSize((m_region_size + nb_threads - 1) / 
+				    nb_threads, page_size);
+	DEB_TRACE() << "Prefaulting with " << DEB_VAR2(nb_threads, chunk);
+
+	std::vector<PrefaultThread *> thread_list;
+	char *ptr = m_region, *end = m_region + m_region_size;
+	try {
+		// the calling thread takes the last chunk
+		for (; end - ptr > chunk; ptr += chunk) {
+			PrefaultThread *t = new PrefaultThread(ptr, chunk);
+			thread_list.push_back(t);
+			t->start();
+		}
+	} catch (...) {
+		DEB_WARNING() << "Could not start prefault thread #" 
+			      << thread_list.size();
+	}
+	memset(ptr, 0, end - ptr);
+
+	std::vector<PrefaultThread *>::iterator it, tend = thread_list.end();
+	for (it = thread_list.begin(); it != tend; ++it)
+		delete *it;
+}
+
+void SoftBufferAllocMgr::releaseRegion()
+{
+	DEB_MEMBER_FUNCT();
+	if (!m_region)
+		return;
+	if (munmap(m_region, m_region_size) < 0)
+		DEB_ERROR() << "Error unmapping buffers: " << strerror(errno);
+	m_region = NULL;
+	m_region_size = m_region_stride = 0;
+	m_region_nb_buffers = 0;
+}
+
+#else // !__linux__
+
+void SoftBufferAllocMgr::allocRegion(int nb_buffers, int frame_size)
+{
+	DEB_MEMBER_FUNCT();
+	THROW_HW_ERROR(NotSupported) << "Buffer region not supported";
+}
+
+void SoftBufferAllocMgr::prefaultRegion()
+{
+}
+
+void SoftBufferAllocMgr::releaseRegion()
+{
+}
+
+#endif // __linux__
+
 const FrameDim& SoftBufferAllocMgr::getFrameDim()
 {
 	DEB_MEMBER_FUNCT();
@@ -136,18 +413,376 @@ const FrameDim& SoftBufferAllocMgr::getFrameDim()
 void SoftBufferAllocMgr::getNbBuffers(int& nb_buffers)
 {
 	DEB_MEMBER_FUNCT();
-	nb_buffers = m_buffer_list.size();
+	nb_buffers = m_region ? m_region_nb_buffers : m_buffer_list.size();
 	DEB_RETURN() << DEB_VAR1(nb_buffers);
 }
 
 void *SoftBufferAllocMgr::getBufferPtr(int buffer_nb)
 {
 	DEB_MEMBER_FUNCT();
-	void *ptr = m_buffer_list[buffer_nb]->getPtr();
+	void *ptr;
+	if (m_region)
+		ptr = m_region + m_region_stride * buffer_nb;
+	else
+		ptr = m_buffer_list[buffer_nb]->getPtr();
+	DEB_RETURN() << DEB_VAR1(ptr);
+	return ptr;
+}
+
+
+#ifdef __unix
+/*******************************************************************
+ * \brief MmapBufferAllocMgr constructor
+ *******************************************************************/
+
+MmapBufferAllocMgr::MmapBufferAllocMgr(const std::string& file_name)
+	: m_file_name(file_name), m_fd(-1), m_map(NULL), m_map_size(0),
+	  m_header(NULL), m_index(NULL), m_generation(0)
+{
+	DEB_CONSTRUCTOR();
+	DEB_PARAM() << DEB_VAR1(m_file_name);
+}
+
+MmapBufferAllocMgr::~MmapBufferAllocMgr()
+{
+	DEB_DESTRUCTOR();
+	releaseBuffers();
+	unlink(m_file_name.c_str());
+}
+
+int MmapBufferAllocMgr::getMaxNbBuffers(const FrameDim& frame_dim)
+{
+	return GetDefMaxNbBuffers(frame_dim);
+}
+
+void MmapBufferAllocMgr::allocBuffers(int nb_buffers,
+				      const FrameDim& frame_dim)
+{
+	DEB_MEMBER_FUNCT();
+	DEB_PARAM() << DEB_VAR2(nb_buffers, frame_dim);
+
+	int frame_size = frame_dim.getMemSize();
+	if (frame_size <= 0) 
+		THROW_HW_ERROR(InvalidValue) << "Invalid " 
+					     << DEB_VAR1(frame_dim);
+       
+	int max_buffers = getMaxNbBuffers(frame_dim);
+	if ((nb_buffers < 1) || (nb_buffers > max_buffers)) 
+		THROW_HW_ERROR(InvalidValue) << "Invalid " 
+					     << DEB_VAR1(nb_buffers);
+
+	int curr_nb_buffers;
+	getNbBuffers(curr_nb_buffers);
+	if ((frame_dim == m_frame_dim) && (nb_buffers == curr_nb_buffers)) {
+		DEB_TRACE() << "Nothing to do";
+		return;
+	}
+
+	releaseBuffers();
+
+	// readers may still map the previous file, create a new one
+	unlink(m_file_name.c_str());
+	m_fd = open(m_file_name.c_str(), O_RDWR | O_CREAT | O_TRUNC, 0644);
+	if (m_fd < 0)
+		THROW_HW_ERROR(Error) << "Can't create " << m_file_name 
+				      << ": " << strerror(errno);
+
+	try {
+		// hugetlbfs needs huge page aligned sizes
+		long long block_size = sysconf(_SC_PAGESIZE);
+		struct stat file_stat;
+		if (!fstat(m_fd, &file_stat) && 
+		    (file_stat.st_blksize > block_size))
+			block_size = file_stat.st_blksize;
+
+		long long index_size = nb_buffers * sizeof(long long);
+		long long header_size = sizeof(Header) + index_size;
+		header_size = (header_size + block_size - 1) / block_size * 
+			      block_size;
+		long long stride = (frame_size + block_size - 1) / 
+				   block_size * block_size;
+		m_map_size = header_size + nb_buffers * stride;
+		DEB_TRACE() << DEB_VAR3(block_size, stride, m_map_size);
+
+		if (ftruncate(m_fd, m_map_size) < 0)
+			THROW_HW_ERROR(Error) << "Can't resize " << m_file_name
+					      << ": " << strerror(errno);
+		// reserve the space now rather than getting a SIGBUS later
+		int ret = posix_fallocate(m_fd, 0, m_map_size);
+		if (ret == ENOSPC)
+			THROW_HW_ERROR(Error) << "Not enough space for " 
+					      << m_file_name;
+
+		int flags = MAP_SHARED;
+#ifdef MAP_POPULATE
+		flags |= MAP_POPULATE;
+#endif
+		void *map = mmap(NULL, m_map_size, PROT_READ | PROT_WRITE,
+				 flags, m_fd, 0);
+		if (map == MAP_FAILED)
+			THROW_HW_ERROR(Error) << "Can't map " << m_file_name
+					      << ": " << strerror(errno);
+		m_map = (char *) map;
+
+		m_header = (Header *) m_map;
+		m_index = (volatile long long *) (m_header + 1);
+		for (int i = 0; i < nb_buffers; ++i)
+			m_index[i] = -1;
+
+		Size size = frame_dim.getSize();
+		m_header->version = Header::VERSION;
+		m_header->header_size = header_size;
+		m_header->nb_buffers = nb_buffers;
+		m_header->width = size.getWidth();
+		m_header->height = size.getHeight();
+		m_header->image_type = frame_dim.getImageType();
+		m_header->depth = frame_dim.getDepth();
+		m_header->buffer_size = frame_size;
+		m_header->buffer_stride = stride;
+		m_header->generation = ++m_generation;
+		m_header->last_frame_nb = -1;
+		// header is complete before the magic is visible
+		__sync_synchronize();
+		m_header->magic = Header::MAGIC;
+	} catch (...) {
+		releaseBuffers();
+		throw;
+	}
+
+	m_frame_dim = frame_dim;
+}
+
+void MmapBufferAllocMgr::releaseBuffers()
+{
+	DEB_MEMBER_FUNCT();
+
+	if (m_map) {
+		// tell the readers the buffers are gone
+		m_header->nb_buffers = 0;
+		m_header->generation = ++m_generation;
+		__sync_synchronize();
+		munmap(m_map, m_map_size);
+	}
+	if (m_fd >= 0)
+		close(m_fd);
+
+	m_fd = -1;
+	m_map = NULL;
+	m_map_size = 0;
+	m_header = NULL;
+	m_index = NULL;
+	m_frame_dim = FrameDim();
+}
+
+const FrameDim& MmapBufferAllocMgr::getFrameDim()
+{
+	DEB_MEMBER_FUNCT();
+	DEB_RETURN() << DEB_VAR1(m_frame_dim);
+	return m_frame_dim;
+}
+
+void MmapBufferAllocMgr::getNbBuffers(int& nb_buffers)
+{
+	DEB_MEMBER_FUNCT();
+	nb_buffers = m_header ? m_header->nb_buffers : 0;
+	DEB_RETURN() << DEB_VAR1(nb_buffers);
+}
+
+void *MmapBufferAllocMgr::getBufferPtr(int buffer_nb)
+{
+	DEB_MEMBER_FUNCT();
+	void *ptr = m_map + m_header->header_size + 
+		    buffer_nb * m_header->buffer_stride;
+	DEB_RETURN() << DEB_VAR1(ptr);
+	return ptr;
+}
+
+void MmapBufferAllocMgr::setBufferFrameNb(int buffer_nb, int acq_frame_nb)
+{
+	if (!m_header)
+		return;
+	// the frame data must be visible before its index entry
+	__sync_synchronize();
+	m_index[buffer_nb] = acq_frame_nb;
+	if (acq_frame_nb > m_header->last_frame_nb)
+		m_header->last_frame_nb = acq_frame_nb;
+}
+
+
+/*******************************************************************
+ * \brief MmapBufferReader constructor
+ *******************************************************************/
+
+MmapBufferReader::MmapBufferReader(const std::string& file_name)
+	: m_file_name(file_name), m_map(NULL), m_map_size(0),
+	  m_header(NULL), m_index(NULL), m_generation(0)
+{
+	DEB_CONSTRUCTOR();
+	DEB_PARAM() << DEB_VAR1(m_file_name);
+}
+
+MmapBufferReader::~MmapBufferReader()
+{
+	DEB_DESTRUCTOR();
+	close();
+}
+
+bool MmapBufferReader::update()
+{
+	DEB_MEMBER_FUNCT();
+
+	if (m_header && (m_header->generation == m_generation) &&
+	    (m_header->nb_buffers > 0))
+		return true;
+
+	close();
+
+	int fd = open(m_file_name.c_str(), O_RDONLY);
+	if (fd < 0) {
+		DEB_TRACE() << "Can't open " << m_file_name << ": " 
+			    << strerror(errno);
+		return false;
+	}
+
+	struct stat file_stat;
+	void *map = MAP_FAILED;
+	long long file_size = 0;
+	if (!fstat(fd, &file_stat)) {
+		file_size = file_stat.st_size;
+		if (file_size >= (long long) sizeof(Header))
+			map = mmap(NULL, file_size, PROT_READ, MAP_SHARED, 
+				   fd, 0);
+	}
+	::close(fd);
+	if (map == MAP_FAILED) {
+		DEB_TRACE() << "Can't map " << m_file_name;
+		return false;
+	}
+	m_map = (char *) map;
+	m_map_size = file_size;
+
+	const Header *header = (const Header *) m_map;
+	if (header->magic != Header::MAGIC) {
+		DEB_TRACE() << "Buffers not ready in " << m_file_name;
+		close();
+		return false;
+	}
+	__sync_synchronize();
+
+	int generation = header->generation;
+	long long nb_buffers = header->nb_buffers;
+	if (nb_buffers == 0) {
+		DEB_TRACE() << "Buffers released in " << m_file_name;
+		close();
+		return false;
+	}
+	long long index_end = sizeof(Header) + nb_buffers * sizeof(long long);
+	FrameDim frame_dim(header->width, header->height, 
+			   ImageType(header->image_type));
+	bool valid = ((header->version == Header::VERSION) && 
+		      (nb_buffers > 0) && 
+		      (header->header_size >= index_end) &&
+		      (header->buffer_size == frame_dim.getMemSize()) &&
+		      (header->buffer_stride >= header->buffer_size) &&
+		      (header->header_size + nb_buffers * 
+		       header->buffer_stride <= file_size));
+	if (!valid) {
+		DEB_ERROR() << "Invalid buffer file " << m_file_name;
+		close();
+		return false;
+	}
+
+	m_header = header;
+	m_index = (const volatile long long *) (header + 1);
+	m_frame_dim = frame_dim;
+	m_generation = generation;
+	DEB_TRACE() << DEB_VAR3(m_frame_dim, nb_buffers, m_generation);
+	return true;
+}
+
+void MmapBufferReader::close()
+{
+	DEB_MEMBER_FUNCT();
+
+	if (m_map)
+		munmap(m_map, m_map_size);
+
+	m_map = NULL;
+	m_map_size = 0;
+	m_header = NULL;
+	m_index = NULL;
+	m_frame_dim = FrameDim();
+}
+
+int MmapBufferReader::getNbBuffers() const
+{
+	return m_header ? m_header->nb_buffers : 0;
+}
+
+long long MmapBufferReader::getLastFrameNb() const
+{
+	return m_header ? m_header->last_frame_nb : -1;
+}
+
+int MmapBufferReader::findBuffer(long long frame_nb)
+{
+	if (!m_header || (frame_nb < 0) || 
+	    (m_header->generation != m_generation))
+		return -1;
+
+	int nb_buffers = m_header->nb_buffers;
+	if (nb_buffers <= 0)
+		return -1;
+	int buffer_nb = frame_nb % nb_buffers;
+	if (m_index[buffer_nb] == frame_nb)
+		return buffer_nb;
+	for (buffer_nb = 0; buffer_nb < nb_buffers; ++buffer_nb)
+		if (m_index[buffer_nb] == frame_nb)
+			return buffer_nb;
+	return -1;
+}
+
+const void *MmapBufferReader::getFramePtr(long long frame_nb)
+{
+	DEB_MEMBER_FUNCT();
+	DEB_PARAM() << DEB_VAR1(frame_nb);
+
+	int buffer_nb = findBuffer(frame_nb);
+	if (buffer_nb < 0)
+		return NULL;
+	// the index entry is read before the frame data
+	__sync_synchronize();
+	const void *ptr = m_map + m_header->header_size + 
+			  buffer_nb * m_header->buffer_stride;
 	DEB_RETURN() << DEB_VAR1(ptr);
 	return ptr;
 }
 
+bool MmapBufferReader::isFrameValid(long long frame_nb)
+{
+	// the frame data is read before the index entry is checked
+	__sync_synchronize();
+	if (findBuffer(frame_nb) < 0)
+		return false;
+	return (m_header->last_frame_nb - frame_nb < 
+		m_header->nb_buffers - 1);
+}
+
+bool MmapBufferReader::copyFrame(long long frame_nb, void *dest)
+{
+	DEB_MEMBER_FUNCT();
+	DEB_PARAM() << DEB_VAR1(frame_nb);
+
+	const void *ptr = getFramePtr(frame_nb);
+	if (!ptr)
+		return false;
+	memcpy(dest, ptr, m_header->buffer_size);
+	bool valid = isFrameValid(frame_nb);
+	DEB_RETURN() << DEB_VAR1(valid);
+	return valid;
+}
+#endif
+
 
 /*******************************************************************
  * \brief BufferCbMgr destructor
@@ -343,6 +978,21 @@ void StdBufferCbMgr::releaseBuffers()
 	m_frame_dim = FrameDim();
 }
 
+void StdBufferCbMgr::setAllocMgr(BufferAllocMgr& alloc_mgr)
+{
+	DEB_MEMBER_FUNCT();
+
+	if (&alloc_mgr == m_alloc_mgr)
+		return;
+	releaseBuffers();
+	m_alloc_mgr = &alloc_mgr;
+}
+
+BufferAllocMgr& StdBufferCbMgr::getAllocMgr()
+{
+	return *m_alloc_mgr;
+}
+
 void StdBufferCbMgr::setFrameCallbackActive(bool cb_active)
 {
 	DEB_MEMBER_FUNCT();
@@ -384,6 +1034,7 @@ bool StdBufferCbMgr::newFrameReady(HwFrameInfoType& frame_info)
 
 	int frame_nb = buffer_nb * m_nb_concat_frames + concat_frame_nb;
 	m_info_list[frame_nb] = frame_info;
+	m_alloc_mgr->setBufferFrameNb(buffer_nb, frame_info.acq_frame_nb);
 
 	if (!m_fcb_act) {
 		DEB_TRACE() << "No cb registered";
@@ -685,11 +1336,22 @@ BufferCtrlMgr::AcqFrameCallback::newFrameReady(const HwFrameInfoType& finfo)
 
 SoftBufferCtrlObj::SoftBufferCtrlObj() 
 	: HwBufferCtrlObj(), 
+#ifdef __unix
+	  m_mmap_alloc_mgr(NULL),
+#endif
 	  m_buffer_cb_mgr(m_buffer_alloc_mgr), m_mgr(m_buffer_cb_mgr), 
 	  m_acq_frame_nb(-1), m_buffer_callback(NULL)
 {
 }
 
+SoftBufferCtrlObj::~SoftBufferCtrlObj()
+{
+#ifdef __unix
+	m_buffer_cb_mgr.setAllocMgr(m_buffer_alloc_mgr);
+	delete m_mmap_alloc_mgr;
+#endif
+}
+
 void SoftBufferCtrlObj::setFrameDim(const FrameDim& frame_dim) 
 {
 	m_mgr.setFrameDim(frame_dim);
@@ -760,6 +1422,86 @@ StdBufferCbMgr& SoftBufferCtrlObj::getBuffer()
 	return m_buffer_cb_mgr;
 }
 
+void SoftBufferCtrlObj::setPageSize(SoftBufferAllocMgr::PageSize page_size)
+{
+	SoftBufferAllocMgr::PageSize curr_page_size;
+	m_buffer_alloc_mgr.getPageSize(curr_page_size);
+	m_buffer_alloc_mgr.setPageSize(page_size);
+	if (page_size != curr_page_size)
+		softAllocOptionChanged();
+}
+
+void SoftBufferCtrlObj::getPageSize(SoftBufferAllocMgr::PageSize& page_size)
+{
+	m_buffer_alloc_mgr.getPageSize(page_size);
+}
+
+void SoftBufferCtrlObj::setNumaNode(int numa_node)
+{
+	int curr_numa_node;
+	m_buffer_alloc_mgr.getNumaNode(curr_numa_node);
+	m_buffer_alloc_mgr.setNumaNode(numa_node);
+	if (numa_node != curr_numa_node)
+		softAllocOptionChanged();
+}
+
+void SoftBufferCtrlObj::getNumaNode(int& numa_node)
+{
+	m_buffer_alloc_mgr.getNumaNode(numa_node);
+}
+
+void SoftBufferCtrlObj::setNbPrefaultThreads(int nb_threads)
+{
+	int curr_nb_threads;
+	m_buffer_alloc_mgr.getNbPrefaultThreads(curr_nb_threads);
+	m_buffer_alloc_mgr.setNbPrefaultThreads(nb_threads);
+	if (nb_threads != curr_nb_threads)
+		softAllocOptionChanged();
+}
+
+void SoftBufferCtrlObj::getNbPrefaultThreads(int& nb_threads)
+{
+	m_buffer_alloc_mgr.getNbPrefaultThreads(nb_threads);
+}
+
+void SoftBufferCtrlObj::getAllocTime(double& alloc_time)
+{
+	m_buffer_alloc_mgr.getAllocTime(alloc_time);
+}
+
+/** @brief the buffers are kept while their size does not change,
+ *  release them so the next allocation uses the new options
+ */
+void SoftBufferCtrlObj::softAllocOptionChanged()
+{
+	if (&m_buffer_cb_mgr.getAllocMgr() == &m_buffer_alloc_mgr)
+		m_buffer_cb_mgr.releaseBuffers();
+}
+
+#ifdef __unix
+void SoftBufferCtrlObj::setMmapFile(const std::string& file_name)
+{
+	std::string curr_file_name;
+	getMmapFile(curr_file_name);
+	if (file_name == curr_file_name)
+		return;
+
+	m_buffer_cb_mgr.setAllocMgr(m_buffer_alloc_mgr);
+	delete m_mmap_alloc_mgr;
+	m_mmap_alloc_mgr = NULL;
+	if (file_name.empty())
+		return;
+	m_mmap_alloc_mgr = new MmapBufferAllocMgr(file_name);
+	m_buffer_cb_mgr.setAllocMgr(*m_mmap_alloc_mgr);
+}
+
+void SoftBufferCtrlObj::getMmapFile(std::string& file_name)
+{
+	file_name = m_mmap_alloc_mgr ? m_mmap_alloc_mgr->getFileName() : 
+				       std::string();
+}
+#endif
+
 int SoftBufferCtrlObj::getNbAcquiredFrames() 
 {
 	return m_acq_frame_nb + 1;
@@ -0,0 +1,162 @@
+//###########################################################################
+// This file is part of LImA, a Library for Image Acquisition
+//
+// Copyright (C) : 2009-2011
+// European Synchrotron Radiation Facility
+// BP 220, Grenoble 38043
+// FRANCE
+//
+// This is free software; you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation; either version 3 of the License, or
+// (at your option) any later version.
+//
+// This software is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program; if not, see <http://www.gnu.org/licenses/>.
+//###########################################################################
+#include "lima/HwBufferMgr.h"
+
+#include <iostream>
+#include <sstream>
+#include <cstdlib>
+#include <unistd.h>
+#include <sys/wait.h>
+
+using namespace lima;
+using namespace std;
+
+// buffers of a SoftBufferCtrlObj in a shared file, read back by
+// MmapBufferReader from a second process and from a second mapping
+// usage: testmmapbuffer [file_name]
+
+static const int NB_BUFFERS = 4;
+static const int NB_FRAMES = 6;
+
+#define CHECK(cond)							\
+	do {								\
+		if (!(cond)) {						\
+			cerr << __FILE__ << ":" << __LINE__ << ": "	\
+			     << #cond << " failed" << endl;		\
+			exit(1);					\
+		}							\
+	} while (0)
+
+static unsigned short pixel(int frame_nb, int i)
+{
+	return (frame_nb * 1000 + i) & 0xffff;
+}
+
+static void write_frames(SoftBufferCtrlObj& buffer, const FrameDim& fdim,
+			 int first, int nb_frames)
+{
+	StdBufferCbMgr& cb_mgr = buffer.getBuffer();
+	cb_mgr.setStartTimestamp(Timestamp::now());
+	int nb_pixels = Point(fdim.getSize()).getArea();
+	for (int f = first; f < first + nb_frames; ++f) {
+		unsigned short *ptr;
+		ptr = (unsigned short *) buffer.getBufferPtr(f % NB_BUFFERS);
+		for (int i = 0; i < nb_pixels; ++i)
+			ptr[i] = pixel(f, i);
+		HwFrameInfoType finfo(f, ptr, &fdim, Timestamp(), 0,
+				      HwFrameInfoType::Managed);
+		cb_mgr.newFrameReady(finfo);
+	}
+}
+
+static bool check_frame(MmapBufferReader& reader, int frame_nb)
+{
+	const FrameDim& fdim = reader.getFrameDim();
+	int nb_pixels = Point(fdim.getSize()).getArea();
+	vector<unsigned short> data(nb_pixels);
+	if (!reader.copyFrame(frame_nb, &data[0]))
+		return false;
+	for (int i = 0; i < nb_pixels; ++i)
+		CHECK(data[i] == pixel(frame_nb, i));
+	return true;
+}
+
+static int read_frames(const string& file_name, const FrameDim& fdim)
+{
+	MmapBufferReader reader(file_name);
+	CHECK(reader.update());
+	CHECK(reader.getFrameDim() == fdim);
+	CHECK(reader.getNbBuffers() == NB_BUFFERS);
+	CHECK(reader.getLastFrameNb() == NB_FRAMES - 1);
+	// overwritten frames
+	for (int f = 0; f < NB_FRAMES - NB_BUFFERS; ++f)
+		CHECK(!reader.getFramePtr(f));
+	// the oldest frame in the buffers is the next one to be written
+	CHECK(!check_frame(reader, NB_FRAMES - NB_BUFFERS));
+	for (int f = NB_FRAMES - NB_BUFFERS + 1; f < NB_FRAMES; ++f)
+		CHECK(check_frame(reader, f));
+	CHECK(!reader.getFramePtr(NB_FRAMES));
+	return 0;
+}
+
+int main(int argc, char *argv[])
+{
+	string file_name;
+	if (argc > 1) {
+		file_name = argv[1];
+	} else {
+		ostringstream os;
+		os << "/tmp/testmmapbuffer." << getpid();
+		file_name = os.str();
+	}
+
+	try {
+		FrameDim fdim(64, 32, Bpp16);
+		SoftBufferCtrlObj buffer;
+		buffer.setMmapFile(file_name);
+		string mmap_file;
+		buffer.getMmapFile(mmap_file);
+		CHECK(mmap_file == file_name);
+
+		buffer.setFrameDim(fdim);
+		buffer.setNbBuffers(NB_BUFFERS);
+		write_frames(buffer, fdim, 0, NB_FRAMES);
+
+		pid_t pid = fork();
+		CHECK(pid >= 0);
+		if (pid == 0)
+			_exit(read_frames(file_name, fdim));
+		int status;
+		CHECK(waitpid(pid, &status, 0) == pid);
+		CHECK(WIFEXITED(status) && (WEXITSTATUS(status) == 0));
+		cout << "Frames read from a second process" << endl;
+
+		MmapBufferReader reader(file_name);
+		CHECK(reader.update());
+		CHECK(check_frame(reader, NB_FRAMES - 1));
+
+		// new buffers: the reader must follow
+		FrameDim new_fdim(32, 16, Bpp16);
+		buffer.setFrameDim(new_fdim);
+		CHECK(!reader.getFramePtr(NB_FRAMES - 1));
+		CHECK(!reader.update());
+		buffer.setNbBuffers(NB_BUFFERS);
+		write_frames(buffer, new_fdim, 0, 2);
+		CHECK(reader.update());
+		CHECK(reader.getFrameDim() == new_fdim);
+		CHECK(check_frame(reader, 1));
+		cout << "Reader followed the re-allocation" << endl;
+
+		// back to the default allocation, the file is removed
+		buffer.setMmapFile("");
+		CHECK(!reader.update());
+		CHECK(access(file_name.c_str(), F_OK) < 0);
+		buffer.setNbBuffers(NB_BUFFERS);
+		write_frames(buffer, new_fdim, 0, 2);
+	} catch (Exception e) {
+		cerr << "LIMA Exception: " << e << endl;
+		return 1;
+	}
+
+	cout << "OK" << endl;
+	return 0;
+}
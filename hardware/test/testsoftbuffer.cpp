@@ -0,0 +1,120 @@
+//###########################################################################
+// This file is part of LImA, a Library for Image Acquisition
+//
+// Copyright (C) : 2009-2011
+// European Synchrotron Radiation Facility
+// BP 220, Grenoble 38043
+// FRANCE
+//
+// This is free software; you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation; either version 3 of the License, or
+// (at your option) any later version.
+//
+// This software is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program; if not, see <http://www.gnu.org/licenses/>.
+//###########################################################################
+#include "lima/HwBufferMgr.h"
+
+#include <iostream>
+#include <cstdlib>
+#include <cstring>
+
+using namespace lima;
+using namespace std;
+
+// allocation options of SoftBufferCtrlObj: huge pages, NUMA binding
+// and parallel prefault, each change re-allocating the buffers
+// usage: testsoftbuffer [nb_buffers [numa_node]]
+
+#define CHECK(cond)							\
+	do {								\
+		if (!(cond)) {						\
+			cerr << __FILE__ << ":" << __LINE__ << ": "	\
+			     << #cond << " failed" << endl;		\
+			exit(1);					\
+		}							\
+	} while (0)
+
+static void alloc_and_check(SoftBufferCtrlObj& buffer, int nb_buffers,
+			    const char *desc)
+{
+	int curr_nb_buffers;
+	buffer.getNbBuffers(curr_nb_buffers);
+	CHECK(curr_nb_buffers == 0);
+
+	buffer.setNbBuffers(nb_buffers);
+	buffer.getNbBuffers(curr_nb_buffers);
+	CHECK(curr_nb_buffers == nb_buffers);
+
+	FrameDim fdim;
+	buffer.getFrameDim(fdim);
+	int frame_size = fdim.getMemSize();
+	for (int i = 0; i < nb_buffers; ++i) {
+		char *ptr = (char *) buffer.getBufferPtr(i);
+		CHECK(ptr != NULL);
+		memset(ptr, i, frame_size);
+	}
+	for (int i = 0; i < nb_buffers; ++i) {
+		char *ptr = (char *) buffer.getBufferPtr(i);
+		CHECK((ptr[0] == char(i)) && (ptr[frame_size - 1] == char(i)));
+	}
+
+	double alloc_time;
+	buffer.getAllocTime(alloc_time);
+	cout << desc << ": " << nb_buffers << " buffers allocated in " 
+	     << alloc_time * 1e3 << " ms" << endl;
+}
+
+int main(int argc, char *argv[])
+{
+	int nb_buffers = 16;
+	int numa_node = 0;
+	if (argc > 1)
+		nb_buffers = atoi(argv[1]);
+	if (argc > 2)
+		numa_node = atoi(argv[2]);
+
+	try {
+		SoftBufferCtrlObj buffer;
+		buffer.setFrameDim(FrameDim(1024, 1024, Bpp16));
+		alloc_and_check(buffer, nb_buffers, "Default");
+
+		// same options: the buffers are kept
+		buffer.setNbPrefaultThreads(1);
+		buffer.setNumaNode(-1);
+		buffer.setPageSize(SoftBufferAllocMgr::StdPages);
+		int curr_nb_buffers;
+		buffer.getNbBuffers(curr_nb_buffers);
+		CHECK(curr_nb_buffers == nb_buffers);
+
+		buffer.setNbPrefaultThreads(0);
+		int nb_threads;
+		buffer.getNbPrefaultThreads(nb_threads);
+		CHECK(nb_threads == 0);
+		alloc_and_check(buffer, nb_buffers, "Parallel prefault");
+
+		buffer.setPageSize(SoftBufferAllocMgr::HugePages2M);
+		SoftBufferAllocMgr::PageSize page_size;
+		buffer.getPageSize(page_size);
+		CHECK(page_size == SoftBufferAllocMgr::HugePages2M);
+		alloc_and_check(buffer, nb_buffers, "2 MB huge pages");
+
+		buffer.setNumaNode(numa_node);
+		int curr_numa_node;
+		buffer.getNumaNode(curr_numa_node);
+		CHECK(curr_numa_node == numa_node);
+		alloc_and_check(buffer, nb_buffers, "NUMA binding");
+	} catch (Exception e) {
+		cerr << "LIMA Exception: " << e << endl;
+		return 1;
+	}
+
+	cout << "OK" << endl;
+	return 0;
+}
@@ -249,6 +249,8 @@ def main():
         cmdargs = [config.sip_bin,"-g", "-e","-c", '.','-t',plat]
         if 'config' in excludeMods:
             cmdargs.extend(['-x','WITH_CONFIG'])
+        if 'shm_ring' in excludeMods:
+            cmdargs.extend(['-x','WITH_SHM_RING'])
         cmdargs.extend(["-b", build_file,sipFileName])
         cmd = " ".join(cmdargs)
         print(cmd)
@@ -311,6 +313,8 @@ def main():
             makefile.extra_cxxflags = ['-pthread', '-g','-DWITH_SPS_IMAGE'] + extra_cxxflags
             if 'config' not in excludeMods:
                 makefile.extra_cxxflags.append('-DWITH_CONFIG')
+            if 'shm_ring' not in excludeMods:
+                makefile.extra_cxxflags.append('-DWITH_SHM_RING')
             makefile.extra_lib_dirs = [rootName('build')]
         makefile.extra_cxxflags.extend(['-I"%s"' % x for x in extraIncludes])
         